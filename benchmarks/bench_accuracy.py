@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Accuracy-versus-speed harness for grid sizes, OT engines and barycenters.
+
+Computes the same quantities as the scripts - pairwise (p2p) distances
+between cloud samples, the cloud barycenter, sample-to-barycenter (p2b)
+distances and the one-sided Wilcoxon p-value of olga-p2b-ot-wilcoxon.py -
+for every combination of
+
+    --grids            grid sizes (n_grid)
+    --discretizations  nearest (whole weight to one bin), linear (mass splitting)
+    --engines          emd, sinkhorn (reg --sinkhorn-reg), exact_1d
+    --barycenters      lp (ot.lp.barycenter), median (median of quantile functions)
+
+and reports, next to wall time and peak memory, the error against an
+exact reference computed without any grid: W1 of the raw samples by the
+sorted-merge solution, and the exact W1 barycenter of the raw cloud
+(median_quantile_barycenter). Errors are relative to the reference; rank
+agreement (Spearman) matters for the Wilcoxon test, and the p-value column
+shows how far the test result moves.
+
+Without inputs, a synthetic cloud and a synthetic sample group (shifted by
+--synthetic-shift) are generated with synthetic_repertoires.py.
+
+Usage:
+    python3 benchmarks/bench_accuracy.py
+    python3 benchmarks/bench_accuracy.py work/pilot-Tumeh-2014/cloud-Tumeh2014-Base \\
+        work/pilot-Tumeh-2014/mapped-Tumeh2014-Post --grids 50 100 200 400
+"""
+
+import sys
+import argparse
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import warnings
+from itertools import combinations, islice
+from pathlib import Path
+
+import numpy as np
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from synthetic_repertoires import generate_cohort  # noqa: E402
+from ot_utils import (  # noqa: E402
+    DISCRETIZATION_METHODS,
+    load_distribution,
+    find_tsv_files,
+    is_sample_source,
+    create_common_grid,
+    discretize_distribution,
+    compute_wasserstein_distance,
+    compute_lp_barycenter_on_grid,
+    compute_median_barycenter_on_grid,
+    median_quantile_barycenter,
+)
+
+
+ENGINES = ("emd", "sinkhorn", "exact_1d")
+BARYCENTERS = {
+    "lp": compute_lp_barycenter_on_grid,
+    "median": compute_median_barycenter_on_grid,
+}
+
+
+def _measure(function, *args, **kwargs):
+    """Run a function; returns (result, seconds, peak traced memory in MB)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, seconds, peak / (1024.0 * 1024.0)
+
+
+def _input_files(path):
+    """TSV files of a folder, cohort store or list file."""
+    path = Path(os.path.expanduser(path))
+    if is_sample_source(path):
+        return [str(f) for f in find_tsv_files(path)]
+    with open(path) as handle:
+        return [
+            os.path.expanduser(line.split(None, 1)[0])
+            for line in handle
+            if line.strip() and not line.startswith("#")
+        ]
+
+
+def _errors(values, reference):
+    """Mean and max relative error and Spearman rank correlation."""
+    from scipy.stats import spearmanr
+    values = np.asarray(values, dtype=float)
+    reference = np.asarray(reference, dtype=float)
+    if not np.all(np.isfinite(values)):
+        return {"mean_rel_error": float("nan"), "max_rel_error": float("nan"), "spearman": float("nan")}
+    relative = np.abs(values - reference) / np.maximum(np.abs(reference), 1e-300)
+    # Undefined for constant input (e.g. an engine that returns 0 everywhere)
+    spearman = spearmanr(values, reference).statistic if len(values) > 2 and np.ptp(values) > 0 else float("nan")
+    return {
+        "mean_rel_error": float(relative.mean()),
+        "max_rel_error": float(relative.max()),
+        "spearman": float(spearman),
+    }
+
+
+def _wilcoxon_pvalue(cloud_distances, sample_distances):
+    """One-sided Mann-Whitney U p-value, as in olga-p2b-ot-wilcoxon.py."""
+    from scipy.stats import mannwhitneyu
+    if not (np.all(np.isfinite(cloud_distances)) and np.all(np.isfinite(sample_distances))):
+        return float("nan")
+    return float(mannwhitneyu(cloud_distances, sample_distances, alternative="less", method="auto").pvalue)
+
+
+def _distances(engine, reg, grid, histograms, pairs):
+    """Distances between histogram pairs with one engine (NaN where it fails)."""
+    distances = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for left, right in pairs:
+            try:
+                distance = compute_wasserstein_distance(
+                    grid, histograms[left], grid, right if isinstance(right, np.ndarray) else histograms[right],
+                    metric="log_l1", method=engine, reg=reg,
+                )
+            except Exception:
+                distance = float("nan")
+            distances.append(float(distance))
+    return np.array(distances)
+
+
+def compute_reference(cloud, samples, pairs):
+    """Exact, grid-free p2p and p2b distances, barycenter and p-value."""
+    cloud_values = [v for v, _ in cloud]
+    cloud_weights = [w for _, w in cloud]
+    exact = lambda a, b: compute_wasserstein_distance(a[0], a[1], b[0], b[1], method="exact_1d")  # noqa: E731
+
+    p2p = np.array([exact(cloud[left], cloud[right]) for left, right in pairs])
+    barycenter, seconds, memory = _measure(median_quantile_barycenter, cloud_values, cloud_weights)
+    cloud_p2b = np.array([exact(sample, barycenter) for sample in cloud])
+    sample_p2b = np.array([exact(sample, barycenter) for sample in samples])
+    return {
+        "p2p": p2p,
+        "barycenter": barycenter,
+        "barycenter_seconds": seconds,
+        "barycenter_memory_mb": memory,
+        "cloud_p2b": cloud_p2b,
+        "sample_p2b": sample_p2b,
+        "pvalue": _wilcoxon_pvalue(cloud_p2b, sample_p2b),
+    }
+
+
+def evaluate_grid(n_grid, discretization, cloud, samples, pairs, reference, engines, barycenters, reg, max_lp_grid):
+    """All result rows of one grid size and discretization method."""
+    all_values = [v for v, _ in cloud] + [v for v, _ in samples]
+    grid = create_common_grid(all_values, n_grid=n_grid)
+    cloud_histograms = [discretize_distribution(v, w, grid, method=discretization) for v, w in cloud]
+    sample_histograms = [discretize_distribution(v, w, grid, method=discretization) for v, w in samples]
+    rows = []
+
+    for engine in engines:
+        distances, seconds, memory = _measure(_distances, engine, reg, grid, cloud_histograms, pairs)
+        row = {"kind": "p2p", "n_grid": n_grid, "discretization": discretization, "engine": engine,
+               "barycenter": "", "seconds": seconds, "memory_mb": memory}
+        row.update(_errors(distances, reference["p2p"]))
+        rows.append(row)
+
+    for method in barycenters:
+        if method == "lp" and n_grid > max_lp_grid:
+            continue
+        barycenter, seconds, memory = _measure(
+            BARYCENTERS[method], grid, [v for v, _ in cloud], [w for _, w in cloud], discretization=discretization
+        )
+        # Distance of the barycenter to the exact barycenter, relative to the
+        # mean cloud-to-barycenter distance
+        error = compute_wasserstein_distance(
+            grid, barycenter, reference["barycenter"][0], reference["barycenter"][1], method="exact_1d"
+        ) / reference["cloud_p2b"].mean()
+        rows.append({"kind": "barycenter", "n_grid": n_grid, "discretization": discretization, "engine": "",
+                     "barycenter": method, "seconds": seconds, "memory_mb": memory,
+                     "mean_rel_error": error, "max_rel_error": error, "spearman": float("nan")})
+
+        for engine in engines:
+            (cloud_p2b, sample_p2b), seconds, memory = _measure(
+                lambda: (
+                    _distances(engine, reg, grid, cloud_histograms, [(i, barycenter) for i in range(len(cloud))]),
+                    _distances(engine, reg, grid, sample_histograms, [(i, barycenter) for i in range(len(samples))]),
+                )
+            )
+            row = {"kind": "p2b", "n_grid": n_grid, "discretization": discretization, "engine": engine,
+                   "barycenter": method, "seconds": seconds, "memory_mb": memory,
+                   "pvalue": _wilcoxon_pvalue(cloud_p2b, sample_p2b)}
+            row.update(_errors(
+                np.concatenate([cloud_p2b, sample_p2b]),
+                np.concatenate([reference["cloud_p2b"], reference["sample_p2b"]]),
+            ))
+            rows.append(row)
+    return rows
+
+
+def format_rows(rows, reference):
+    """Result table as text."""
+    lines = [
+        f"{'Kind':<11} {'n_grid':>6} {'Disc':<8} {'Engine':<9} {'Bary':<7} {'Seconds':>9} {'Mem MB':>7} "
+        f"{'Mean err':>9} {'Max err':>9} {'Spearman':>9} {'p-value':>10}",
+        "-" * 104,
+        f"{'reference':<11} {'-':>6} {'-':<8} {'exact_1d':<9} {'median':<7} {reference['barycenter_seconds']:>9.3f} "
+        f"{reference['barycenter_memory_mb']:>7.1f} {'':>9} {'':>9} {'':>9} {reference['pvalue']:>10.3e}",
+    ]
+    for row in rows:
+        pvalue = f"{row['pvalue']:.3e}" if "pvalue" in row else ""
+        lines.append(
+            f"{row['kind']:<11} {row['n_grid']:>6} {row['discretization']:<8} {row['engine']:<9} {row['barycenter']:<7} "
+            f"{row['seconds']:>9.3f} {row['memory_mb']:>7.1f} {row['mean_rel_error']:>9.2e} "
+            f"{row['max_rel_error']:>9.2e} {row['spearman']:>9.4f} {pvalue:>10}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args():
+    """Parse CLI arguments."""
+    parser = argparse.ArgumentParser(
+        description="Compare grid sizes, OT engines and barycenter methods against an exact reference.",
+    )
+    parser.add_argument("cloud", nargs="?", default=None, help="Cloud folder, cohort store or list file (default: synthetic)")
+    parser.add_argument("samples", nargs="?", default=None, help="Sample folder, cohort store or list file (default: synthetic)")
+    parser.add_argument("--grids", type=int, nargs="+", default=[50, 100, 200, 400], dest="grids",
+                        help="Grid sizes to compare (default: 50 100 200 400)")
+    parser.add_argument("--discretizations", nargs="+", choices=DISCRETIZATION_METHODS,
+                        default=list(DISCRETIZATION_METHODS), dest="discretizations",
+                        help="Discretization methods (default: all)")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES), dest="engines",
+                        help="Distance engines (default: all)")
+    parser.add_argument("--barycenters", nargs="+", choices=list(BARYCENTERS), default=list(BARYCENTERS),
+                        dest="barycenters", help="Barycenter methods (default: all)")
+    parser.add_argument("--sinkhorn-reg", type=float, default=0.01, dest="sinkhorn_reg",
+                        help="Sinkhorn regularization (default: 0.01, as used by the scripts)")
+    parser.add_argument("--max-lp-grid", type=int, default=200, dest="max_lp_grid",
+                        help="Skip the LP barycenter above this grid size (default: 200)")
+    parser.add_argument("--max-pairs", type=int, default=200, dest="max_pairs",
+                        help="At most this many cloud pairs for p2p (default: 200)")
+    parser.add_argument("--synthetic-cloud", type=int, default=20, dest="synthetic_cloud",
+                        help="Synthetic cloud size (default: 20)")
+    parser.add_argument("--synthetic-samples", type=int, default=10, dest="synthetic_samples",
+                        help="Synthetic sample group size (default: 10)")
+    parser.add_argument("--synthetic-depth", type=int, default=5000, dest="synthetic_depth",
+                        help="Rows per synthetic repertoire (default: 5000)")
+    parser.add_argument("--synthetic-shift", type=float, default=0.3, dest="synthetic_shift",
+                        help="log10(pgen) shift of the synthetic sample group (default: 0.3)")
+    parser.add_argument("--seed", type=int, default=0, dest="seed")
+    parser.add_argument("--output", default=None, dest="output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    if (args.cloud is None) != (args.samples is None):
+        parser.error("give both cloud and samples, or neither for synthetic data")
+    if min(args.grids) <= 1:
+        parser.error("--grids must be > 1")
+    if args.max_pairs <= 0:
+        parser.error("--max-pairs must be > 0")
+
+    return args
+
+
+def _synthetic_inputs(args, folder):
+    """Synthetic cloud and (shifted) sample group."""
+    cloud_files = generate_cohort(
+        os.path.join(folder, "cloud"), args.synthetic_cloud, args.synthetic_depth, seed=args.seed,
+    )
+    sample_files = generate_cohort(
+        os.path.join(folder, "samples"), args.synthetic_samples, args.synthetic_depth, seed=args.seed + 1,
+        label="Post",
+    )
+    return cloud_files, sample_files, args.synthetic_shift
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+
+    temporary = None
+    shift = 0.0
+    if args.cloud is None:
+        temporary = tempfile.mkdtemp(prefix="bench-accuracy-")
+        cloud_files, sample_files, shift = _synthetic_inputs(args, temporary)
+    else:
+        cloud_files, sample_files = _input_files(args.cloud), _input_files(args.samples)
+
+    try:
+        cloud = [load_distribution(f) for f in cloud_files]
+        samples = [load_distribution(f) for f in sample_files]
+    finally:
+        if temporary is not None:
+            shutil.rmtree(temporary, ignore_errors=True)
+    if shift:
+        # Shift the sample group in log10(pgen) so the test has something to detect
+        samples = [(values * 10.0 ** shift, weights) for values, weights in samples]
+    print(f"Cloud: {len(cloud)} samples, sample group: {len(samples)} samples, "
+          f"{sum(len(v) for v, _ in cloud + samples)} rows")
+
+    # Imported here so its import time is not charged to the first engine
+    importlib.import_module("ot")
+    pairs = list(islice(combinations(range(len(cloud)), 2), args.max_pairs))
+    reference = compute_reference(cloud, samples, pairs)
+
+    rows = []
+    for n_grid in args.grids:
+        for discretization in args.discretizations:
+            rows.extend(evaluate_grid(
+                n_grid, discretization, cloud, samples, pairs, reference,
+                args.engines, args.barycenters, args.sinkhorn_reg, args.max_lp_grid,
+            ))
+        print(f"  n_grid {n_grid} done")
+    print()
+    print(format_rows(rows, reference))
+    print()
+    print("Errors are relative to the exact grid-free reference; barycenter error is W1 to the exact")
+    print("barycenter over the mean cloud-to-barycenter distance. Memory is the peak traced by tracemalloc.")
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump({
+                "reference": {"pvalue": reference["pvalue"], "barycenter_seconds": reference["barycenter_seconds"]},
+                "rows": rows,
+            }, handle, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
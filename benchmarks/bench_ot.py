@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the OT hot paths on synthetic cohorts.
+
+Times, at several scales (cohort size x repertoire depth x grid size):
+
+    load_distribution            read and filter every TSV file of the cohort
+    discretize_distribution      bin every sample onto the common grid
+    compute_wasserstein_distance one exact OT distance per sample pair (capped)
+    compute_lp_barycenter        LP barycenter of the whole cohort
+    bootstrap                    the olga-barycenter-ot-bootstrap.py loop
+    all_pairs                    olga-p2p-ot.py --all (load, discretize, all pairs)
+
+The cohorts come from synthetic_repertoires.py and are deterministic for a
+given scale and seed, so runs on the same machine are comparable. Results
+are compared with a stored baseline (benchmarks/baselines/bench_ot.json by
+default); the script exits with status 1 if a benchmark is slower than
+--max-slowdown times its baseline, so it can guard against regressions.
+Run it before and after an optimization and keep the baseline up to date
+with --update-baseline.
+
+Usage:
+    python3 benchmarks/bench_ot.py [--scales small medium] [--repeat 3]
+    python3 benchmarks/bench_ot.py --scales large --benchmarks load_distribution all_pairs
+    python3 benchmarks/bench_ot.py --update-baseline
+"""
+
+import sys
+import argparse
+import contextlib
+import datetime
+import functools
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from itertools import combinations, islice
+from pathlib import Path
+
+import numpy as np
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from synthetic_repertoires import generate_cohort  # noqa: E402
+from ot_utils import (  # noqa: E402
+    load_distribution,
+    create_common_grid,
+    discretize_distribution,
+    compute_wasserstein_distance,
+    compute_lp_barycenter,
+)
+from repertoires import open_repertoires, value_ranges  # noqa: E402
+
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baselines" / "bench_ot.json"
+
+# n_grid: grid of distances and all-pairs; barycenter_grid: grid of the
+# LP barycenter and the bootstrap (the LP cost grows steeply with it)
+SCALES = {
+    "small": dict(n_samples=8, depth=2000, n_grid=100, barycenter_grid=50, bootstrap_n=2),
+    "medium": dict(n_samples=25, depth=20000, n_grid=200, barycenter_grid=100, bootstrap_n=2),
+    "large": dict(n_samples=50, depth=200000, n_grid=200, barycenter_grid=100, bootstrap_n=1),
+}
+
+# At most this many sample pairs are timed by compute_wasserstein_distance
+MAX_PAIRS = 300
+
+
+@functools.lru_cache(maxsize=None)
+def _load_script(filename):
+    """Import an olga-*.py script as a module."""
+    spec = importlib.util.spec_from_file_location(filename[:-3].replace("-", "_"), REPO_DIR / filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Cohort:
+    """Synthetic cohort of one scale, loaded lazily for the benchmarks that need it."""
+
+    def __init__(self, files, parameters):
+        self.files = files
+        self.parameters = parameters
+        self._distributions = None
+        self._histograms = None
+
+    @property
+    def distributions(self):
+        """(values, weights) of every file, loaded on first use."""
+        if self._distributions is None:
+            self._distributions = [load_distribution(f) for f in self.files]
+        return self._distributions
+
+    @property
+    def histograms(self):
+        """(common grid, discretized samples), computed on first use."""
+        if self._histograms is None:
+            grid = create_common_grid([v for v, _ in self.distributions], n_grid=self.parameters["n_grid"])
+            self._histograms = (grid, [discretize_distribution(v, w, grid) for v, w in self.distributions])
+        return self._histograms
+
+
+# Each benchmark: name -> (unit, slow, function(cohort) -> number of units).
+# Slow benchmarks run once; the others run --repeat times after a warm-up.
+
+def _bench_load(cohort):
+    for file_path in cohort.files:
+        load_distribution(file_path)
+    return len(cohort.files)
+
+
+def _bench_discretize(cohort):
+    grid, _ = cohort.histograms
+    for values, weights in cohort.distributions:
+        discretize_distribution(values, weights, grid)
+    return len(cohort.distributions)
+
+
+def _bench_distance(cohort):
+    grid, histograms = cohort.histograms
+    pairs = list(islice(combinations(range(len(histograms)), 2), MAX_PAIRS))
+    for left, right in pairs:
+        compute_wasserstein_distance(grid, histograms[left], grid, histograms[right], metric="log_l1", method="emd")
+    return len(pairs)
+
+
+def _bench_barycenter(cohort):
+    compute_lp_barycenter(
+        [v for v, _ in cohort.distributions],
+        [w for _, w in cohort.distributions],
+        n_grid=cohort.parameters["barycenter_grid"],
+    )
+    return 1
+
+
+def _bench_bootstrap(cohort):
+    bootstrap = _load_script("olga-barycenter-ot-bootstrap.py")
+    repertoires = open_repertoires(cohort.files)
+    grid = create_common_grid(value_ranges(repertoires), n_grid=cohort.parameters["barycenter_grid"])
+    # Same entry point as the script's main(); the reference barycenter
+    # only enters the (cheap) reference distances
+    barycenter = np.full(len(grid), 1.0 / len(grid))
+    with contextlib.redirect_stdout(io.StringIO()):
+        bootstrap._build_null_distribution(
+            repertoires,
+            grid,
+            barycenter,
+            bootstrap_n=cohort.parameters["bootstrap_n"],
+        )
+    return cohort.parameters["bootstrap_n"]
+
+
+def _bench_all_pairs(cohort):
+    p2p = _load_script("olga-p2p-ot.py")
+    list_file = os.path.join(os.path.dirname(cohort.files[0]), "files.txt")
+    with open(list_file, "w") as handle:
+        handle.write("\n".join(cohort.files) + "\n")
+    p2p.compute_distance_all_pairs(list_file, n_grid=cohort.parameters["n_grid"])
+    n_files = len(cohort.files)
+    return n_files * (n_files - 1) // 2
+
+
+BENCHMARKS = {
+    "load_distribution": ("file", False, _bench_load),
+    "discretize_distribution": ("sample", False, _bench_discretize),
+    "compute_wasserstein_distance": ("pair", False, _bench_distance),
+    "compute_lp_barycenter": ("barycenter", True, _bench_barycenter),
+    "bootstrap": ("iteration", True, _bench_bootstrap),
+    "all_pairs": ("pair", True, _bench_all_pairs),
+}
+
+
+def _prepare_cohort(data_dir, scale, seed):
+    """Generate (or reuse) the synthetic cohort of a scale."""
+    parameters = SCALES[scale]
+    folder = os.path.join(
+        data_dir, f"{scale}-{parameters['n_samples']}x{parameters['depth']}-seed{seed}"
+    )
+    files = sorted(str(p) for p in Path(folder).glob("*.tsv"))
+    if len(files) != parameters["n_samples"]:
+        start = time.perf_counter()
+        files = generate_cohort(folder, parameters["n_samples"], parameters["depth"], seed=seed)
+        print(f"  generated {len(files)} x {parameters['depth']} rows in {time.perf_counter() - start:.1f} s")
+    return Cohort(files, parameters)
+
+
+def _run_benchmark(name, cohort, repeat):
+    """Time one benchmark; returns its result record."""
+    unit, slow, function = BENCHMARKS[name]
+    # Inputs and script modules are not part of the timed work
+    cohort.histograms
+    _load_script("olga-barycenter-ot-bootstrap.py")
+    _load_script("olga-p2p-ot.py")
+    if not slow:
+        function(cohort)  # warm-up: imports, file cache, lazily loaded inputs
+    timings = []
+    for _ in range(1 if slow else repeat):
+        start = time.perf_counter()
+        n_units = function(cohort)
+        timings.append(time.perf_counter() - start)
+    seconds = statistics.median(timings)
+    return {
+        "seconds": seconds,
+        "min_seconds": min(timings),
+        "runs": len(timings),
+        "units": n_units,
+        "unit": unit,
+        "seconds_per_unit": seconds / n_units,
+    }
+
+
+def _environment():
+    """Versions and machine the results were measured on."""
+    import ot
+    import pandas
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pandas.__version__,
+        "pot": ot.__version__,
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def _compare(scale, name, result, baseline, max_slowdown):
+    """Ratio to the baseline ('' if there is none) and whether it is a regression."""
+    stored = baseline.get("scales", {}).get(scale)
+    if not stored or stored.get("parameters") != SCALES[scale] or name not in stored.get("results", {}):
+        return "", False
+    ratio = result["seconds"] / stored["results"][name]["seconds"]
+    return f"{ratio:.2f}x", ratio > max_slowdown
+
+
+def parse_args():
+    """Parse CLI arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark the OT hot paths on synthetic cohorts.")
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        choices=list(SCALES),
+        default=["small", "medium"],
+        dest="scales",
+        help="Scales to run (default: small medium)",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        choices=list(BENCHMARKS),
+        default=list(BENCHMARKS),
+        dest="benchmarks",
+        help="Benchmarks to run (default: all)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        dest="repeat",
+        help="Timed runs of the fast benchmarks; barycenter, bootstrap and all-pairs run once (default: 3)",
+    )
+    parser.add_argument("--seed", type=int, default=0, dest="seed", help="Seed of the synthetic cohorts (default: 0)")
+    parser.add_argument(
+        "--data-dir",
+        default=None,
+        dest="data_dir",
+        help="Keep the synthetic cohorts in this folder and reuse them (default: temporary folder)",
+    )
+    parser.add_argument("--output", default=None, dest="output", help="Write the results to this JSON file")
+    parser.add_argument(
+        "--baseline",
+        default=str(DEFAULT_BASELINE),
+        dest="baseline",
+        help="Baseline JSON to compare with (default: benchmarks/baselines/bench_ot.json)",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        dest="update_baseline",
+        help="Store the results of this run in the baseline file",
+    )
+    parser.add_argument(
+        "--max-slowdown",
+        type=float,
+        default=1.5,
+        dest="max_slowdown",
+        help="Fail if a benchmark takes more than this times its baseline (default: 1.5)",
+    )
+    args = parser.parse_args()
+
+    if args.repeat <= 0:
+        parser.error("--repeat must be > 0")
+    if args.max_slowdown <= 0:
+        parser.error("--max-slowdown must be > 0")
+
+    return args
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bench-ot-")
+    record = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "environment": _environment(),
+        "seed": args.seed,
+        "scales": {},
+    }
+    regressions = []
+    try:
+        for scale in args.scales:
+            parameters = SCALES[scale]
+            print(
+                f"Scale {scale}: {parameters['n_samples']} samples x {parameters['depth']} rows, "
+                f"n_grid {parameters['n_grid']}, barycenter grid {parameters['barycenter_grid']}"
+            )
+            cohort = _prepare_cohort(data_dir, scale, args.seed)
+            print(f"  {'Benchmark':<30} {'Seconds':>10} {'Per unit (ms)':>22} {'vs baseline':>12}")
+            results = {}
+            for name in args.benchmarks:
+                result = _run_benchmark(name, cohort, args.repeat)
+                results[name] = result
+                ratio, regressed = _compare(scale, name, result, baseline, args.max_slowdown)
+                per_unit = f"{result['seconds_per_unit'] * 1000:.3f}/{result['unit']}"
+                print(f"  {name:<30} {result['seconds']:>10.3f} {per_unit:>22} {ratio:>12}")
+                if regressed:
+                    regressions.append(f"{scale}/{name}: {ratio} of baseline")
+            record["scales"][scale] = {"parameters": parameters, "results": results}
+            print()
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(record, handle, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.update_baseline:
+        # Merge, so running a subset only replaces the measured entries
+        merged = baseline or {"scales": {}}
+        merged["created"] = record["created"]
+        merged["environment"] = record["environment"]
+        merged["seed"] = record["seed"]
+        for scale, entry in record["scales"].items():
+            stored = merged["scales"].get(scale)
+            if not stored or stored.get("parameters") != entry["parameters"]:
+                merged["scales"][scale] = entry
+            else:
+                stored["results"].update(entry["results"])
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as handle:
+            json.dump(merged, handle, indent=2)
+        print(f"Baseline updated: {args.baseline}")
+        return
+
+    if regressions:
+        print(f"Slower than {args.max_slowdown}x baseline:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        sys.exit(1)
+    if baseline:
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Start-up time benchmark for the CLI scripts.
+
+Runs every olga-*.py script with --help in a fresh interpreter and reports
+the median wall time. Also checks that neither --help nor importing the
+shared modules loads a heavy dependency (POT, pandas, scipy, sklearn,
+matplotlib, adjustText): those must stay imported lazily in the code paths
+that need them.
+
+Exits with status 1 if a heavy module is imported at start-up or a script
+is slower than --max-seconds, so it can guard against regressions.
+
+Usage:
+    python3 benchmarks/bench_startup.py [--repeat 5] [--max-seconds 0.5]
+"""
+
+import sys
+import argparse
+import json
+import statistics
+import subprocess
+import time
+from pathlib import Path
+
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+SHARED_MODULES = ("ot_utils", "mds_utils", "plot_utils", "cohort_store", "instrumentation", "repertoires")
+HEAVY_MODULES = ("ot", "pandas", "scipy", "sklearn", "matplotlib", "adjustText")
+
+# Runs a script's --help in-process and prints the heavy modules it loaded.
+_HELP_PROBE = """
+import json, runpy, sys
+sys.path.insert(0, {repo!r})
+sys.argv = [{script!r}, '--help']
+try:
+    runpy.run_path({script!r}, run_name='__main__')
+except SystemExit:
+    pass
+print(json.dumps(sorted({{m.split('.')[0] for m in sys.modules}} & set({heavy!r}))), file=sys.stderr)
+"""
+
+_IMPORT_PROBE = """
+import json, sys
+sys.path.insert(0, {repo!r})
+for name in {modules!r}:
+    __import__(name)
+print(json.dumps(sorted({{m.split('.')[0] for m in sys.modules}} & set({heavy!r}))))
+"""
+
+
+def _heavy_modules_loaded(code, from_stderr=False):
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, cwd=REPO_DIR, check=True
+    )
+    output = result.stderr if from_stderr else result.stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _time_help(script, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, str(script), "--help"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=REPO_DIR, check=False,
+        )
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def _time_interpreter(repeat):
+    """Median start-up time of a bare interpreter, for reference."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+
+def parse_args():
+    """Parse CLI arguments."""
+    parser = argparse.ArgumentParser(description="Start-up time benchmark for the CLI scripts.")
+    parser.add_argument("--repeat", type=int, default=5, dest="repeat", help="Runs per script (default: 5)")
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=0.5,
+        dest="max_seconds",
+        help="Fail if the median --help time of a script exceeds this (default: 0.5)",
+    )
+    args = parser.parse_args()
+
+    if args.repeat <= 0:
+        parser.error("--repeat must be > 0")
+
+    return args
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    failures = []
+
+    baseline = _time_interpreter(args.repeat)
+    print(f"Bare interpreter: {baseline * 1000:.0f} ms")
+    print()
+
+    heavy = _heavy_modules_loaded(
+        _IMPORT_PROBE.format(repo=str(REPO_DIR), modules=SHARED_MODULES, heavy=HEAVY_MODULES)
+    )
+    status = "ok" if not heavy else f"FAIL (loads {', '.join(heavy)})"
+    print(f"import {', '.join(SHARED_MODULES)}: {status}")
+    if heavy:
+        failures.append(f"shared modules import {', '.join(heavy)}")
+    print()
+
+    print(f"{'Script':<42} {'--help (ms)':>12}  Heavy imports")
+    print("-" * 80)
+    for script in sorted(REPO_DIR.glob("olga-*.py")):
+        median = _time_help(script, args.repeat)
+        heavy = _heavy_modules_loaded(
+            _HELP_PROBE.format(repo=str(REPO_DIR), script=str(script), heavy=HEAVY_MODULES),
+            from_stderr=True,
+        )
+        print(f"{script.name:<42} {median * 1000:>12.0f}  {', '.join(heavy) or '-'}")
+        if heavy:
+            failures.append(f"{script.name} --help imports {', '.join(heavy)}")
+        if median > args.max_seconds:
+            failures.append(f"{script.name} --help took {median:.2f} s (> {args.max_seconds} s)")
+
+    print()
+    if failures:
+        print("Start-up regressions:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    print("No start-up regressions")
+
+
+if __name__ == "__main__":
+    main()
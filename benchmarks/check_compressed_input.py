@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Check that compressed repertoires load like their plain TSV originals.
+
+Writes a small synthetic cohort, compresses it as .tsv.gz, .tsv.bz2 and
+.tsv.zst, loads every file through load_distribution, and packs each
+compressed copy of the cohort into a cohort store. The `zstandard`
+package is blocked for the whole run, so .tsv.zst files can only be read
+through the zstd command line tool: the setup README.md documents as
+sufficient. The .tsv.zst case is skipped (and reported) when zstd is not
+installed.
+
+Exits with status 1 if a compressed file fails to load or to be packed,
+or gives other values than its plain original.
+
+Usage:
+    python3 benchmarks/check_compressed_input.py [--samples 3] [--depth 2000]
+"""
+
+import sys
+import argparse
+import bz2
+import gzip
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+# Only the command line tool may decompress .tsv.zst
+sys.modules['zstandard'] = None
+
+from synthetic_repertoires import generate_cohort  # noqa: E402
+from ot_utils import build_cohort_store, find_tsv_files, load_distribution  # noqa: E402
+
+
+def _compress_gz(source, target):
+    with open(source, 'rb') as src, gzip.open(target, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+
+def _compress_bz2(source, target):
+    with open(source, 'rb') as src, bz2.open(target, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+
+def _compress_zst(source, target):
+    subprocess.run(['zstd', '-q', '-o', str(target), str(source)], check=True)
+
+
+# suffix -> (compress function, command line tool it needs or None)
+COMPRESSIONS = {
+    '.gz': (_compress_gz, None),
+    '.bz2': (_compress_bz2, None),
+    '.zst': (_compress_zst, 'zstd'),
+}
+
+
+def _same_distribution(left, right):
+    return all(np.array_equal(a, b) for a, b in zip(left, right))
+
+
+def check_folder(plain_files, folder):
+    """
+    Compress `plain_files` into `folder` and compare their loaded contents.
+
+    Returns
+    -------
+    failures : list of str
+    skipped : list of str
+        Compressions whose tool is not installed
+    """
+    failures = []
+    skipped = []
+    for suffix, (compress, tool) in COMPRESSIONS.items():
+        if tool is not None and shutil.which(tool) is None:
+            skipped.append(f".tsv{suffix} ({tool} not installed)")
+            continue
+        compressed_folder = Path(folder) / suffix.lstrip('.')
+        compressed_folder.mkdir()
+        for plain in plain_files:
+            target = compressed_folder / (Path(plain).name + suffix)
+            compress(plain, target)
+            try:
+                loaded = load_distribution(str(target))
+            except Exception as exc:
+                failures.append(f"{target.name}: {exc}")
+                continue
+            if not _same_distribution(loaded, load_distribution(plain)):
+                failures.append(f"{target.name}: values differ from {Path(plain).name}")
+
+        store_path = Path(folder) / f"{suffix.lstrip('.')}.cohort"
+        try:
+            build_cohort_store(find_tsv_files(compressed_folder), store_path)
+            members = find_tsv_files(store_path)
+            for member, plain in zip(members, plain_files):
+                if not np.allclose(load_distribution(str(member))[0], load_distribution(plain)[0], rtol=1e-12):
+                    failures.append(f"{member.name} in {store_path.name}: values differ from {Path(plain).name}")
+        except Exception as exc:
+            failures.append(f"{store_path.name}: {exc}")
+        print(f"  .tsv{suffix:<5} {len(plain_files)} file(s) and a cohort store checked")
+    return failures, skipped
+
+
+def parse_args():
+    """Parse CLI arguments."""
+    parser = argparse.ArgumentParser(
+        description="Check that compressed repertoires load like their plain originals (zstd via the CLI only).",
+    )
+    parser.add_argument("--samples", type=int, default=3, dest="n_samples", help="Number of repertoires (default: 3)")
+    parser.add_argument("--depth", type=int, default=2000, dest="depth", help="Rows per repertoire (default: 2000)")
+    args = parser.parse_args()
+
+    if args.n_samples <= 0:
+        parser.error("--samples must be > 0")
+    if args.depth <= 0:
+        parser.error("--depth must be > 0")
+
+    return args
+
+
+def main():
+    args = parse_args()
+    folder = tempfile.mkdtemp(prefix="check-compressed-")
+    try:
+        plain_files = generate_cohort(str(Path(folder) / "plain"), args.n_samples, args.depth)
+        print(f"Loading {len(plain_files)} synthetic repertoires per compression (zstandard package blocked):")
+        failures, skipped = check_folder(plain_files, folder)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    for name in skipped:
+        print(f"Skipped {name}")
+    if failures:
+        print()
+        print("Failures:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("All compressed inputs match their plain originals")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Synthetic AIRR-TSV repertoires for benchmarks.
+
+Writes cohorts of TSV files shaped like the OLGA-annotated samples the
+scripts read (sequence_id, productive, v_call, d_call, j_call, junction_aa,
+duplicate_count, duplicate_frequency_percent, pgen), at any depth and
+cohort size.
+
+log10(pgen) follows a left-skewed law fitted to the Tumeh2014 samples:
+-6 minus a gamma variate (shape 2.4, scale 1.16), i.e. mean about -8.8,
+median about -8.4 and a long tail towards rare sequences. Each sample
+gets its own shift of that law so distances between samples are not all
+equal. A share of
+rows has pgen 0 (sequences OLGA cannot generate), a share is
+non-productive and a share has no D call, so the loading filters have
+rows to drop. Clone counts are log-normal (heavy right tail).
+
+Usage:
+    python3 benchmarks/synthetic_repertoires.py OUTPUT_FOLDER --samples 25 --depth 10000
+"""
+
+import argparse
+import gzip
+import os
+import sys
+
+import numpy as np
+
+
+COLUMNS = (
+    "sequence_id", "productive", "v_call", "d_call", "j_call", "junction_aa",
+    "duplicate_count", "duplicate_frequency_percent", "pgen",
+)
+
+_V_GENES = np.array([
+    "TRBV2*01", "TRBV3-1*01", "TRBV4-1*01", "TRBV5-1*01", "TRBV6-5*01", "TRBV7-2*01",
+    "TRBV7-9*01", "TRBV9*01", "TRBV10-3*01", "TRBV11-2*01", "TRBV12-3*01", "TRBV18*01",
+    "TRBV19*01", "TRBV20-1*01", "TRBV27*01", "TRBV28*01", "TRBV29-1*01", "TRBV30*01",
+])
+_D_GENES = np.array(["TRBD1*01", "TRBD2*01"])
+_J_GENES = np.array([
+    "TRBJ1-1*01", "TRBJ1-2*01", "TRBJ1-5*01", "TRBJ1-6*01", "TRBJ2-1*01",
+    "TRBJ2-2*01", "TRBJ2-3*01", "TRBJ2-5*01", "TRBJ2-7*01",
+])
+_AMINO_ACIDS = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+
+# Shape of log10(pgen): -LOG10_PGEN_MAX - Gamma(shape, scale)
+LOG10_PGEN_MAX = -6.0
+LOG10_PGEN_SHAPE = 2.4
+LOG10_PGEN_SCALE = 1.16
+
+
+def generate_repertoire(
+    depth,
+    rng,
+    shift=0.0,
+    zero_pgen_share=0.02,
+    nonproductive_share=0.05,
+    missing_d_share=0.3,
+):
+    """
+    Draw the columns of one synthetic repertoire.
+
+    Parameters
+    ----------
+    depth : int
+        Number of clonotypes (rows)
+    rng : np.random.Generator
+        Random generator
+    shift : float
+        Added to every log10(pgen) of this sample
+    zero_pgen_share, nonproductive_share, missing_d_share : float
+        Shares of rows with pgen 0, productive False and an empty d_call
+
+    Returns
+    -------
+    dict
+        Column name -> np.ndarray, in COLUMNS order
+    """
+    log10_pgen = LOG10_PGEN_MAX + shift - rng.gamma(LOG10_PGEN_SHAPE, LOG10_PGEN_SCALE, size=depth)
+    pgen = 10.0 ** log10_pgen
+    pgen[rng.random(depth) < zero_pgen_share] = 0.0
+
+    counts = np.floor(rng.lognormal(mean=1.0, sigma=1.5, size=depth)).astype(np.int64) + 1
+    frequency = 100.0 * counts / counts.sum()
+
+    d_call = _D_GENES[rng.integers(len(_D_GENES), size=depth)].astype(object)
+    d_call[rng.random(depth) < missing_d_share] = ""
+
+    # CDR3: conserved C...F with a random middle of 7 to 13 residues
+    lengths = rng.integers(7, 14, size=depth)
+    residues = _AMINO_ACIDS[rng.integers(len(_AMINO_ACIDS), size=(depth, 13))]
+    middles = ["".join(row[:length]) for row, length in zip(residues, lengths)]
+    junction_aa = np.array([f"CAS{middle}F" for middle in middles], dtype=object)
+
+    return {
+        "sequence_id": np.array([f"sequence{i + 1}" for i in range(depth)], dtype=object),
+        "productive": np.where(rng.random(depth) < nonproductive_share, "False", "True"),
+        "v_call": _V_GENES[rng.integers(len(_V_GENES), size=depth)],
+        "d_call": d_call,
+        "j_call": _J_GENES[rng.integers(len(_J_GENES), size=depth)],
+        "junction_aa": junction_aa,
+        "duplicate_count": counts,
+        "duplicate_frequency_percent": frequency,
+        "pgen": pgen,
+    }
+
+
+def write_repertoire(path, columns, sample_id):
+    """
+    Write repertoire columns as a tab-separated file (.gz paths are gzipped).
+
+    Parameters
+    ----------
+    path : str
+        Output file path
+    columns : dict
+        As returned by generate_repertoire
+    sample_id : str
+        Prefix of the sequence ids ("<sample_id>|sequence1", ...)
+    """
+    sequence_ids = [f"{sample_id}|{sequence_id}" for sequence_id in columns["sequence_id"]]
+    rows = zip(
+        sequence_ids,
+        columns["productive"],
+        columns["v_call"],
+        columns["d_call"],
+        columns["j_call"],
+        columns["junction_aa"],
+        columns["duplicate_count"].tolist(),
+        columns["duplicate_frequency_percent"].tolist(),
+        columns["pgen"].tolist(),
+    )
+    lines = ["\t".join(COLUMNS)]
+    lines.extend(
+        f"{sid}\t{productive}\t{v}\t{d}\t{j}\t{cdr3}\t{count}\t{frequency!r}\t{pgen!r}"
+        for sid, productive, v, d, j, cdr3, count, frequency, pgen in rows
+    )
+    text = "\n".join(lines) + "\n"
+    if path.endswith(".gz"):
+        with gzip.open(path, "wt", compresslevel=1) as handle:
+            handle.write(text)
+    else:
+        with open(path, "w") as handle:
+            handle.write(text)
+
+
+def generate_cohort(
+    folder,
+    n_samples,
+    depth,
+    seed=0,
+    sample_shift=0.3,
+    depth_spread=0.0,
+    label="Base",
+    compress=False,
+):
+    """
+    Write a cohort of synthetic repertoires into a folder.
+
+    Files are named Patient01_<label>_tcr_pgen.tsv, Patient02_..., as in the
+    real cohorts, so labels and listings behave the same.
+
+    Parameters
+    ----------
+    folder : str
+        Output folder (created if missing)
+    n_samples : int
+        Number of repertoires
+    depth : int
+        Clonotypes per repertoire
+    seed : int
+        Seed; the same arguments always give the same files
+    sample_shift : float
+        Standard deviation of the per-sample log10(pgen) shift
+    depth_spread : float
+        Relative spread of the depth: each sample has
+        depth * U(1 - depth_spread, 1 + depth_spread) rows
+    label : str
+        Timepoint part of the file names
+    compress : bool
+        Write .tsv.gz files
+
+    Returns
+    -------
+    list of str
+        Paths of the written files
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    width = max(2, len(str(n_samples)))
+    paths = []
+    for index in range(n_samples):
+        sample_depth = depth
+        if depth_spread > 0:
+            sample_depth = max(1, int(round(depth * rng.uniform(1 - depth_spread, 1 + depth_spread))))
+        sample_id = f"Patient{index + 1:0{width}d}_{label}"
+        path = os.path.join(folder, f"{sample_id}_tcr_pgen.tsv" + (".gz" if compress else ""))
+        columns = generate_repertoire(sample_depth, rng, shift=rng.normal(0.0, sample_shift))
+        write_repertoire(path, columns, sample_id)
+        paths.append(path)
+    return paths
+
+
+def parse_args():
+    """Parse CLI arguments."""
+    parser = argparse.ArgumentParser(description="Write a cohort of synthetic AIRR-TSV repertoires.")
+    parser.add_argument("output_folder", help="Folder for the TSV files (created if missing)")
+    parser.add_argument("--samples", type=int, default=25, dest="n_samples", help="Number of repertoires (default: 25)")
+    parser.add_argument("--depth", type=int, default=10000, dest="depth", help="Clonotypes per repertoire (default: 10000)")
+    parser.add_argument(
+        "--depth-spread",
+        type=float,
+        default=0.0,
+        dest="depth_spread",
+        help="Relative spread of the per-sample depth, in [0, 1) (default: 0, all samples equally deep)",
+    )
+    parser.add_argument(
+        "--sample-shift",
+        type=float,
+        default=0.3,
+        dest="sample_shift",
+        help="Standard deviation of the per-sample log10(pgen) shift (default: 0.3)",
+    )
+    parser.add_argument("--label", default="Base", dest="label", help="Timepoint part of the file names (default: Base)")
+    parser.add_argument("--seed", type=int, default=0, dest="seed")
+    parser.add_argument("--gzip", action="store_true", dest="compress", help="Write gzip-compressed .tsv.gz files")
+    args = parser.parse_args()
+
+    if args.n_samples <= 0:
+        parser.error("--samples must be > 0")
+    if args.depth <= 0:
+        parser.error("--depth must be > 0")
+    if not 0 <= args.depth_spread < 1:
+        parser.error("--depth-spread must be in [0, 1)")
+
+    return args
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    paths = generate_cohort(
+        args.output_folder,
+        args.n_samples,
+        args.depth,
+        seed=args.seed,
+        sample_shift=args.sample_shift,
+        depth_spread=args.depth_spread,
+        label=args.label,
+        compress=args.compress,
+    )
+    print(f"Wrote {len(paths)} repertoires to {args.output_folder}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
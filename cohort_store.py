@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped columnar store for a whole cohort (cloud) of repertoires.
+
+All repertoires live in one file:
+
+    MAGIC (8 bytes) | header length (uint64, little endian) | JSON header |
+    padding | raw arrays, each aligned to ARRAY_ALIGNMENT bytes
+
+Arrays (concatenated over samples in header order):
+    log_values : float64  natural log of the frequency column (pgen > 0 only)
+    weights    : float64  raw values of the weights column (ones if none)
+    flags      : uint8    FLAG_* bits of the row filters the row passes
+    offsets    : int64    n_samples + 1 row offsets into the arrays above
+
+    sketch_bins    : int32    canonical lattice bin of each sketch entry
+    sketch_flags   : uint8    FLAG_* bits shared by the rows of the entry
+    sketch_weights : float64  summed raw weights of those rows
+    sketch_counts  : float64  number of those rows
+    sketch_offsets : int64    n_samples + 1 entry offsets into the sketch arrays
+
+The sketch is a sparse histogram of every sample on a fine canonical
+log-pgen lattice, split by filter flags so that any filter combination can
+be served without the rows (see ot_utils.load_sketch).
+
+The JSON header holds the build options, the sketch lattice and per-sample
+metadata (source file identity, label, row count, min/max). Opening a store only parses the
+header and maps the arrays, so it costs the same for 5 or 500 samples, and
+the pages are shared between processes reading the same file.
+"""
+import json
+import os
+import shutil
+import struct
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+
+COHORT_STORE_SUFFIX = '.cohort'
+COHORT_STORE_VERSION = 2
+
+MAGIC = b'OTCOHORT'
+ARRAY_ALIGNMENT = 64
+
+# Row filter bits stored in the 'flags' array.
+FLAG_PRODUCTIVE = 1
+FLAG_VDJ = 2
+FLAG_VJ = 4
+
+_ARRAY_DTYPES = {
+    'log_values': np.dtype('<f8'),
+    'weights': np.dtype('<f8'),
+    'flags': np.dtype('u1'),
+    'offsets': np.dtype('<i8'),
+    'sketch_bins': np.dtype('<i4'),
+    'sketch_flags': np.dtype('u1'),
+    'sketch_weights': np.dtype('<f8'),
+    'sketch_counts': np.dtype('<f8'),
+    'sketch_offsets': np.dtype('<i8'),
+}
+
+# Arrays spooled to disk while writing, grouped by their offsets index.
+_ROW_ARRAYS = ('log_values', 'weights', 'flags')
+_SKETCH_ARRAYS = ('sketch_bins', 'sketch_flags', 'sketch_weights', 'sketch_counts')
+
+# Opened stores, keyed by path and file identity (rebuilt files reopen).
+_open_stores = {}
+
+
+def filter_flags(productive_filter=False, vdj_filter=False, vj_filter=False):
+    """FLAG_* bits a row must have to pass the requested filters."""
+    required = 0
+    if productive_filter:
+        required |= FLAG_PRODUCTIVE
+    if vdj_filter:
+        required |= FLAG_VDJ
+    if vj_filter:
+        required |= FLAG_VJ
+    return required
+
+
+def is_cohort_store(path):
+    """Check if a path is an existing cohort store file."""
+    path = Path(os.path.expanduser(str(path)))
+    if path.suffix != COHORT_STORE_SUFFIX or not path.is_file():
+        return False
+    with open(path, 'rb') as handle:
+        return handle.read(len(MAGIC)) == MAGIC
+
+
+def split_member_path(path):
+    """
+    Split a store member path ('cloud.cohort/Patient01.tsv') into parts.
+
+    Returns
+    -------
+    (store_path, member_name) or None
+        None if the path does not point into a cohort store.
+    """
+    path = Path(os.path.expanduser(str(path)))
+    if path.parent.suffix != COHORT_STORE_SUFFIX or not path.parent.is_file():
+        return None
+    return path.parent, path.name
+
+
+def _aligned(offset):
+    return (offset + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
+
+
+class CohortStore:
+    """
+    Read-only view of a cohort store file.
+
+    Use open_cohort_store() to get a cached instance.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as handle:
+            if handle.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"'{self.path}' is not a cohort store file")
+            (header_length,) = struct.unpack('<Q', handle.read(8))
+            self.header = json.loads(handle.read(header_length).decode('utf-8'))
+
+        version = self.header.get('version')
+        if version != COHORT_STORE_VERSION:
+            raise ValueError(
+                f"Cohort store '{self.path}' has format version {version}, "
+                f"expected {COHORT_STORE_VERSION}. Rebuild it with olga-build-cohort-store.py."
+            )
+
+        self.arrays = {}
+        for name, spec in self.header['arrays'].items():
+            count = int(spec['count'])
+            if count == 0:
+                self.arrays[name] = np.zeros(0, dtype=spec['dtype'])
+            else:
+                self.arrays[name] = np.memmap(
+                    self.path, dtype=spec['dtype'], mode='r',
+                    offset=int(spec['offset']), shape=(count,),
+                )
+        self.samples = self.header['samples']
+        self._index = {sample['file']: i for i, sample in enumerate(self.samples)}
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def names(self):
+        """Source file names of the samples, in store order."""
+        return [sample['file'] for sample in self.samples]
+
+    def member_paths(self):
+        """Paths addressing the samples ('<store>/<file name>')."""
+        return [self.path / name for name in self.names]
+
+    def index(self, name):
+        """Position of a sample by its source file name."""
+        try:
+            return self._index[name]
+        except KeyError:
+            raise ValueError(f"Sample '{name}' not found in cohort store '{self.path}'") from None
+
+    def rows(self, index):
+        """
+        Arrays of one sample (read-only views into the mapped file).
+
+        Returns
+        -------
+        log_values, weights, flags : np.ndarray
+        """
+        offsets = self.arrays['offsets']
+        start, stop = int(offsets[index]), int(offsets[index + 1])
+        return (
+            self.arrays['log_values'][start:stop],
+            self.arrays['weights'][start:stop],
+            self.arrays['flags'][start:stop],
+        )
+
+    def sketch(self, index):
+        """
+        Sparse canonical-lattice sketch of one sample.
+
+        Returns
+        -------
+        bins, flags, weights, counts : np.ndarray
+        """
+        offsets = self.arrays['sketch_offsets']
+        start, stop = int(offsets[index]), int(offsets[index + 1])
+        return tuple(self.arrays[name][start:stop] for name in _SKETCH_ARRAYS)
+
+
+def open_cohort_store(path):
+    """Open a cohort store, reusing an already mapped instance if unchanged."""
+    path = Path(os.path.expanduser(str(path))).resolve()
+    stat = os.stat(path)
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    store = _open_stores.get(key)
+    if store is None:
+        store = CohortStore(path)
+        _open_stores[key] = store
+    return store
+
+
+class CohortStoreWriter:
+    """
+    Write a cohort store sample by sample with bounded memory.
+
+    Row arrays are spooled to temporary files next to the output and copied
+    into place by close(), once the header (which needs the final array
+    sizes) is known.
+
+    Example
+    -------
+    >>> with CohortStoreWriter(path, header_fields) as writer:
+    ...     writer.begin_sample(metadata)
+    ...     writer.append_rows(log_values, weights, flags)
+    ...     writer.set_sketch(bins, flags, weights, counts)
+    """
+
+    def __init__(self, path, header_fields):
+        self.path = Path(path)
+        self.header_fields = dict(header_fields)
+        self.samples = []
+        self.offsets = [0]
+        self.sketch_offsets = [0]
+        self._rows_in_sample = 0
+        self._sketch_in_sample = 0
+        self._spool_dir = tempfile.mkdtemp(prefix='.cohort-', dir=self.path.parent)
+        self._spools = {
+            name: open(os.path.join(self._spool_dir, name), 'wb')
+            for name in _ROW_ARRAYS + _SKETCH_ARRAYS
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def begin_sample(self, metadata):
+        """
+        Start a new sample; `metadata` must contain a unique 'file' key.
+
+        Returns the stored metadata dict, which may be updated until close().
+        """
+        if self.samples:
+            self._finish_sample()
+        self.samples.append(dict(metadata))
+        return self.samples[-1]
+
+    def append_rows(self, log_values, weights, flags):
+        """Append rows to the current sample."""
+        for name, array in zip(_ROW_ARRAYS, (log_values, weights, flags)):
+            self._spools[name].write(np.asarray(array, dtype=_ARRAY_DTYPES[name]).tobytes())
+        self._rows_in_sample += len(log_values)
+
+    def set_sketch(self, bins, flags, weights, counts):
+        """Write the sparse sketch entries of the current sample."""
+        for name, array in zip(_SKETCH_ARRAYS, (bins, flags, weights, counts)):
+            self._spools[name].write(np.asarray(array, dtype=_ARRAY_DTYPES[name]).tobytes())
+        self._sketch_in_sample += len(bins)
+
+    def _finish_sample(self):
+        self.offsets.append(self.offsets[-1] + self._rows_in_sample)
+        self.sketch_offsets.append(self.sketch_offsets[-1] + self._sketch_in_sample)
+        self._rows_in_sample = 0
+        self._sketch_in_sample = 0
+
+    def close(self):
+        """Assemble header and arrays into the output file."""
+        if self.samples:
+            self._finish_sample()
+        for spool in self._spools.values():
+            spool.close()
+
+        n_rows = self.offsets[-1]
+        counts = {name: n_rows for name in _ROW_ARRAYS}
+        counts.update({name: self.sketch_offsets[-1] for name in _SKETCH_ARRAYS})
+        counts['offsets'] = len(self.offsets)
+        counts['sketch_offsets'] = len(self.sketch_offsets)
+        index_arrays = {'offsets': self.offsets, 'sketch_offsets': self.sketch_offsets}
+        header = dict(self.header_fields)
+        header.update({
+            'version': COHORT_STORE_VERSION,
+            'n_samples': len(self.samples),
+            'n_rows': n_rows,
+            'samples': self.samples,
+        })
+
+        # Array offsets depend on the header length, which depends on the
+        # offsets written into it; iterate until the layout is stable.
+        arrays = {}
+        header_length = 0
+        while True:
+            position = _aligned(len(MAGIC) + 8 + header_length)
+            for name, dtype in _ARRAY_DTYPES.items():
+                arrays[name] = {'dtype': dtype.str, 'count': counts[name], 'offset': position}
+                position = _aligned(position + counts[name] * dtype.itemsize)
+            header['arrays'] = arrays
+            payload = json.dumps(header, sort_keys=True).encode('utf-8')
+            if len(payload) == header_length:
+                break
+            header_length = len(payload)
+
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            with open(tmp_path, 'wb') as out:
+                out.write(MAGIC)
+                out.write(struct.pack('<Q', len(payload)))
+                out.write(payload)
+                for name in _ARRAY_DTYPES:
+                    out.write(b'\0' * (arrays[name]['offset'] - out.tell()))
+                    if name in index_arrays:
+                        out.write(np.asarray(index_arrays[name], dtype='<i8').tobytes())
+                    else:
+                        with open(os.path.join(self._spool_dir, name), 'rb') as spool:
+                            shutil.copyfileobj(spool, out, 1 << 20)
+            os.replace(tmp_path, self.path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            shutil.rmtree(self._spool_dir, ignore_errors=True)
+
+    def abort(self):
+        """Discard everything written so far."""
+        for spool in self._spools.values():
+            spool.close()
+        shutil.rmtree(self._spool_dir, ignore_errors=True)
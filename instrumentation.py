@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Stage timers, counters, peak memory and progress reporting for the scripts.
+
+Library code wraps its expensive steps in stage(name) and records counts
+with count(name, n). Stages nest: a 'filter' stage entered inside 'load'
+is reported as 'load/filter'. Recording is always on and costs two
+perf_counter calls per stage, so the numbers are available whenever a
+script is run with --profile or --metrics-json
+(see add_instrumentation_arguments and start_instrumentation).
+"""
+import atexit
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+class _Stage:
+    """Context manager timing one stage entry (see Metrics.stage)."""
+
+    __slots__ = ('metrics', 'name', 'path', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        stack = self.metrics._stack
+        self.path = f"{stack[-1]}/{self.name}" if stack else self.name
+        stack.append(self.path)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        elapsed = time.perf_counter() - self.start
+        metrics = self.metrics
+        metrics._stack.pop()
+        timer = metrics.timers.get(self.path)
+        if timer is None:
+            metrics.timers[self.path] = [elapsed, 1]
+        else:
+            timer[0] += elapsed
+            timer[1] += 1
+        return False
+
+
+class Metrics:
+    """
+    Nested stage timers and counters of one run.
+
+    Use the module-level functions stage() and count(), which record into
+    the shared `metrics` instance.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far and restart the wall clock."""
+        self.timers = {}
+        self.counters = {}
+        self._stack = []
+        self._start = time.perf_counter()
+
+    def stage(self, name):
+        """Context manager timing a (possibly nested) stage."""
+        return _Stage(self, name)
+
+    def count(self, name, n=1):
+        """Add `n` to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def wall_seconds(self):
+        """Seconds since the metrics were (re)started."""
+        return time.perf_counter() - self._start
+
+    def as_dict(self):
+        """JSON-serializable summary: wall time, peak RSS, stages and counters."""
+        return {
+            'wall_seconds': self.wall_seconds(),
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': {
+                path: {'seconds': seconds, 'calls': calls}
+                for path, (seconds, calls) in self.timers.items()
+            },
+            'counters': dict(self.counters),
+        }
+
+    def format_report(self):
+        """Human-readable table of stages (nested by indentation) and counters."""
+        wall = self.wall_seconds()
+        # Children follow their parent, siblings keep the order they first ran in
+        first_seen = {path: i for i, path in enumerate(self.timers)}
+
+        def sort_key(path):
+            parts = path.split('/')
+            return [first_seen.get('/'.join(parts[:depth + 1]), -1) for depth in range(len(parts))]
+
+        lines = [
+            "=" * 72,
+            "PROFILE",
+            "=" * 72,
+            f"{'Stage':<40} {'Calls':>8} {'Seconds':>10} {'Share':>9}",
+            "-" * 72,
+        ]
+        for path in sorted(self.timers, key=sort_key):
+            seconds, calls = self.timers[path]
+            depth = path.count('/')
+            name = "  " * depth + path.rsplit('/', 1)[-1]
+            share = 100.0 * seconds / wall if wall > 0 else 0.0
+            lines.append(f"{name:<40} {calls:>8} {seconds:>10.3f} {share:>8.1f}%")
+        lines.append("-" * 72)
+        lines.append(f"{'Wall time':<40} {'':>8} {wall:>10.3f}")
+        rss = peak_rss_mb()
+        if rss is not None:
+            lines.append(f"{'Peak RSS (MB)':<40} {'':>8} {rss:>10.1f}")
+        if self.counters:
+            lines.append("-" * 72)
+            for name, value in self.counters.items():
+                lines.append(f"{name:<40} {value:>8}")
+        lines.append("=" * 72)
+        return "\n".join(lines)
+
+
+# Shared instance used by the library code and the scripts
+metrics = Metrics()
+
+
+def stage(name):
+    """Time a stage of the current run (context manager)."""
+    return metrics.stage(name)
+
+
+def count(name, n=1):
+    """Add `n` to a counter of the current run."""
+    metrics.count(name, n)
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size in MB of this process and its waited-for children.
+
+    Returns None where the resource module is unavailable.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    scale = 1.0 if sys.platform == 'darwin' else 1024.0
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak * scale / (1024.0 * 1024.0)
+
+
+def format_seconds(seconds):
+    """Short duration: '8.2s', '4m05s', '1h02m'."""
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    if minutes < 60:
+        return f"{minutes}m{seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m"
+
+
+class Progress:
+    """
+    Throttled progress reporting with an ETA.
+
+    A line is printed for the first and the last step and otherwise at most
+    once every `interval` seconds, so long loops do not flood the output.
+
+    Example
+    -------
+    >>> progress = Progress(len(tasks), "Bootstrap")
+    >>> for task in tasks:
+    ...     run(task)
+    ...     progress.update(message="added 3 distances")
+    """
+
+    def __init__(self, total, label, interval=5.0, enabled=True, stream=None):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.enabled = enabled
+        self.stream = stream
+        self.done = 0
+        self._start = time.perf_counter()
+        self._last_report = None
+
+    def update(self, n=1, message=""):
+        """Record `n` finished steps and report if due."""
+        self.done += n
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        finished = self.done >= self.total
+        if self._last_report is not None and not finished and now - self._last_report < self.interval:
+            return
+        self._last_report = now
+
+        elapsed = now - self._start
+        line = f"{self.label} {self.done}/{self.total}"
+        if self.total:
+            line += f" ({100.0 * self.done / self.total:.0f}%)"
+        line += f", elapsed {format_seconds(elapsed)}"
+        if not finished and self.done:
+            line += f", ETA {format_seconds(elapsed / self.done * (self.total - self.done))}"
+        if message:
+            line += f"; {message}"
+        print(line, file=self.stream or sys.stdout, flush=True)
+
+
+def add_instrumentation_arguments(parser):
+    """Add --profile, --metrics-json and --cprofile to a script's parser."""
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument(
+        "--profile",
+        action="store_true",
+        dest="profile",
+        help="Print stage timings, counters and peak memory to stderr at exit",
+    )
+    group.add_argument(
+        "--metrics-json",
+        default=None,
+        dest="metrics_json",
+        help="Write stage timings, counters and peak memory to this JSON file at exit",
+    )
+    group.add_argument(
+        "--cprofile",
+        default=None,
+        dest="cprofile",
+        help="Run under cProfile and write the statistics to this file (view with: python -m pstats FILE)",
+    )
+
+
+def start_instrumentation(args):
+    """
+    Start recording a script run as requested by the instrumentation flags.
+
+    The report, JSON file and cProfile dump are written at interpreter exit,
+    so they also cover runs that end with sys.exit().
+    """
+    metrics.reset()
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.profile or args.metrics_json or profiler is not None:
+        atexit.register(_finish_instrumentation, args, profiler)
+
+
+def _finish_instrumentation(args, profiler):
+    """Write the requested reports (registered by start_instrumentation)."""
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+        print(f"cProfile statistics written to {args.cprofile}", file=sys.stderr)
+    if args.profile:
+        print(metrics.format_report(), file=sys.stderr)
+    if args.metrics_json:
+        record = metrics.as_dict()
+        record['script'] = sys.argv[0]
+        record['argv'] = sys.argv[1:]
+        with open(args.metrics_json, 'w', encoding='utf-8') as handle:
+            json.dump(record, handle, indent=2)
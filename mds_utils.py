@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""
+Multidimensional scaling helpers for the MDS plotting scripts.
+
+Provides classical (Torgerson) MDS by eigendecomposition, SMACOF
+(optionally seeded with the classical solution) and Kruskal stress, so
+that both methods can be compared on the same distance matrix, plus
+landmark MDS for embeddings that only know the distances to a few
+landmark points, and saved embeddings into which new points are projected
+from their distances to the reference points alone.
+"""
+import json
+
+import numpy as np
+
+
+MDS_METHODS = ("classical", "smacof")
+LANDMARK_SELECTIONS = ("farthest", "random")
+EMBEDDING_VERSION = 1
+
+
+def classical_mds(distances, n_components=2):
+    """
+    Classical (Torgerson) MDS of a distance matrix.
+
+    The squared distances are double-centered and the top eigenvectors of
+    the resulting Gram matrix, scaled by the square roots of their
+    eigenvalues, give the coordinates. The result is deterministic (up to
+    the sign convention fixed below).
+
+    Parameters
+    ----------
+    distances : np.ndarray
+        Symmetric (n, n) distance matrix
+    n_components : int
+        Embedding dimension
+
+    Returns
+    -------
+    coords : np.ndarray
+        (n, n_components) coordinates
+    eigenvalues : np.ndarray
+        The n_components largest eigenvalues of the centered Gram matrix
+        (negative values indicate non-Euclidean distances and are clipped
+        to zero in the coordinates)
+    """
+    from scipy.linalg import eigh
+
+    distances = np.asarray(distances, dtype=float)
+    n = distances.shape[0]
+    n_components = min(n_components, n)
+
+    squared = distances ** 2
+    row_means = squared.mean(axis=1, keepdims=True)
+    gram = -0.5 * (squared - row_means - row_means.T + squared.mean())
+
+    eigenvalues, eigenvectors = eigh(gram, subset_by_index=[n - n_components, n - 1])
+    order = np.argsort(eigenvalues)[::-1]
+    eigenvalues = eigenvalues[order]
+    eigenvectors = eigenvectors[:, order]
+
+    # Fix the sign of each axis so repeated runs give identical pictures
+    signs = np.sign(eigenvectors[np.argmax(np.abs(eigenvectors), axis=0), np.arange(n_components)])
+    signs[signs == 0] = 1
+    coords = eigenvectors * signs * np.sqrt(np.clip(eigenvalues, 0, None))
+    return coords, eigenvalues
+
+
+def kruskal_stress(distances, coords):
+    """
+    Kruskal's stress-1 of an embedding.
+
+    sqrt(sum (d_ij - ||x_i - x_j||)^2 / sum d_ij^2) over pairs i < j;
+    0 is a perfect fit, values below ~0.1 are usually considered good.
+    """
+    distances = np.asarray(distances, dtype=float)
+    i, j = np.triu_indices(distances.shape[0], k=1)
+    target = distances[i, j]
+    embedded = np.linalg.norm(coords[i] - coords[j], axis=1)
+    denominator = np.sum(target ** 2)
+    if denominator == 0:
+        return 0.0
+    return float(np.sqrt(np.sum((target - embedded) ** 2) / denominator))
+
+
+def smacof_mds(distances, n_components=2, init=None, random_state=42):
+    """
+    Metric SMACOF MDS (sklearn), from a random start or from `init`.
+
+    Returns
+    -------
+    coords : np.ndarray
+        (n, n_components) coordinates
+    """
+    from sklearn.manifold import MDS, smacof
+
+    if init is None:
+        mds = MDS(n_components=n_components, dissimilarity='precomputed', random_state=random_state)
+        return mds.fit_transform(distances)
+    coords, _ = smacof(distances, n_components=n_components, init=init, n_init=1, random_state=random_state)
+    return coords
+
+
+def fit_mds(distances, method="smacof", refine=False, n_components=2, random_state=42):
+    """
+    Embed a distance matrix with the selected MDS method.
+
+    Parameters
+    ----------
+    distances : np.ndarray
+        Symmetric (n, n) distance matrix
+    method : str
+        'classical' (eigendecomposition) or 'smacof' (iterative, random start)
+    refine : bool
+        With method='classical', refine the classical solution with SMACOF
+        seeded from it
+    n_components : int
+        Embedding dimension
+    random_state : int
+        Seed for SMACOF
+
+    Returns
+    -------
+    coords : np.ndarray
+        (n, n_components) coordinates
+    report : dict
+        'method' and Kruskal stress-1 of the final embedding ('stress');
+        for classical runs also 'classical_stress' and 'eigenvalues'
+    """
+    if method not in MDS_METHODS:
+        raise ValueError(f"Unknown MDS method '{method}'. Choose from: {', '.join(MDS_METHODS)}")
+
+    if method == "smacof":
+        coords = smacof_mds(distances, n_components=n_components, random_state=random_state)
+        return coords, {'method': 'smacof', 'stress': kruskal_stress(distances, coords)}
+
+    coords, eigenvalues = classical_mds(distances, n_components=n_components)
+    report = {
+        'method': 'classical',
+        'eigenvalues': eigenvalues,
+        'classical_stress': kruskal_stress(distances, coords),
+    }
+    if refine:
+        coords = smacof_mds(distances, n_components=n_components, init=coords, random_state=random_state)
+        report['method'] = 'classical+smacof'
+    report['stress'] = kruskal_stress(distances, coords)
+    return coords, report
+
+
+def format_mds_report(report):
+    """One-line human-readable summary of a fit_mds report."""
+    text = f"MDS method: {report['method']}, stress-1 = {report['stress']:.4f}"
+    if report['method'] == 'landmark':
+        text += f" over {report['n_landmarks']} landmarks"
+    if report['method'] == 'classical+smacof':
+        text += f" (classical: {report['classical_stress']:.4f})"
+    return text
+
+
+def select_landmarks(n_points, n_landmarks, distances_from, selection="farthest", random_state=42):
+    """
+    Choose landmark points and compute their distances to all points.
+
+    Parameters
+    ----------
+    n_points : int
+        Number of points
+    n_landmarks : int
+        Number of landmarks (capped at n_points)
+    distances_from : callable
+        distances_from(i) -> np.ndarray of the n_points distances from point i
+        to every point. Called exactly once per landmark.
+    selection : str
+        'farthest' (greedy max-min: each new landmark is the point farthest
+        from the landmarks chosen so far, starting from a random point) or
+        'random' (uniform without replacement)
+    random_state : int
+        Seed for the random choices
+
+    Returns
+    -------
+    landmarks : np.ndarray
+        Indices of the landmarks
+    landmark_distances : np.ndarray
+        (n_landmarks, n_points) distances from each landmark to all points
+    """
+    if selection not in LANDMARK_SELECTIONS:
+        raise ValueError(
+            f"Unknown landmark selection '{selection}'. Choose from: {', '.join(LANDMARK_SELECTIONS)}"
+        )
+    rng = np.random.default_rng(random_state)
+    n_landmarks = min(n_landmarks, n_points)
+
+    if selection == "random":
+        landmarks = np.sort(rng.choice(n_points, size=n_landmarks, replace=False))
+        rows = [distances_from(i) for i in landmarks]
+        return landmarks, np.vstack(rows)
+
+    landmarks = [int(rng.integers(n_points))]
+    rows = [distances_from(landmarks[0])]
+    nearest = np.array(rows[0], dtype=float)
+    nearest[landmarks[0]] = -np.inf
+    while len(landmarks) < n_landmarks:
+        candidate = int(np.argmax(nearest))
+        landmarks.append(candidate)
+        rows.append(distances_from(candidate))
+        nearest = np.minimum(nearest, rows[-1])
+        nearest[landmarks] = -np.inf
+    return np.array(landmarks), np.vstack(rows)
+
+
+def landmark_model(landmark_distances_square, n_components=2):
+    """
+    Fit classical MDS on the landmarks and keep what triangulation needs.
+
+    Parameters
+    ----------
+    landmark_distances_square : np.ndarray
+        (k, k) distances between the landmarks
+
+    Returns
+    -------
+    model : dict
+        'coords' (k, n_components) landmark coordinates, 'eigenvalues',
+        and the 'center', 'pseudo_inverse' (n_components, k) and
+        'mean_squared' (k,) used by landmark_project
+    """
+    coords, eigenvalues = classical_mds(landmark_distances_square, n_components=n_components)
+    positive = eigenvalues > 0
+    pseudo_inverse = np.zeros((len(eigenvalues), coords.shape[0]))
+    pseudo_inverse[positive] = (coords[:, positive] / eigenvalues[positive]).T
+    return {
+        'coords': coords,
+        'eigenvalues': eigenvalues,
+        'center': np.zeros(coords.shape[1]),
+        'pseudo_inverse': pseudo_inverse,
+        'mean_squared': np.mean(np.asarray(landmark_distances_square, dtype=float) ** 2, axis=1),
+    }
+
+
+def landmark_project(model, distances_to_landmarks):
+    """
+    Place points into a landmark embedding by distance-based triangulation.
+
+    Parameters
+    ----------
+    model : dict
+        Result of landmark_model or projection_model
+    distances_to_landmarks : np.ndarray
+        (m, k) or (k,) distances from each point to the k landmarks
+
+    Returns
+    -------
+    np.ndarray
+        (m, n_components) or (n_components,) coordinates; landmarks map onto
+        their own coordinates
+    """
+    squared = np.asarray(distances_to_landmarks, dtype=float) ** 2
+    return model['center'] - 0.5 * (squared - model['mean_squared']) @ model['pseudo_inverse'].T
+
+
+def projection_model(reference_distances, reference_coords):
+    """
+    Projection model for an existing embedding of reference points.
+
+    Generalizes the landmark triangulation (Gower's add-a-point formula) to
+    any embedding: a new point is placed by least squares from its squared
+    distances to the references. For a classical MDS embedding this is the
+    exact out-of-sample extension; for other embeddings (SMACOF) it is only
+    a start for stress_project.
+
+    Parameters
+    ----------
+    reference_distances : np.ndarray
+        (r, r) distances between the reference points
+    reference_coords : np.ndarray
+        (r, n_components) embedded coordinates of the reference points
+
+    Returns
+    -------
+    model : dict
+        Usable with landmark_project
+    """
+    reference_coords = np.asarray(reference_coords, dtype=float)
+    center = reference_coords.mean(axis=0)
+    return {
+        'center': center,
+        'pseudo_inverse': np.linalg.pinv(reference_coords - center),
+        'mean_squared': np.mean(np.asarray(reference_distances, dtype=float) ** 2, axis=1),
+    }
+
+
+def stress_project(model, reference_coords, distances_to_references, n_starts=3, max_iter=500, eps=1e-10):
+    """
+    Place points into a fixed embedding by minimizing their stress.
+
+    Gower's formula (landmark_project) is exact only for classical
+    embeddings. For others, e.g. SMACOF, each new point x is placed by
+    minimizing its raw stress sum_j (d_j - ||x - y_j||)^2 against the fixed
+    reference coordinates y_j, with the SMACOF (Guttman) update restricted
+    to x, which never increases the stress. The search starts from the
+    triangulated position and from the `n_starts` nearest references, and
+    keeps the lowest stress; a copy of a reference point lands on it.
+
+    Parameters
+    ----------
+    model : dict
+        Result of landmark_model or projection_model (for the start)
+    reference_coords : np.ndarray
+        (k, n_components) coordinates of the reference points
+    distances_to_references : np.ndarray
+        (m, k) or (k,) distances from each point to the k references
+
+    Returns
+    -------
+    np.ndarray
+        (m, n_components) or (n_components,) coordinates
+    """
+    reference_coords = np.asarray(reference_coords, dtype=float)
+    distances = np.asarray(distances_to_references, dtype=float)
+    single = distances.ndim == 1
+    distances = np.atleast_2d(distances)
+    triangulated = np.atleast_2d(landmark_project(model, distances))
+
+    placed = np.empty((len(distances), reference_coords.shape[1]))
+    for i, target in enumerate(distances):
+        nearest = np.argsort(target, kind='stable')[:n_starts]
+        x = np.vstack([triangulated[i], reference_coords[nearest]])
+        for _ in range(max_iter):
+            offsets = x[:, None, :] - reference_coords[None, :, :]
+            norms = np.linalg.norm(offsets, axis=2)
+            ratio = np.divide(target, norms, out=np.zeros_like(norms), where=norms > 0)
+            updated = np.mean(reference_coords[None, :, :] + ratio[:, :, None] * offsets, axis=1)
+            converged = np.max(np.abs(updated - x)) <= eps * (1.0 + np.max(np.abs(x)))
+            x = updated
+            if converged:
+                break
+        stress = np.sum((target - np.linalg.norm(x[:, None, :] - reference_coords[None, :, :], axis=2)) ** 2, axis=1)
+        placed[i] = x[np.argmin(stress)]
+    return placed[0] if single else placed
+
+
+def landmark_mds(landmarks, landmark_distances, n_components=2):
+    """
+    Landmark MDS (de Silva & Tenenbaum): embed all points from the
+    distances to a few landmarks only.
+
+    Parameters
+    ----------
+    landmarks : np.ndarray
+        Landmark indices (from select_landmarks)
+    landmark_distances : np.ndarray
+        (k, n) distances from each landmark to all points
+
+    Returns
+    -------
+    coords : np.ndarray
+        (n, n_components) coordinates
+    model : dict
+        Landmark model (see landmark_model), usable to place further points
+    report : dict
+        'method', 'n_landmarks' and 'stress' (Kruskal stress-1 over the
+        landmark-to-point distances, the only ones known)
+    """
+    model = landmark_model(landmark_distances[:, landmarks], n_components=n_components)
+    coords = landmark_project(model, landmark_distances.T)
+    embedded = np.linalg.norm(coords[landmarks][:, None, :] - coords[None, :, :], axis=2)
+    denominator = np.sum(landmark_distances ** 2)
+    stress = 0.0 if denominator == 0 else float(
+        np.sqrt(np.sum((landmark_distances - embedded) ** 2) / denominator)
+    )
+    report = {'method': 'landmark', 'n_landmarks': len(landmarks), 'stress': stress}
+    return coords, model, report
+
+
+def save_embedding(filepath, coords, model, reference_index, reference_histograms, grid, labels, kinds, metadata):
+    """
+    Save a fitted embedding with everything needed to project new points.
+
+    Parameters
+    ----------
+    filepath : str or Path
+        Output .npz file
+    coords : np.ndarray
+        (n, n_components) coordinates of all embedded points
+    model : dict
+        Projection model (landmark_model or projection_model)
+    reference_index : np.ndarray
+        Indices (into coords) of the reference points of the model
+    reference_histograms : np.ndarray
+        (r, len(grid)) discretized distributions of the reference points,
+        so that distances to them can be computed without the source files
+    grid : np.ndarray
+        Grid of the reference histograms
+    labels, kinds : list of str
+        Label and kind ('cloud', 'sample', 'barycenter') of each point
+    metadata : dict
+        JSON-serializable fit parameters (columns, filters, MDS method, ...)
+    """
+    np.savez(
+        filepath,
+        coords=coords,
+        reference_index=np.asarray(reference_index, dtype=int),
+        reference_histograms=np.asarray(reference_histograms, dtype=float),
+        grid=grid,
+        labels=np.array(labels, dtype=str),
+        kinds=np.array(kinds, dtype=str),
+        model_center=model['center'],
+        model_pseudo_inverse=model['pseudo_inverse'],
+        model_mean_squared=model['mean_squared'],
+        metadata=np.array(json.dumps(dict(metadata, version=EMBEDDING_VERSION), sort_keys=True)),
+    )
+
+
+def load_embedding(filepath):
+    """
+    Load an embedding written by save_embedding.
+
+    Returns
+    -------
+    embedding : dict
+        The saved arrays ('coords', 'reference_index', 'reference_histograms',
+        'grid'), 'labels' and 'kinds' as lists, 'model' (for landmark_project)
+        and 'metadata' (dict)
+    """
+    with np.load(filepath) as data:
+        metadata = json.loads(str(data['metadata']))
+        if metadata.get('version') != EMBEDDING_VERSION:
+            raise ValueError(
+                f"Embedding '{filepath}' has format version {metadata.get('version')}, "
+                f"expected {EMBEDDING_VERSION}"
+            )
+        return {
+            'coords': data['coords'],
+            'reference_index': data['reference_index'],
+            'reference_histograms': data['reference_histograms'],
+            'grid': data['grid'],
+            'labels': data['labels'].tolist(),
+            'kinds': data['kinds'].tolist(),
+            'model': {
+                'center': data['model_center'],
+                'pseudo_inverse': data['model_pseudo_inverse'],
+                'mean_squared': data['model_mean_squared'],
+            },
+            'metadata': metadata,
+        }
@@ -3,7 +3,8 @@
 Build a null distribution of OT distances to barycenter.
 
 Workflow:
-1) Ensure a reference barycenter exists (compute it if missing).
+1) Ensure an up-to-date reference barycenter exists (compute it if missing
+   or if its provenance does not match the current inputs).
 2) Add distances from all cloud samples to that reference barycenter.
 3) Run bootstrap iterations:
    - Build a bootstrap barycenter from resampled cloud samples.
@@ -11,6 +12,11 @@ Workflow:
      to the bootstrap barycenter.
    - Append those distances to the null distribution.
 4) Save the null distribution as a plain text file.
+
+With --leave-one-out no distance compares a sample with a barycenter built
+from it: step 2 uses the barycenter of the other cloud samples (exact 1-D
+barycenters, see leave_one_out_distances), and step 3 draws the samples
+left out of the bootstrap list (out-of-bag) instead of bootstrap samples.
 """
 
 import os
@@ -20,15 +26,30 @@ from pathlib import Path
 
 import numpy as np
 
+from instrumentation import Progress, add_instrumentation_arguments, start_instrumentation
 from ot_utils import (
-    load_distribution,
+    DISCRETIZATION_METHODS,
+    N_GRID_AUTO_TOLERANCE,
+    find_tsv_files,
+    is_sample_source,
+    sample_source_dir,
     load_barycenter,
+    barycenter_provenance,
+    check_barycenter_provenance,
+    save_barycenter,
     compute_wasserstein_distance,
-    discretize_distribution,
-    compute_lp_barycenter,
-    compute_lp_barycenter_on_grid,
+    create_common_grid,
     extend_grid_if_needed,
+    leave_one_out_distances,
+    lp_barycenter_of_histograms,
+    pad_to_extended_grid,
+    values_range,
+    n_grid_argument,
+    n_grid_selection_settings,
+    select_n_grid,
+    format_n_grid_selection,
 )
+from repertoires import REPERTOIRE_PRECISIONS, memory_budget_argument, open_repertoires, value_ranges, values_view, weights_view
 
 
 def parse_args():
@@ -36,14 +57,36 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description="Build p2b OT null distribution using cloud samples and bootstrap barycenters.",
     )
-    parser.add_argument("input_folder", help="Folder with cloud TSV files and optional barycenter file")
+    parser.add_argument("input_folder", help="Folder (or cohort store) with cloud TSV files and optional barycenter file")
     parser.add_argument("--freq-column", default="pgen", dest="freq_column")
     parser.add_argument(
         "--weights-column",
         default="duplicate_frequency_percent",
         dest="weights_column",
     )
-    parser.add_argument("--n-grid", type=int, default=200, dest="n_grid")
+    parser.add_argument(
+        "--n-grid",
+        type=n_grid_argument,
+        default=200,
+        dest="n_grid",
+        help="Grid size of the reference barycenter, or 'auto' to pick the smallest size at which "
+             "the barycenter and distances have converged on a subsample of the cloud (default: 200)",
+    )
+    parser.add_argument(
+        "--n-grid-tolerance",
+        type=float,
+        default=N_GRID_AUTO_TOLERANCE,
+        dest="n_grid_tolerance",
+        help=f"Relative change accepted as converged by --n-grid auto (default: {N_GRID_AUTO_TOLERANCE})",
+    )
+    parser.add_argument(
+        "--discretization",
+        choices=DISCRETIZATION_METHODS,
+        default="nearest",
+        dest="discretization",
+        help="Assign each value to its nearest grid bin, or split its mass linearly (in log pgen) "
+             "between the two neighbouring grid points, which needs a smaller grid (default: nearest)",
+    )
     parser.add_argument("--barycenter", default="barycenter.npz", dest="barycenter_file")
     parser.add_argument("--bootstrap-n", type=int, default=5000, dest="bootstrap_n")
     parser.add_argument(
@@ -59,15 +102,48 @@ def parse_args():
         dest="return_when_sample_samples",
         help="Sample bootstrap subset with replacement (default: without replacement)",
     )
+    parser.add_argument(
+        "--leave-one-out",
+        action="store_true",
+        dest="leave_one_out",
+        help="Measure each cloud sample against a barycenter built without it: the exact 1-D "
+             "barycenter of the other samples for the reference distances, and out-of-bag "
+             "samples for the bootstrap distances",
+    )
     parser.add_argument("--output-null", default="p2b-ot-null.txt", dest="output_null")
     parser.add_argument("--seed", type=int, default=42, dest="seed")
     parser.add_argument("--productive-filter", action="store_true", dest="productive_filter")
     parser.add_argument("--vdj-filter", action="store_true", dest="vdj_filter")
     parser.add_argument("--vj-filter", action="store_true", dest="vj_filter")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=memory_budget_argument,
+        default=None,
+        dest="memory_budget",
+        help="Keep at most this much raw repertoire data in memory, e.g. 512M or 4G; "
+             "samples beyond it are read again when needed (default: unlimited)",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=REPERTOIRE_PRECISIONS,
+        default="float32",
+        dest="precision",
+        help="Precision of the log pgen values and non-count weights held in memory (default: float32)",
+    )
+    add_instrumentation_arguments(parser)
     args = parser.parse_args()
 
-    if args.n_grid <= 1:
-        parser.error("--n-grid must be > 1")
+    if args.n_grid_tolerance <= 0:
+        parser.error("--n-grid-tolerance must be > 0")
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
     if args.bootstrap_n < 0:
         parser.error("--bootstrap-n must be >= 0")
     if args.share_samples_to_null <= 0 or args.share_samples_to_null > 1:
@@ -83,175 +159,298 @@ def _resolve_path(folder, filename):
     return folder / filename
 
 
-def _load_cloud_distributions(args, input_folder):
-    """Load cloud sample files and return immutable arrays for reuse."""
-    cloud_files = sorted(input_folder.glob("*.tsv"))
+def _open_cloud_repertoires(args, input_folder):
+    """Open lazy handles on the cloud sample files (see repertoires)."""
+    cloud_files = find_tsv_files(input_folder)
     if not cloud_files:
         raise ValueError(f"No TSV files found in {input_folder}")
 
-    values_list = []
-    weights_list = []
-    for file_path in cloud_files:
-        values, weights = load_distribution(
-            str(file_path),
-            freq_column=args.freq_column,
-            weights_column=args.weights_column,
-            productive_filter=args.productive_filter,
-            vdj_filter=args.vdj_filter,
-            vj_filter=args.vj_filter,
-        )
-        values_list.append(values)
-        weights_list.append(weights)
-
-    return cloud_files, values_list, weights_list
-
-
-def _get_reference_barycenter(barycenter_path, values_list, weights_list, n_grid):
-    """Load existing reference barycenter or compute/save if missing."""
+    repertoires = open_repertoires(
+        cloud_files,
+        memory_budget=args.memory_budget,
+        precision=args.precision,
+        freq_column=args.freq_column,
+        weights_column=args.weights_column,
+        productive_filter=args.productive_filter,
+        vdj_filter=args.vdj_filter,
+        vj_filter=args.vj_filter,
+        chunk_size=args.chunk_size,
+    )
+    return cloud_files, repertoires
+
+
+def _get_reference_barycenter(args, barycenter_path, cloud_files, repertoires):
+    """Load existing reference barycenter if up to date, else compute/save it."""
+    auto_grid = args.n_grid == 'auto'
+    load_options = dict(
+        freq_column=args.freq_column,
+        weights_column=args.weights_column,
+        productive_filter=args.productive_filter,
+        vdj_filter=args.vdj_filter,
+        vj_filter=args.vj_filter,
+        n_grid=None if auto_grid else args.n_grid,
+        solver="ot.lp.barycenter",
+        discretization=args.discretization,
+    )
     if barycenter_path.exists():
-        print(f"Using existing barycenter: {barycenter_path}")
-        return load_barycenter(str(barycenter_path))
-
-    print(f"Barycenter not found, computing: {barycenter_path}")
+        problems = check_barycenter_provenance(
+            str(barycenter_path), cloud_files,
+            n_grid_selection=n_grid_selection_settings(args.n_grid_tolerance) if auto_grid else None,
+            **load_options,
+        )
+        if not problems:
+            print(f"Using existing barycenter: {barycenter_path}")
+            return load_barycenter(str(barycenter_path))
+        print(f"Existing barycenter is stale, recomputing: {barycenter_path}")
+        for problem in problems:
+            print(f"  - {problem}")
+    else:
+        print(f"Barycenter not found, computing: {barycenter_path}")
+
+    n_grid, selection = args.n_grid, None
+    if auto_grid:
+        print("Selecting grid size (--n-grid auto):")
+        n_grid, selection = select_n_grid(
+            values_view(repertoires),
+            weights_view(repertoires),
+            tolerance=args.n_grid_tolerance,
+            discretization=args.discretization,
+        )
+        print(format_n_grid_selection(selection))
+        load_options['n_grid'] = n_grid
+    provenance = barycenter_provenance(cloud_files, n_grid_selection=selection, **load_options)
     t0 = time.perf_counter()
-    grid, barycenter = compute_lp_barycenter(values_list, weights_list, n_grid=n_grid)
+    grid = create_common_grid(value_ranges(repertoires), n_grid=n_grid, log_space=True)
+    barycenter = lp_barycenter_of_histograms(
+        grid, [repertoire.histogram(grid, args.discretization) for repertoire in repertoires]
+    )
     elapsed = time.perf_counter() - t0
     barycenter_path.parent.mkdir(parents=True, exist_ok=True)
-    np.savez(barycenter_path, grid=grid, barycenter=barycenter)
+    save_barycenter(str(barycenter_path), grid, barycenter, provenance)
     print("Reference barycenter computed and saved.")
     print(f"Reference barycenter computation time: {elapsed:.2f} s")
     return grid, barycenter
 
 
-def _distance_to_barycenter(values, weights, grid, barycenter):
-    """Compute p2b OT distance for one distribution."""
+def _discretize_cloud(repertoires, grid, barycenter, discretization="nearest"):
+    """
+    Discretize every cloud sample once on one grid covering all of them.
+
+    The barycenter grid is extended (once) to the range of the whole cloud,
+    so every distance of the run compares histograms on the same arrays.
+
+    Returns
+    -------
+    histograms : list of np.ndarray
+        Cloud samples on the extended grid
+    extended_grid : np.ndarray
+        Barycenter grid extended to the cloud range (if needed)
+    extended_barycenter : np.ndarray
+        Barycenter weights on the extended grid
+    """
     extended_grid, extended_barycenter = extend_grid_if_needed(
-        grid,
-        barycenter,
-        values.min(),
-        values.max(),
+        grid, barycenter, *values_range(value_ranges(repertoires))
     )
-    sample_discretized = discretize_distribution(values, weights, extended_grid)
+    histograms = []
+    for repertoire in repertoires:
+        # Kept on the handle for the bootstrap replicates, while the raw
+        # values are still cached
+        repertoire.histogram(grid, discretization)
+        histograms.append(repertoire.histogram(extended_grid, discretization))
+    return histograms, extended_grid, extended_barycenter
+
+
+def _distance_to_barycenter(histogram, grid, barycenter):
+    """Compute p2b OT distance for one discretized distribution."""
     return compute_wasserstein_distance(
-        extended_grid,
-        sample_discretized,
-        extended_grid,
-        extended_barycenter,
+        grid,
+        histogram,
+        grid,
+        barycenter,
         metric="log_l1",
         method="emd",
     )
 
 
-def _collect_reference_null(values_list, weights_list, ref_grid, ref_barycenter):
-    """Collect all cloud -> reference barycenter distances."""
-    return [
-        _distance_to_barycenter(values, weights, ref_grid, ref_barycenter)
-        for values, weights in zip(values_list, weights_list)
-    ]
+def _collect_reference_null(histograms, grid, barycenter, leave_one_out=False):
+    """
+    Collect all cloud -> reference barycenter distances, or with
+    `leave_one_out` each sample's distance to the barycenter of the others.
+    """
+    if leave_one_out:
+        return list(leave_one_out_distances(grid, histograms))
+    return [_distance_to_barycenter(histogram, grid, barycenter) for histogram in histograms]
 
 
 def _collect_bootstrap_null(
-    values_list,
-    weights_list,
+    repertoires,
+    histograms,
     fixed_grid,
+    extended_grid,
     bootstrap_n,
     share_samples_to_null,
     return_when_sample_samples,
     rng,
+    discretization="nearest",
+    out_of_bag=False,
 ):
     """Collect null distances from bootstrap barycenters.
 
     Bootstrap is applied only to the sample index list. Input distributions
-    themselves are fixed and reused unchanged on every iteration.
+    themselves are fixed and reused unchanged on every iteration: their
+    histograms on the fixed and on the extended grid are computed once,
+    so replicates need no raw values, and each bootstrap barycenter, solved
+    on the fixed grid, is padded onto the extended grid. With `out_of_bag`
+    the distances are drawn from the samples missing from the bootstrap
+    list (at most a share of them without replacement).
     """
-    n_samples = len(values_list)
+    fixed_histograms = [repertoire.histogram(fixed_grid, discretization) for repertoire in repertoires]
+    n_samples = len(repertoires)
     all_idx = np.arange(n_samples)
     subset_size = max(1, int(np.ceil(share_samples_to_null * n_samples)))
     distances = []
     barycenter_time_total = 0.0
+    progress = Progress(bootstrap_n, "Bootstrap")
 
     for iteration in range(bootstrap_n):
         # 1) Bootstrap sample list by indices (with replacement).
         bootstrap_idx = rng.choice(all_idx, size=n_samples, replace=True)
 
         # 2) Compute bootstrap barycenter weights on the fixed precomputed grid.
-        boot_values = [values_list[i] for i in bootstrap_idx]
-        boot_weights = [weights_list[i] for i in bootstrap_idx]
         t0 = time.perf_counter()
-        boot_barycenter = compute_lp_barycenter_on_grid(
+        boot_barycenter = lp_barycenter_of_histograms(
             fixed_grid,
-            boot_values,
-            boot_weights,
+            [fixed_histograms[i] for i in bootstrap_idx],
         )
         elapsed = time.perf_counter() - t0
         barycenter_time_total += elapsed
-
-        # 3) Select a share of bootstrap-list positions.
-        subset_pos = rng.choice(
-            np.arange(n_samples),
-            size=subset_size,
-            replace=return_when_sample_samples,
-        )
+        boot_barycenter = pad_to_extended_grid(boot_barycenter, fixed_grid, extended_grid)
+
+        # 3) Select a share of bootstrap-list positions (or of out-of-bag samples).
+        if out_of_bag:
+            candidates = np.setdiff1d(all_idx, bootstrap_idx)
+        else:
+            candidates = bootstrap_idx
+        if len(candidates) > 0:
+            subset_idx = rng.choice(
+                candidates,
+                size=subset_size if return_when_sample_samples else min(subset_size, len(candidates)),
+                replace=return_when_sample_samples,
+            )
+        else:
+            subset_idx = []
 
         # 4) Compute distances for original unchanged distributions referenced by indices.
-        for pos in subset_pos:
-            original_idx = bootstrap_idx[pos]
-            dist = _distance_to_barycenter(
-                values_list[original_idx],
-                weights_list[original_idx],
-                fixed_grid,
-                boot_barycenter,
-            )
+        for original_idx in subset_idx:
+            dist = _distance_to_barycenter(histograms[original_idx], extended_grid, boot_barycenter)
             distances.append(dist)
 
-        if (iteration + 1) % 1 == 0 or iteration == 0 or (iteration + 1) == bootstrap_n:
-            avg_time = barycenter_time_total / (iteration + 1)
-            print(
-                f"Bootstrap {iteration + 1}/{bootstrap_n}: "
-                f"added {len(distances)} distances; "
-                f"last barycenter {elapsed:.2f} s; avg {avg_time:.2f} s"
-            )
+        avg_time = barycenter_time_total / (iteration + 1)
+        progress.update(
+            message=f"added {len(distances)} distances; "
+            f"last barycenter {elapsed:.2f} s; avg {avg_time:.2f} s"
+        )
 
     return distances
 
 
+def _build_null_distribution(
+    repertoires,
+    grid,
+    barycenter,
+    bootstrap_n,
+    share_samples_to_null=0.1,
+    return_when_sample_samples=False,
+    seed=42,
+    discretization="nearest",
+    leave_one_out=False,
+):
+    """
+    Reference and bootstrap null distances of a cloud (steps 2 and 3).
+
+    The one entry point shared by main() and benchmarks/bench_ot.py, so
+    changes to the steps below keep the benchmark running.
+
+    Parameters
+    ----------
+    repertoires : list of repertoires.Repertoire
+        Handles on the cloud samples
+    grid, barycenter : np.ndarray
+        Reference barycenter and its (fixed) grid
+    bootstrap_n : int
+        Number of bootstrap iterations
+    share_samples_to_null, return_when_sample_samples, seed, discretization, leave_one_out
+        As the command-line options
+
+    Returns
+    -------
+    list of float
+        Null distances, reference distances first
+    """
+    histograms, extended_grid, extended_bary = _discretize_cloud(
+        repertoires, grid, barycenter, discretization
+    )
+    null_distances = _collect_reference_null(
+        histograms, extended_grid, extended_bary, leave_one_out=leave_one_out
+    )
+    reference = "leave-one-out barycenters" if leave_one_out else "reference barycenter"
+    print(f"Initial null size (cloud -> {reference}): {len(null_distances)}")
+
+    rng = np.random.default_rng(seed)
+    if bootstrap_n > 0:
+        extra = _collect_bootstrap_null(
+            repertoires=repertoires,
+            histograms=histograms,
+            fixed_grid=grid,
+            extended_grid=extended_grid,
+            bootstrap_n=bootstrap_n,
+            share_samples_to_null=share_samples_to_null,
+            return_when_sample_samples=return_when_sample_samples,
+            rng=rng,
+            discretization=discretization,
+            out_of_bag=leave_one_out,
+        )
+        null_distances.extend(extra)
+    return null_distances
+
+
 def main():
     args = parse_args()
+    start_instrumentation(args)
     input_folder = Path(args.input_folder).expanduser()
 
-    if not input_folder.exists() or not input_folder.is_dir():
+    if not is_sample_source(input_folder):
         print(f"Error: input folder does not exist: {input_folder}")
         raise SystemExit(1)
 
-    barycenter_path = _resolve_path(input_folder, args.barycenter_file)
-    output_path = _resolve_path(input_folder, args.output_null)
+    barycenter_path = _resolve_path(sample_source_dir(input_folder), args.barycenter_file)
+    output_path = _resolve_path(sample_source_dir(input_folder), args.output_null)
 
     print(f"Loading cloud samples from: {input_folder}")
-    cloud_files, values_list, weights_list = _load_cloud_distributions(args, input_folder)
-    print(f"Loaded {len(cloud_files)} cloud sample distribution(s)")
+    cloud_files, repertoires = _open_cloud_repertoires(args, input_folder)
+    print(f"Found {len(cloud_files)} cloud sample file(s)")
 
     ref_grid, ref_bary = _get_reference_barycenter(
+        args,
         barycenter_path,
-        values_list,
-        weights_list,
-        n_grid=args.n_grid,
+        cloud_files,
+        repertoires,
     )
 
-    null_distances = _collect_reference_null(values_list, weights_list, ref_grid, ref_bary)
-    print(f"Initial null size (cloud -> reference barycenter): {len(null_distances)}")
-
-    rng = np.random.default_rng(args.seed)
-    if args.bootstrap_n > 0:
-        extra = _collect_bootstrap_null(
-            values_list=values_list,
-            weights_list=weights_list,
-            fixed_grid=ref_grid,
-            bootstrap_n=args.bootstrap_n,
-            share_samples_to_null=args.share_samples_to_null,
-            return_when_sample_samples=args.return_when_sample_samples,
-            rng=rng,
-        )
-        null_distances.extend(extra)
+    if args.leave_one_out and len(repertoires) < 2:
+        print("Error: --leave-one-out needs at least two cloud samples")
+        raise SystemExit(1)
+    null_distances = _build_null_distribution(
+        repertoires,
+        ref_grid,
+        ref_bary,
+        bootstrap_n=args.bootstrap_n,
+        share_samples_to_null=args.share_samples_to_null,
+        return_when_sample_samples=args.return_when_sample_samples,
+        seed=args.seed,
+        discretization=args.discretization,
+        leave_one_out=args.leave_one_out,
+    )
 
     null_array = np.array(null_distances, dtype=float)
     null_array.sort()
@@ -5,123 +5,24 @@ Calculate Wasserstein barycenter of distributions from all TSV files in a folder
 
 import sys
 import os
-import glob
 import argparse
-import pandas as pd
 import numpy as np
-import ot
-
-
-def is_no_weights(value):
-    """Check if the weights column should be disabled."""
-    if isinstance(value, str):
-        return value.lower() in ["no", "off", "none", "disabled", "ones"]
-    return False
-
-
-def get_column_index(df, column_param):
-    """
-    Get column index from either a number or column name.
-    
-    Parameters:
-    -----------
-    df : DataFrame
-        The pandas DataFrame
-    column_param : str or int
-        Either a column index (string representation of number) or column name
-    
-    Returns:
-    --------
-    int: Column index
-    """
-    # Try to interpret as a number first
-    try:
-        col_idx = int(column_param)
-        if 0 <= col_idx < len(df.columns):
-            return col_idx
-    except (ValueError, TypeError):
-        pass
-    
-    # Try to find by column name
-    if column_param in df.columns:
-        return df.columns.get_loc(column_param)
-    
-    # If not found, raise an error
-    raise ValueError(f"Column '{column_param}' not found. Available columns: {list(df.columns)}")
-
-
-def load_distribution(filepath, freq_column, weights_column, productive_filter=False, vdj_filter=False, vj_filter=False):
-    """
-    Load TSV file and extract sample values and their weights.
-    
-    Parameters:
-    -----------
-    filepath : str
-        Path to the TSV file
-    freq_column : str or int
-        Column index or name for sample values
-    weights_column : str or int
-        Column index or name for weights, or "NO"/"off" to disable weights
-    productive_filter : bool
-        If True and 'productive' column exists, filter only productive sequences
-    vdj_filter : bool
-        If True, require non-empty v_call/d_call/j_call for existing columns
-    vj_filter : bool
-        If True, require non-empty v_call/j_call for existing columns
-    
-    Returns:
-    --------
-    tuple: (sample_values, weights)
-    """
-    df = pd.read_csv(filepath, sep='\t')
-    
-    # Apply productive filter if requested and column exists
-    if productive_filter and 'productive' in df.columns:
-        df = df[df['productive'] == True].copy()
-
-    # Apply VDJ filter if requested (for existing columns only)
-    if vdj_filter:
-        for vdj_col in ['v_call', 'd_call', 'j_call']:
-            if vdj_col in df.columns:
-                mask = df[vdj_col].notna() & (df[vdj_col].astype(str).str.strip() != "")
-                df = df[mask].copy()
-
-    # Apply VJ filter if requested (for existing columns only)
-    if vj_filter:
-        for vj_col in ['v_call', 'j_call']:
-            if vj_col in df.columns:
-                mask = df[vj_col].notna() & (df[vj_col].astype(str).str.strip() != "")
-                df = df[mask].copy()
-    
-    # Get sample values
-    freq_idx = get_column_index(df, freq_column)
-    sample_values = df.iloc[:, freq_idx].values.astype(float)
-
-    if len(sample_values) == 0:
-        raise ValueError(
-            f"No valid rows remaining after filtering for file '{filepath}'. "
-            "Check --productive-filter / --vdj-filter / --vj-filter or input data."
-        )
-    
-    # Check if we should use weights
-    use_weights = not is_no_weights(weights_column)
-    
-    if use_weights:
-        try:
-            weights_idx = get_column_index(df, weights_column)
-            weights = df.iloc[:, weights_idx].values.astype(float)
-        except (ValueError, IndexError) as e:
-            print(f"Warning ({os.path.basename(filepath)}): {e}. Using uniform weights.")
-            weights = np.ones(len(sample_values))
-    else:
-        weights = np.ones(len(sample_values))
-    
-    # Normalize weights
-    if weights.sum() <= 0:
-        raise ValueError(f"Weights sum to zero after filtering for file '{filepath}'.")
-    weights = weights / weights.sum()
-    
-    return sample_values, weights
+from instrumentation import add_instrumentation_arguments, count, stage, start_instrumentation
+from ot_utils import (
+    DISCRETIZATION_METHODS,
+    N_GRID_AUTO_TOLERANCE,
+    barycenter_provenance,
+    check_barycenter_provenance,
+    find_tsv_files,
+    sample_source_dir,
+    save_barycenter,
+    n_grid_argument,
+    n_grid_selection_settings,
+    select_n_grid,
+    format_n_grid_selection,
+    values_range,
+)
+from repertoires import REPERTOIRE_PRECISIONS, memory_budget_argument, open_repertoires, value_ranges, values_view, weights_view
 
 
 def parse_args():
@@ -129,22 +30,75 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description="Calculate Wasserstein barycenter of distributions from all TSV files in a folder.",
     )
-    parser.add_argument("input_folder", help="Path to folder containing TSV files")
+    parser.add_argument("input_folder", help="Path to folder (or cohort store) containing TSV files")
     parser.add_argument("--freq-column", default="pgen", dest="freq_column")
     parser.add_argument(
         "--weights-column",
         default="duplicate_frequency_percent",
         dest="weights_column",
     )
-    parser.add_argument("--n-grid", type=int, default=200, dest="n_grid")
+    parser.add_argument(
+        "--n-grid",
+        type=n_grid_argument,
+        default=200,
+        dest="n_grid",
+        help="Grid size, or 'auto' to pick the smallest size at which the barycenter "
+             "and distances have converged on a subsample of the cloud (default: 200)",
+    )
+    parser.add_argument(
+        "--n-grid-tolerance",
+        type=float,
+        default=N_GRID_AUTO_TOLERANCE,
+        dest="n_grid_tolerance",
+        help=f"Relative change accepted as converged by --n-grid auto (default: {N_GRID_AUTO_TOLERANCE})",
+    )
+    parser.add_argument(
+        "--discretization",
+        choices=DISCRETIZATION_METHODS,
+        default="nearest",
+        dest="discretization",
+        help="Assign each value to its nearest grid bin, or split its mass linearly (in log pgen) "
+             "between the two neighbouring grid points, which needs a smaller grid (default: nearest)",
+    )
     parser.add_argument("--barycenter", default="barycenter.npz", dest="barycenter_file")
     parser.add_argument("--productive-filter", action="store_true", dest="productive_filter")
     parser.add_argument("--vdj-filter", action="store_true", dest="vdj_filter")
     parser.add_argument("--vj-filter", action="store_true", dest="vj_filter")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=memory_budget_argument,
+        default=None,
+        dest="memory_budget",
+        help="Keep at most this much raw repertoire data in memory, e.g. 512M or 4G; "
+             "samples beyond it are read again when needed (default: unlimited)",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=REPERTOIRE_PRECISIONS,
+        default="float32",
+        dest="precision",
+        help="Precision of the log pgen values and non-count weights held in memory (default: float32)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        dest="force",
+        help="Recompute the barycenter even if the existing file is up to date",
+    )
+    add_instrumentation_arguments(parser)
     args = parser.parse_args()
 
-    if args.n_grid <= 1:
-        parser.error("--n-grid must be > 1")
+    if args.n_grid_tolerance <= 0:
+        parser.error("--n-grid-tolerance must be > 0")
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
 
     return args
 
@@ -152,6 +106,7 @@ def parse_args():
 def main():
     """Main function."""
     args = parse_args()
+    start_instrumentation(args)
     input_folder = args.input_folder
     freq_column = args.freq_column
     weights_column = args.weights_column
@@ -160,9 +115,13 @@ def main():
     productive_filter = args.productive_filter
     vdj_filter = args.vdj_filter
     vj_filter = args.vj_filter
+    chunk_size = args.chunk_size
+    discretization = args.discretization
+    auto_grid = n_grid == 'auto'
+    selection_settings = n_grid_selection_settings(args.n_grid_tolerance) if auto_grid else None
     
     # Find all TSV files
-    tsv_files = sorted(glob.glob(os.path.join(input_folder, "*.tsv")))
+    tsv_files = [str(f) for f in find_tsv_files(input_folder)]
     
     if not tsv_files:
         print(f"Error: No TSV files found in {input_folder}")
@@ -173,30 +132,81 @@ def main():
     print(f"Weights column: {weights_column}")
     print()
     
+    # Determine path for barycenter file
+    if os.path.isabs(barycenter_file) or barycenter_file.startswith('~'):
+        output_file = os.path.expanduser(barycenter_file)
+    else:
+        output_file = os.path.join(sample_source_dir(input_folder), barycenter_file)
+
+    # Reuse the existing barycenter if it was computed from the same inputs
+    if os.path.exists(output_file) and not args.force:
+        problems = check_barycenter_provenance(
+            output_file, tsv_files,
+            freq_column=freq_column,
+            weights_column=weights_column,
+            productive_filter=productive_filter,
+            vdj_filter=vdj_filter,
+            vj_filter=vj_filter,
+            n_grid=None if auto_grid else n_grid,
+            solver="ot.lp.barycenter",
+            n_grid_selection=selection_settings,
+            discretization=discretization,
+        )
+        if not problems:
+            print(f"Barycenter is up to date: {output_file}")
+            print("Use --force to recompute it anyway.")
+            return
+        print(f"Existing barycenter is stale and will be recomputed: {output_file}")
+        for problem in problems:
+            print(f"  - {problem}")
+        print()
+
     try:
-        # Load all distributions
-        all_values = []
-        all_weights = []
-        
-        for filepath in tsv_files:
-            filename = os.path.basename(filepath)
-            values, weights = load_distribution(filepath, freq_column, weights_column, productive_filter, vdj_filter, vj_filter)
-            all_values.append(values)
-            all_weights.append(weights)
-            print(f"  Loaded {filename}: {len(values)} samples")
+        provenance = barycenter_provenance(
+            tsv_files,
+            freq_column=freq_column,
+            weights_column=weights_column,
+            productive_filter=productive_filter,
+            vdj_filter=vdj_filter,
+            vj_filter=vj_filter,
+            n_grid=None if auto_grid else n_grid,
+            solver="ot.lp.barycenter",
+            discretization=discretization,
+        )
+
+        # Load all distributions (lazy handles: beyond --memory-budget the
+        # raw values are dropped and read again for discretization)
+        repertoires = open_repertoires(
+            tsv_files,
+            memory_budget=args.memory_budget,
+            precision=args.precision,
+            freq_column=freq_column,
+            weights_column=weights_column,
+            productive_filter=productive_filter,
+            vdj_filter=vdj_filter,
+            vj_filter=vj_filter,
+            chunk_size=chunk_size,
+        )
+        for repertoire in repertoires:
+            print(f"  Loaded {os.path.basename(repertoire.path)}: {repertoire.n_rows} samples")
         
         # Create common support grid (log scale for pgen values)
-        # Find min and max across all distributions
-        all_concatenated = np.concatenate(all_values)
-        # Filter out zero values
-        all_concatenated = all_concatenated[all_concatenated > 0]
-        
-        if len(all_concatenated) == 0:
-            print("Error: No valid (non-zero) values found in data")
-            sys.exit(1)
-        
-        min_val = all_concatenated.min()
-        max_val = all_concatenated.max()
+        # Find min and max across all distributions (load_distribution
+        # keeps positive values only)
+        min_val, max_val = values_range(value_ranges(repertoires))
+
+        if auto_grid:
+            print()
+            print("Selecting grid size (--n-grid auto):")
+            n_grid, selection = select_n_grid(
+                values_view(repertoires),
+                weights_view(repertoires),
+                tolerance=args.n_grid_tolerance,
+                discretization=discretization,
+            )
+            print(format_n_grid_selection(selection))
+            provenance['n_grid'] = n_grid
+            provenance['n_grid_selection'] = selection
         
         # Create log-spaced grid
         # Note: Grid size should be ~2-3x smaller than average number of samples
@@ -206,38 +216,19 @@ def main():
         print()
         print(f"Creating common support grid with {n_grid} points")
         print(f"  Range: [{min_val:.3e}, {max_val:.3e}]")
+        print(f"  Discretization: {discretization}")
         print()
         
-        # Discretize each distribution onto the grid
-        
-        # Discretize each distribution onto the grid
-        # Use histogram with consistent binning
+        # Discretize each distribution onto the grid (same binning as the
+        # distance scripts)
         discretized_distributions = []
-        
-        # Define bin edges for consistent histogramming
-        bin_edges = np.concatenate([[grid[0] / 2], (grid[:-1] + grid[1:]) / 2, [grid[-1] * 2]])
-        
-        for values, weights in zip(all_values, all_weights):
-            # Filter out zero values
-            mask = values > 0
-            values_filtered = values[mask]
-            weights_filtered = weights[mask]
-            
-            if len(values_filtered) == 0:
+        for repertoire in repertoires:
+            hist = repertoire.histogram(grid, discretization)
+            if hist.sum() <= 0:
                 # Use uniform if no valid values
                 hist = np.ones(len(grid)) / len(grid)
-            else:
-                # Create histogram on the grid with consistent bins
-                hist, _ = np.histogram(values_filtered, bins=bin_edges, weights=weights_filtered)
-                # Normalize to probability distribution
-                hist_sum = hist.sum()
-                if hist_sum > 0:
-                    hist = hist / hist_sum
-                else:
-                    hist = np.ones(len(grid)) / len(grid)
-            
             discretized_distributions.append(hist)
-        
+
         # Stack into a matrix (n_distributions x n_grid)
         distributions_matrix = np.array(discretized_distributions)
         
@@ -252,12 +243,15 @@ def main():
         # Use linear program barycenter (exact optimal transport solution)
         # Note: ot.bregman.barycenter() (Sinkhorn) fails with sparse discretized data,
         # returning uniform distribution. LP solver is more robust but slower.
-        barycenter = ot.lp.barycenter(
-            distributions_matrix.T,  # Transpose: columns are distributions
-            cost_matrix,
-            weights=None,  # Equal weights for all distributions
-            verbose=False
-        )
+        import ot
+        count('barycenter_calls')
+        with stage('barycenter'):
+            barycenter = ot.lp.barycenter(
+                distributions_matrix.T,  # Transpose: columns are distributions
+                cost_matrix,
+                weights=None,  # Equal weights for all distributions
+                verbose=False
+            )
         
         print(f"Barycenter computation complete")
         
@@ -279,14 +273,8 @@ def main():
             print(f"  Entropy: {entropy:.6f}")
         print("=" * 60)
         
-        # Save barycenter to file
-        # Determine path for barycenter file
-        if os.path.isabs(barycenter_file) or barycenter_file.startswith('~'):
-            output_file = os.path.expanduser(barycenter_file)
-        else:
-            output_file = os.path.join(input_folder, barycenter_file)
-        
-        np.savez(output_file, grid=grid, barycenter=barycenter)
+        # Save barycenter to file together with the description of its inputs
+        save_barycenter(output_file, grid, barycenter, provenance)
         print(f"\nBarycenter saved to: {output_file}")
         
     except FileNotFoundError as e:
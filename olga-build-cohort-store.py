@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Build a memory-mapped cohort store from all TSV files in a folder.
+
+The store can be passed to the other scripts in place of the folder.
+"""
+
+import sys
+import os
+import argparse
+from cohort_store import COHORT_STORE_SUFFIX
+from instrumentation import add_instrumentation_arguments, start_instrumentation
+from ot_utils import build_cohort_store, find_tsv_files
+
+
+def parse_args():
+    """Parse CLI arguments."""
+    parser = argparse.ArgumentParser(
+        description="Build a memory-mapped cohort store from all TSV files in a folder.",
+    )
+    parser.add_argument("input_folder", help="Path to folder containing TSV files")
+    parser.add_argument(
+        "--output",
+        default=None,
+        dest="output",
+        help=f"Store file to write (default: <input_folder>{COHORT_STORE_SUFFIX} next to the folder)",
+    )
+    parser.add_argument("--freq-column", default="pgen", dest="freq_column")
+    parser.add_argument(
+        "--weights-column",
+        default="duplicate_frequency_percent",
+        dest="weights_column",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
+
+    return args
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    start_instrumentation(args)
+    input_folder = os.path.expanduser(args.input_folder)
+
+    if not os.path.isdir(input_folder):
+        print(f"Error: Input folder does not exist: {input_folder}")
+        sys.exit(1)
+
+    tsv_files = find_tsv_files(input_folder)
+    if not tsv_files:
+        print(f"Error: No TSV files found in {input_folder}")
+        sys.exit(1)
+
+    if args.output is None:
+        output_path = os.path.normpath(input_folder) + COHORT_STORE_SUFFIX
+    else:
+        output_path = os.path.expanduser(args.output)
+    if not output_path.endswith(COHORT_STORE_SUFFIX):
+        print(f"Error: Cohort store file name must end with {COHORT_STORE_SUFFIX}: {output_path}")
+        sys.exit(1)
+
+    print(f"Found {len(tsv_files)} TSV file(s)")
+    print(f"Frequency column: {args.freq_column}")
+    print(f"Weights column: {args.weights_column}")
+    print()
+
+    try:
+        store = build_cohort_store(
+            tsv_files,
+            output_path,
+            freq_column=args.freq_column,
+            weights_column=args.weights_column,
+            chunk_size=args.chunk_size,
+        )
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    for sample in store.samples:
+        print(f"  Stored {sample['file']}: {sample['n_rows']} samples")
+    print()
+    print(f"Cohort store saved to: {output_path}")
+    print(f"  Samples: {len(store)}")
+    print(f"  Rows:    {store.header['n_rows']}")
+    print(f"  Size:    {os.path.getsize(output_path) / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
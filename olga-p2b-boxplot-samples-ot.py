@@ -9,22 +9,32 @@ import os
 import argparse
 from pathlib import Path
 import numpy as np
-import matplotlib.pyplot as plt
-from adjustText import adjust_text
+from instrumentation import add_instrumentation_arguments, stage, start_instrumentation
+from plot_utils import pyplot
+from repertoires import REPERTOIRE_PRECISIONS, load_log_distribution
 from ot_utils import (
+    DISCRETIZATION_METHODS,
     _label_from_filename,
-    load_distribution,
+    find_tsv_files,
+    input_exists,
+    is_sample_source,
+    sample_source_dir,
     load_barycenter,
+    barycenter_fingerprint,
+    check_barycenter_provenance,
     compute_wasserstein_distance,
-    discretize_distribution,
-    extend_grid_if_needed
+    distance_parameters,
+    extend_grid_for_files,
+    extend_grid_if_needed,
+    lookup_distances,
+    save_distances,
 )
 
 
 def _resolve_barycenter_path(barycenter_folder, barycenter_file):
     if os.path.isabs(barycenter_file) or barycenter_file.startswith("~"):
         return Path(os.path.expanduser(barycenter_file))
-    return barycenter_folder / barycenter_file
+    return sample_source_dir(barycenter_folder) / barycenter_file
 
 
 def _load_sample_files(samples_path):
@@ -49,10 +59,10 @@ def _load_sample_files(samples_path):
     """
     custom_labels = {}
     
-    if samples_path.is_dir():
+    if is_sample_source(samples_path):
         # samples_path is a folder - get all TSV files
-        files = sorted(samples_path.glob("*.tsv"))
-        output_folder = samples_path
+        files = find_tsv_files(samples_path)
+        output_folder = sample_source_dir(samples_path)
     elif samples_path.is_file():
         # samples_path is a file - read list of files (and optional labels)
         files = []
@@ -70,7 +80,7 @@ def _load_sample_files(samples_path):
                     custom_labels[file_path] = parts[1].strip()
         
         # Verify all files exist
-        missing = [f for f in files if not f.exists()]
+        missing = [f for f in files if not input_exists(f)]
         if missing:
             print(f"Error: The following files from list do not exist:")
             for f in missing:
@@ -84,22 +94,26 @@ def _load_sample_files(samples_path):
     return files, output_folder, custom_labels
 
 
-def _compute_distances_to_barycenter(files, grid, barycenter_weights, freq_column, weights_column, productive_filter, vdj_filter, vj_filter):
+def _compute_distances_to_barycenter(files, grid, barycenter_weights, freq_column, weights_column, productive_filter, vdj_filter, vj_filter, chunk_size=None, discretization="nearest", precision="float32"):
     distances = []
+    # One extended grid for all files, grown only by samples outside it
+    extended_grid, extended_barycenter = extend_grid_for_files(grid, barycenter_weights, files)
     for file_path in files:
-        values, weights = load_distribution(
+        distribution = load_log_distribution(
             str(file_path),
             freq_column=freq_column,
             weights_column=weights_column,
             productive_filter=productive_filter,
             vdj_filter=vdj_filter,
-            vj_filter=vj_filter
+            vj_filter=vj_filter,
+            chunk_size=chunk_size,
+            precision=precision,
         )
         extended_grid, extended_barycenter = extend_grid_if_needed(
-            grid, barycenter_weights,
-            values.min(), values.max()
+            extended_grid, extended_barycenter,
+            distribution.min, distribution.max
         )
-        sample_discretized = discretize_distribution(values, weights, extended_grid)
+        sample_discretized = distribution.histogram(extended_grid, discretization)
         distance = compute_wasserstein_distance(
             extended_grid, sample_discretized,
             extended_grid, extended_barycenter,
@@ -115,10 +129,10 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description="Map sample distributions to a barycenter and plot distances.",
     )
-    parser.add_argument("barycenter_folder", help="Folder containing TSV files and barycenter.npz")
+    parser.add_argument("barycenter_folder", help="Folder (or cohort store) containing TSV files and barycenter.npz")
     parser.add_argument(
         "samples",
-        help="Either folder with TSV files to map or text file with one TSV path per line",
+        help="Either folder (or cohort store) with TSV files to map or text file with one TSV path per line",
     )
     parser.add_argument("--freq-column", default="pgen", dest="freq_column")
     parser.add_argument(
@@ -135,12 +149,57 @@ def parse_args():
     parser.add_argument("--productive-filter", action="store_true", dest="productive_filter")
     parser.add_argument("--vdj-filter", action="store_true", dest="vdj_filter")
     parser.add_argument("--vj-filter", action="store_true", dest="vj_filter")
-    return parser.parse_args()
+    parser.add_argument(
+        "--discretization",
+        choices=DISCRETIZATION_METHODS,
+        default="nearest",
+        dest="discretization",
+        help="Assign each value to its nearest grid bin, or split its mass linearly (in log pgen) "
+             "between the two neighbouring grid points; must match the barycenter (default: nearest)",
+    )
+    parser.add_argument(
+        "--distances",
+        nargs="+",
+        default=None,
+        dest="distances_files",
+        help=(
+            "Distance files written by --save-distances (here or in olga-p2b-ot.py); "
+            "used instead of computing when they match the files and options"
+        ),
+    )
+    parser.add_argument(
+        "--save-distances",
+        default=None,
+        dest="save_distances",
+        help="Write the computed distances to this .npz file for reuse with --distances",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=REPERTOIRE_PRECISIONS,
+        default="float32",
+        dest="precision",
+        help="Precision of the log pgen values and non-count weights held in memory (default: float32)",
+    )
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
+
+    return args
 
 
 def main():
     """Main function."""
     args = parse_args()
+    start_instrumentation(args)
     barycenter_folder = Path(args.barycenter_folder)
     samples_path = Path(args.samples)
     freq_column = args.freq_column
@@ -150,6 +209,8 @@ def main():
     productive_filter = args.productive_filter
     vdj_filter = args.vdj_filter
     vj_filter = args.vj_filter
+    chunk_size = args.chunk_size
+    discretization = args.discretization
 
     try:
         barycenter_path = _resolve_barycenter_path(barycenter_folder, barycenter_file)
@@ -159,7 +220,7 @@ def main():
 
         grid, barycenter_weights = load_barycenter(str(barycenter_path))
 
-        normal_files = sorted(barycenter_folder.glob("*.tsv"))
+        normal_files = find_tsv_files(barycenter_folder)
         mapped_files, output_folder, custom_labels = _load_sample_files(samples_path)
 
         if len(normal_files) == 0:
@@ -169,26 +230,88 @@ def main():
             print(f"Error: No TSV files found for samples")
             sys.exit(1)
 
-        normal_distances = _compute_distances_to_barycenter(
+        stale = check_barycenter_provenance(
+            str(barycenter_path),
             normal_files,
-            grid,
-            barycenter_weights,
-            freq_column,
-            weights_column,
-            productive_filter,
-            vdj_filter,
-            vj_filter
+            freq_column=freq_column,
+            weights_column=weights_column,
+            productive_filter=productive_filter,
+            vdj_filter=vdj_filter,
+            vj_filter=vj_filter,
+            discretization=discretization,
         )
-        mapped_distances = _compute_distances_to_barycenter(
-            mapped_files,
-            grid,
-            barycenter_weights,
-            freq_column,
-            weights_column,
-            productive_filter,
-            vdj_filter,
-            vj_filter
+        if stale:
+            print("Warning: barycenter does not match the current cloud files or options:")
+            for problem in stale:
+                print(f"  - {problem}")
+            print("Rerun olga-barycenter-ot.py to refresh it.")
+
+        parameters = distance_parameters(
+            f"barycenter:{barycenter_fingerprint(str(barycenter_path))}",
+            freq_column=freq_column,
+            weights_column=weights_column,
+            productive_filter=productive_filter,
+            vdj_filter=vdj_filter,
+            vj_filter=vj_filter,
+            discretization=discretization,
         )
+        cached = None
+        if args.distances_files:
+            cached, problems = lookup_distances(
+                args.distances_files, normal_files + mapped_files, parameters, to_barycenter=True
+            )
+            if problems:
+                print("Warning: precomputed distances cannot be used:")
+                for problem in problems:
+                    print(f"  - {problem}")
+                print("Computing distances instead.")
+
+        if cached is not None:
+            normal_distances = cached['to_barycenter'][:len(normal_files)]
+            mapped_distances = cached['to_barycenter'][len(normal_files):]
+        else:
+            normal_distances = _compute_distances_to_barycenter(
+                normal_files,
+                grid,
+                barycenter_weights,
+                freq_column,
+                weights_column,
+                productive_filter,
+                vdj_filter,
+                vj_filter,
+                chunk_size=chunk_size,
+                discretization=discretization,
+                precision=args.precision,
+            )
+            mapped_distances = _compute_distances_to_barycenter(
+                mapped_files,
+                grid,
+                barycenter_weights,
+                freq_column,
+                weights_column,
+                productive_filter,
+                vdj_filter,
+                vj_filter,
+                chunk_size=chunk_size,
+                discretization=discretization,
+                precision=args.precision,
+            )
+
+        if args.save_distances:
+            save_distances(
+                args.save_distances,
+                normal_files + mapped_files,
+                parameters,
+                labels=(
+                    [_label_from_filename(f) for f in normal_files]
+                    + [custom_labels.get(f, _label_from_filename(f)) for f in mapped_files]
+                ),
+                to_barycenter=np.concatenate([normal_distances, mapped_distances]),
+            )
+            print(f"Distances saved to {args.save_distances}")
+
+        plt = pyplot()
+        from adjustText import adjust_text
 
         fig, ax = plt.subplots(figsize=(16, 12))
 
@@ -259,7 +382,8 @@ def main():
             output_path = output_folder / output_plot
         
         fig.tight_layout()
-        fig.savefig(output_path, dpi=150)
+        with stage('plot'):
+            fig.savefig(output_path, dpi=150)
         plt.close(fig)
 
         print(f"Saved plot to: {output_path}")
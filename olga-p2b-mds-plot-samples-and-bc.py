@@ -2,7 +2,9 @@
 """
 MDS visualization of sample distributions relative to a barycenter.
 Computes all pairwise distances between samples and barycenter,
-then visualizes them using Multidimensional Scaling (MDS).
+then visualizes them using Multidimensional Scaling (MDS). With
+--landmarks only the distances to a few landmark samples are computed,
+which scales to atlases of thousands of repertoires.
 """
 
 import sys
@@ -10,25 +12,50 @@ import os
 import argparse
 from pathlib import Path
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.path as mpath
-from sklearn.manifold import MDS
-from adjustText import adjust_text
+from instrumentation import add_instrumentation_arguments, stage, start_instrumentation
+from plot_utils import LABEL_PLACEMENTS, place_labels, pyplot
+from mds_utils import (
+    LANDMARK_SELECTIONS,
+    MDS_METHODS,
+    fit_mds,
+    format_mds_report,
+    landmark_mds,
+    landmark_project,
+    load_embedding,
+    projection_model,
+    save_embedding,
+    select_landmarks,
+    stress_project,
+)
 from ot_utils import (
+    DISCRETIZATION_METHODS,
     _label_from_filename,
     load_distribution,
+    find_tsv_files,
+    input_exists,
+    is_sample_source,
+    sample_source_dir,
     load_barycenter,
+    load_barycenter_provenance,
+    provenance_fingerprint,
+    barycenter_fingerprint,
+    check_barycenter_provenance,
     compute_wasserstein_distance,
     discretize_distribution,
-    extend_grid_if_needed
+    distance_parameters,
+    extend_grid_if_needed,
+    lookup_distances,
+    save_distances,
+    values_range,
 )
+from repertoires import REPERTOIRE_PRECISIONS, memory_budget_argument, open_repertoires, value_ranges
 
 
 def _resolve_barycenter_path(barycenter_folder, barycenter_file):
     """Resolve barycenter file path (absolute or relative to folder)."""
     if os.path.isabs(barycenter_file) or barycenter_file.startswith("~"):
         return Path(os.path.expanduser(barycenter_file))
-    return barycenter_folder / barycenter_file
+    return sample_source_dir(barycenter_folder) / barycenter_file
 
 
 def _load_sample_files(samples_path):
@@ -54,9 +81,9 @@ def _load_sample_files(samples_path):
     samples_path = Path(os.path.expanduser(str(samples_path)))
     custom_labels = {}
     
-    if samples_path.is_dir():
-        files = sorted(samples_path.glob("*.tsv"))
-        output_folder = samples_path
+    if is_sample_source(samples_path):
+        files = find_tsv_files(samples_path)
+        output_folder = sample_source_dir(samples_path)
     elif samples_path.is_file():
         files = []
         with open(samples_path, 'r') as f:
@@ -72,7 +99,7 @@ def _load_sample_files(samples_path):
                     # Custom label provided
                     custom_labels[file_path] = parts[1].strip()
         
-        missing = [f for f in files if not f.exists()]
+        missing = [f for f in files if not input_exists(f)]
         if missing:
             print(f"Error: The following files from {samples_path} do not exist:")
             for f in missing:
@@ -88,6 +115,8 @@ def _load_sample_files(samples_path):
 
 def _create_8pointed_star_marker():
     """Create an 8-pointed star marker using matplotlib Path."""
+    import matplotlib.path as mpath
+
     n_points = 8
     # Outer points
     angles_outer = np.linspace(0, 2*np.pi, n_points, endpoint=False)
@@ -112,16 +141,16 @@ def _create_8pointed_star_marker():
     return mpath.Path(vertices, codes)
 
 
-def _compute_pairwise_distances(files, grid, barycenter_weights, freq_column, weights_column, productive_filter, vdj_filter, vj_filter):
+def _discretize_samples(files, grid, barycenter_weights, freq_column, weights_column, productive_filter, vdj_filter, vj_filter, chunk_size=None, discretization="nearest", memory_budget=None, precision="float32"):
     """
-    Compute pairwise Wasserstein distances between samples.
+    Discretize all samples on a common grid, keeping only their histograms.
     
     Parameters
     ----------
     files : list of Path
         List of sample files
     grid : np.ndarray
-        Grid for discretization
+        Barycenter grid
     barycenter_weights : np.ndarray
         Barycenter weights
     freq_column : str
@@ -134,132 +163,292 @@ def _compute_pairwise_distances(files, grid, barycenter_weights, freq_column, we
         If True, require non-empty V/D/J call columns when present
     vj_filter : bool
         If True, require non-empty V/J call columns when present
+    chunk_size : int or None
+        Rows per chunk for streaming TSV reading (None reads whole files)
+    discretization : str
+        Method of discretize_distribution ('nearest' or 'linear')
+    memory_budget : int or None
+        Bytes of raw values kept in memory (see repertoires.RepertoireCache);
+        samples evicted after the range pass are read again
+    precision : str
+        Precision of the values held in memory (see repertoires.LogDistribution)
         
     Returns
     -------
-    distances : np.ndarray
-        (n_files, n_files) distance matrix
+    histograms : list of np.ndarray
+        Discretized samples on the extended grid
     extended_grid : np.ndarray
-        Extended grid (if needed)
+        Grid extended to cover all samples (if needed)
     extended_barycenter : np.ndarray
-        Extended barycenter weights
+        Barycenter weights on the extended grid
     """
-    n_files = len(files)
-    distances = np.zeros((n_files, n_files))
-    
-    # First pass: load all samples and extend grid if needed
-    all_samples = []
-    all_values = []
-    
-    for file_path in files:
-        values, weights = load_distribution(
-            str(file_path),
-            freq_column=freq_column,
-            weights_column=weights_column,
-            productive_filter=productive_filter,
-            vdj_filter=vdj_filter,
-            vj_filter=vj_filter
-        )
-        all_samples.append((values, weights))
-        all_values.append(values)
+    repertoires = open_repertoires(
+        files,
+        memory_budget=memory_budget,
+        precision=precision,
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        chunk_size=chunk_size,
+    )
     
     # Extend grid to cover all samples
     extended_grid, extended_barycenter = extend_grid_if_needed(
-        grid, barycenter_weights,
-        np.concatenate(all_values).min(),
-        np.concatenate(all_values).max()
+        grid, barycenter_weights, *values_range(value_ranges(repertoires))
     )
     
-    # Compute distances
-    for i in range(n_files):
-        for j in range(n_files):
-            values_i, weights_i = all_samples[i]
-            values_j, weights_j = all_samples[j]
-            
-            # Discretize both samples on extended grid
-            disc_i = discretize_distribution(values_i, weights_i, extended_grid)
-            disc_j = discretize_distribution(values_j, weights_j, extended_grid)
-            
-            # Compute distance
-            distance = compute_wasserstein_distance(
-                extended_grid, disc_i,
-                extended_grid, disc_j,
-                metric="log_l1",
-                method="emd"
-            )
-            distances[i, j] = distance
-    
-    return distances, extended_grid, extended_barycenter
+    histograms = [repertoire.histogram(extended_grid, discretization) for repertoire in repertoires]
+    return histograms, extended_grid, extended_barycenter
+
+
+def _distance(grid, weights_a, weights_b):
+    """Wasserstein distance between two histograms on the same grid."""
+    return compute_wasserstein_distance(
+        grid, weights_a,
+        grid, weights_b,
+        metric="log_l1",
+        method="emd"
+    )
 
 
-def _compute_distances_to_barycenter(files, grid, barycenter_weights, freq_column, weights_column, productive_filter, vdj_filter, vj_filter):
+def _compute_pairwise_distances(histograms, grid):
     """
-    Compute distances from samples to barycenter.
+    Compute pairwise Wasserstein distances between discretized samples.
     
-    Parameters
-    ----------
-    files : list of Path
-        List of sample files
-    grid : np.ndarray
-        Barycenter grid
-    barycenter_weights : np.ndarray
-        Barycenter weights
-    freq_column : str
-        Frequency column name/index
-    weights_column : str
-        Weights column name/index
-    productive_filter : bool
-        Filter only productive sequences
-    vdj_filter : bool
-        If True, require non-empty V/D/J call columns when present
-    vj_filter : bool
-        If True, require non-empty V/J call columns when present
-        
     Returns
     -------
     distances : np.ndarray
-        1D array of distances to barycenter
-    extended_grid : np.ndarray
-        Extended grid
-    extended_barycenter : np.ndarray
-        Extended barycenter
+        Symmetric (n_files, n_files) distance matrix
+    """
+    n_files = len(histograms)
+    distances = np.zeros((n_files, n_files))
+    for i in range(n_files):
+        for j in range(i + 1, n_files):
+            distances[i, j] = distances[j, i] = _distance(grid, histograms[i], histograms[j])
+    return distances
+
+
+def _compute_distances_from(index, histograms, grid):
+    """Distances from one discretized sample to all samples."""
+    return np.array([
+        0.0 if j == index else _distance(grid, histograms[index], histogram)
+        for j, histogram in enumerate(histograms)
+    ])
+
+
+def _compute_distances_to_barycenter(histograms, grid, barycenter_weights):
+    """Distances from each discretized sample to the barycenter."""
+    return np.array([_distance(grid, histogram, barycenter_weights) for histogram in histograms])
+
+
+def _plot_embedding(coords, kinds, labels, output_path, labels_cloud_samples=False, label_placement="auto", max_labels_per_region=3):
     """
-    # Load all samples first to determine grid extension
-    all_samples = []
-    all_values = []
+    Plot embedded points by kind and save the figure.
     
-    for file_path in files:
+    Parameters
+    ----------
+    coords : np.ndarray
+        (n, 2) MDS coordinates
+    kinds : list of str
+        'cloud', 'sample', 'projected' or 'barycenter' for each point
+    labels : list of str
+        Label of each point (cloud labels shown only with labels_cloud_samples)
+    output_path : str
+        Output image path
+    labels_cloud_samples : bool
+        Label the cloud (normal) samples too
+    label_placement : str
+        'auto', 'grid' or 'adjust' (see plot_utils.place_labels)
+    max_labels_per_region : int
+        Label cap per plot region for grid placement (0: no cap)
+    """
+    plt = pyplot()
+
+    fig, ax = plt.subplots(figsize=(12, 10))
+    styles = {
+        # Barycenter files (light green #90EE90)
+        'cloud': dict(c='#90EE90', s=100, alpha=.7, edgecolors='#0B5D1E', linewidth=2, zorder=4),
+        # Samples (orange #F28E2B with labels)
+        'sample': dict(c='#F28E2B', s=150, alpha=0.8, edgecolors='black', linewidth=1.5, zorder=3),
+        # Samples projected into a saved embedding (blue #4E79A7)
+        'projected': dict(c='#4E79A7', s=150, alpha=0.8, edgecolors='black', linewidth=1.5, zorder=3),
+    }
+    kinds = np.asarray(kinds)
+    for kind, style in styles.items():
+        mask = kinds == kind
+        if mask.any():
+            ax.scatter(coords[mask, 0], coords[mask, 1], **style)
+
+    # Plot barycenter center (light green with 8-pointed star)
+    star_marker = _create_8pointed_star_marker()
+    is_barycenter = kinds == 'barycenter'
+    if is_barycenter.any():
+        ax.scatter(
+            coords[is_barycenter, 0], coords[is_barycenter, 1],
+            c='#90EE90', s=600, alpha=0.9, marker=star_marker,
+            edgecolors='#0B5D1E', linewidth=2,
+            zorder=5
+        )
+
+    # Labels and title
+    ax.set_xlabel('MDS Dimension 1', fontsize=12, fontweight='bold')
+    ax.set_ylabel('MDS Dimension 2', fontsize=12, fontweight='bold')
+    ax.set_title('MDS: Sample Distributions vs Barycenter', fontsize=14, fontweight='bold')
+    ax.grid(True, alpha=0.3, linestyle='--')
+
+    # Legend
+    from matplotlib.patches import Patch
+    legend_elements = [
+        Patch(facecolor='#90EE90', edgecolor='#0B5D1E', label='Normal samples', linewidth=1.5),
+        Patch(facecolor='#F28E2B', edgecolor='black', label='Mapped samples', linewidth=1.5),
+    ]
+    if 'projected' in kinds:
+        legend_elements.append(
+            Patch(facecolor='#4E79A7', edgecolor='black', label='Projected samples', linewidth=1.5)
+        )
+    ax.legend(handles=legend_elements, loc='best', fontsize=11)
+    plt.tight_layout()
+
+    # Label samples first, then the points farthest from the barycenter
+    labeled = (kinds == 'sample') | (kinds == 'projected')
+    if labels_cloud_samples:
+        labeled |= kinds == 'cloud'
+    center = coords[is_barycenter, :2].mean(axis=0) if is_barycenter.any() else coords[:, :2].mean(axis=0)
+    distance = np.linalg.norm(coords[:, :2] - center, axis=1)
+    priority = distance + np.where(kinds == 'cloud', 0.0, distance.max() + 1.0)
+    _, n_skipped = place_labels(
+        ax,
+        coords[labeled, 0], coords[labeled, 1],
+        [label for label, keep in zip(labels, labeled) if keep],
+        priority=priority[labeled],
+        method=label_placement,
+        max_per_region=max_labels_per_region or None,
+        fontsize=9, label_offset=0.04, fontweight='bold', color='#000000', zorder=4,
+    )
+    if n_skipped:
+        print(f"  {n_skipped} labels skipped (overlapping, or over --max-labels-per-region)")
+
+    # Create output directory if needed
+    output_dir = os.path.dirname(output_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    # Save plot
+    plt.savefig(output_path, dpi=300, bbox_inches='tight')
+    print(f"Plot saved to {output_path}")
+    plt.close()
+
+
+def _resolve_output_path(output_plot, output_folder):
+    """Resolve the plot path (absolute, or relative to the output folder)."""
+    if os.path.isabs(output_plot) or os.path.dirname(output_plot):
+        return os.path.expanduser(output_plot)
+    return os.path.join(output_folder, output_plot)
+
+
+_EMBEDDING_OPTIONS = ('freq_column', 'weights_column', 'productive_filter', 'vdj_filter', 'vj_filter', 'discretization')
+
+# Value of options missing from embeddings saved before they existed
+_EMBEDDING_DEFAULTS = {'discretization': 'nearest'}
+
+
+def _embedding_metadata(args, barycenter_path, mds_report):
+    """Fit parameters stored with a saved embedding."""
+    provenance = load_barycenter_provenance(str(barycenter_path))
+    metadata = {option: getattr(args, option) for option in _EMBEDDING_OPTIONS}
+    metadata.update({
+        'barycenter': str(barycenter_path),
+        'barycenter_fingerprint': provenance_fingerprint(provenance) if provenance else None,
+        'mds_method': mds_report['method'],
+        'stress': mds_report['stress'],
+        'landmarks': args.landmarks,
+        'landmark_selection': args.landmark_selection if args.landmarks is not None else None,
+    })
+    return metadata
+
+
+def _project_into_embedding(embedding_path, samples_path, args):
+    """
+    Place new samples into a saved embedding and plot them with it.
+
+    Only the distances from each new sample to the reference points of the
+    embedding are computed; the saved coordinates are not refitted. Gower's
+    formula places the samples exactly in classical and landmark embeddings;
+    in the others (SMACOF) the samples are placed by minimizing their stress
+    against the reference coordinates.
+    """
+    if not embedding_path.exists():
+        print(f"Error: Embedding file not found: {embedding_path}")
+        print("Run olga-p2b-mds-plot-samples-and-bc.py with --save-embedding first.")
+        sys.exit(1)
+
+    try:
+        embedding = load_embedding(str(embedding_path))
+    except (ValueError, KeyError) as e:
+        print(f"Error loading embedding: {e}")
+        sys.exit(1)
+
+    metadata = embedding['metadata']
+    mismatches = [
+        f"{option}: embedding {metadata.get(option, _EMBEDDING_DEFAULTS.get(option))!r}, now {getattr(args, option)!r}"
+        for option in _EMBEDDING_OPTIONS
+        if metadata.get(option, _EMBEDDING_DEFAULTS.get(option)) != getattr(args, option)
+    ]
+    if mismatches:
+        print("Warning: options differ from those the embedding was fitted with:")
+        for problem in mismatches:
+            print(f"  - {problem}")
+
+    samples_files, output_folder, custom_labels = _load_sample_files(samples_path)
+    if not samples_files:
+        print("Error: No sample TSV files found")
+        sys.exit(1)
+
+    grid = embedding['grid']
+    references = embedding['reference_histograms']
+    print(
+        f"Projecting {len(samples_files)} sample files into {embedding_path} "
+        f"({metadata['mds_method']}, {len(references)} reference points)"
+    )
+
+    reference_coords = embedding['coords'][embedding['reference_index']]
+    exact_triangulation = metadata['mds_method'] in ('classical', 'landmark')
+
+    projected = []
+    for file_path in samples_files:
         values, weights = load_distribution(
             str(file_path),
-            freq_column=freq_column,
-            weights_column=weights_column,
-            productive_filter=productive_filter,
-            vdj_filter=vdj_filter,
-            vj_filter=vj_filter
+            freq_column=args.freq_column,
+            weights_column=args.weights_column,
+            productive_filter=args.productive_filter,
+            vdj_filter=args.vdj_filter,
+            vj_filter=args.vj_filter,
+            chunk_size=args.chunk_size,
         )
-        all_samples.append((values, weights))
-        all_values.append(values)
-    
-    # Extend grid
-    extended_grid, extended_barycenter = extend_grid_if_needed(
-        grid, barycenter_weights,
-        np.concatenate(all_values).min(),
-        np.concatenate(all_values).max()
+        if values.min() < grid[0] or values.max() > grid[-1]:
+            print(f"  Warning: {file_path.name} extends beyond the embedding grid; its tails are clipped to the grid ends")
+        histogram = discretize_distribution(values, weights, grid, method=args.discretization)
+        distances = np.array([_distance(grid, histogram, reference) for reference in references])
+        if exact_triangulation:
+            projected.append(landmark_project(embedding['model'], distances))
+        else:
+            projected.append(stress_project(embedding['model'], reference_coords, distances))
+
+    labels = [custom_labels.get(f, _label_from_filename(f)) for f in samples_files]
+    for label, (x, y) in zip(labels, projected):
+        print(f"  {label:<12} ({x:.4f}, {y:.4f})")
+
+    _plot_embedding(
+        np.vstack([embedding['coords']] + projected),
+        embedding['kinds'] + ['projected'] * len(samples_files),
+        embedding['labels'] + labels,
+        _resolve_output_path(args.output_plot, output_folder),
+        labels_cloud_samples=args.labels_cloud_samples,
+        label_placement=args.label_placement,
+        max_labels_per_region=args.max_labels_per_region,
     )
-    
-    # Compute distances to barycenter
-    distances = []
-    for values, weights in all_samples:
-        sample_discretized = discretize_distribution(values, weights, extended_grid)
-        distance = compute_wasserstein_distance(
-            extended_grid, sample_discretized,
-            extended_grid, extended_barycenter,
-            metric="log_l1",
-            method="emd"
-        )
-        distances.append(distance)
-    
-    return np.array(distances), extended_grid, extended_barycenter
 
 
 def parse_args():
@@ -267,10 +456,10 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description="MDS visualization of sample distributions relative to a barycenter.",
     )
-    parser.add_argument("barycenter_folder", help="Folder containing TSV files and barycenter.npz")
+    parser.add_argument("barycenter_folder", help="Folder (or cohort store) containing TSV files and barycenter.npz")
     parser.add_argument(
         "samples",
-        help="Either folder with TSV files to map or text file with one TSV file path per line",
+        help="Either folder (or cohort store) with TSV files to map or text file with one TSV file path per line",
     )
     parser.add_argument("--freq-column", default="pgen", dest="freq_column")
     parser.add_argument(
@@ -281,15 +470,145 @@ def parse_args():
     parser.add_argument("--barycenter", default="barycenter.npz", dest="barycenter_file")
     parser.add_argument("--output-plot", default="ot-mds-plot.png", dest="output_plot")
     parser.add_argument("--label-cloud-samples", action="store_true", dest="labels_cloud_samples")
+    parser.add_argument(
+        "--label-placement",
+        choices=LABEL_PLACEMENTS,
+        default="auto",
+        dest="label_placement",
+        help="Label layout: adjust (adjustText, small plots), grid (fast, capped per region) or auto (default)",
+    )
+    parser.add_argument(
+        "--max-labels-per-region",
+        type=int,
+        default=3,
+        dest="max_labels_per_region",
+        help="With grid placement, label at most this many points per plot region (default: 3; 0 = no cap)",
+    )
+    parser.add_argument(
+        "--mds-method",
+        choices=MDS_METHODS,
+        default="smacof",
+        dest="mds_method",
+        help="MDS algorithm: classical (eigendecomposition, fast, deterministic) or smacof (iterative; default)",
+    )
+    parser.add_argument(
+        "--smacof-refine",
+        action="store_true",
+        dest="smacof_refine",
+        help="With --mds-method classical, refine the classical embedding with SMACOF seeded from it",
+    )
+    parser.add_argument(
+        "--landmarks",
+        type=int,
+        default=None,
+        dest="landmarks",
+        help=(
+            "Landmark MDS: compute distances only to this many landmark samples and "
+            "triangulate the rest (default: full pairwise MDS)"
+        ),
+    )
+    parser.add_argument(
+        "--landmark-selection",
+        choices=LANDMARK_SELECTIONS,
+        default="farthest",
+        dest="landmark_selection",
+        help="How landmarks are chosen: farthest-point (default) or random",
+    )
+    parser.add_argument(
+        "--embedding",
+        default="mds-embedding.npz",
+        dest="embedding_file",
+        help="Saved embedding file, absolute or relative to the barycenter folder (default: mds-embedding.npz)",
+    )
+    parser.add_argument(
+        "--save-embedding",
+        action="store_true",
+        dest="save_embedding",
+        help="Save the fitted embedding (coordinates, reference distributions, fit parameters) to --embedding",
+    )
+    parser.add_argument(
+        "--project",
+        action="store_true",
+        dest="project",
+        help="Place the samples into the saved --embedding from their distances to its reference points, without refitting",
+    )
+    parser.add_argument(
+        "--distances",
+        nargs="+",
+        default=None,
+        dest="distances_files",
+        help=(
+            "Distance files written by --save-distances; used instead of computing "
+            "when they match the files, barycenter and options"
+        ),
+    )
+    parser.add_argument(
+        "--save-distances",
+        default=None,
+        dest="save_distances",
+        help="Write the sample-sample and sample-barycenter distances to this .npz file for reuse with --distances",
+    )
     parser.add_argument("--productive-filter", action="store_true", dest="productive_filter")
     parser.add_argument("--vdj-filter", action="store_true", dest="vdj_filter")
     parser.add_argument("--vj-filter", action="store_true", dest="vj_filter")
-    return parser.parse_args()
+    parser.add_argument(
+        "--discretization",
+        choices=DISCRETIZATION_METHODS,
+        default="nearest",
+        dest="discretization",
+        help="Assign each value to its nearest grid bin, or split its mass linearly (in log pgen) "
+             "between the two neighbouring grid points; must match the barycenter (default: nearest)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=memory_budget_argument,
+        default=None,
+        dest="memory_budget",
+        help="Keep at most this much raw repertoire data in memory, e.g. 512M or 4G; "
+             "samples beyond it are read again when needed (default: unlimited)",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=REPERTOIRE_PRECISIONS,
+        default="float32",
+        dest="precision",
+        help="Precision of the log pgen values and non-count weights held in memory (default: float32)",
+    )
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
+    if args.smacof_refine and args.mds_method != "classical":
+        parser.error("--smacof-refine requires --mds-method classical")
+    if args.landmarks is not None:
+        if args.landmarks < 3:
+            parser.error("--landmarks must be >= 3")
+        if args.smacof_refine:
+            parser.error("--smacof-refine cannot be combined with --landmarks")
+    if args.max_labels_per_region < 0:
+        parser.error("--max-labels-per-region must be >= 0")
+    if args.save_embedding and args.project:
+        parser.error("--save-embedding and --project are mutually exclusive")
+    if args.project and (args.distances_files or args.save_distances):
+        parser.error("--distances and --save-distances cannot be combined with --project")
+    if args.save_distances and args.landmarks is not None:
+        parser.error("--save-distances needs the full distance matrix and cannot be combined with --landmarks")
+
+    return args
 
 
 def main():
     """Main function."""
     args = parse_args()
+    start_instrumentation(args)
     barycenter_folder = Path(args.barycenter_folder)
     samples_path = Path(args.samples)
     freq_column = args.freq_column
@@ -300,6 +619,13 @@ def main():
     productive_filter = args.productive_filter
     vdj_filter = args.vdj_filter
     vj_filter = args.vj_filter
+    chunk_size = args.chunk_size
+    discretization = args.discretization
+    embedding_path = _resolve_barycenter_path(barycenter_folder, args.embedding_file)
+
+    if args.project:
+        _project_into_embedding(embedding_path, samples_path, args)
+        return
 
     # Load barycenter
     barycenter_path = _resolve_barycenter_path(barycenter_folder, barycenter_file)
@@ -307,7 +633,7 @@ def main():
     grid, barycenter_weights = load_barycenter(str(barycenter_path))
 
     # Get TSV files
-    barycenter_files = sorted(barycenter_folder.glob("*.tsv"))
+    barycenter_files = find_tsv_files(barycenter_folder)
     samples_files, output_folder, custom_labels = _load_sample_files(samples_path)
 
     if not barycenter_files:
@@ -319,129 +645,149 @@ def main():
 
     print(f"Found {len(barycenter_files)} barycenter files, {len(samples_files)} sample files")
 
-    # Combine all files for distance computation
-    all_files = barycenter_files + samples_files
-    all_distances, extended_grid, extended_barycenter = _compute_pairwise_distances(
-        all_files, grid, barycenter_weights,
-        freq_column, weights_column, productive_filter, vdj_filter, vj_filter
+    stale = check_barycenter_provenance(
+        str(barycenter_path),
+        barycenter_files,
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        discretization=discretization,
     )
+    if stale:
+        print("Warning: barycenter does not match the current cloud files or options:")
+        for problem in stale:
+            print(f"  - {problem}")
+        print("Rerun olga-barycenter-ot.py to refresh it.")
 
-    # Add barycenter as a point (distance 0 to itself)
+    # Combine all files for distance computation
+    all_files = barycenter_files + samples_files
     n_barycenter = len(barycenter_files)
     n_samples = len(samples_files)
-    n_total = n_barycenter + n_samples + 1  # +1 for barycenter center point
-
-    # Create full distance matrix including barycenter
-    full_distances = np.zeros((n_total, n_total))
-    full_distances[:n_barycenter + n_samples, :n_barycenter + n_samples] = all_distances
-
-    # Distances to barycenter center point
-    barycenter_dists, _, _ = _compute_distances_to_barycenter(
-        all_files, extended_grid, extended_barycenter,
-        freq_column, weights_column, productive_filter, vdj_filter, vj_filter
+    n_files = n_barycenter + n_samples
+
+    parameters = distance_parameters(
+        f"barycenter:{barycenter_fingerprint(str(barycenter_path))}",
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        discretization=discretization,
     )
-    full_distances[n_barycenter + n_samples, :n_barycenter + n_samples] = barycenter_dists
-    full_distances[:n_barycenter + n_samples, n_barycenter + n_samples] = barycenter_dists
-
-    # Apply MDS
-    print("Computing MDS...")
-    mds = MDS(n_components=2, dissimilarity='precomputed', random_state=42)
-    mds_coords = mds.fit_transform(full_distances)
-
-    # Create plot
-    fig, ax = plt.subplots(figsize=(12, 10))
+    cached = None
+    if args.distances_files:
+        cached, problems = lookup_distances(
+            args.distances_files, all_files, parameters, to_barycenter=True, pairwise=True
+        )
+        if problems:
+            print("Warning: precomputed distances cannot be used:")
+            for problem in problems:
+                print(f"  - {problem}")
+            print("Computing distances instead.")
+        else:
+            print(f"Using precomputed distances from {', '.join(args.distances_files)}")
+
+    # The histograms are needed to compute distances, and are stored with a saved embedding
+    if cached is None or args.save_embedding:
+        histograms, extended_grid, extended_barycenter = _discretize_samples(
+            all_files, grid, barycenter_weights,
+            freq_column, weights_column, productive_filter, vdj_filter, vj_filter,
+            chunk_size=chunk_size,
+            discretization=discretization,
+            memory_budget=args.memory_budget,
+            precision=args.precision,
+        )
 
-    # Plot barycenter files (light green #90EE90)
-    texts = []
-    for i in range(n_barycenter):
-        x, y = mds_coords[i, 0], mds_coords[i, 1]
-        ax.scatter(
-            x, y,
-            c='#90EE90', s=100, alpha=.7, edgecolors='#0B5D1E', linewidth=2,
-            zorder=4
+    if args.landmarks is not None:
+        # Landmark MDS: n x k sample distances, barycenter triangulated
+        # from its distances to the landmarks like any other point
+        print(f"Computing distances to {min(args.landmarks, n_files)} landmarks ({args.landmark_selection})...")
+        if cached is not None:
+            distances_from = lambda index: cached['pairwise'][index]
+        else:
+            distances_from = lambda index: _compute_distances_from(index, histograms, extended_grid)
+        landmarks, landmark_distances = select_landmarks(
+            n_files, args.landmarks,
+            distances_from,
+            selection=args.landmark_selection,
         )
-        if labels_cloud_samples:
-            label = _label_from_filename(barycenter_files[i])
-            txt = ax.text(
-                x, y + 0.04,
-                label,
-                ha='center', va='bottom',
-                fontsize=9, fontweight='bold',
-                color='#000000',
-                zorder=4
+        print("Computing MDS...")
+        with stage('mds'):
+            sample_coords, landmark_fit, mds_report = landmark_mds(landmarks, landmark_distances)
+        if cached is not None:
+            barycenter_to_landmarks = cached['to_barycenter'][landmarks]
+        else:
+            barycenter_to_landmarks = _compute_distances_to_barycenter(
+                [histograms[i] for i in landmarks], extended_grid, extended_barycenter
             )
-            texts.append(txt)
+        mds_coords = np.vstack([sample_coords, landmark_project(landmark_fit, barycenter_to_landmarks)])
+    else:
+        # Full distance matrix with the barycenter as the last point
+        full_distances = np.zeros((n_files + 1, n_files + 1))
+        if cached is not None:
+            full_distances[:n_files, :n_files] = cached['pairwise']
+            barycenter_dists = cached['to_barycenter']
+        else:
+            full_distances[:n_files, :n_files] = _compute_pairwise_distances(histograms, extended_grid)
+            barycenter_dists = _compute_distances_to_barycenter(histograms, extended_grid, extended_barycenter)
+        full_distances[n_files, :n_files] = barycenter_dists
+        full_distances[:n_files, n_files] = barycenter_dists
+
+        print("Computing MDS...")
+        with stage('mds'):
+            mds_coords, mds_report = fit_mds(full_distances, method=args.mds_method, refine=args.smacof_refine)
+    print(f"  {format_mds_report(mds_report)}")
+
+    kinds = ['cloud'] * n_barycenter + ['sample'] * n_samples + ['barycenter']
+    labels = (
+        [_label_from_filename(f) for f in barycenter_files]
+        + [custom_labels.get(f, _label_from_filename(f)) for f in samples_files]
+        + ['barycenter']
+    )
 
-    # Plot samples (orange #F28E2B with labels)
-    for i in range(n_samples):
-        file_idx = n_barycenter + i
-        x, y = mds_coords[file_idx, 0], mds_coords[file_idx, 1]
-        ax.scatter(
-            x, y,
-            c='#F28E2B', s=150, alpha=0.8, edgecolors='black', linewidth=1.5,
-            zorder=3
+    if args.save_distances:
+        save_distances(
+            args.save_distances,
+            all_files,
+            parameters,
+            labels=labels[:n_files],
+            to_barycenter=barycenter_dists,
+            pairwise=full_distances[:n_files, :n_files],
         )
-        # Add label - use custom if provided, otherwise auto-generate
-        label = custom_labels.get(samples_files[i], _label_from_filename(samples_files[i]))
-        txt = ax.text(
-            x, y + 0.04,
-            label,
-            ha='center', va='bottom',
-            fontsize=9, fontweight='bold',
-            color='#000000',
-            zorder=4
+        print(f"Distances saved to {args.save_distances}")
+
+    if args.save_embedding:
+        if args.landmarks is not None:
+            projection = landmark_fit
+            reference_index = landmarks
+        else:
+            # Every embedded point, barycenter included, is a reference
+            projection = projection_model(full_distances, mds_coords)
+            reference_index = np.arange(n_files + 1)
+        point_histograms = histograms + [extended_barycenter]
+        save_embedding(
+            embedding_path,
+            mds_coords,
+            projection,
+            reference_index,
+            [point_histograms[i] for i in reference_index],
+            extended_grid,
+            labels,
+            kinds,
+            _embedding_metadata(args, barycenter_path, mds_report),
+        )
+        print(f"Embedding saved to {embedding_path} ({len(reference_index)} reference points)")
+
+    with stage('plot'):
+        _plot_embedding(
+            mds_coords, kinds, labels,
+            _resolve_output_path(output_plot, output_folder),
+            labels_cloud_samples=labels_cloud_samples,
+            label_placement=args.label_placement,
+            max_labels_per_region=args.max_labels_per_region,
         )
-        texts.append(txt)
-
-    # Move labels only (no arrows/boxes) to avoid overlaps
-    adjust_text(
-        texts,
-        expand_points=(1.2, 1.2),
-        expand_text=(1.1, 1.1),
-        force_points=0.2,
-        force_text=0.3
-    )
-
-    # Plot barycenter center (light green with 8-pointed star)
-    barycenter_idx = n_barycenter + n_samples
-    star_marker = _create_8pointed_star_marker()
-    ax.scatter(
-        mds_coords[barycenter_idx, 0], mds_coords[barycenter_idx, 1],
-        c='#90EE90', s=600, alpha=0.9, marker=star_marker,
-        edgecolors='#0B5D1E', linewidth=2,
-        zorder=5
-    )
-
-    # Labels and title
-    ax.set_xlabel('MDS Dimension 1', fontsize=12, fontweight='bold')
-    ax.set_ylabel('MDS Dimension 2', fontsize=12, fontweight='bold')
-    ax.set_title('MDS: Sample Distributions vs Barycenter', fontsize=14, fontweight='bold')
-    ax.grid(True, alpha=0.3, linestyle='--')
-
-    # Legend
-    from matplotlib.patches import Patch
-    legend_elements = [
-        Patch(facecolor='#90EE90', edgecolor='#0B5D1E', label='Normal samples', linewidth=1.5),
-        Patch(facecolor='#F28E2B', edgecolor='black', label='Mapped samples', linewidth=1.5),
-    ]
-    ax.legend(handles=legend_elements, loc='best', fontsize=11)
-
-    # Determine output path
-    if os.path.isabs(output_plot) or os.path.dirname(output_plot):
-        output_path = os.path.expanduser(output_plot)
-    else:
-        output_path = os.path.join(output_folder, output_plot)
-
-    # Create output directory if needed
-    output_dir = os.path.dirname(output_path)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
-
-    # Save plot
-    plt.tight_layout()
-    plt.savefig(output_path, dpi=300, bbox_inches='tight')
-    print(f"Plot saved to {output_path}")
-    plt.close()
 
 
 if __name__ == "__main__":
@@ -6,6 +6,10 @@ Compare OT distances to barycenter between two groups:
 
 Reports descriptive statistics for both groups and a one-sided
 Wilcoxon rank-sum (Mann-Whitney U) p-value testing cloud < sample.
+
+With --leave-one-out, each cloud file (and each sample that is also a
+cloud file) is compared with the barycenter of the other cloud files
+instead of a barycenter that includes itself.
 """
 
 import os
@@ -14,19 +18,27 @@ import argparse
 import numpy as np
 from pathlib import Path
 
-try:
-    from scipy.stats import mannwhitneyu
-except ImportError:
-    print("Error: scipy is required. Install with: pip install scipy")
-    sys.exit(1)
-
+from instrumentation import add_instrumentation_arguments, stage, start_instrumentation
+from repertoires import REPERTOIRE_PRECISIONS, load_log_distribution
 from ot_utils import (
+    DISCRETIZATION_METHODS,
     _label_from_filename,
-    load_distribution,
+    find_tsv_files,
+    input_exists,
+    is_sample_source,
+    sample_source_dir,
     load_barycenter,
+    barycenter_fingerprint,
+    check_barycenter_provenance,
     compute_wasserstein_distance,
-    discretize_distribution,
+    distance_parameters,
+    extend_grid_for_files,
     extend_grid_if_needed,
+    leave_one_out_distances,
+    lookup_distances,
+    member_positions,
+    pad_to_extended_grid,
+    save_distances,
 )
 
 
@@ -34,7 +46,7 @@ def _resolve_barycenter_path(barycenter_folder, barycenter_file):
     """Resolve barycenter file path (absolute or relative to folder)."""
     if os.path.isabs(barycenter_file) or barycenter_file.startswith("~"):
         return Path(os.path.expanduser(barycenter_file))
-    return barycenter_folder / barycenter_file
+    return sample_source_dir(barycenter_folder) / barycenter_file
 
 
 def _load_sample_files(samples_path):
@@ -42,8 +54,8 @@ def _load_sample_files(samples_path):
     samples_path = Path(os.path.expanduser(str(samples_path)))
     custom_labels = {}
 
-    if samples_path.is_dir():
-        files = sorted(samples_path.glob("*.tsv"))
+    if is_sample_source(samples_path):
+        files = find_tsv_files(samples_path)
     elif samples_path.is_file():
         files = []
         with open(samples_path, "r", encoding="utf-8") as handle:
@@ -57,7 +69,7 @@ def _load_sample_files(samples_path):
                 if len(parts) > 1:
                     custom_labels[file_path] = parts[1].strip()
 
-        missing = [f for f in files if not f.exists()]
+        missing = [f for f in files if not input_exists(f)]
         if missing:
             print(f"Error: The following files from {samples_path} do not exist:")
             for missing_file in missing:
@@ -72,7 +84,7 @@ def _load_sample_files(samples_path):
 
 def _load_cloud_files(barycenter_folder):
     """Load cloud files from barycenter folder (all TSV files)."""
-    files = sorted(barycenter_folder.glob("*.tsv"))
+    files = find_tsv_files(barycenter_folder)
     return files
 
 
@@ -86,31 +98,38 @@ def _compute_distances(
     vdj_filter,
     vj_filter,
     custom_labels=None,
+    chunk_size=None,
+    discretization="nearest",
+    precision="float32",
 ):
     """Compute distance-to-barycenter for each file path."""
     if custom_labels is None:
         custom_labels = {}
 
     results = []
+    # One extended grid for all files, grown only by samples outside it
+    extended_grid, extended_barycenter = extend_grid_for_files(grid, barycenter_weights, file_paths)
     for file_path in file_paths:
         try:
-            values, weights = load_distribution(
+            distribution = load_log_distribution(
                 str(file_path),
                 freq_column=freq_column,
                 weights_column=weights_column,
                 productive_filter=productive_filter,
                 vdj_filter=vdj_filter,
                 vj_filter=vj_filter,
+                chunk_size=chunk_size,
+                precision=precision,
             )
 
             extended_grid, extended_barycenter = extend_grid_if_needed(
-                grid,
-                barycenter_weights,
-                values.min(),
-                values.max(),
+                extended_grid,
+                extended_barycenter,
+                distribution.min,
+                distribution.max,
             )
 
-            sample_discretized = discretize_distribution(values, weights, extended_grid)
+            sample_discretized = distribution.histogram(extended_grid, discretization)
 
             distance = compute_wasserstein_distance(
                 extended_grid,
@@ -123,10 +142,11 @@ def _compute_distances(
 
             results.append(
                 {
+                    "path": file_path,
                     "file": file_path.name,
                     "label": custom_labels.get(file_path, _label_from_filename(file_path)),
                     "distance": distance,
-                    "n_samples": len(values),
+                    "n_samples": len(distribution),
                 }
             )
         except ValueError as exc:
@@ -139,6 +159,91 @@ def _compute_distances(
     return results
 
 
+def _leave_one_out_results(
+    file_paths,
+    grid,
+    barycenter_weights,
+    freq_column,
+    weights_column,
+    productive_filter,
+    vdj_filter,
+    vj_filter,
+    chunk_size=None,
+    discretization="nearest",
+    precision="float32",
+):
+    """
+    Per-file results (as _compute_distances) with each file's distance to
+    the barycenter of the other files (see leave_one_out_distances).
+
+    The files are read once; histograms already computed are padded when
+    a later file extends the grid.
+    """
+    results = []
+    histograms = []
+    extended_grid, extended_barycenter = extend_grid_for_files(grid, barycenter_weights, file_paths)
+    for file_path in file_paths:
+        try:
+            distribution = load_log_distribution(
+                str(file_path),
+                freq_column=freq_column,
+                weights_column=weights_column,
+                productive_filter=productive_filter,
+                vdj_filter=vdj_filter,
+                vj_filter=vj_filter,
+                chunk_size=chunk_size,
+                precision=precision,
+            )
+        except ValueError as exc:
+            print(f"Error: {exc}")
+            sys.exit(1)
+        except Exception as exc:
+            print(f"Warning: Error processing {file_path.name}: {exc}")
+            continue
+
+        grown_grid, extended_barycenter = extend_grid_if_needed(
+            extended_grid,
+            extended_barycenter,
+            distribution.min,
+            distribution.max,
+        )
+        if len(grown_grid) != len(extended_grid):
+            histograms = [pad_to_extended_grid(h, extended_grid, grown_grid) for h in histograms]
+            extended_grid = grown_grid
+        histograms.append(distribution.histogram(extended_grid, discretization))
+        results.append(
+            {
+                "path": file_path,
+                "file": file_path.name,
+                "label": _label_from_filename(file_path),
+                "n_samples": len(distribution),
+            }
+        )
+
+    if len(results) < 2:
+        print("Error: --leave-one-out needs at least two valid cloud files")
+        sys.exit(1)
+    for result, distance in zip(results, leave_one_out_distances(extended_grid, histograms)):
+        result["distance"] = float(distance)
+    return results
+
+
+def _cached_results(file_paths, cached, custom_labels=None):
+    """Per-file results (as _compute_distances) from precomputed distances."""
+    if custom_labels is None:
+        custom_labels = {}
+    return [
+        {
+            "path": file_path,
+            "file": file_path.name,
+            "label": custom_labels.get(file_path, _label_from_filename(file_path)),
+            "distance": float(distance),
+            "n_samples": int(n_rows) if n_rows >= 0 else "-",
+        }
+        for file_path, distance, n_rows in zip(file_paths, cached["to_barycenter"], cached["n_rows"])
+    ]
+
+
 def _print_group_table(title, results, statistics_only=False):
     """Print sorted per-file table and descriptive statistics for one group."""
     results = sorted(results, key=lambda x: x["distance"], reverse=True)
@@ -175,10 +280,10 @@ def parse_args():
             "and run a one-sided Wilcoxon rank-sum test."
         ),
     )
-    parser.add_argument("barycenter_folder", help="Folder containing cloud TSV files and barycenter.npz")
+    parser.add_argument("barycenter_folder", help="Folder (or cohort store) containing cloud TSV files and barycenter.npz")
     parser.add_argument(
         "samples",
-        help="Either folder with TSV files or text file with one TSV path per line",
+        help="Either folder (or cohort store) with TSV files or text file with one TSV path per line",
     )
     parser.add_argument("--freq-column", default="pgen", dest="freq_column")
     parser.add_argument(
@@ -189,15 +294,74 @@ def parse_args():
     parser.add_argument("--barycenter", default="barycenter.npz", dest="barycenter_file")
     parser.add_argument("--pipeline", action="store_true", dest="pipeline_mode")
     parser.add_argument("--statistics-only", action="store_true", dest="statistics_only")
+    parser.add_argument(
+        "--leave-one-out",
+        action="store_true",
+        dest="leave_one_out",
+        help="Compare each cloud file (and each sample that is a cloud file) with the exact 1-D "
+             "barycenter of the other cloud files, so its own data does not pull the barycenter "
+             "towards it",
+    )
     parser.add_argument("--productive-filter", action="store_true", dest="productive_filter")
     parser.add_argument("--vdj-filter", action="store_true", dest="vdj_filter")
     parser.add_argument("--vj-filter", action="store_true", dest="vj_filter")
-    return parser.parse_args()
+    parser.add_argument(
+        "--discretization",
+        choices=DISCRETIZATION_METHODS,
+        default="nearest",
+        dest="discretization",
+        help="Assign each value to its nearest grid bin, or split its mass linearly (in log pgen) "
+             "between the two neighbouring grid points; must match the barycenter (default: nearest)",
+    )
+    parser.add_argument(
+        "--distances",
+        nargs="+",
+        default=None,
+        dest="distances_files",
+        help=(
+            "Distance files written by --save-distances (here or in olga-p2b-ot.py); "
+            "used instead of computing when they match the files and options"
+        ),
+    )
+    parser.add_argument(
+        "--save-distances",
+        default=None,
+        dest="save_distances",
+        help="Write the computed sample and cloud distances to this .npz file for reuse with --distances",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=REPERTOIRE_PRECISIONS,
+        default="float32",
+        dest="precision",
+        help="Precision of the log pgen values and non-count weights held in memory (default: float32)",
+    )
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
+
+    return args
 
 
 def main():
     """Main function."""
     args = parse_args()
+    start_instrumentation(args)
+    try:
+        from scipy.stats import mannwhitneyu
+    except ImportError:
+        print("Error: scipy is required. Install with: pip install scipy")
+        sys.exit(1)
+
     barycenter_folder = Path(args.barycenter_folder).expanduser()
     samples_path = Path(args.samples).expanduser()
     freq_column = args.freq_column
@@ -208,8 +372,10 @@ def main():
     productive_filter = args.productive_filter
     vdj_filter = args.vdj_filter
     vj_filter = args.vj_filter
+    chunk_size = args.chunk_size
+    discretization = args.discretization
 
-    if not barycenter_folder.exists() or not barycenter_folder.is_dir():
+    if not is_sample_source(barycenter_folder):
         print(f"Error: Barycenter folder does not exist: {barycenter_folder}")
         sys.exit(1)
 
@@ -237,41 +403,126 @@ def main():
         print(f"Error: No cloud TSV files found in barycenter folder: {barycenter_folder}")
         sys.exit(1)
 
-    sample_results = _compute_distances(
-        sample_files,
-        grid,
-        barycenter_weights,
-        freq_column,
-        weights_column,
-        productive_filter,
-        vdj_filter,
-        vj_filter,
-        custom_labels=custom_labels,
-    )
-    if len(sample_results) == 0:
-        print("Error: No valid sample results to report")
-        sys.exit(1)
-
-    cloud_results = _compute_distances(
+    stale = check_barycenter_provenance(
+        str(barycenter_path),
         cloud_files,
-        grid,
-        barycenter_weights,
-        freq_column,
-        weights_column,
-        productive_filter,
-        vdj_filter,
-        vj_filter,
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        discretization=discretization,
     )
-    if len(cloud_results) == 0:
-        print("Error: No valid cloud results to report")
-        sys.exit(1)
+    if stale and not pipeline_mode:
+        print("Warning: barycenter does not match the current cloud files or options:")
+        for problem in stale:
+            print(f"  - {problem}")
+        print("Rerun olga-barycenter-ot.py to refresh it.")
+        print()
+
+    reference = f"barycenter:{barycenter_fingerprint(str(barycenter_path))}"
+    if args.leave_one_out:
+        # Cloud distances do not use the stored barycenter weights
+        reference += "+leave-one-out"
+    parameters = distance_parameters(
+        reference,
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        discretization=discretization,
+    )
+    cached = None
+    if args.distances_files:
+        cached, problems = lookup_distances(
+            args.distances_files, sample_files + cloud_files, parameters, to_barycenter=True
+        )
+        if problems and not pipeline_mode:
+            print("Warning: precomputed distances cannot be used:")
+            for problem in problems:
+                print(f"  - {problem}")
+            print("Computing distances instead.")
+            print()
+
+    if cached is not None:
+        n_sample_files = len(sample_files)
+        sample_results = _cached_results(
+            sample_files,
+            {key: values[:n_sample_files] for key, values in cached.items()},
+            custom_labels=custom_labels,
+        )
+        cloud_results = _cached_results(
+            cloud_files,
+            {key: values[n_sample_files:] for key, values in cached.items()},
+        )
+    else:
+        sample_results = _compute_distances(
+            sample_files,
+            grid,
+            barycenter_weights,
+            freq_column,
+            weights_column,
+            productive_filter,
+            vdj_filter,
+            vj_filter,
+            custom_labels=custom_labels,
+            chunk_size=chunk_size,
+            discretization=discretization,
+            precision=args.precision,
+        )
+        if len(sample_results) == 0:
+            print("Error: No valid sample results to report")
+            sys.exit(1)
+
+        compute_cloud = _leave_one_out_results if args.leave_one_out else _compute_distances
+        cloud_results = compute_cloud(
+            cloud_files,
+            grid,
+            barycenter_weights,
+            freq_column,
+            weights_column,
+            productive_filter,
+            vdj_filter,
+            vj_filter,
+            chunk_size=chunk_size,
+            discretization=discretization,
+            precision=args.precision,
+        )
+        if len(cloud_results) == 0:
+            print("Error: No valid cloud results to report")
+            sys.exit(1)
+
+        if args.leave_one_out:
+            # Samples that belong to the cloud take their leave-one-out distance
+            positions = member_positions(
+                [r["path"] for r in sample_results], [r["path"] for r in cloud_results]
+            )
+            for result, position in zip(sample_results, positions):
+                if position is not None:
+                    result["distance"] = cloud_results[position]["distance"]
+
+    if args.save_distances:
+        saved = sample_results + cloud_results
+        save_distances(
+            args.save_distances,
+            [r["path"] for r in saved],
+            parameters,
+            labels=[r["label"] for r in saved],
+            to_barycenter=[r["distance"] for r in saved],
+            n_rows=[r["n_samples"] if r["n_samples"] != "-" else -1 for r in saved],
+        )
+        if not pipeline_mode:
+            print(f"Distances saved to {args.save_distances}")
+            print()
 
     sample_distances = np.array([r["distance"] for r in sample_results])
     cloud_distances = np.array([r["distance"] for r in cloud_results])
 
     # One-sided Wilcoxon rank-sum via Mann-Whitney U:
     # H1 is cloud distances are smaller than sample distances.
-    test_result = mannwhitneyu(cloud_distances, sample_distances, alternative="less", method="auto")
+    with stage('statistics'):
+        test_result = mannwhitneyu(cloud_distances, sample_distances, alternative="less", method="auto")
     u_stat = float(test_result.statistic)
     p_value = float(test_result.pvalue)
 
@@ -293,8 +544,9 @@ def main():
         statistics_only=statistics_only,
     )
     print()
+    cloud_title = "CLOUD -> LEAVE-ONE-OUT BARYCENTER" if args.leave_one_out else "CLOUD -> BARYCENTER"
     _print_group_table(
-        "CLOUD -> BARYCENTER WASSERSTEIN DISTANCES (sorted by distance, decreasing)",
+        f"{cloud_title} WASSERSTEIN DISTANCES (sorted by distance, decreasing)",
         cloud_results,
         statistics_only=statistics_only,
     )
@@ -9,13 +9,23 @@ import os
 import argparse
 import numpy as np
 from pathlib import Path
+from instrumentation import add_instrumentation_arguments, start_instrumentation
+from repertoires import REPERTOIRE_PRECISIONS, load_log_distribution
 from ot_utils import (
+    DISCRETIZATION_METHODS,
     _label_from_filename,
-    load_distribution,
+    find_tsv_files,
+    input_exists,
+    is_sample_source,
+    sample_source_dir,
     load_barycenter,
+    barycenter_fingerprint,
+    check_barycenter_provenance,
+    distance_parameters,
+    save_distances,
     compute_wasserstein_distance,
-    discretize_distribution,
-    extend_grid_if_needed
+    extend_grid_for_files,
+    extend_grid_if_needed,
 )
 
 
@@ -23,7 +33,7 @@ def _resolve_barycenter_path(barycenter_folder, barycenter_file):
     """Resolve barycenter file path (absolute or relative to folder)."""
     if os.path.isabs(barycenter_file) or barycenter_file.startswith("~"):
         return Path(os.path.expanduser(barycenter_file))
-    return barycenter_folder / barycenter_file
+    return sample_source_dir(barycenter_folder) / barycenter_file
 
 
 def _load_sample_files(samples_path):
@@ -31,8 +41,8 @@ def _load_sample_files(samples_path):
     samples_path = Path(os.path.expanduser(str(samples_path)))
     custom_labels = {}
 
-    if samples_path.is_dir():
-        files = sorted(samples_path.glob("*.tsv"))
+    if is_sample_source(samples_path):
+        files = find_tsv_files(samples_path)
     elif samples_path.is_file():
         files = []
         with open(samples_path, 'r') as f:
@@ -46,7 +56,7 @@ def _load_sample_files(samples_path):
                 if len(parts) > 1:
                     custom_labels[file_path] = parts[1].strip()
 
-        missing = [f for f in files if not f.exists()]
+        missing = [f for f in files if not input_exists(f)]
         if missing:
             print(f"Error: The following files from {samples_path} do not exist:")
             for f in missing:
@@ -64,10 +74,10 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description="Compute Wasserstein distances from sample distributions to a barycenter.",
     )
-    parser.add_argument("barycenter_folder", help="Folder containing TSV files and barycenter.npz")
+    parser.add_argument("barycenter_folder", help="Folder (or cohort store) containing TSV files and barycenter.npz")
     parser.add_argument(
         "samples",
-        help="Either folder with TSV files or text file with one TSV path per line",
+        help="Either folder (or cohort store) with TSV files or text file with one TSV path per line",
     )
     parser.add_argument("--freq-column", default="pgen", dest="freq_column")
     parser.add_argument(
@@ -81,12 +91,47 @@ def parse_args():
     parser.add_argument("--productive-filter", action="store_true", dest="productive_filter")
     parser.add_argument("--vdj-filter", action="store_true", dest="vdj_filter")
     parser.add_argument("--vj-filter", action="store_true", dest="vj_filter")
-    return parser.parse_args()
+    parser.add_argument(
+        "--discretization",
+        choices=DISCRETIZATION_METHODS,
+        default="nearest",
+        dest="discretization",
+        help="Assign each value to its nearest grid bin, or split its mass linearly (in log pgen) "
+             "between the two neighbouring grid points; must match the barycenter (default: nearest)",
+    )
+    parser.add_argument(
+        "--save-distances",
+        default=None,
+        dest="save_distances",
+        help="Also write the distances, labels and a parameter fingerprint to this .npz file (reusable with --distances)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=REPERTOIRE_PRECISIONS,
+        default="float32",
+        dest="precision",
+        help="Precision of the log pgen values and non-count weights held in memory (default: float32)",
+    )
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
+
+    return args
 
 
 def main():
     """Main function."""
     args = parse_args()
+    start_instrumentation(args)
     barycenter_folder = Path(args.barycenter_folder)
     samples_path = Path(args.samples)
     freq_column = args.freq_column
@@ -97,6 +142,8 @@ def main():
     productive_filter = args.productive_filter
     vdj_filter = args.vdj_filter
     vj_filter = args.vj_filter
+    chunk_size = args.chunk_size
+    discretization = args.discretization
 
     # Load barycenter
     barycenter_path = _resolve_barycenter_path(barycenter_folder, barycenter_file)
@@ -119,6 +166,24 @@ def main():
             print(f"Error loading barycenter: {e}")
         sys.exit(1)
 
+    # Validate that the barycenter was built from the current cloud and options
+    stale = check_barycenter_provenance(
+        str(barycenter_path),
+        find_tsv_files(barycenter_folder),
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        discretization=discretization,
+    )
+    if stale and not pipeline_mode:
+        print("Warning: barycenter does not match the current cloud files or options:")
+        for problem in stale:
+            print(f"  - {problem}")
+        print("Rerun olga-barycenter-ot.py to refresh it.")
+        print()
+
     # Get files to process
     files_to_process, custom_labels = _load_sample_files(samples_path)
     if len(files_to_process) == 0:
@@ -131,27 +196,30 @@ def main():
 
     # Process files
     results = []
+    extended_grid, extended_barycenter = extend_grid_for_files(grid, barycenter_weights, files_to_process)
 
     for file_path in files_to_process:
         try:
             # Load distribution
-            values, weights = load_distribution(
+            distribution = load_log_distribution(
                 str(file_path),
                 freq_column=freq_column,
                 weights_column=weights_column,
                 productive_filter=productive_filter,
                 vdj_filter=vdj_filter,
-                vj_filter=vj_filter
+                vj_filter=vj_filter,
+                chunk_size=chunk_size,
+                precision=args.precision,
             )
             
-            # Extend grid if new data falls outside barycenter range
+            # Extend the run's grid if new data falls outside its range
             extended_grid, extended_barycenter = extend_grid_if_needed(
-                grid, barycenter_weights,
-                values.min(), values.max()
+                extended_grid, extended_barycenter,
+                distribution.min, distribution.max
             )
             
             # Discretize sample to extended grid for fair comparison
-            sample_discretized = discretize_distribution(values, weights, extended_grid)
+            sample_discretized = distribution.histogram(extended_grid, discretization)
             
             # Compute distance to barycenter
             distance = compute_wasserstein_distance(
@@ -162,10 +230,11 @@ def main():
             )
             
             results.append({
+                'path': file_path,
                 'file': file_path.name,
                 'label': custom_labels.get(file_path, _label_from_filename(file_path)),
                 'distance': distance,
-                'n_samples': len(values)
+                'n_samples': len(distribution)
             })
 
         except ValueError as e:
@@ -181,6 +250,27 @@ def main():
         print("Error: No valid results to report")
         sys.exit(1)
 
+    if args.save_distances:
+        save_distances(
+            args.save_distances,
+            [r['path'] for r in results],
+            distance_parameters(
+                f"barycenter:{barycenter_fingerprint(str(barycenter_path))}",
+                freq_column=freq_column,
+                weights_column=weights_column,
+                productive_filter=productive_filter,
+                vdj_filter=vdj_filter,
+                vj_filter=vj_filter,
+                discretization=discretization,
+            ),
+            labels=[r['label'] for r in results],
+            to_barycenter=[r['distance'] for r in results],
+            n_rows=[r['n_samples'] for r in results],
+        )
+        if not pipeline_mode:
+            print(f"Distances saved to {args.save_distances}")
+            print()
+
     # Display results
     if pipeline_mode:
         results.sort(key=lambda x: x['distance'], reverse=True)
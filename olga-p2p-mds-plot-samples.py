@@ -3,6 +3,8 @@
 Simplified MDS visualization of sample distributions.
 Computes pairwise distances between samples and visualizes them using MDS.
 Samples from different directories are color-coded.
+With --landmarks only the distances to a few landmark samples are
+computed, which scales to atlases of thousands of repertoires.
 """
 
 import sys
@@ -10,15 +12,29 @@ import os
 import argparse
 from pathlib import Path
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.manifold import MDS
-from adjustText import adjust_text
+from instrumentation import add_instrumentation_arguments, stage, start_instrumentation
+from plot_utils import LABEL_PLACEMENTS, place_labels, pyplot
+from mds_utils import (
+    LANDMARK_SELECTIONS,
+    MDS_METHODS,
+    fit_mds,
+    format_mds_report,
+    landmark_mds,
+    select_landmarks,
+)
 from ot_utils import (
+    DISCRETIZATION_METHODS,
     _label_from_filename,
-    load_distribution,
+    load_sketch,
+    coarsen_sketches,
+    find_tsv_files,
+    input_exists,
+    is_sample_source,
+    sample_source_dir,
     compute_wasserstein_distance,
-    discretize_distribution,
-    extend_grid_if_needed
+    distance_parameters,
+    lookup_distances,
+    save_distances,
 )
 
 
@@ -45,9 +61,9 @@ def _load_sample_files(samples_path):
     samples_path = Path(os.path.expanduser(str(samples_path)))
     custom_labels = {}
     
-    if samples_path.is_dir():
-        files = sorted(samples_path.glob("*.tsv"))
-        output_folder = samples_path
+    if is_sample_source(samples_path):
+        files = find_tsv_files(samples_path)
+        output_folder = sample_source_dir(samples_path)
     elif samples_path.is_file():
         files = []
         with open(samples_path, 'r') as f:
@@ -63,7 +79,7 @@ def _load_sample_files(samples_path):
                     # Custom label provided
                     custom_labels[file_path] = parts[1].strip()
         
-        missing = [f for f in files if not f.exists()]
+        missing = [f for f in files if not input_exists(f)]
         if missing:
             print(f"Error: The following files from {samples_path} do not exist:")
             for f in missing:
@@ -130,9 +146,9 @@ def _get_directory_colors(files):
     return colors, dir_to_color
 
 
-def _compute_pairwise_distances(files, freq_column, weights_column, productive_filter, vdj_filter, vj_filter):
+def _load_histograms(files, freq_column, weights_column, productive_filter, vdj_filter, vj_filter, chunk_size=None, n_grid=500, discretization="nearest"):
     """
-    Compute pairwise Wasserstein distances between samples.
+    Load all samples as histograms on a common grid.
     
     Parameters
     ----------
@@ -148,60 +164,72 @@ def _compute_pairwise_distances(files, freq_column, weights_column, productive_f
         If True, require non-empty V/D/J call columns when present
     vj_filter : bool
         If True, require non-empty V/J call columns when present
+    chunk_size : int or None
+        Rows per chunk for streaming TSV reading (None reads whole files)
+    n_grid : int
+        Approximate number of points of the common grid
+    discretization : str
+        How the sketches are moved onto the common grid (see coarsen_sketches)
         
     Returns
     -------
-    distances : np.ndarray
-        (n_files, n_files) distance matrix
-    extended_grid : np.ndarray
-        Extended grid (if needed)
+    histograms : list of np.ndarray
+        Sample weights on the common grid
+    grid : np.ndarray
+        Common log-spaced grid derived from the canonical sketches
     """
-    n_files = len(files)
-    distances = np.zeros((n_files, n_files))
-    
-    # First pass: load all samples and extend grid if needed
-    all_samples = []
-    all_values = []
-    
+    # Load every sample as a sketch on the canonical log-pgen lattice
+    sketches = []
     for file_path in files:
-        values, weights = load_distribution(
+        sketch, _ = load_sketch(
             str(file_path),
             freq_column=freq_column,
             weights_column=weights_column,
             productive_filter=productive_filter,
             vdj_filter=vdj_filter,
-            vj_filter=vj_filter
+            vj_filter=vj_filter,
+            chunk_size=chunk_size,
         )
-        all_samples.append((values, weights))
-        all_values.append(values)
+        sketches.append(sketch)
     
-    # Create grid from all values
-    all_values_concat = np.concatenate(all_values)
-    min_val = all_values_concat.min()
-    max_val = all_values_concat.max()
-    extended_grid = np.linspace(min_val, max_val, 500)
+    # Common grid over the joint support, by summing adjacent lattice bins
+    grid, histograms = coarsen_sketches(sketches, n_grid=n_grid, method=discretization)
+    return histograms, grid
+
+
+def _distance(grid, weights_a, weights_b):
+    """Wasserstein distance between two histograms on the same grid."""
+    return compute_wasserstein_distance(
+        grid, weights_a,
+        grid, weights_b,
+        metric="log_l1",
+        method="emd"
+    )
+
+
+def _compute_pairwise_distances(histograms, grid):
+    """
+    Compute pairwise Wasserstein distances between samples.
     
-    # Compute distances
+    Returns
+    -------
+    distances : np.ndarray
+        Symmetric (n_files, n_files) distance matrix
+    """
+    n_files = len(histograms)
+    distances = np.zeros((n_files, n_files))
     for i in range(n_files):
-        for j in range(i, n_files):
-            values_i, weights_i = all_samples[i]
-            values_j, weights_j = all_samples[j]
-            
-            # Discretize both samples on extended grid
-            disc_i = discretize_distribution(values_i, weights_i, extended_grid)
-            disc_j = discretize_distribution(values_j, weights_j, extended_grid)
-            
-            # Compute distance
-            distance = compute_wasserstein_distance(
-                extended_grid, disc_i,
-                extended_grid, disc_j,
-                metric="log_l1",
-                method="emd"
-            )
-            distances[i, j] = distance
-            distances[j, i] = distance
-    
-    return distances, extended_grid
+        for j in range(i + 1, n_files):
+            distances[i, j] = distances[j, i] = _distance(grid, histograms[i], histograms[j])
+    return distances
+
+
+def _compute_distances_from(index, histograms, grid):
+    """Distances from one sample to all samples."""
+    return np.array([
+        0.0 if j == index else _distance(grid, histograms[index], histogram)
+        for j, histogram in enumerate(histograms)
+    ])
 
 
 def parse_args():
@@ -224,15 +252,117 @@ def parse_args():
         default="ot-simple-p2p-mds-plot.png",
         dest="output_plot",
     )
+    parser.add_argument(
+        "--label-placement",
+        choices=LABEL_PLACEMENTS,
+        default="auto",
+        dest="label_placement",
+        help="Label layout: adjust (adjustText, small plots), grid (fast, capped per region) or auto (default)",
+    )
+    parser.add_argument(
+        "--max-labels-per-region",
+        type=int,
+        default=3,
+        dest="max_labels_per_region",
+        help="With grid placement, label at most this many points per plot region (default: 3; 0 = no cap)",
+    )
+    parser.add_argument(
+        "--n-grid",
+        type=int,
+        default=500,
+        dest="n_grid",
+        help="Approximate number of log-spaced grid points for the distances (default: 500)",
+    )
+    parser.add_argument(
+        "--mds-method",
+        choices=MDS_METHODS,
+        default="smacof",
+        dest="mds_method",
+        help="MDS algorithm: classical (eigendecomposition, fast, deterministic) or smacof (iterative; default)",
+    )
+    parser.add_argument(
+        "--smacof-refine",
+        action="store_true",
+        dest="smacof_refine",
+        help="With --mds-method classical, refine the classical embedding with SMACOF seeded from it",
+    )
+    parser.add_argument(
+        "--landmarks",
+        type=int,
+        default=None,
+        dest="landmarks",
+        help=(
+            "Landmark MDS: compute distances only to this many landmark samples and "
+            "triangulate the rest (default: full pairwise MDS)"
+        ),
+    )
+    parser.add_argument(
+        "--landmark-selection",
+        choices=LANDMARK_SELECTIONS,
+        default="farthest",
+        dest="landmark_selection",
+        help="How landmarks are chosen: farthest-point (default) or random",
+    )
+    parser.add_argument(
+        "--distances",
+        nargs="+",
+        default=None,
+        dest="distances_files",
+        help=(
+            "Distance files written by --save-distances (here or in olga-p2p-ot.py --all); "
+            "used instead of computing when they match the files and options"
+        ),
+    )
+    parser.add_argument(
+        "--save-distances",
+        default=None,
+        dest="save_distances",
+        help="Write the pairwise distances to this .npz file for reuse with --distances",
+    )
     parser.add_argument("--productive-filter", action="store_true", dest="productive_filter")
     parser.add_argument("--vdj-filter", action="store_true", dest="vdj_filter")
     parser.add_argument("--vj-filter", action="store_true", dest="vj_filter")
-    return parser.parse_args()
+    parser.add_argument(
+        "--discretization",
+        choices=DISCRETIZATION_METHODS,
+        default="nearest",
+        dest="discretization",
+        help="Assign each value to its nearest grid bin, or split its mass linearly (in log pgen) "
+             "between the two neighbouring grid points, which needs a smaller grid (default: nearest)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    if args.n_grid <= 1:
+        parser.error("--n-grid must be > 1")
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
+    if args.max_labels_per_region < 0:
+        parser.error("--max-labels-per-region must be >= 0")
+    if args.smacof_refine and args.mds_method != "classical":
+        parser.error("--smacof-refine requires --mds-method classical")
+    if args.landmarks is not None:
+        if args.landmarks < 3:
+            parser.error("--landmarks must be >= 3")
+        if args.smacof_refine:
+            parser.error("--smacof-refine cannot be combined with --landmarks")
+        if args.save_distances:
+            parser.error("--save-distances needs the full distance matrix and cannot be combined with --landmarks")
+
+    return args
 
 
 def main():
     """Main function."""
     args = parse_args()
+    start_instrumentation(args)
     samples_path = Path(args.samples)
     freq_column = args.freq_column
     weights_column = args.weights_column
@@ -240,6 +370,8 @@ def main():
     productive_filter = args.productive_filter
     vdj_filter = args.vdj_filter
     vj_filter = args.vj_filter
+    chunk_size = args.chunk_size
+    discretization = args.discretization
 
     # Get TSV files
     samples_files, output_folder, custom_labels = _load_sample_files(samples_path)
@@ -250,54 +382,83 @@ def main():
 
     print(f"Found {len(samples_files)} sample files")
 
-    # Compute pairwise distances
-    print("Computing pairwise distances...")
-    distances, extended_grid = _compute_pairwise_distances(
-        samples_files, freq_column, weights_column, productive_filter, vdj_filter, vj_filter
+    parameters = distance_parameters(
+        f"common:{args.n_grid}",
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        discretization=discretization,
     )
+    cached = None
+    if args.distances_files:
+        cached, problems = lookup_distances(args.distances_files, samples_files, parameters, pairwise=True)
+        if problems:
+            print("Warning: precomputed distances cannot be used:")
+            for problem in problems:
+                print(f"  - {problem}")
+            print("Computing distances instead.")
+        else:
+            print(f"Using precomputed distances from {', '.join(args.distances_files)}")
 
-    # Apply MDS
-    print("Computing MDS...")
-    mds = MDS(n_components=2, dissimilarity='precomputed', random_state=42)
-    mds_coords = mds.fit_transform(distances)
+    if cached is None:
+        histograms, grid = _load_histograms(
+            samples_files, freq_column, weights_column, productive_filter, vdj_filter, vj_filter,
+            chunk_size=chunk_size,
+            n_grid=args.n_grid,
+            discretization=discretization,
+        )
+
+    if args.landmarks is not None:
+        print(f"Computing distances to {min(args.landmarks, len(samples_files))} landmarks ({args.landmark_selection})...")
+        if cached is not None:
+            distances_from = lambda index: cached['pairwise'][index]
+        else:
+            distances_from = lambda index: _compute_distances_from(index, histograms, grid)
+        landmarks, landmark_distances = select_landmarks(
+            len(samples_files), args.landmarks,
+            distances_from,
+            selection=args.landmark_selection,
+        )
+        print("Computing MDS...")
+        with stage('mds'):
+            mds_coords, _, mds_report = landmark_mds(landmarks, landmark_distances)
+    else:
+        if cached is not None:
+            distances = cached['pairwise']
+        else:
+            print("Computing pairwise distances...")
+            distances = _compute_pairwise_distances(histograms, grid)
+        if args.save_distances:
+            save_distances(
+                args.save_distances,
+                samples_files,
+                parameters,
+                labels=[custom_labels.get(f, _label_from_filename(f)) for f in samples_files],
+                pairwise=distances,
+            )
+            print(f"Distances saved to {args.save_distances}")
+
+        print("Computing MDS...")
+        with stage('mds'):
+            mds_coords, mds_report = fit_mds(distances, method=args.mds_method, refine=args.smacof_refine)
+    print(f"  {format_mds_report(mds_report)}")
 
     # Get colors by directory
     colors, dir_to_color = _get_directory_colors(samples_files)
 
     # Create plot
+    plt = pyplot()
+
     fig, ax = plt.subplots(figsize=(14, 12))
 
     # Plot samples with colors by directory
-    texts = []
-    for i, file_path in enumerate(samples_files):
-        x, y = mds_coords[i, 0], mds_coords[i, 1]
-        color = colors[file_path]
-        
-        ax.scatter(
-            x, y,
-            c=[color], s=100, alpha=0.6, edgecolors='black', linewidth=1,
-            zorder=3
-        )
-        
-        # Add label - use custom if provided, otherwise auto-generate
-        label = custom_labels.get(file_path, _label_from_filename(file_path))
-        txt = ax.text(
-            x, y + 0.05,
-            label,
-            ha='center', va='bottom',
-            fontsize=9, fontweight='bold',
-            color='#000000',
-            zorder=4
-        )
-        texts.append(txt)
-
-    # Move labels to avoid overlaps
-    adjust_text(
-        texts,
-        expand_points=(1.2, 1.2),
-        expand_text=(1.1, 1.1),
-        force_points=0.2,
-        force_text=0.3
+    ax.scatter(
+        mds_coords[:, 0], mds_coords[:, 1],
+        c=[colors[file_path] for file_path in samples_files],
+        s=100, alpha=0.6, edgecolors='black', linewidth=1,
+        zorder=3
     )
 
     # Labels and title
@@ -313,6 +474,22 @@ def main():
         for d in sorted(dir_to_color.keys())
     ]
     ax.legend(handles=legend_elements, loc='best', fontsize=10, title='Directory')
+    plt.tight_layout()
+
+    # Add labels - use custom if provided, otherwise auto-generate;
+    # points far from the centroid (outliers) are labeled first
+    labels = [custom_labels.get(f, _label_from_filename(f)) for f in samples_files]
+    _, n_skipped = place_labels(
+        ax,
+        mds_coords[:, 0], mds_coords[:, 1],
+        labels,
+        priority=np.linalg.norm(mds_coords - mds_coords.mean(axis=0), axis=1),
+        method=args.label_placement,
+        max_per_region=args.max_labels_per_region or None,
+        fontsize=9, label_offset=0.05, fontweight='bold', color='#000000', zorder=4,
+    )
+    if n_skipped:
+        print(f"  {n_skipped} labels skipped (overlapping, or over --max-labels-per-region)")
 
     # Determine output path
     if os.path.isabs(output_plot) or os.path.dirname(output_plot):
@@ -326,8 +503,8 @@ def main():
         os.makedirs(output_dir, exist_ok=True)
 
     # Save plot
-    plt.tight_layout()
-    plt.savefig(output_path, dpi=300, bbox_inches='tight')
+    with stage('plot'):
+        plt.savefig(output_path, dpi=300, bbox_inches='tight')
     print(f"Plot saved to {output_path}")
     plt.close()
 
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 """
 Calculate Wasserstein distances between TCR distributions.
-Supports two-file comparison and all-pairs comparison from a file list.
+Supports two-file comparison and all-pairs comparison from a file list,
+optionally for several row filter combinations from one read of each file.
 """
 
 import sys
@@ -9,26 +10,53 @@ import argparse
 import numpy as np
 from pathlib import Path
 from itertools import combinations
+from instrumentation import add_instrumentation_arguments, start_instrumentation
 from ot_utils import (
+    DISCRETIZATION_METHODS,
     load_distribution,
+    is_tsv_path,
+    find_tsv_files,
+    input_exists,
+    is_sample_source,
     compute_wasserstein_distance,
     discretize_distribution,
-    create_common_grid
+    create_common_grid,
+    distance_parameters,
+    filter_variant_label,
+    filter_variants_argument,
+    save_distances,
+    save_square_distances,
+    N_GRID_AUTO_TOLERANCE,
+    n_grid_argument,
+    select_n_grid,
+)
+from repertoires import (
+    REPERTOIRE_PRECISIONS,
+    memory_budget_argument,
+    open_filter_variants,
+    open_repertoires,
+    value_ranges,
+    values_view,
+    weights_view,
 )
 
 
-def compute_distance_single_pair(file1, file2, freq_column, weights_column, n_grid, productive_filter=False, vdj_filter=False, vj_filter=False):
-    """Compute distance between two specific files."""
+def compute_distance_single_pair(file1, file2, freq_column, weights_column, n_grid, productive_filter=False, vdj_filter=False, vj_filter=False, chunk_size=None, n_grid_tolerance=N_GRID_AUTO_TOLERANCE, discretization="nearest"):
+    """Compute distance between two specific files (n_grid may be 'auto', see select_n_grid)."""
     filepath1 = Path(file1)
     filepath2 = Path(file2)
     
-    values1, weights1 = load_distribution(str(filepath1), freq_column, weights_column, productive_filter, vdj_filter, vj_filter)
-    values2, weights2 = load_distribution(str(filepath2), freq_column, weights_column, productive_filter, vdj_filter, vj_filter)
+    values1, weights1 = load_distribution(str(filepath1), freq_column, weights_column, productive_filter, vdj_filter, vj_filter, chunk_size)
+    values2, weights2 = load_distribution(str(filepath2), freq_column, weights_column, productive_filter, vdj_filter, vj_filter, chunk_size)
+    if n_grid == 'auto':
+        n_grid, _ = select_n_grid(
+            [values1, values2], [weights1, weights2], tolerance=n_grid_tolerance, discretization=discretization
+        )
     
     grid = create_common_grid([values1, values2], n_grid=n_grid, log_space=True)
     
-    dist1 = discretize_distribution(values1, weights1, grid)
-    dist2 = discretize_distribution(values2, weights2, grid)
+    dist1 = discretize_distribution(values1, weights1, grid, method=discretization)
+    dist2 = discretize_distribution(values2, weights2, grid, method=discretization)
     
     distance = compute_wasserstein_distance(
         grid, dist1,
@@ -37,15 +65,25 @@ def compute_distance_single_pair(file1, file2, freq_column, weights_column, n_gr
         method='emd'
     )
     
-    return distance, file1, file2, len(values1), len(values2)
+    return distance, file1, file2, len(values1), len(values2), n_grid
 
 
 def load_files_from_list(list_file):
-    """Load TSV file paths from a list file using first token of each non-empty line."""
+    """
+    Load TSV file paths from a list file using first token of each non-empty line.
+
+    A folder or cohort store is also accepted and contributes all its TSV files.
+    """
     list_path = Path(list_file)
     if not list_path.exists():
         raise FileNotFoundError(f"File list not found: {list_file}")
 
+    if is_sample_source(list_path):
+        entries = [(path.name, str(path)) for path in find_tsv_files(list_path)]
+        if len(entries) < 2:
+            raise ValueError("Need at least 2 files in list for pairwise comparison")
+        return entries
+
     entries = []
     with open(list_path, 'r', encoding='utf-8') as handle:
         for line_number, raw_line in enumerate(handle, start=1):
@@ -58,7 +96,7 @@ def load_files_from_list(list_file):
             if not file_path.is_absolute():
                 file_path = list_path.parent / file_path
 
-            if not file_path.exists():
+            if not input_exists(file_path):
                 raise FileNotFoundError(
                     f"Listed file not found at line {line_number}: {first_token}"
                 )
@@ -71,84 +109,198 @@ def load_files_from_list(list_file):
     return entries
 
 
-def compute_distance_all_pairs(file_list, freq_column="pgen", weights_column="duplicate_frequency_percent", n_grid=200, productive_filter=False, vdj_filter=False, vj_filter=False):
-    """Compute distances for all pairs from file list (upper triangle of distance matrix)."""
+def compute_distance_all_pairs(file_list, freq_column="pgen", weights_column="duplicate_frequency_percent", n_grid=200, productive_filter=False, vdj_filter=False, vj_filter=False, chunk_size=None, n_grid_tolerance=N_GRID_AUTO_TOLERANCE, discretization="nearest", memory_budget=None, precision="float32"):
+    """
+    Compute distances for all pairs from file list (upper triangle of distance matrix).
+
+    With n_grid='auto' the grid size is chosen by select_n_grid on the
+    loaded distributions. Samples are opened as lazy repertoire handles:
+    only their histograms are kept, and at most `memory_budget` bytes of
+    raw values (None: no limit), so the pair loop runs in fixed memory.
+    Values are held as log pgen in `precision` ('float32' or 'float64').
+
+    Returns
+    -------
+    file_entries : list of (label, file path)
+        Listed files, in list order
+    distances : np.ndarray
+        Condensed upper triangle: pairs (i, j), i < j, row by row, as
+        scipy.spatial.distance.squareform
+    n_grid : int
+        Grid size used
+    """
     file_entries = load_files_from_list(file_list)
 
-    # Pre-load all distributions
-    distributions = []
-    for label, file_path in file_entries:
-        values, weights = load_distribution(
-            file_path,
-            freq_column=freq_column,
-            weights_column=weights_column,
-            productive_filter=productive_filter,
-            vdj_filter=vdj_filter,
-            vj_filter=vj_filter
+    repertoires = open_repertoires(
+        [file_path for _, file_path in file_entries],
+        memory_budget=memory_budget,
+        precision=precision,
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        chunk_size=chunk_size,
+    )
+
+    if n_grid == 'auto':
+        n_grid, _ = select_n_grid(
+            values_view(repertoires),
+            weights_view(repertoires),
+            tolerance=n_grid_tolerance,
+            discretization=discretization,
         )
-        distributions.append((label, values, weights))
+    grid = create_common_grid(value_ranges(repertoires), n_grid=n_grid, log_space=True)
+    histograms = [repertoire.histogram(grid, discretization) for repertoire in repertoires]
+    repertoires[0].cache.clear()
+
+    return file_entries, _pairwise_distances(grid, histograms), n_grid
+
+
+def compute_distance_all_pairs_variants(file_list, filter_variants, freq_column="pgen", weights_column="duplicate_frequency_percent", n_grid=200, chunk_size=None, n_grid_tolerance=N_GRID_AUTO_TOLERANCE, discretization="nearest", memory_budget=None, precision="float32"):
+    """
+    compute_distance_all_pairs for each of several filter combinations.
+
+    Each file is parsed once for all combinations (open_filter_variants);
+    each combination then gets its own common grid (and --n-grid auto
+    selection), exactly as in a separate run with its filters.
+
+    Parameters
+    ----------
+    filter_variants : list of (productive_filter, vdj_filter, vj_filter)
+        Filter combinations (see ot_utils.parse_filter_variants)
+    Other parameters
+        As in compute_distance_all_pairs
+
+    Returns
+    -------
+    file_entries : list of (label, file path)
+        Listed files, in list order
+    results : list of dict
+        Per combination: variant, label, distances (condensed), n_grid and
+        n_rows (rows kept per file)
+    """
+    file_entries = load_files_from_list(file_list)
+    variant_repertoires = open_filter_variants(
+        [file_path for _, file_path in file_entries],
+        filter_variants,
+        memory_budget=memory_budget,
+        precision=precision,
+        freq_column=freq_column,
+        weights_column=weights_column,
+        chunk_size=chunk_size,
+    )
 
-    all_values = [values for _, values, _ in distributions]
-    grid = create_common_grid(all_values, n_grid=n_grid, log_space=True)
+    grids = []
+    for repertoires in variant_repertoires:
+        variant_n_grid = n_grid
+        if n_grid == 'auto':
+            variant_n_grid, _ = select_n_grid(
+                values_view(repertoires),
+                weights_view(repertoires),
+                tolerance=n_grid_tolerance,
+                discretization=discretization,
+            )
+        grids.append(create_common_grid(value_ranges(repertoires), n_grid=variant_n_grid, log_space=True))
+
+    # File by file, so that all combinations of a file come from one read
+    # even when the memory budget holds a single file
+    histograms = [[] for _ in filter_variants]
+    for file_index in range(len(file_entries)):
+        for variant_index, repertoires in enumerate(variant_repertoires):
+            histograms[variant_index].append(
+                repertoires[file_index].histogram(grids[variant_index], discretization)
+            )
+    variant_repertoires[0][0].cache.clear()
 
     results = []
-
-    # Compute upper triangle (i < j)
-    for left_index, right_index in combinations(range(len(distributions)), 2):
-        file1, values1, weights1 = distributions[left_index]
-        file2, values2, weights2 = distributions[right_index]
-
-        dist1 = discretize_distribution(values1, weights1, grid)
-        dist2 = discretize_distribution(values2, weights2, grid)
-
-        distance = compute_wasserstein_distance(
-            grid, dist1,
-            grid, dist2,
+    for variant, repertoires, grid, variant_histograms in zip(filter_variants, variant_repertoires, grids, histograms):
+        results.append({
+            'variant': variant,
+            'label': filter_variant_label(variant),
+            'distances': _pairwise_distances(grid, variant_histograms),
+            'n_grid': len(grid),
+            'n_rows': [repertoire.n_rows for repertoire in repertoires],
+        })
+    return file_entries, results
+
+
+def _pairwise_distances(grid, histograms):
+    """Condensed upper triangle (i < j) of the distances between histograms on `grid`."""
+    n_files = len(histograms)
+    distances = np.empty(n_files * (n_files - 1) // 2)
+    for pair_index, (left_index, right_index) in enumerate(combinations(range(n_files), 2)):
+        distances[pair_index] = compute_wasserstein_distance(
+            grid, histograms[left_index],
+            grid, histograms[right_index],
             metric='log_l1',
             method='emd'
         )
+    return distances
 
-        results.append((file1, file2, distance))
-
-    return results
 
-
-def print_results_normal(results, title="PAIRWISE WASSERSTEIN DISTANCES", statistics_only=False):
-    """Print results in normal mode with table and statistics."""
+def print_results_normal(labels, distances, title="PAIRWISE WASSERSTEIN DISTANCES", statistics_only=False):
+    """Print all-pairs results (condensed distances) with table and statistics."""
     print("=" * 100)
     print(title)
     print("=" * 100)
-    
-    distances = []
+
     if not statistics_only:
         print(f"{'File 1':<45} {'File 2':<45} {'Distance':>8}")
         print("-" * 100)
-        for file1, file2, distance in results:
-            print(f"{file1:<45} {file2:<45} {distance:>8.6e}")
-            distances.append(distance)
-    else:
-        # Statistics only: just collect distances
-        distances = [distance for _, _, distance in results]
-    
+        for (left_index, right_index), distance in zip(combinations(range(len(labels)), 2), distances):
+            print(f"{labels[left_index]:<45} {labels[right_index]:<45} {distance:>8.6e}")
+
+    left, right = np.triu_indices(len(labels), k=1)
+    closest = np.argmin(distances)
+    farthest = np.argmax(distances)
     print("=" * 100)
     print("STATISTICS")
     print("=" * 100)
-    distances = np.array(distances)
     print(f"Count:        {len(distances)}")
     print(f"Mean:         {np.mean(distances):.6e}")
     print(f"Median:       {np.median(distances):.6e}")
     print(f"Std:          {np.std(distances):.6e}")
-    print(f"Min:          {np.min(distances):.6e} ({results[np.argmin(distances)][0]} ↔ {results[np.argmin(distances)][1]})")
-    print(f"Max:          {np.max(distances):.6e} ({results[np.argmax(distances)][0]} ↔ {results[np.argmax(distances)][1]})")
+    print(f"Min:          {distances[closest]:.6e} ({labels[left[closest]]} ↔ {labels[right[closest]]})")
+    print(f"Max:          {distances[farthest]:.6e} ({labels[left[farthest]]} ↔ {labels[right[farthest]]})")
     print(f"Q1 (25%):     {np.percentile(distances, 25):.6e}")
     print(f"Q3 (75%):     {np.percentile(distances, 75):.6e}")
     print("=" * 100)
 
 
-def print_results_pipeline(results):
+def print_filter_variants_summary(results):
+    """Print rows kept and distance statistics per filter combination, against the first."""
+    reference = results[0]
+    print("=" * 100)
+    print(f"FILTER VARIANTS (compared pair by pair with '{reference['label']}')")
+    print("=" * 100)
+    print(f"{'Filters':<22} {'Rows kept':>12} {'Grid':>6} {'Mean':>14} {'Median':>14} {'Corr.':>8} {'Max |diff|':>14}")
+    print("-" * 100)
+    for result in results:
+        distances = result['distances']
+        difference = distances - reference['distances']
+        if len(distances) > 1 and np.std(distances) > 0 and np.std(reference['distances']) > 0:
+            correlation = f"{np.corrcoef(distances, reference['distances'])[0, 1]:>8.4f}"
+        else:
+            correlation = f"{'-':>8}"
+        print(
+            f"{result['label']:<22} {sum(result['n_rows']):>12} {result['n_grid']:>6} "
+            f"{np.mean(distances):>14.6e} {np.median(distances):>14.6e} {correlation} "
+            f"{np.abs(difference).max():>14.6e}"
+        )
+    print("=" * 100)
+
+
+def _variant_path(path, label):
+    """Output path of one filter combination: distances.npz -> distances.productive+vdj.npz."""
+    path = Path(path)
+    return str(path.with_name(f"{path.stem}.{label}{path.suffix}"))
+
+
+def print_results_pipeline(distances):
     """Print results in pipeline mode - only distances (upper triangle order)."""
-    for file1, file2, distance in results:
-        print(f"{distance:.10e}")
+    if len(distances):
+        sys.stdout.write("\n".join(f"{distance:.10e}" for distance in distances.tolist()) + "\n")
 
 
 def parse_args():
@@ -170,26 +322,165 @@ def parse_args():
         default="duplicate_frequency_percent",
         dest="weights_column",
     )
-    parser.add_argument("--n-grid", type=int, default=200, dest="n_grid")
+    parser.add_argument(
+        "--n-grid",
+        type=n_grid_argument,
+        default=200,
+        dest="n_grid",
+        help="Grid size, or 'auto' to pick the smallest size at which distances have converged "
+             "on a subsample of the inputs (default: 200)",
+    )
+    parser.add_argument(
+        "--n-grid-tolerance",
+        type=float,
+        default=N_GRID_AUTO_TOLERANCE,
+        dest="n_grid_tolerance",
+        help=f"Relative change accepted as converged by --n-grid auto (default: {N_GRID_AUTO_TOLERANCE})",
+    )
     parser.add_argument("--all", action="store_true", dest="all_mode")
     parser.add_argument("--pipeline", action="store_true", dest="pipeline_mode")
     parser.add_argument("--statistics-only", action="store_true", dest="statistics_only")
     parser.add_argument("--productive-filter", action="store_true", dest="productive_filter")
     parser.add_argument("--vdj-filter", action="store_true", dest="vdj_filter")
     parser.add_argument("--vj-filter", action="store_true", dest="vj_filter")
+    parser.add_argument(
+        "--filter-variants",
+        type=filter_variants_argument,
+        default=None,
+        dest="filter_variants",
+        help="With --all, compute the distances for each of these filter combinations, reading each "
+             "file once: comma-separated, filters joined with '+', e.g. 'none,productive,productive+vdj', "
+             "or 'all' for all eight (replaces --productive-filter/--vdj-filter/--vj-filter)",
+    )
+    parser.add_argument(
+        "--discretization",
+        choices=DISCRETIZATION_METHODS,
+        default="nearest",
+        dest="discretization",
+        help="Assign each value to its nearest grid bin, or split its mass linearly (in log pgen) "
+             "between the two neighbouring grid points, which needs a smaller grid (default: nearest)",
+    )
+    parser.add_argument(
+        "--output",
+        "--save-distances",
+        default=None,
+        dest="output_file",
+        help=(
+            "With --all, write the condensed pairwise distances, labels and a parameter fingerprint "
+            "to this .npz file and print only the statistics"
+        ),
+    )
+    parser.add_argument(
+        "--square-matrix",
+        default=None,
+        dest="square_matrix",
+        help="With --output, also write the full square matrix to this memory-mappable .npy file",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=memory_budget_argument,
+        default=None,
+        dest="memory_budget",
+        help="With --all, keep at most this much raw repertoire data in memory, e.g. 512M or 4G; "
+             "samples beyond it are read again when needed (default: unlimited)",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=REPERTOIRE_PRECISIONS,
+        default="float32",
+        dest="precision",
+        help="Precision of the log pgen values and non-count weights held in memory (default: float32)",
+    )
+    add_instrumentation_arguments(parser)
     args = parser.parse_args()
 
-    if args.n_grid <= 1:
-        parser.error("--n-grid must be > 1")
+    if args.n_grid_tolerance <= 0:
+        parser.error("--n-grid-tolerance must be > 0")
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
     if args.statistics_only:
         args.all_mode = True
+    if args.output_file and not args.all_mode:
+        parser.error("--output requires --all")
+    if args.square_matrix and not args.output_file:
+        parser.error("--square-matrix requires --output")
+    if args.filter_variants is not None:
+        if not args.all_mode:
+            parser.error("--filter-variants requires --all")
+        if args.pipeline_mode:
+            parser.error("--filter-variants cannot be combined with --pipeline")
+        if args.productive_filter or args.vdj_filter or args.vj_filter:
+            parser.error("--filter-variants replaces --productive-filter, --vdj-filter and --vj-filter")
 
     return args
 
 
+def run_filter_variants(args, files_list):
+    """--all --filter-variants: distances of every filter combination from one read of each file."""
+    labels = [filter_variant_label(variant) for variant in args.filter_variants]
+    print(f"Computing all-pairs distances from file list: {files_list}")
+    print(f"Filter combinations: {', '.join(labels)}")
+    print()
+    file_entries, results = compute_distance_all_pairs_variants(
+        files_list,
+        args.filter_variants,
+        args.freq_column,
+        args.weights_column,
+        args.n_grid,
+        args.chunk_size,
+        args.n_grid_tolerance,
+        args.discretization,
+        args.memory_budget,
+        args.precision,
+    )
+    file_labels = [label for label, _ in file_entries]
+    for result in results:
+        productive_filter, vdj_filter, vj_filter = result['variant']
+        title = f"ALL PAIRWISE WASSERSTEIN DISTANCES - FILTERS: {result['label']}"
+        if args.n_grid == 'auto':
+            print(f"Grid size (--n-grid auto, {result['label']}): {result['n_grid']}")
+            print()
+        if args.output_file:
+            output_file = _variant_path(args.output_file, result['label'])
+            save_distances(
+                output_file,
+                [file_path for _, file_path in file_entries],
+                distance_parameters(
+                    f"common:{result['n_grid']}",
+                    freq_column=args.freq_column,
+                    weights_column=args.weights_column,
+                    productive_filter=productive_filter,
+                    vdj_filter=vdj_filter,
+                    vj_filter=vj_filter,
+                    discretization=args.discretization,
+                ),
+                pairwise=result['distances'],
+            )
+            print(f"Distances saved to {output_file}")
+            if args.square_matrix:
+                square_matrix = _variant_path(args.square_matrix, result['label'])
+                save_square_distances(square_matrix, result['distances'], len(file_entries))
+                print(f"Square matrix saved to {square_matrix}")
+            print()
+        if args.statistics_only or args.output_file:
+            print_results_normal(file_labels, result['distances'], f"{title} - STATISTICS", statistics_only=True)
+        else:
+            print_results_normal(file_labels, result['distances'], title)
+        print()
+    print_filter_variants_summary(results)
+
+
 def main():
     """Main function."""
     args = parse_args()
+    start_instrumentation(args)
     freq_column = args.freq_column
     weights_column = args.weights_column
     n_grid = args.n_grid
@@ -199,6 +490,8 @@ def main():
     productive_filter = args.productive_filter
     vdj_filter = args.vdj_filter
     vj_filter = args.vj_filter
+    chunk_size = args.chunk_size
+    discretization = args.discretization
     positional_args = args.inputs
     
     try:
@@ -210,17 +503,47 @@ def main():
                 sys.exit(1)
 
             files_list = positional_args[0]
+            if args.filter_variants is not None:
+                run_filter_variants(args, files_list)
+                return
             if not pipeline_mode:
                 print(f"Computing all-pairs distances from file list: {files_list}")
                 print()
-            results = compute_distance_all_pairs(files_list, freq_column, weights_column, n_grid, productive_filter, vdj_filter, vj_filter)
+            file_entries, distances, n_grid = compute_distance_all_pairs(files_list, freq_column, weights_column, n_grid, productive_filter, vdj_filter, vj_filter, chunk_size, args.n_grid_tolerance, discretization, args.memory_budget, args.precision)
+            if args.n_grid == 'auto' and not pipeline_mode:
+                print(f"Grid size (--n-grid auto): {n_grid}")
+                print()
+            labels = [label for label, _ in file_entries]
+            if args.output_file:
+                save_distances(
+                    args.output_file,
+                    [file_path for _, file_path in file_entries],
+                    distance_parameters(
+                        f"common:{n_grid}",
+                        freq_column=freq_column,
+                        weights_column=weights_column,
+                        productive_filter=productive_filter,
+                        vdj_filter=vdj_filter,
+                        vj_filter=vj_filter,
+                        discretization=discretization,
+                    ),
+                    pairwise=distances,
+                )
+                if args.square_matrix:
+                    save_square_distances(args.square_matrix, distances, len(file_entries))
+                if not pipeline_mode:
+                    print(f"Distances saved to {args.output_file}")
+                    if args.square_matrix:
+                        print(f"Square matrix saved to {args.square_matrix}")
+                    print()
             if not pipeline_mode:
-                if statistics_only:
-                    print_results_normal(results, "ALL PAIRWISE WASSERSTEIN DISTANCES - STATISTICS", statistics_only=True)
+                # With --output the per-pair table is left to the file
+                if statistics_only or args.output_file:
+                    print_results_normal(labels, distances, "ALL PAIRWISE WASSERSTEIN DISTANCES - STATISTICS", statistics_only=True)
                 else:
-                    print_results_normal(results, "ALL PAIRWISE WASSERSTEIN DISTANCES")
-            else:
-                print_results_pipeline(results)
+                    print_results_normal(labels, distances, "ALL PAIRWISE WASSERSTEIN DISTANCES")
+            elif not args.output_file:
+                print_results_pipeline(distances)
         else:
             # Single pair mode
             if len(positional_args) != 2:
@@ -229,8 +552,8 @@ def main():
                 sys.exit(1)
 
             file1, file2 = positional_args
-            if not file1.endswith('.tsv') or not file2.endswith('.tsv'):
-                print("Error: Single-pair mode requires two .tsv files")
+            if not is_tsv_path(file1) or not is_tsv_path(file2):
+                print("Error: Single-pair mode requires two .tsv (or .tsv.gz/.tsv.zst/.tsv.bz2) files")
                 sys.exit(1)
             
             if not pipeline_mode:
@@ -239,12 +562,15 @@ def main():
                 print(f"  File 2: {file2}")
                 print()
             
-            distance, f1, f2, n_rows1, n_rows2 = compute_distance_single_pair(
+            distance, f1, f2, n_rows1, n_rows2, n_grid = compute_distance_single_pair(
                 file1, file2,
                 freq_column, weights_column, n_grid,
                 productive_filter,
                 vdj_filter,
-                vj_filter
+                vj_filter,
+                chunk_size,
+                args.n_grid_tolerance,
+                discretization,
             )
             
             if pipeline_mode:
@@ -257,6 +583,8 @@ def main():
                 print("Rows after filtering:")
                 print(f"  {file1}: {n_rows1}")
                 print(f"  {file2}: {n_rows2}")
+                if args.n_grid == 'auto':
+                    print(f"Grid size (--n-grid auto): {n_grid}")
                 print(f"Distance: {distance:.10e}")
                 print("=" * 60)
     
@@ -1,169 +1,81 @@
 #!/usr/bin/env python3
 """
 Plot distributions from TSV files and their Wasserstein barycenter on a single figure.
+
+Individual distributions are drawn as one line collection, or above
+--band-threshold samples as a quantile band (median, IQR, 5-95%).
 """
 
 import sys
 import os
-import glob
 import argparse
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+from instrumentation import add_instrumentation_arguments, stage, start_instrumentation
+from plot_utils import pyplot
+from ot_utils import (
+    DISCRETIZATION_METHODS,
+    check_barycenter_provenance,
+    find_tsv_files,
+    histogram_cache_mismatches,
+    load_histogram,
+    load_histograms,
+    sample_source_dir,
+    save_histograms,
+)
 
 
-def is_no_weights(value):
-    """Check if the weights column should be disabled."""
-    if isinstance(value, str):
-        return value.lower() in ["no", "off", "none", "disabled", "ones"]
-    return False
+PLOT_STYLES = ("auto", "lines", "band")
 
+# Loading options recorded with cached histograms
+_HISTOGRAM_OPTIONS = ('freq_column', 'weights_column', 'productive_filter', 'vdj_filter', 'vj_filter', 'discretization')
 
-def get_column_index(df, column_param):
-    """
-    Get column index from either a number or column name.
-    
-    Parameters:
-    -----------
-    df : DataFrame
-        The pandas DataFrame
-    column_param : str or int
-        Either a column index (string representation of number) or column name
-    
-    Returns:
-    --------
-    int: Column index
-    """
-    # Try to interpret as a number first
-    try:
-        col_idx = int(column_param)
-        if 0 <= col_idx < len(df.columns):
-            return col_idx
-    except (ValueError, TypeError):
-        pass
-    
-    # Try to find by column name
-    if column_param in df.columns:
-        return df.columns.get_loc(column_param)
-    
-    # If not found, raise an error
-    raise ValueError(f"Column '{column_param}' not found. Available columns: {list(df.columns)}")
+# Value of options missing from caches saved before they existed
+_HISTOGRAM_DEFAULTS = {'discretization': 'nearest'}
 
 
-def load_distribution(filepath, freq_column, weights_column, productive_filter=False, vdj_filter=False, vj_filter=False):
-    """
-    Load TSV file and extract sample values and their weights.
-    
-    Parameters:
-    -----------
-    filepath : str
-        Path to the TSV file
-    freq_column : str or int
-        Column index or name for sample values
-    weights_column : str or int
-        Column index or name for weights, or "NO"/"off" to disable weights
-    productive_filter : bool
-        If True and 'productive' column exists, filter only productive sequences
-    vdj_filter : bool
-        If True, require non-empty v_call/d_call/j_call for existing columns
-    vj_filter : bool
-        If True, require non-empty v_call/j_call for existing columns
-    
-    Returns:
-    --------
-    tuple: (sample_values, weights)
-    """
-    df = pd.read_csv(filepath, sep='\t')
-    
-    # Apply productive filter if requested and column exists
-    if productive_filter and 'productive' in df.columns:
-        df = df[df['productive'] == True].copy()
+def _load_distributions(tsv_files, grid, freq_column, weights_column, productive_filter, vdj_filter, vj_filter, chunk_size, discretization="nearest"):
+    """Bin every file on the barycenter grid while streaming it."""
+    discretized_distributions = []
+    filenames = []
+    for filepath in tsv_files:
+        filename = os.path.basename(filepath)
+        dist, n_rows, _ = load_histogram(
+            filepath,
+            grid,
+            freq_column=freq_column,
+            weights_column=weights_column,
+            productive_filter=productive_filter,
+            vdj_filter=vdj_filter,
+            vj_filter=vj_filter,
+            chunk_size=chunk_size,
+            discretization=discretization,
+        )
+        discretized_distributions.append(dist)
+        filenames.append(filename)
+        print(f"  Loaded {filename}: {n_rows} samples")
+    return discretized_distributions, filenames
 
-    # Apply VDJ filter if requested (for existing columns only)
-    if vdj_filter:
-        for vdj_col in ['v_call', 'd_call', 'j_call']:
-            if vdj_col in df.columns:
-                mask = df[vdj_col].notna() & (df[vdj_col].astype(str).str.strip() != "")
-                df = df[mask].copy()
 
-    # Apply VJ filter if requested (for existing columns only)
-    if vj_filter:
-        for vj_col in ['v_call', 'j_call']:
-            if vj_col in df.columns:
-                mask = df[vj_col].notna() & (df[vj_col].astype(str).str.strip() != "")
-                df = df[mask].copy()
-    
-    # Get sample values
-    freq_idx = get_column_index(df, freq_column)
-    sample_values = df.iloc[:, freq_idx].values.astype(float)
+def _plot_lines(ax, grid, histograms):
+    """Draw all individual distributions as a single LineCollection."""
+    from matplotlib.collections import LineCollection
 
-    if len(sample_values) == 0:
-        raise ValueError(
-            f"No valid rows remaining after filtering for file '{filepath}'. "
-            "Check --productive-filter / --vdj-filter / --vj-filter or input data."
-        )
-    
-    # Check if we should use weights
-    use_weights = not is_no_weights(weights_column)
-    
-    if use_weights:
-        try:
-            weights_idx = get_column_index(df, weights_column)
-            weights = df.iloc[:, weights_idx].values.astype(float)
-        except (ValueError, IndexError) as e:
-            print(f"Warning ({os.path.basename(filepath)}): {e}. Using uniform weights.")
-            weights = np.ones(len(sample_values))
-    else:
-        weights = np.ones(len(sample_values))
-    
-    # Normalize weights
-    if weights.sum() <= 0:
-        raise ValueError(f"Weights sum to zero after filtering for file '{filepath}'.")
-    weights = weights / weights.sum()
-    
-    return sample_values, weights
+    segments = np.empty((len(histograms), len(grid), 2))
+    segments[:, :, 0] = grid
+    segments[:, :, 1] = histograms
+    lines = LineCollection(
+        segments, colors='gray', alpha=0.25, linewidths=1.0, label='Individual distributions'
+    )
+    ax.add_collection(lines)
+    ax.autoscale_view()
 
 
-def discretize_on_grid(values, weights, grid):
-    """
-    Discretize a weighted distribution onto a grid.
-    
-    Parameters:
-    -----------
-    values : array
-        Sample values
-    weights : array
-        Weights for each sample (normalized)
-    grid : array
-        Grid points for discretization
-    
-    Returns:
-    --------
-    array: Discretized probability distribution on the grid
-    """
-    # Filter out zero values
-    mask = values > 0
-    values_filtered = values[mask]
-    weights_filtered = weights[mask]
-    
-    if len(values_filtered) == 0:
-        # Use uniform if no valid values
-        return np.ones(len(grid)) / len(grid)
-    
-    # Define bin edges for consistent histogramming
-    bin_edges = np.concatenate([[grid[0] / 2], (grid[:-1] + grid[1:]) / 2, [grid[-1] * 2]])
-    
-    # Create histogram on the grid with consistent bins
-    hist, _ = np.histogram(values_filtered, bins=bin_edges, weights=weights_filtered)
-    
-    # Normalize to probability distribution
-    hist_sum = hist.sum()
-    if hist_sum > 0:
-        hist = hist / hist_sum
-    else:
-        hist = np.ones(len(grid)) / len(grid)
-    
-    return hist
+def _plot_band(ax, grid, histograms):
+    """Draw the median, IQR and 5-95% envelope of the distributions."""
+    p5, p25, p50, p75, p95 = np.percentile(histograms, [5, 25, 50, 75, 95], axis=0)
+    ax.fill_between(grid, p5, p95, color='gray', alpha=0.2, linewidth=0, label='5–95% of distributions')
+    ax.fill_between(grid, p25, p75, color='gray', alpha=0.4, linewidth=0, label='Interquartile range')
+    ax.plot(grid, p50, color='dimgray', linewidth=1.5, linestyle='--', label='Median of distributions')
 
 
 def parse_args():
@@ -171,7 +83,7 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description="Plot distributions from TSV files and their Wasserstein barycenter.",
     )
-    parser.add_argument("input_folder", help="Path to folder containing TSV files")
+    parser.add_argument("input_folder", help="Path to folder (or cohort store) containing TSV files")
     parser.add_argument("--barycenter", default="barycenter.npz", dest="barycenter_file")
     parser.add_argument("--freq-column", default="pgen", dest="freq_column")
     parser.add_argument(
@@ -180,15 +92,67 @@ def parse_args():
         dest="weights_column",
     )
     parser.add_argument("--output-plot", default="barycenter_plot.png", dest="output_plot")
+    parser.add_argument(
+        "--plot-style",
+        choices=PLOT_STYLES,
+        default="auto",
+        dest="plot_style",
+        help="lines (one line per sample), band (median/IQR/5-95%% quantiles) or auto (default)",
+    )
+    parser.add_argument(
+        "--band-threshold",
+        type=int,
+        default=100,
+        dest="band_threshold",
+        help="With --plot-style auto, draw a quantile band above this many samples (default: 100)",
+    )
+    parser.add_argument(
+        "--histograms",
+        default=None,
+        dest="histograms_file",
+        help="Read the discretized distributions from this cache (see --save-histograms) instead of the TSV files",
+    )
+    parser.add_argument(
+        "--save-histograms",
+        default=None,
+        dest="save_histograms_file",
+        help="Save the discretized distributions to this .npz cache for later plots",
+    )
     parser.add_argument("--productive-filter", action="store_true", dest="productive_filter")
     parser.add_argument("--vdj-filter", action="store_true", dest="vdj_filter")
     parser.add_argument("--vj-filter", action="store_true", dest="vj_filter")
-    return parser.parse_args()
+    parser.add_argument(
+        "--discretization",
+        choices=DISCRETIZATION_METHODS,
+        default="nearest",
+        dest="discretization",
+        help="Assign each value to its nearest grid bin, or split its mass linearly (in log pgen) "
+             "between the two neighbouring grid points; must match the barycenter (default: nearest)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
+    if args.band_threshold < 1:
+        parser.error("--band-threshold must be >= 1")
+    if args.histograms_file and args.save_histograms_file:
+        parser.error("--histograms and --save-histograms are mutually exclusive")
+
+    return args
 
 
 def main():
     """Main function."""
     args = parse_args()
+    start_instrumentation(args)
     input_folder = args.input_folder
     barycenter_file = args.barycenter_file
     freq_column = args.freq_column
@@ -197,6 +161,8 @@ def main():
     productive_filter = args.productive_filter
     vdj_filter = args.vdj_filter
     vj_filter = args.vj_filter
+    chunk_size = args.chunk_size
+    discretization = args.discretization
     
     # Determine path to barycenter file
     if os.path.isabs(barycenter_file) or barycenter_file.startswith('~'):
@@ -204,7 +170,7 @@ def main():
         barycenter_path = os.path.expanduser(barycenter_file)
     else:
         # Just a filename - search in input_folder
-        barycenter_path = os.path.join(input_folder, barycenter_file)
+        barycenter_path = os.path.join(sample_source_dir(input_folder), barycenter_file)
     
     # Check if barycenter file exists
     if not os.path.exists(barycenter_path):
@@ -221,7 +187,7 @@ def main():
     print()
     
     # Find all TSV files
-    tsv_files = sorted(glob.glob(os.path.join(input_folder, "*.tsv")))
+    tsv_files = [str(f) for f in find_tsv_files(input_folder)]
     
     if not tsv_files:
         print(f"Error: No TSV files found in {input_folder}")
@@ -231,33 +197,85 @@ def main():
     print(f"Frequency column: {freq_column}")
     print(f"Weights column: {weights_column}")
     print()
+
+    stale = check_barycenter_provenance(
+        barycenter_path,
+        tsv_files,
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        discretization=discretization,
+    )
+    if stale:
+        print("Warning: barycenter does not match the current cloud files or options:")
+        for problem in stale:
+            print(f"  - {problem}")
+        print("Rerun olga-barycenter-ot.py to refresh it.")
+        print()
     
     try:
-        # Load all distributions
-        discretized_distributions = []
-        filenames = []
-        
-        for filepath in tsv_files:
-            filename = os.path.basename(filepath)
-            values, weights = load_distribution(filepath, freq_column, weights_column, productive_filter, vdj_filter, vj_filter)
-            
-            # Discretize on the barycenter's grid
-            dist = discretize_on_grid(values, weights, grid)
-            discretized_distributions.append(dist)
-            filenames.append(filename)
-            
-            print(f"  Loaded {filename}: {len(values)} samples")
+        discretized_distributions = None
+        if args.histograms_file:
+            histograms_path = os.path.expanduser(args.histograms_file)
+            cached_grid, histograms, filenames, options = load_histograms(histograms_path)
+            if not np.array_equal(cached_grid, grid):
+                print(f"Error: Histograms in {histograms_path} are on a different grid than the barycenter")
+                sys.exit(1)
+            mismatches = [
+                f"{option}: cache {options.get(option, _HISTOGRAM_DEFAULTS.get(option))!r}, now {getattr(args, option)!r}"
+                for option in _HISTOGRAM_OPTIONS
+                if options.get(option, _HISTOGRAM_DEFAULTS.get(option)) != getattr(args, option)
+            ]
+            stale = histogram_cache_mismatches(histograms_path, tsv_files)
+            if mismatches:
+                print("Warning: histogram cache was built with different options:")
+                for problem in mismatches:
+                    print(f"  - {problem}")
+            if stale:
+                print(f"Warning: histogram cache does not match the TSV files in {input_folder}:")
+                for problem in stale:
+                    print(f"  - {problem}")
+            if mismatches or stale:
+                print("Reading the TSV files instead.")
+                print()
+            else:
+                print(f"Loaded {len(filenames)} cached histograms from: {histograms_path}")
+                discretized_distributions = histograms
+        if discretized_distributions is None:
+            discretized_distributions, filenames = _load_distributions(
+                tsv_files, grid, freq_column, weights_column,
+                productive_filter, vdj_filter, vj_filter, chunk_size,
+                discretization=discretization,
+            )
+            if args.save_histograms_file:
+                histograms_path = os.path.expanduser(args.save_histograms_file)
+                save_histograms(
+                    histograms_path, grid, discretized_distributions, tsv_files,
+                    options={option: getattr(args, option) for option in _HISTOGRAM_OPTIONS},
+                )
+                print(f"Histograms saved to: {histograms_path}")
+        histograms = np.asarray(discretized_distributions)
+
+        plot_style = args.plot_style
+        if plot_style == "auto":
+            plot_style = "band" if len(histograms) > args.band_threshold else "lines"
         
         print()
-        print("Generating plot...")
+        print(f"Generating plot ({plot_style})...")
         
         # Create figure
+        plt = pyplot()
         fig, ax = plt.subplots(figsize=(26, 14))
         
-        # Plot all individual distributions in light gray
-        for i, dist in enumerate(discretized_distributions):
-            ax.plot(grid, dist, color='gray', alpha=0.25, linewidth=1.0, label='Individual distributions' if i == 0 else '')
-        
+        # Plot the individual distributions in light gray
+        with stage('plot'):
+            if plot_style == "band":
+                _plot_band(ax, grid, histograms)
+            else:
+                _plot_lines(ax, grid, histograms)
+
         # Plot barycenter in red with thicker line
         ax.plot(grid, barycenter, color='red', linewidth=2.5, label='Wasserstein Barycenter', zorder=10)
         
@@ -282,10 +300,11 @@ def main():
         if os.path.isabs(output_plot) or os.path.dirname(output_plot):
             output_path = os.path.expanduser(output_plot)
         else:
-            output_path = os.path.join(input_folder, output_plot)
+            output_path = os.path.join(sample_source_dir(input_folder), output_plot)
         
         print(f"Saving plot to: {output_path}")
-        plt.savefig(output_path, dpi=150, bbox_inches='tight')
+        with stage('plot'):
+            plt.savefig(output_path, dpi=150, bbox_inches='tight')
         
         print("Plot generated successfully!")
         
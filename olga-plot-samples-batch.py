@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Render one diagnostic plot per sample: the sample's discretized
+distribution against the barycenter, with its distance to the barycenter.
+
+The barycenter is loaded once and handed to a pool of worker processes;
+each worker renders with the Agg backend into a single reused figure.
+"""
+
+import sys
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from instrumentation import add_instrumentation_arguments, stage, start_instrumentation
+from plot_utils import pyplot
+from repertoires import REPERTOIRE_PRECISIONS, load_log_distribution
+from ot_utils import (
+    DISCRETIZATION_METHODS,
+    _label_from_filename,
+    find_tsv_files,
+    input_exists,
+    is_sample_source,
+    sample_source_dir,
+    load_barycenter,
+    check_barycenter_provenance,
+    compute_wasserstein_distance,
+    extend_grid_for_files,
+    extend_grid_if_needed,
+    tsv_stem,
+)
+
+
+# Per-process state set up once by _init_worker
+_worker = {}
+
+
+def _resolve_barycenter_path(barycenter_folder, barycenter_file):
+    """Resolve barycenter file path (absolute or relative to folder)."""
+    if os.path.isabs(barycenter_file) or barycenter_file.startswith("~"):
+        return Path(os.path.expanduser(barycenter_file))
+    return sample_source_dir(barycenter_folder) / barycenter_file
+
+
+def _load_sample_files(samples_path):
+    """Load sample files from folder or text file list."""
+    samples_path = Path(os.path.expanduser(str(samples_path)))
+    custom_labels = {}
+
+    if is_sample_source(samples_path):
+        files = find_tsv_files(samples_path)
+        output_folder = sample_source_dir(samples_path)
+    elif samples_path.is_file():
+        files = []
+        with open(samples_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split(None, 1)
+                file_path = Path(os.path.expanduser(parts[0]))
+                files.append(file_path)
+                if len(parts) > 1:
+                    custom_labels[file_path] = parts[1].strip()
+
+        missing = [f for f in files if not input_exists(f)]
+        if missing:
+            print(f"Error: The following files from {samples_path} do not exist:")
+            for f in missing:
+                print(f"  {f}")
+            sys.exit(1)
+        output_folder = samples_path.parent
+    else:
+        print(f"Error: Path does not exist: {samples_path}")
+        sys.exit(1)
+
+    return files, output_folder, custom_labels
+
+
+def _init_worker(grid, barycenter_weights, options, dpi, discretization="nearest"):
+    """
+    Keep the barycenter and one reusable figure in the worker process.
+
+    `grid` is the run's extended grid; a worker grows its copy only for
+    samples outside it, so all plots of a run usually share one x range.
+    """
+    plt = pyplot()
+    fig, ax = plt.subplots(figsize=(13, 7))
+    _worker.update(
+        grid=grid,
+        barycenter_weights=barycenter_weights,
+        options=options,
+        dpi=dpi,
+        discretization=discretization,
+        fig=fig,
+        ax=ax,
+    )
+
+
+def _render_sample(task):
+    """
+    Load one sample, compute its distance to the barycenter and save its plot.
+
+    Parameters
+    ----------
+    task : tuple
+        (file path, label, output image path)
+
+    Returns
+    -------
+    dict
+        file, label, distance, n_samples, output (or error)
+    """
+    file_path, label, output_path = task
+    try:
+        distribution = load_log_distribution(str(file_path), **_worker['options'])
+        extended_grid, extended_barycenter = extend_grid_if_needed(
+            _worker['grid'], _worker['barycenter_weights'], distribution.min, distribution.max
+        )
+        _worker.update(grid=extended_grid, barycenter_weights=extended_barycenter)
+        sample_discretized = distribution.histogram(extended_grid, _worker['discretization'])
+        distance = compute_wasserstein_distance(
+            extended_grid, sample_discretized,
+            extended_grid, extended_barycenter,
+            metric="log_l1",
+            method="emd"
+        )
+
+        fig, ax = _worker['fig'], _worker['ax']
+        ax.clear()
+        ax.plot(extended_grid, extended_barycenter, color='red', linewidth=2.0, label='Wasserstein Barycenter')
+        ax.plot(extended_grid, sample_discretized, color='#4E79A7', linewidth=1.5, label=label)
+        ax.set_xscale('log')
+        ax.set_xlabel('pgen (log scale)', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Probability Density', fontsize=12, fontweight='bold')
+        ax.set_title(f'{label}: distance to barycenter = {distance:.4f} ({len(distribution)} samples)',
+                     fontsize=14, fontweight='bold')
+        ax.grid(True, alpha=0.3, linestyle='--')
+        ax.legend(fontsize=11, loc='best')
+        fig.savefig(output_path, dpi=_worker['dpi'], bbox_inches='tight')
+    except Exception as exc:
+        return {'file': Path(file_path).name, 'label': label, 'error': str(exc)}
+
+    return {
+        'file': Path(file_path).name,
+        'label': label,
+        'distance': distance,
+        'n_samples': len(distribution),
+        'output': output_path,
+    }
+
+
+def parse_args():
+    """Parse CLI arguments."""
+    parser = argparse.ArgumentParser(
+        description="Render one distribution-vs-barycenter plot per sample, in parallel.",
+    )
+    parser.add_argument("barycenter_folder", help="Folder (or cohort store) containing TSV files and barycenter.npz")
+    parser.add_argument(
+        "samples",
+        help="Either folder (or cohort store) with TSV files or text file with one TSV path per line",
+    )
+    parser.add_argument("--freq-column", default="pgen", dest="freq_column")
+    parser.add_argument(
+        "--weights-column",
+        default="duplicate_frequency_percent",
+        dest="weights_column",
+    )
+    parser.add_argument("--barycenter", default="barycenter.npz", dest="barycenter_file")
+    parser.add_argument(
+        "--output-dir",
+        default="sample-plots",
+        dest="output_dir",
+        help="Directory for the plots, absolute or relative to the samples folder (default: sample-plots)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        dest="workers",
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument("--dpi", type=int, default=100, dest="dpi", help="Image resolution (default: 100)")
+    parser.add_argument("--productive-filter", action="store_true", dest="productive_filter")
+    parser.add_argument("--vdj-filter", action="store_true", dest="vdj_filter")
+    parser.add_argument("--vj-filter", action="store_true", dest="vj_filter")
+    parser.add_argument(
+        "--discretization",
+        choices=DISCRETIZATION_METHODS,
+        default="nearest",
+        dest="discretization",
+        help="Assign each value to its nearest grid bin, or split its mass linearly (in log pgen) "
+             "between the two neighbouring grid points; must match the barycenter (default: nearest)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=REPERTOIRE_PRECISIONS,
+        default="float32",
+        dest="precision",
+        help="Precision of the log pgen values and non-count weights held in memory (default: float32)",
+    )
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
+    if args.workers is not None and args.workers <= 0:
+        parser.error("--workers must be > 0")
+    if args.dpi <= 0:
+        parser.error("--dpi must be > 0")
+
+    return args
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    start_instrumentation(args)
+    barycenter_folder = Path(args.barycenter_folder).expanduser()
+    samples_path = Path(args.samples).expanduser()
+
+    if not is_sample_source(barycenter_folder):
+        print(f"Error: Barycenter folder does not exist: {barycenter_folder}")
+        sys.exit(1)
+
+    barycenter_path = _resolve_barycenter_path(barycenter_folder, args.barycenter_file)
+    if not barycenter_path.exists():
+        print(f"Error: Barycenter file not found: {barycenter_path}")
+        print("Please run olga-barycenter-ot.py first to compute the barycenter.")
+        sys.exit(1)
+
+    print(f"Loading barycenter from: {barycenter_path}")
+    grid, barycenter_weights = load_barycenter(str(barycenter_path))
+
+    samples_files, output_folder, custom_labels = _load_sample_files(samples_path)
+    if not samples_files:
+        print("Error: No sample TSV files found")
+        sys.exit(1)
+
+    stale = check_barycenter_provenance(
+        str(barycenter_path),
+        find_tsv_files(barycenter_folder),
+        freq_column=args.freq_column,
+        weights_column=args.weights_column,
+        productive_filter=args.productive_filter,
+        vdj_filter=args.vdj_filter,
+        vj_filter=args.vj_filter,
+        discretization=args.discretization,
+    )
+    if stale:
+        print("Warning: barycenter does not match the current cloud files or options:")
+        for problem in stale:
+            print(f"  - {problem}")
+        print("Rerun olga-barycenter-ot.py to refresh it.")
+
+    output_dir = os.path.expanduser(args.output_dir)
+    if not os.path.isabs(output_dir):
+        output_dir = os.path.join(output_folder, output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    tasks = [
+        (
+            str(file_path),
+            custom_labels.get(file_path, _label_from_filename(file_path)),
+            os.path.join(output_dir, f"{tsv_stem(file_path)}.png"),
+        )
+        for file_path in samples_files
+    ]
+    options = dict(
+        freq_column=args.freq_column,
+        weights_column=args.weights_column,
+        productive_filter=args.productive_filter,
+        vdj_filter=args.vdj_filter,
+        vj_filter=args.vj_filter,
+        chunk_size=args.chunk_size,
+        precision=args.precision,
+    )
+    grid, barycenter_weights = extend_grid_for_files(grid, barycenter_weights, samples_files)
+    workers = min(args.workers or os.cpu_count() or 1, len(tasks))
+    print(f"Rendering {len(tasks)} plots with {workers} worker(s) into {output_dir}")
+
+    results = []
+    if workers == 1:
+        # No pool overhead for a single worker
+        _init_worker(grid, barycenter_weights, options, args.dpi, args.discretization)
+        rendered = map(_render_sample, tasks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(grid, barycenter_weights, options, args.dpi, args.discretization),
+        )
+        rendered = pool.map(_render_sample, tasks, chunksize=max(1, len(tasks) // (4 * workers)))
+    try:
+        # Stages run inside worker processes are not recorded here
+        with stage('render'):
+            for result in rendered:
+                results.append(result)
+                if 'error' in result:
+                    print(f"  Warning: Error processing {result['file']}: {result['error']}")
+                else:
+                    print(f"  {result['label']:<12} {result['distance']:>12.6e}  {result['output']}")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    n_failed = sum('error' in result for result in results)
+    print()
+    print(f"Plots written: {len(results) - n_failed}, failed: {n_failed}")
+    if n_failed == len(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
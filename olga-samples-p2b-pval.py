@@ -3,6 +3,10 @@
 Compute p-values for sample distributions relative to a barycenter.
 For each sample, compute distance to barycenter and assess significance
 using a null hypothesis model fitted to normal samples.
+
+With --leave-one-out, the normal (cloud) samples used for the model, and
+samples that are themselves cloud files, are compared with the barycenter
+of the other cloud samples instead of one that includes themselves.
 """
 
 import sys
@@ -10,22 +14,30 @@ import os
 import argparse
 from pathlib import Path
 import numpy as np
-from scipy import stats
+from instrumentation import add_instrumentation_arguments, stage, start_instrumentation
 from ot_utils import (
+    DISCRETIZATION_METHODS,
     _label_from_filename,
-    load_distribution,
+    find_tsv_files,
+    input_exists,
+    is_sample_source,
+    sample_source_dir,
     load_barycenter,
+    check_barycenter_provenance,
     compute_wasserstein_distance,
-    discretize_distribution,
-    extend_grid_if_needed
+    extend_grid_if_needed,
+    leave_one_out_distances,
+    member_positions,
+    values_range,
 )
+from repertoires import REPERTOIRE_PRECISIONS, RepertoireCache, memory_budget_argument, open_repertoires, value_ranges
 
 
 def _resolve_barycenter_path(barycenter_folder, barycenter_file):
     """Resolve barycenter file path (absolute or relative to folder)."""
     if os.path.isabs(barycenter_file) or barycenter_file.startswith("~"):
         return Path(os.path.expanduser(barycenter_file))
-    return barycenter_folder / barycenter_file
+    return sample_source_dir(barycenter_folder) / barycenter_file
 
 
 def _load_sample_files(samples_path):
@@ -51,9 +63,9 @@ def _load_sample_files(samples_path):
     samples_path = Path(os.path.expanduser(str(samples_path)))
     custom_labels = {}
     
-    if samples_path.is_dir():
-        files = sorted(samples_path.glob("*.tsv"))
-        output_folder = samples_path
+    if is_sample_source(samples_path):
+        files = find_tsv_files(samples_path)
+        output_folder = sample_source_dir(samples_path)
     elif samples_path.is_file():
         files = []
         with open(samples_path, 'r') as f:
@@ -69,7 +81,7 @@ def _load_sample_files(samples_path):
                     # Custom label provided
                     custom_labels[file_path] = parts[1].strip()
         
-        missing = [f for f in files if not f.exists()]
+        missing = [f for f in files if not input_exists(f)]
         if missing:
             print(f"Error: The following files from {samples_path} do not exist:")
             for f in missing:
@@ -83,65 +95,30 @@ def _load_sample_files(samples_path):
     return files, output_folder, custom_labels
 
 
-def _compute_distances_to_barycenter(files, grid, barycenter_weights, freq_column, weights_column, productive_filter, vdj_filter, vj_filter):
+def _compute_distances_to_barycenter(repertoires, extended_grid, extended_barycenter, discretization="nearest"):
     """
     Compute distances from multiple samples to barycenter.
     
     Parameters
     ----------
-    files : list of Path
-        List of sample files
-    grid : np.ndarray
-        Barycenter grid
-    barycenter_weights : np.ndarray
-        Barycenter weights
-    freq_column : str
-        Frequency column name/index
-    weights_column : str
-        Weights column name/index
-    productive_filter : bool
-        Filter only productive sequences
-    vdj_filter : bool
-        If True, require non-empty V/D/J call columns when present
-    vj_filter : bool
-        If True, require non-empty V/J call columns when present
+    repertoires : list of repertoires.Repertoire
+        Handles on the sample files
+    extended_grid : np.ndarray
+        Barycenter grid, extended to cover every sample (computed once per
+        run with extend_grid_if_needed)
+    extended_barycenter : np.ndarray
+        Barycenter weights on the extended grid
+    discretization : str
+        Method of discretize_distribution ('nearest' or 'linear')
         
     Returns
     -------
     distances : np.ndarray
         1D array of distances to barycenter
-    extended_grid : np.ndarray
-        Extended grid
-    extended_barycenter : np.ndarray
-        Extended barycenter
     """
-    # Load all samples first to determine grid extension
-    all_samples = []
-    all_values = []
-    
-    for file_path in files:
-        values, weights = load_distribution(
-            str(file_path),
-            freq_column=freq_column,
-            weights_column=weights_column,
-            productive_filter=productive_filter,
-            vdj_filter=vdj_filter,
-            vj_filter=vj_filter
-        )
-        all_samples.append((values, weights))
-        all_values.append(values)
-    
-    # Extend grid
-    extended_grid, extended_barycenter = extend_grid_if_needed(
-        grid, barycenter_weights,
-        np.concatenate(all_values).min(),
-        np.concatenate(all_values).max()
-    )
-    
-    # Compute distances to barycenter
     distances = []
-    for values, weights in all_samples:
-        sample_discretized = discretize_distribution(values, weights, extended_grid)
+    for repertoire in repertoires:
+        sample_discretized = repertoire.histogram(extended_grid, discretization)
         distance = compute_wasserstein_distance(
             extended_grid, sample_discretized,
             extended_grid, extended_barycenter,
@@ -150,7 +127,7 @@ def _compute_distances_to_barycenter(files, grid, barycenter_weights, freq_colum
         )
         distances.append(distance)
     
-    return np.array(distances), extended_grid, extended_barycenter
+    return np.array(distances)
 
 
 # ============================================================================
@@ -257,6 +234,8 @@ def compute_pvalue(distance, model):
             # Degenerate case: all distances are identical
             return 1.0 if distance == mean else 0.0
         
+        from scipy import stats
+
         # Standardize
         z_score = (distance - mean) / std
         # Two-tailed p-value
@@ -326,10 +305,10 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description="Compute p-values for sample distributions relative to a barycenter.",
     )
-    parser.add_argument("barycenter_folder", help="Folder containing TSV files and barycenter.npz")
+    parser.add_argument("barycenter_folder", help="Folder (or cohort store) containing TSV files and barycenter.npz")
     parser.add_argument(
         "samples",
-        help="Either folder with TSV files to evaluate or text file with one TSV path per line",
+        help="Either folder (or cohort store) with TSV files to evaluate or text file with one TSV path per line",
     )
     parser.add_argument("--freq-column", default="pgen", dest="freq_column")
     parser.add_argument(
@@ -341,6 +320,43 @@ def parse_args():
     parser.add_argument("--productive-filter", action="store_true", dest="productive_filter")
     parser.add_argument("--vdj-filter", action="store_true", dest="vdj_filter")
     parser.add_argument("--vj-filter", action="store_true", dest="vj_filter")
+    parser.add_argument(
+        "--discretization",
+        choices=DISCRETIZATION_METHODS,
+        default="nearest",
+        dest="discretization",
+        help="Assign each value to its nearest grid bin, or split its mass linearly (in log pgen) "
+             "between the two neighbouring grid points; must match the barycenter (default: nearest)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=memory_budget_argument,
+        default=None,
+        dest="memory_budget",
+        help="Keep at most this much raw repertoire data in memory, e.g. 512M or 4G; "
+             "samples beyond it are read again when needed (default: unlimited)",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=REPERTOIRE_PRECISIONS,
+        default="float32",
+        dest="precision",
+        help="Precision of the log pgen values and non-count weights held in memory (default: float32)",
+    )
+    parser.add_argument(
+        "--leave-one-out",
+        action="store_true",
+        dest="leave_one_out",
+        help="Compare each cloud sample (for the normal model, or when it is also scored) with "
+             "the exact 1-D barycenter of the other cloud samples",
+    )
     parser.add_argument(
         "--null-distribution",
         default=None,
@@ -359,7 +375,13 @@ def parse_args():
         dest="no_null_distribution",
         help="Do not use null distribution (use normal approximation only)"
     )
-    return parser.parse_args()
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
+
+    return args
 
 
 # ============================================================================
@@ -369,6 +391,7 @@ def parse_args():
 def main():
     """Main function."""
     args = parse_args()
+    start_instrumentation(args)
     barycenter_folder = Path(args.barycenter_folder)
     samples_path = Path(args.samples)
     freq_column = args.freq_column
@@ -377,6 +400,8 @@ def main():
     productive_filter = args.productive_filter
     vdj_filter = args.vdj_filter
     vj_filter = args.vj_filter
+    chunk_size = args.chunk_size
+    discretization = args.discretization
 
     # Load barycenter
     barycenter_path = _resolve_barycenter_path(barycenter_folder, barycenter_file)
@@ -384,7 +409,7 @@ def main():
     grid, barycenter_weights = load_barycenter(str(barycenter_path))
 
     # Get TSV files
-    barycenter_files = sorted(barycenter_folder.glob("*.tsv"))
+    barycenter_files = find_tsv_files(barycenter_folder)
     samples_files, _, custom_labels = _load_sample_files(samples_path)
 
     if not barycenter_files:
@@ -396,6 +421,22 @@ def main():
 
     print(f"Found {len(barycenter_files)} barycenter files, {len(samples_files)} sample files")
 
+    stale = check_barycenter_provenance(
+        str(barycenter_path),
+        barycenter_files,
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        discretization=discretization,
+    )
+    if stale:
+        print("Warning: barycenter does not match the current cloud files or options:")
+        for problem in stale:
+            print(f"  - {problem}")
+        print("Rerun olga-barycenter-ot.py to refresh it.")
+
     # Determine p-value computation method
     use_null_distribution = False
     use_normal_approx = False
@@ -412,7 +453,7 @@ def main():
             null_dist_path = args.null_distribution_file
         else:
             # Default: look for p2b-ot-null.txt in barycenter folder
-            null_dist_path = barycenter_folder / "p2b-ot-null.txt"
+            null_dist_path = sample_source_dir(barycenter_folder) / "p2b-ot-null.txt"
         
         if Path(null_dist_path).exists():
             try:
@@ -437,70 +478,108 @@ def main():
     # Show both p-values if null distribution is available and --normal-approximation is requested
     show_both = use_null_distribution and args.use_normal_approximation
 
-    # If not using null distribution, fit normal model
-    if use_normal_approx or (not use_null_distribution and not args.use_normal_approximation):
-        print("Computing distances for normal samples (barycenter files)...")
-        barycenter_distances, extended_grid, extended_barycenter = _compute_distances_to_barycenter(
-            barycenter_files, grid, barycenter_weights,
-            freq_column, weights_column, productive_filter, vdj_filter, vj_filter
+    # The cloud distances are only needed to fit the normal model; with a
+    # null distribution the cloud files are not loaded at all
+    fit_model = use_normal_approx or (not use_null_distribution and not args.use_normal_approximation)
+    load_options = dict(
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        chunk_size=chunk_size,
+        precision=args.precision,
+    )
+    # Scored samples that are cloud files (leave-one-out only)
+    positions = member_positions(samples_files, barycenter_files) if args.leave_one_out else []
+    leave_one_out = any(position is not None for position in positions) or (args.leave_one_out and fit_model)
+    if leave_one_out and len(barycenter_files) < 2:
+        print("Error: --leave-one-out needs at least two barycenter files")
+        sys.exit(1)
+    cache = RepertoireCache(args.memory_budget)
+    load_cloud = fit_model or leave_one_out
+    cloud_samples = open_repertoires(barycenter_files, cache=cache, **load_options) if load_cloud else []
+    sample_samples = open_repertoires(samples_files, cache=cache, **load_options)
+
+    # One extended grid for the whole run, covering every sample
+    extended_grid, extended_barycenter = extend_grid_if_needed(
+        grid, barycenter_weights, *values_range(value_ranges(cloud_samples + sample_samples))
+    )
+
+    if leave_one_out:
+        print("Computing leave-one-out distances for normal samples (barycenter files)...")
+        leave_one_out_cloud = leave_one_out_distances(
+            extended_grid, [sample.histogram(extended_grid, discretization) for sample in cloud_samples]
         )
+
+    # If not using null distribution, fit normal model
+    if fit_model:
+        if leave_one_out:
+            barycenter_distances = leave_one_out_cloud
+        else:
+            print("Computing distances for normal samples (barycenter files)...")
+            barycenter_distances = _compute_distances_to_barycenter(
+                cloud_samples, extended_grid, extended_barycenter, discretization=discretization
+            )
         
         print("Fitting normal distribution model...")
-        model = fit_null_hypothesis(barycenter_distances)
+        with stage('statistics'):
+            model = fit_null_hypothesis(barycenter_distances)
         print(f"  Model: {model['description']}")
         print()
-    else:
-        # Using null distribution, still need to compute extended grid from barycenter files
-        print("Computing extended grid from barycenter files...")
-        barycenter_distances, extended_grid, extended_barycenter = _compute_distances_to_barycenter(
-            barycenter_files, grid, barycenter_weights,
-            freq_column, weights_column, productive_filter, vdj_filter, vj_filter
-        )
-        print()
 
     # Compute distances and p-values for sample files
     print("Computing distances and p-values for sample files...")
-    sample_distances, _, _ = _compute_distances_to_barycenter(
-        samples_files, extended_grid, extended_barycenter,
-        freq_column, weights_column, productive_filter, vdj_filter, vj_filter
+    sample_distances = _compute_distances_to_barycenter(
+        [sample for sample, position in zip(sample_samples, positions) if position is None]
+        if leave_one_out else sample_samples,
+        extended_grid, extended_barycenter, discretization=discretization
     )
-
-    # Compute p-values
-    results = []
-    for sample_file, distance in zip(samples_files, sample_distances):
-        result = {}
-        # Compute primary p-value
-        if use_null_distribution and null_distribution is not None:
-            result['pvalue'] = compute_pvalue_from_null_distribution(distance, null_distribution)
-        elif model is not None:
-            result['pvalue'] = compute_pvalue(distance, model)
-        else:
-            result['pvalue'] = 1.0
-        
-        # If showing both, also compute normal approximation p-value
-        if show_both and model is not None:
-            result['pvalue_normal'] = compute_pvalue(distance, model)
-        
-        # Use custom label if provided, otherwise auto-generate
-        label = custom_labels.get(sample_file, _label_from_filename(sample_file))
-        result.update({
-            'filename': str(sample_file),
-            'sample': label,
-            'distance': distance,
-        })
-        results.append(result)
-
-    # Compute Bonferroni-adjusted p-values
-    raw_pvalues = [r['pvalue'] for r in results]
-    adjusted_pvalues = compute_bonferroni_adjusted_pvalues(raw_pvalues)
-    for r, adj_p in zip(results, adjusted_pvalues):
-        r['pvalue_adjusted'] = adj_p
-
-    if show_both:
-        raw_pvalues_normal = [r['pvalue_normal'] for r in results]
-        adjusted_pvalues_normal = compute_bonferroni_adjusted_pvalues(raw_pvalues_normal)
-        for r, adj_p in zip(results, adjusted_pvalues_normal):
-            r['pvalue_normal_adjusted'] = adj_p
+    if leave_one_out:
+        # Cloud members take their leave-one-out distance, in sample order
+        other_distances = iter(sample_distances)
+        sample_distances = np.array([
+            leave_one_out_cloud[position] if position is not None else next(other_distances)
+            for position in positions
+        ])
+
+    with stage('statistics'):
+        # Compute p-values
+        results = []
+        for sample_file, distance in zip(samples_files, sample_distances):
+            result = {}
+            # Compute primary p-value
+            if use_null_distribution and null_distribution is not None:
+                result['pvalue'] = compute_pvalue_from_null_distribution(distance, null_distribution)
+            elif model is not None:
+                result['pvalue'] = compute_pvalue(distance, model)
+            else:
+                result['pvalue'] = 1.0
+
+            # If showing both, also compute normal approximation p-value
+            if show_both and model is not None:
+                result['pvalue_normal'] = compute_pvalue(distance, model)
+
+            # Use custom label if provided, otherwise auto-generate
+            label = custom_labels.get(sample_file, _label_from_filename(sample_file))
+            result.update({
+                'filename': str(sample_file),
+                'sample': label,
+                'distance': distance,
+            })
+            results.append(result)
+
+        # Compute Bonferroni-adjusted p-values
+        raw_pvalues = [r['pvalue'] for r in results]
+        adjusted_pvalues = compute_bonferroni_adjusted_pvalues(raw_pvalues)
+        for r, adj_p in zip(results, adjusted_pvalues):
+            r['pvalue_adjusted'] = adj_p
+
+        if show_both:
+            raw_pvalues_normal = [r['pvalue_normal'] for r in results]
+            adjusted_pvalues_normal = compute_bonferroni_adjusted_pvalues(raw_pvalues_normal)
+            for r, adj_p in zip(results, adjusted_pvalues_normal):
+                r['pvalue_normal_adjusted'] = adj_p
 
     # Sort by adjusted p-value
     results = sorted(results, key=lambda x: x['pvalue_adjusted'])
@@ -532,6 +611,8 @@ def main():
         print(f"P-value computation method: Empirical null distribution ({len(null_distribution)} values)")
     else:
         print(f"P-value computation method: Normal approximation")
+    if leave_one_out:
+        print("Cloud samples compared with leave-one-out barycenters (the other cloud samples)")
     print()
 
     # Print summary statistics
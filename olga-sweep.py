@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+"""
+Sweep the barycenter and sample-to-barycenter distances over a grid of
+parameters: grid size, weights column, row filters and discretization.
+
+Each combination gets what olga-barycenter-ot.py followed by olga-p2b-ot.py
+would compute with its options. The work is planned once for the whole
+sweep instead of once per combination:
+
+- each file is read once per weights column, for all filter combinations
+  at once ('off' reuses the rows of a weighted read);
+- a grid depends only on the filters and the grid size, so the weights
+  columns and discretizations share it;
+- each histogram is computed once; when the samples are the cloud it
+  serves both the barycenter and the distances;
+- combinations that come to the same settings (--n-grid auto choosing a
+  listed size), or whose histograms agree to within --share-tolerance
+  (weights columns proportional to each other, such as
+  duplicate_frequency_percent and duplicate_count), share their
+  barycenter and distances.
+
+The barycenters and distances are then solved in parallel, one task per
+distinct combination, and all results are written to one table.
+"""
+
+import sys
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+import numpy as np
+from instrumentation import add_instrumentation_arguments, stage, start_instrumentation
+from ot_utils import (
+    DISCRETIZATION_METHODS,
+    N_GRID_AUTO_TOLERANCE,
+    _label_from_filename,
+    _weights_disabled,
+    compute_wasserstein_distance,
+    create_common_grid,
+    extend_grid_if_needed,
+    filter_variant_label,
+    filter_variants_argument,
+    find_tsv_files,
+    input_exists,
+    is_sample_source,
+    lp_barycenter_of_histograms,
+    n_grid_argument,
+    pad_to_extended_grid,
+    select_n_grid,
+    values_range,
+)
+from repertoires import (
+    REPERTOIRE_PRECISIONS,
+    memory_budget_argument,
+    open_repertoire_settings,
+    value_ranges,
+    values_view,
+    weights_view,
+)
+
+
+# Columns of the results table, one row per (combination, sample)
+RESULT_COLUMNS = (
+    'configuration', 'n_grid_requested', 'n_grid', 'weights_column', 'filters',
+    'discretization', 'label', 'file', 'n_rows', 'distance',
+)
+
+
+def _comma_list(value):
+    """Split a comma-separated option value, dropping repeats."""
+    items = [item.strip() for item in str(value).split(',')]
+    if not all(items):
+        raise argparse.ArgumentTypeError(f"empty item in {value!r}")
+    return list(dict.fromkeys(items))
+
+
+def _n_grid_list(value):
+    """argparse type of --n-grid: comma-separated sizes and/or 'auto'."""
+    return list(dict.fromkeys(n_grid_argument(item) for item in _comma_list(value)))
+
+
+def _discretization_list(value):
+    """argparse type of --discretization: comma-separated methods."""
+    methods = _comma_list(value)
+    unknown = [method for method in methods if method not in DISCRETIZATION_METHODS]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"unknown discretization {unknown[0]!r} (use {', '.join(DISCRETIZATION_METHODS)})"
+        )
+    return methods
+
+
+def _load_sample_files(samples_path):
+    """Load sample files from folder or text file list."""
+    samples_path = Path(os.path.expanduser(str(samples_path)))
+    custom_labels = {}
+
+    if is_sample_source(samples_path):
+        files = find_tsv_files(samples_path)
+    elif samples_path.is_file():
+        files = []
+        with open(samples_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split(None, 1)
+                file_path = Path(os.path.expanduser(parts[0]))
+                files.append(file_path)
+                if len(parts) > 1:
+                    custom_labels[file_path] = parts[1].strip()
+
+        missing = [f for f in files if not input_exists(f)]
+        if missing:
+            print(f"Error: The following files from {samples_path} do not exist:")
+            for f in missing:
+                print(f"  {f}")
+            sys.exit(1)
+    else:
+        print(f"Error: Path does not exist: {samples_path}")
+        sys.exit(1)
+
+    return files, custom_labels
+
+
+def _solve_configuration(task):
+    """
+    Barycenter of the cloud histograms and distances of the sample histograms to it.
+
+    Parameters
+    ----------
+    task : tuple
+        (key, grid, cloud histograms, extended grid, sample histograms)
+
+    Returns
+    -------
+    key : tuple
+        The task's key
+    distances : np.ndarray
+        Distance of each sample to the barycenter
+    """
+    key, grid, cloud_histograms, extended_grid, sample_histograms = task
+    barycenter = lp_barycenter_of_histograms(grid, cloud_histograms)
+    extended_barycenter = pad_to_extended_grid(barycenter, grid, extended_grid)
+    distances = np.array([
+        compute_wasserstein_distance(
+            extended_grid, histogram,
+            extended_grid, extended_barycenter,
+            metric="log_l1",
+            method="emd"
+        )
+        for histogram in sample_histograms
+    ])
+    return key, distances
+
+
+def _same_inputs(task, other, tolerance):
+    """Whether two tasks have the same grids and histograms within `tolerance` (relative)."""
+    _, grid, cloud_histograms, extended_grid, sample_histograms = task
+    _, other_grid, other_cloud, other_extended, other_samples = other
+    if not (np.array_equal(grid, other_grid) and np.array_equal(extended_grid, other_extended)):
+        return False
+    for histograms, other_histograms in ((cloud_histograms, other_cloud), (sample_histograms, other_samples)):
+        histograms, other_histograms = np.array(histograms), np.array(other_histograms)
+        if tolerance == 0:
+            if not np.array_equal(histograms, other_histograms):
+                return False
+        elif not np.allclose(histograms, other_histograms, rtol=tolerance, atol=0):
+            return False
+    return True
+
+
+def _share_tasks(tasks, tolerance):
+    """
+    Keep one task of each group with the same inputs (see _same_inputs).
+
+    Returns
+    -------
+    representatives : list of tuple
+        Tasks to solve
+    shared : dict
+        Key of each task -> key of the task whose result it takes
+    """
+    representatives = []
+    shared = {}
+    for task in tasks:
+        for other in representatives:
+            if _same_inputs(task, other, tolerance):
+                shared[task[0]] = other[0]
+                break
+        else:
+            representatives.append(task)
+            shared[task[0]] = task[0]
+    return representatives, shared
+
+
+def parse_args():
+    """Parse CLI arguments."""
+    parser = argparse.ArgumentParser(
+        description="Compute the barycenter and sample-to-barycenter distances for every combination "
+                    "of grid size, weights column, filters and discretization, sharing the work between them.",
+    )
+    parser.add_argument("cloud", help="Folder (or cohort store) with the TSV files of the cloud")
+    parser.add_argument(
+        "samples",
+        nargs="?",
+        default=None,
+        help="Folder (or cohort store) with TSV files or text file with one TSV path per line "
+             "(default: the cloud samples)",
+    )
+    parser.add_argument("--freq-column", default="pgen", dest="freq_column")
+    parser.add_argument(
+        "--n-grid",
+        type=_n_grid_list,
+        default=[200],
+        dest="n_grids",
+        help="Comma-separated grid sizes; 'auto' selects one per weights column, filters and "
+             "discretization as in olga-barycenter-ot.py (default: 200)",
+    )
+    parser.add_argument(
+        "--n-grid-tolerance",
+        type=float,
+        default=N_GRID_AUTO_TOLERANCE,
+        dest="n_grid_tolerance",
+        help=f"Relative change accepted as converged by --n-grid auto (default: {N_GRID_AUTO_TOLERANCE})",
+    )
+    parser.add_argument(
+        "--weights-column",
+        type=_comma_list,
+        default=["duplicate_frequency_percent"],
+        dest="weights_columns",
+        help="Comma-separated weights columns, 'off' for uniform weights (default: duplicate_frequency_percent)",
+    )
+    parser.add_argument(
+        "--filter-variants",
+        type=filter_variants_argument,
+        default=[(False, False, False)],
+        dest="filter_variants",
+        help="Comma-separated filter combinations, filters joined with '+', e.g. "
+             "'none,productive,productive+vdj', or 'all' for all eight (default: none)",
+    )
+    parser.add_argument(
+        "--discretization",
+        type=_discretization_list,
+        default=["nearest"],
+        dest="discretizations",
+        help=f"Comma-separated discretization methods ({', '.join(DISCRETIZATION_METHODS)}; default: nearest)",
+    )
+    parser.add_argument(
+        "--share-tolerance",
+        type=float,
+        default=1e-6,
+        dest="share_tolerance",
+        help="Combinations whose cloud and sample histograms agree to within this relative "
+             "difference share one barycenter and distance set; 0 shares only identical "
+             "histograms (default: 1e-6)",
+    )
+    parser.add_argument(
+        "--output",
+        default="sweep-results.tsv",
+        dest="output_file",
+        help="Results table (tab-separated, one row per combination and sample; default: sweep-results.tsv)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        dest="workers",
+        help="Number of worker processes solving combinations (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        dest="dry_run",
+        help="Print the plan (reads, grids, histograms, barycenters) without computing it",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        dest="chunk_size",
+        help="Read TSV files in chunks of this many rows to bound memory (default: whole file)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=memory_budget_argument,
+        default=None,
+        dest="memory_budget",
+        help="Keep at most this much raw repertoire data in memory, e.g. 512M or 4G; "
+             "samples beyond it are read again when needed (default: unlimited)",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=REPERTOIRE_PRECISIONS,
+        default="float32",
+        dest="precision",
+        help="Precision of the log pgen values and non-count weights held in memory (default: float32)",
+    )
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    if args.n_grid_tolerance <= 0:
+        parser.error("--n-grid-tolerance must be > 0")
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be > 0")
+    if args.workers is not None and args.workers <= 0:
+        parser.error("--workers must be > 0")
+    if args.share_tolerance < 0:
+        parser.error("--share-tolerance must be >= 0")
+
+    return args
+
+
+def _print_plan(configurations, settings, n_cloud, n_samples, samples_are_cloud):
+    """Print the combinations and the shared work they need."""
+    n_reads = len({column for column, _ in settings if not _weights_disabled(column)}) or 1
+    n_grids = len({(variant, n_grid) for n_grid, _, variant, _ in configurations})
+    n_histogram_sets = len({(column, variant, n_grid, method) for n_grid, column, variant, method in configurations})
+    print(f"Sweep: {len(configurations)} combination(s)")
+    print(f"  --n-grid:          {', '.join(str(n_grid) for n_grid in dict.fromkeys(c[0] for c in configurations))}")
+    print(f"  --weights-column:  {', '.join(dict.fromkeys(c[1] for c in configurations))}")
+    print(f"  --filter-variants: {', '.join(dict.fromkeys(filter_variant_label(c[2]) for c in configurations))}")
+    print(f"  --discretization:  {', '.join(dict.fromkeys(c[3] for c in configurations))}")
+    print("Plan:")
+    print(f"  {n_reads} read(s) of each of {n_cloud} cloud file(s)"
+          + ("" if samples_are_cloud else f" and {n_samples} sample file(s)")
+          + f", for {len(settings)} (weights column, filters) setting(s)")
+    print(f"  {n_grids} common grid(s) (filters x grid size; 'auto' sizes resolved first)")
+    print(f"  {n_histogram_sets} histogram set(s) of the cloud"
+          + (", reused for the distances" if samples_are_cloud else " and as many of the samples"))
+    print(f"  up to {len(configurations)} barycenter(s) and distance set(s), one task each")
+    print()
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    start_instrumentation(args)
+
+    cloud = Path(args.cloud).expanduser()
+    if not is_sample_source(cloud):
+        print(f"Error: Cloud folder does not exist: {cloud}")
+        sys.exit(1)
+    cloud_files = find_tsv_files(cloud)
+    if not cloud_files:
+        print(f"Error: No TSV files found in {cloud}")
+        sys.exit(1)
+
+    samples_are_cloud = args.samples is None
+    if samples_are_cloud:
+        sample_files, custom_labels = cloud_files, {}
+    else:
+        sample_files, custom_labels = _load_sample_files(args.samples)
+        if not sample_files:
+            print("Error: No sample TSV files found")
+            sys.exit(1)
+
+    configurations = list(product(args.n_grids, args.weights_columns, args.filter_variants, args.discretizations))
+    settings = list(dict.fromkeys((column, variant) for _, column, variant, _ in configurations))
+    _print_plan(configurations, settings, len(cloud_files), len(sample_files), samples_are_cloud)
+    if args.dry_run:
+        return
+
+    output_file = os.path.expanduser(args.output_file)
+    try:
+        load_options = dict(freq_column=args.freq_column, chunk_size=args.chunk_size, precision=args.precision)
+        cloud_sets = open_repertoire_settings(
+            [str(f) for f in cloud_files], settings, memory_budget=args.memory_budget, **load_options
+        )
+        if samples_are_cloud:
+            sample_sets = cloud_sets
+        else:
+            sample_sets = open_repertoire_settings(
+                [str(f) for f in sample_files], settings, cache=cloud_sets[0][0].cache, **load_options
+            )
+        cloud_handles = dict(zip(settings, cloud_sets))
+        sample_handles = dict(zip(settings, sample_sets))
+
+        # Value ranges, file by file so that every setting of a file comes
+        # from the same read; they do not depend on the weights column
+        for file_index in range(len(cloud_files)):
+            for repertoires in cloud_sets:
+                repertoires[file_index].value_range
+        if not samples_are_cloud:
+            for file_index in range(len(sample_files)):
+                for repertoires in sample_sets:
+                    repertoires[file_index].value_range
+
+        # Resolve --n-grid auto per (weights column, filters, discretization)
+        resolved = []
+        for n_grid, column, variant, method in configurations:
+            if n_grid == 'auto':
+                with stage('select_n_grid'):
+                    repertoires = cloud_handles[(column, variant)]
+                    n_grid, _ = select_n_grid(
+                        values_view(repertoires),
+                        weights_view(repertoires),
+                        tolerance=args.n_grid_tolerance,
+                        discretization=method,
+                    )
+            resolved.append((n_grid, column, variant, method))
+        if 'auto' in args.n_grids:
+            for (requested, column, variant, method), (n_grid, _, _, _) in zip(configurations, resolved):
+                if requested == 'auto':
+                    print(f"--n-grid auto: {n_grid} ({column}, {filter_variant_label(variant)}, {method})")
+            print()
+
+        # Common grids (filters x size) and their extension over the samples
+        grids = {}
+        extended_grids = {}
+        for n_grid, column, variant, _ in resolved:
+            if (variant, n_grid) in grids:
+                continue
+            grid = create_common_grid(value_ranges(cloud_handles[(column, variant)]), n_grid=n_grid, log_space=True)
+            grids[(variant, n_grid)] = grid
+            extended_grid = grid
+            if not samples_are_cloud:
+                sample_min, sample_max = values_range(value_ranges(sample_handles[(column, variant)]))
+                extended_grid, _ = extend_grid_if_needed(grid, np.zeros(len(grid)), sample_min, sample_max)
+            extended_grids[(variant, n_grid)] = extended_grid
+
+        # Histograms, file by file; each handle keeps one per (grid, method)
+        keys = list(dict.fromkeys(resolved))
+        with stage('histograms'):
+            for file_index in range(len(cloud_files)):
+                for n_grid, column, variant, method in keys:
+                    cloud_handles[(column, variant)][file_index].histogram(grids[(variant, n_grid)], method)
+            for file_index in range(len(sample_files)):
+                for n_grid, column, variant, method in keys:
+                    sample_handles[(column, variant)][file_index].histogram(extended_grids[(variant, n_grid)], method)
+        cloud_sets[0][0].cache.clear()
+
+        tasks = []
+        for key in keys:
+            n_grid, column, variant, method = key
+            grid = grids[(variant, n_grid)]
+            extended_grid = extended_grids[(variant, n_grid)]
+            tasks.append((
+                key,
+                grid,
+                [repertoire.histogram(grid, method) for repertoire in cloud_handles[(column, variant)]],
+                extended_grid,
+                [repertoire.histogram(extended_grid, method) for repertoire in sample_handles[(column, variant)]],
+            ))
+
+        tasks, shared = _share_tasks(tasks, args.share_tolerance)
+        workers = min(args.workers or os.cpu_count() or 1, len(tasks))
+        print(f"Solving {len(tasks)} distinct combination(s) with {workers} worker(s)")
+        if len(tasks) < len(configurations):
+            print(f"  ({len(configurations) - len(tasks)} combination(s) share the result of another)")
+        distances = {}
+        # Stages run inside worker processes are not recorded here
+        with stage('solve'):
+            if workers == 1:
+                solved = map(_solve_configuration, tasks)
+                pool = None
+            else:
+                pool = ProcessPoolExecutor(max_workers=workers)
+                solved = pool.map(_solve_configuration, tasks)
+            try:
+                for key, key_distances in solved:
+                    distances[key] = key_distances
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+        for key, representative in shared.items():
+            distances[key] = distances[representative]
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Error: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+    labels = [custom_labels.get(file_path, _label_from_filename(file_path)) for file_path in sample_files]
+    with open(output_file, 'w') as handle:
+        handle.write('\t'.join(RESULT_COLUMNS) + '\n')
+        for index, (configuration, key) in enumerate(zip(configurations, resolved), start=1):
+            requested, column, variant, method = configuration
+            n_rows = [repertoire.n_rows for repertoire in sample_handles[(column, variant)]]
+            for file_path, label, rows, distance in zip(sample_files, labels, n_rows, distances[key]):
+                handle.write('\t'.join([
+                    str(index), str(requested), str(key[0]), column, filter_variant_label(variant),
+                    method, label, str(file_path), str(rows), f"{distance:.10e}",
+                ]) + '\n')
+
+    print()
+    print("=" * 100)
+    print("SWEEP RESULTS (distance to the barycenter over the samples)")
+    print("=" * 100)
+    print(f"{'#':>3} {'n_grid':>7} {'Weights column':<28} {'Filters':<18} {'Discr.':<8} "
+          f"{'Mean':>12} {'Median':>12} {'Max':>12} {'From':>5}")
+    print("-" * 100)
+    # Number of the first combination solved for each task
+    solved_by = {}
+    for index, key in enumerate(resolved, start=1):
+        solved_by.setdefault(shared[key], index)
+    for index, (configuration, key) in enumerate(zip(configurations, resolved), start=1):
+        requested, column, variant, method = configuration
+        n_grid = f"{key[0]}*" if requested == 'auto' else str(key[0])
+        values = distances[key]
+        source = solved_by[shared[key]]
+        print(f"{index:>3} {n_grid:>7} {column:<28} {filter_variant_label(variant):<18} {method:<8} "
+              f"{np.mean(values):>12.6e} {np.median(values):>12.6e} {np.max(values):>12.6e} "
+              f"{'' if source == index else '#' + str(source):>5}")
+    print("=" * 100)
+    if 'auto' in args.n_grids:
+        print("* chosen by --n-grid auto")
+    if len(tasks) < len(configurations):
+        print("From: combination whose barycenter and distances were reused")
+    print(f"Results table ({len(configurations) * len(sample_files)} rows) saved to: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
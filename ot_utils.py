@@ -3,15 +3,248 @@
 Common utilities for Optimal Transport operations on TCR distributions.
 Provides consistent distance computation across all scripts.
 """
+import bz2
+import contextlib
+import gzip
+import hashlib
+import json
+import os
 import re
+import shutil
+import subprocess
+from itertools import combinations
+from pathlib import Path
 import numpy as np
-import pandas as pd
-import ot
+# pandas and POT are imported inside the functions that use them: they
+# dominate the start-up time of every script.
+from cohort_store import (
+    FLAG_PRODUCTIVE,
+    FLAG_VDJ,
+    FLAG_VJ,
+    CohortStoreWriter,
+    filter_flags,
+    is_cohort_store,
+    open_cohort_store,
+    split_member_path,
+)
+from instrumentation import count, stage
+
+
+# Version of the provenance record stored next to barycenter weights.
+BARYCENTER_PROVENANCE_VERSION = 1
+
+# Version of the parameter record stored in distance artifacts.
+DISTANCES_VERSION = 1
+
+# --n-grid auto: grid sizes tried (N_GRID_AUTO_START, times N_GRID_AUTO_FACTOR
+# up to N_GRID_AUTO_MAX) and number of cohort samples they are tried on.
+N_GRID_AUTO_START = 50
+N_GRID_AUTO_FACTOR = 2
+N_GRID_AUTO_MAX = 800
+N_GRID_AUTO_SUBSAMPLE = 10
+N_GRID_AUTO_TOLERANCE = 0.05
+
+# How values are assigned to grid points (see discretize_distribution):
+# 'nearest' puts each value's whole weight on its bin, 'linear' splits it
+# between the two neighbouring grid points in proportion to log-distance.
+DISCRETIZATION_METHODS = ('nearest', 'linear')
+
+# Canonical log-pgen lattice for histogram sketches: SKETCH_BINS_PER_DECADE
+# equal-width bins per decade of pgen, from 10**SKETCH_LOG10_MIN to 1.
+# Values outside the lattice fall into the end bins.
+SKETCH_LOG10_MIN = -45.0
+SKETCH_LOG10_MAX = 0.0
+SKETCH_BINS_PER_DECADE = 256
+SKETCH_N_BINS = int(round((SKETCH_LOG10_MAX - SKETCH_LOG10_MIN) * SKETCH_BINS_PER_DECADE))
+
+# Recognized repertoire file suffixes, in order of preference when the same
+# sample is present both plain and compressed.
+TSV_SUFFIXES = ('.tsv', '.tsv.gz', '.tsv.zst', '.tsv.bz2')
+
+# External decompressors tried before the Python codecs, fastest first.
+# Each entry is (executable, argument list); '{threads}' is substituted.
+_DECOMPRESSORS = {
+    '.gz': [('pigz', ['-dc', '-p', '{threads}']), ('gzip', ['-dc'])],
+    '.zst': [('zstd', ['-dc', '-q', '-T{threads}'])],
+    '.bz2': [('lbzip2', ['-dc', '-n', '{threads}']), ('pbzip2', ['-dc', '-p{threads}'])],
+}
+
+
+def tsv_suffix(path):
+    """Return the TSV suffix of a path ('.tsv', '.tsv.gz', ...) or None."""
+    name = Path(path).name.lower()
+    for suffix in sorted(TSV_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return suffix
+    return None
+
+
+def is_tsv_path(path):
+    """Check if a path is a plain or compressed TSV file name."""
+    return tsv_suffix(path) is not None
+
+
+def tsv_stem(path):
+    """File name without the (possibly compressed) TSV suffix."""
+    name = Path(path).name
+    suffix = tsv_suffix(path)
+    return name[:-len(suffix)] if suffix else Path(path).stem
+
+
+def find_tsv_files(folder):
+    """
+    Find plain and compressed TSV files in a folder or cohort store.
+
+    If the same sample exists in several forms (e.g. `a.tsv` and
+    `a.tsv.gz`), only the first one in TSV_SUFFIXES order is kept so that
+    no sample is counted twice.
+
+    Parameters
+    ----------
+    folder : str or Path
+        Folder to search (not recursive), or a cohort store file built by
+        olga-build-cohort-store.py. For a store, the returned paths are
+        member paths ('<store>/<file name>') accepted by load_distribution.
+
+    Returns
+    -------
+    list of Path
+        Files sorted by name.
+    """
+    folder = Path(folder)
+    if is_cohort_store(folder):
+        return sorted(open_cohort_store(folder).member_paths(), key=lambda p: p.name)
+    if not folder.is_dir():
+        return []
+    by_stem = {}
+    for path in folder.iterdir():
+        suffix = tsv_suffix(path)
+        if suffix is None or not path.is_file():
+            continue
+        stem = tsv_stem(path)
+        current = by_stem.get(stem)
+        if current is None or TSV_SUFFIXES.index(suffix) < TSV_SUFFIXES.index(tsv_suffix(current)):
+            by_stem[stem] = path
+    return sorted(by_stem.values(), key=lambda p: p.name)
+
+
+def is_sample_source(path):
+    """Check if a path can be used in place of a sample folder (folder or cohort store)."""
+    path = Path(os.path.expanduser(str(path)))
+    return path.is_dir() or is_cohort_store(path)
+
+
+def sample_source_dir(path):
+    """
+    Directory for files named relative to a sample folder or cohort store.
+
+    For a folder this is the folder itself; for a cohort store it is the
+    directory containing the store file.
+    """
+    path = Path(os.path.expanduser(str(path)))
+    return path.parent if is_cohort_store(path) else path
+
+
+def input_exists(path):
+    """Check if an input file exists (TSV file or member of a cohort store)."""
+    member = split_member_path(path)
+    if member is not None:
+        store_path, name = member
+        return name in open_cohort_store(store_path).names
+    return Path(os.path.expanduser(str(path))).exists()
+
+
+def _external_decompressor(compression):
+    """Command line of the first available external decompressor, or None."""
+    threads = str(os.cpu_count() or 1)
+    for executable, arguments in _DECOMPRESSORS.get(compression, []):
+        path = shutil.which(executable)
+        if path:
+            return [path] + [arg.replace('{threads}', threads) for arg in arguments]
+    return None
+
+
+def _needs_external_decompressor(filepath):
+    """True if only a command line tool can decompress `filepath` (.tsv.zst without `zstandard`)."""
+    if tsv_suffix(filepath) != '.tsv.zst':
+        return False
+    import importlib.util
+    return importlib.util.find_spec('zstandard') is None
+
+
+@contextlib.contextmanager
+def open_tsv(filepath, external=True):
+    """
+    Open a plain or compressed TSV file as a binary stream.
+
+    Compressed files are decompressed on the fly. When `external` is True
+    and a (multi-threaded) command line decompressor is available
+    (pigz, zstd, lbzip2/pbzip2), it is run in a subprocess and its output
+    is piped to the caller; otherwise Python's gzip/bz2 modules or the
+    optional `zstandard` package are used.
+
+    Parameters
+    ----------
+    filepath : str or Path
+        Path to a .tsv, .tsv.gz, .tsv.zst or .tsv.bz2 file
+    external : bool
+        Allow external decompressor processes
+
+    Yields
+    ------
+    file object
+        Binary stream of the decompressed TSV content.
+    """
+    filepath = str(filepath)
+    suffix = tsv_suffix(filepath) or '.tsv'
+    compression = suffix[len('.tsv'):]
+
+    if not compression:
+        with open(filepath, 'rb') as handle:
+            yield handle
+        return
+
+    command = _external_decompressor(compression) if external else None
+    if command is not None:
+        proc = subprocess.Popen(
+            command + [filepath], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stopped_early = False
+        try:
+            yield proc.stdout
+        finally:
+            if proc.poll() is None:
+                # Caller stopped reading before the end of the stream
+                proc.terminate()
+                stopped_early = True
+            proc.stdout.close()
+            stderr = proc.stderr.read().decode(errors='replace').strip()
+            proc.stderr.close()
+            returncode = proc.wait()
+        if returncode != 0 and not stopped_early:
+            raise OSError(f"Failed to decompress '{filepath}' with {Path(command[0]).name}: {stderr}")
+        return
+
+    if compression == '.gz':
+        opener = gzip.open
+    elif compression == '.bz2':
+        opener = bz2.open
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                f"Reading '{filepath}' requires the zstd command line tool "
+                "or the zstandard package (pip install zstandard)"
+            ) from None
+        opener = zstandard.open
+    with opener(filepath, 'rb') as handle:
+        yield handle
 
 
 def _label_from_filename(file_path):
     """Extract patient number and Base/Post status from filename."""
-    name = file_path.stem
+    name = tsv_stem(file_path)
     match = re.match(r"patient(\d+)", name, flags=re.IGNORECASE)
     if not match:
         return name
@@ -35,7 +268,8 @@ def _find_column_index(df, column_spec, param_name):
     df : pd.DataFrame
         DataFrame to search in
     column_spec : str or int
-        Column specification (name, substring, or index)
+        Column specification (name, substring, or index; digit strings are
+        treated as an index unless a column has exactly that name)
     param_name : str
         Parameter name for error messages
         
@@ -64,6 +298,10 @@ def _find_column_index(df, column_spec, param_name):
     if column_spec_str in df.columns:
         return df.columns.get_loc(column_spec_str)
     
+    # Numeric string from the command line (e.g. --freq-column 22)
+    if column_spec_str.isdigit():
+        return _find_column_index(df, int(column_spec_str), param_name)
+    
     # Try substring match
     matches = [col for col in df.columns if column_spec_str in col]
     
@@ -82,6 +320,372 @@ def _find_column_index(df, column_spec, param_name):
         )
 
 
+# Spellings of --weights-column that mean "uniform weights".
+_WEIGHTS_OFF_VALUES = ("off", "no", "none", "disabled", "ones")
+
+# Call columns checked by --vdj-filter and --vj-filter.
+_VDJ_COLUMNS = ('v_call', 'd_call', 'j_call')
+_VJ_COLUMNS = ('v_call', 'j_call')
+
+# Row filters, in the order of the (productive_filter, vdj_filter, vj_filter)
+# tuples that describe a filter combination.
+FILTER_NAMES = ('productive', 'vdj', 'vj')
+
+
+def filter_variant_label(variant):
+    """Name of a filter combination: 'none', 'productive', 'productive+vdj', ..."""
+    return '+'.join(name for name, enabled in zip(FILTER_NAMES, variant) if enabled) or 'none'
+
+
+def parse_filter_variants(text):
+    """
+    Parse a list of filter combinations such as 'none,productive,productive+vdj'.
+
+    Each comma-separated item joins filter names (productive, vdj, vj) with
+    '+', or is 'none' for no filter; 'all' stands for all eight
+    combinations. Raises ValueError for unknown names.
+
+    Returns
+    -------
+    list of (productive_filter, vdj_filter, vj_filter) tuples
+        In the given order, without duplicates.
+    """
+    variants = []
+    for item in str(text).split(','):
+        item = item.strip().lower()
+        if item == 'all':
+            candidates = [
+                tuple(name in names for name in FILTER_NAMES)
+                for size in range(len(FILTER_NAMES) + 1)
+                for names in combinations(FILTER_NAMES, size)
+            ]
+        elif item == 'none':
+            candidates = [(False, False, False)]
+        else:
+            names = [name.strip() for name in item.split('+')]
+            unknown = [name for name in names if name not in FILTER_NAMES]
+            if unknown:
+                raise ValueError(
+                    f"unknown filter {unknown[0]!r} in {text!r} (use {', '.join(FILTER_NAMES)}, none or all)"
+                )
+            candidates = [tuple(name in names for name in FILTER_NAMES)]
+        variants.extend(variant for variant in candidates if variant not in variants)
+    return variants
+
+
+def filter_variants_argument(value):
+    """argparse type of --filter-variants (see parse_filter_variants)."""
+    from argparse import ArgumentTypeError
+    try:
+        return parse_filter_variants(value)
+    except ValueError as exc:
+        raise ArgumentTypeError(str(exc))
+
+
+def _weights_disabled(weights_column):
+    """Check if the weights column specification means uniform weights."""
+    return isinstance(weights_column, str) and weights_column.lower() in _WEIGHTS_OFF_VALUES
+
+
+def _resolve_load_columns(filepath, freq_column, weights_column, productive_filter, vdj_filter, vj_filter):
+    """
+    Read the TSV header and decide which columns the loader needs.
+
+    Returns
+    -------
+    freq_name : str
+        Name of the frequency column.
+    weights_name : str or None
+        Name of the weights column (None for uniform weights).
+    filter_columns : dict
+        Filter name -> list of existing columns it checks.
+    """
+    import pandas as pd
+    # The header is tiny, so read it in-process rather than start a
+    # decompressor, unless there is no in-process decoder for the file
+    with open_tsv(filepath, external=_needs_external_decompressor(filepath)) as handle:
+        header = pd.read_csv(handle, sep='\t', nrows=0)
+    columns = header.columns
+
+    freq_name = columns[_find_column_index(header, freq_column, 'freq_column')]
+    weights_name = None
+    if not _weights_disabled(weights_column):
+        weights_name = columns[_find_column_index(header, weights_column, 'weights_column')]
+
+    filter_columns = {
+        'productive': ['productive'] if productive_filter and 'productive' in columns else [],
+        'vdj': [col for col in _VDJ_COLUMNS if vdj_filter and col in columns],
+        'vj': [col for col in _VJ_COLUMNS if vj_filter and col in columns],
+    }
+    return freq_name, weights_name, filter_columns
+
+
+def _row_filter_mask(df, filter_columns):
+    """Boolean mask of rows passing productive / VDJ / VJ filters."""
+    mask = np.ones(len(df), dtype=bool)
+    for col in filter_columns['productive']:
+        mask &= (df[col] == True).to_numpy()
+    for col in filter_columns['vdj'] + filter_columns['vj']:
+        mask &= (df[col].notna() & (df[col].astype(str).str.strip() != "")).to_numpy()
+    return mask
+
+
+def _row_filter_masks(df, filter_columns):
+    """
+    Boolean mask of each filter ('productive', 'vdj', 'vj') on its own.
+
+    Each call column is checked once, even if both --vdj-filter and
+    --vj-filter use it.
+    """
+    call_masks = {}
+    for col in set(filter_columns['vdj'] + filter_columns['vj']):
+        call_masks[col] = (df[col].notna() & (df[col].astype(str).str.strip() != "")).to_numpy()
+    masks = {}
+    for name in FILTER_NAMES:
+        mask = np.ones(len(df), dtype=bool)
+        for col in filter_columns[name]:
+            mask &= (df[col] == True).to_numpy() if name == 'productive' else call_masks[col]
+        masks[name] = mask
+    return masks
+
+
+def iter_filtered_chunks(
+    filepath,
+    freq_column="pgen",
+    weights_column="duplicate_frequency_percent",
+    productive_filter=False,
+    vdj_filter=False,
+    vj_filter=False,
+    chunk_size=None,
+    log_values=False,
+):
+    """
+    Read a TSV file in chunks and yield filtered values and raw weights.
+
+    Only the frequency, weights and filter columns are parsed. Row filters
+    and the positive-value filter are applied per chunk, so peak memory is
+    bounded by `chunk_size` rows of the projected columns.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to TSV file
+    freq_column, weights_column, productive_filter, vdj_filter, vj_filter
+        Same as in load_distribution.
+    chunk_size : int or None
+        Rows per chunk. None reads the whole file at once.
+    log_values : bool
+        Yield natural logs of the values (cohort stores hold them as logs,
+        so no exp/log round trip is made).
+
+    Yields
+    ------
+    values : np.ndarray
+        Positive frequency values of the rows passing all filters (their
+        logs with log_values).
+    weights : np.ndarray
+        Raw (unnormalized) weights of these rows; ones for uniform weights.
+    """
+    import pandas as pd
+    member = split_member_path(filepath)
+    if member is not None:
+        yield from _iter_store_chunks(
+            member, freq_column, weights_column,
+            productive_filter, vdj_filter, vj_filter, chunk_size, log_values,
+        )
+        return
+
+    freq_name, weights_name, filter_columns = _resolve_load_columns(
+        filepath, freq_column, weights_column, productive_filter, vdj_filter, vj_filter
+    )
+    needed = {freq_name}
+    if weights_name is not None:
+        needed.add(weights_name)
+    for cols in filter_columns.values():
+        needed.update(cols)
+
+    with open_tsv(filepath) as handle:
+        reader = pd.read_csv(handle, sep='\t', usecols=sorted(needed), chunksize=chunk_size)
+        chunks = [reader] if chunk_size is None else reader
+        for chunk in chunks:
+            with stage('filter'):
+                mask = _row_filter_mask(chunk, filter_columns)
+                values = chunk[freq_name].to_numpy()[mask]
+                valid_mask = values > 0
+                values = values[valid_mask]
+                if weights_name is None:
+                    weights = np.ones(len(values))
+                else:
+                    weights = chunk[weights_name].to_numpy()[mask][valid_mask]
+                if log_values:
+                    values = np.log(values)
+            count('rows_read', len(chunk))
+            count('rows_kept', len(values))
+            yield values, weights
+
+
+def _store_column_name(sample, column_spec, param_name):
+    """Resolve a column specification against a store sample's source header."""
+    import pandas as pd
+    header = pd.DataFrame(columns=sample['columns'])
+    return sample['columns'][_find_column_index(header, column_spec, param_name)]
+
+
+def _open_store_member(member, freq_column, weights_column):
+    """
+    Open a cohort store member and check the requested columns against the store.
+
+    Returns
+    -------
+    store : CohortStore
+    index : int
+        Position of the member in the store.
+    use_weights : bool
+        False if uniform weights were requested.
+    """
+    store_path, name = member
+    store = open_cohort_store(store_path)
+    index = store.index(name)
+    sample = store.samples[index]
+
+    freq_name = _store_column_name(sample, freq_column, 'freq_column')
+    if freq_name != store.header['freq_column']:
+        raise ValueError(
+            f"Cohort store '{store.path}' holds column '{store.header['freq_column']}', "
+            f"not '{freq_name}'. Rebuild it with olga-build-cohort-store.py --freq-column {freq_column}."
+        )
+    use_weights = not _weights_disabled(weights_column)
+    if use_weights:
+        weights_name = _store_column_name(sample, weights_column, 'weights_column')
+        if weights_name != store.header['weights_column']:
+            raise ValueError(
+                f"Cohort store '{store.path}' holds weights '{store.header['weights_column']}', "
+                f"not '{weights_name}'. Rebuild it with olga-build-cohort-store.py --weights-column {weights_column}."
+            )
+    return store, index, use_weights
+
+
+def _iter_store_chunks(member, freq_column, weights_column, productive_filter, vdj_filter, vj_filter, chunk_size, log_values=False):
+    """Yield (values, raw weights) of a cohort store member, like iter_filtered_chunks."""
+    store, index, use_weights = _open_store_member(member, freq_column, weights_column)
+    required = filter_flags(productive_filter, vdj_filter, vj_filter)
+    stored_log_values, weights, flags = store.rows(index)
+    step = chunk_size or max(len(stored_log_values), 1)
+    for start in range(0, len(stored_log_values), step):
+        stop = start + step
+        with stage('filter'):
+            mask = (flags[start:stop] & required) == required
+            values = stored_log_values[start:stop][mask]
+            if not log_values:
+                values = np.exp(values)
+            if use_weights:
+                chunk_weights = np.array(weights[start:stop][mask])
+            else:
+                chunk_weights = np.ones(len(values))
+        count('rows_read', len(mask))
+        count('rows_kept', len(values))
+        yield values, chunk_weights
+
+
+def iter_filter_variant_chunks(
+    filepath,
+    variants,
+    freq_column="pgen",
+    weights_column="duplicate_frequency_percent",
+    chunk_size=None,
+    log_values=False,
+):
+    """
+    Read a sample once and yield its rows with a mask per filter combination.
+
+    The file is parsed as for the union of the filters the combinations
+    use; each filter is evaluated once per chunk and each combination is a
+    boolean mask over the same parsed rows. Masked, the chunks are exactly
+    those of iter_filtered_chunks with that combination's filters.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to TSV file or cohort store member
+    variants : list of (productive_filter, vdj_filter, vj_filter)
+        Filter combinations (see parse_filter_variants)
+    freq_column, weights_column, chunk_size, log_values
+        Same as in iter_filtered_chunks.
+
+    Yields
+    ------
+    values : np.ndarray
+        Positive frequency values of the rows (their logs with log_values)
+    weights : np.ndarray
+        Raw weights of these rows; ones for uniform weights
+    masks : np.ndarray
+        Boolean array of shape (len(variants), len(values)): rows passing
+        each combination
+    """
+    import pandas as pd
+    used = [any(variant[position] for variant in variants) for position in range(len(FILTER_NAMES))]
+    member = split_member_path(filepath)
+    if member is not None:
+        store, index, use_weights = _open_store_member(member, freq_column, weights_column)
+        required = np.array([filter_flags(*variant) for variant in variants], dtype=np.uint8)[:, None]
+        stored_log_values, weights, flags = store.rows(index)
+        step = chunk_size or max(len(stored_log_values), 1)
+        for start in range(0, len(stored_log_values), step):
+            stop = start + step
+            with stage('filter'):
+                values = np.array(stored_log_values[start:stop])
+                if not log_values:
+                    values = np.exp(values)
+                masks = (flags[start:stop] & required) == required
+                if use_weights:
+                    chunk_weights = np.array(weights[start:stop])
+                else:
+                    chunk_weights = np.ones(len(values))
+            count('rows_read', len(values))
+            _count_variant_rows(variants, masks)
+            yield values, chunk_weights, masks
+        return
+
+    freq_name, weights_name, filter_columns = _resolve_load_columns(
+        filepath, freq_column, weights_column, *used
+    )
+    needed = {freq_name}
+    if weights_name is not None:
+        needed.add(weights_name)
+    for cols in filter_columns.values():
+        needed.update(cols)
+
+    with open_tsv(filepath) as handle:
+        reader = pd.read_csv(handle, sep='\t', usecols=sorted(needed), chunksize=chunk_size)
+        chunks = [reader] if chunk_size is None else reader
+        for chunk in chunks:
+            with stage('filter'):
+                values = chunk[freq_name].to_numpy()
+                valid_mask = values > 0
+                values = values[valid_mask]
+                if weights_name is None:
+                    weights = np.ones(len(values))
+                else:
+                    weights = chunk[weights_name].to_numpy()[valid_mask]
+                filter_masks = _row_filter_masks(chunk, filter_columns)
+                masks = np.ones((len(variants), len(values)), dtype=bool)
+                for row, variant in enumerate(variants):
+                    for name, enabled in zip(FILTER_NAMES, variant):
+                        if enabled:
+                            masks[row] &= filter_masks[name][valid_mask]
+                if log_values:
+                    values = np.log(values)
+            count('rows_read', len(chunk))
+            _count_variant_rows(variants, masks)
+            yield values, weights, masks
+
+
+def _count_variant_rows(variants, masks):
+    """Count the rows kept by each filter combination, as rows_kept[<label>]."""
+    for variant, kept in zip(variants, masks.sum(axis=1)):
+        count(f'rows_kept[{filter_variant_label(variant)}]', int(kept))
+
+
 def load_distribution(
     filepath,
     freq_column="pgen",
@@ -89,6 +693,7 @@ def load_distribution(
     productive_filter=False,
     vdj_filter=False,
     vj_filter=False,
+    chunk_size=None,
 ):
     """
     Load a TCR distribution from a TSV file.
@@ -96,7 +701,8 @@ def load_distribution(
     Parameters
     ----------
     filepath : str
-        Path to TSV file
+        Path to TSV file (plain or .tsv.gz / .tsv.zst / .tsv.bz2), or a
+        cohort store member path ('<store>.cohort/<file name>')
     freq_column : str or int
         Column name, substring of column name, or index for frequency values (e.g., 'pgen').
         If string: tries exact match first, then substring match (must be unique).
@@ -111,6 +717,9 @@ def load_distribution(
     vj_filter : bool
         If True, rows are kept only when each existing V/J call column
         ('v_call', 'j_call') is non-empty.
+    chunk_size : int or None
+        If set, read the file in chunks of this many rows (streaming mode,
+        see iter_filtered_chunks). Only compact value/weight arrays are kept.
         
     Returns
     -------
@@ -124,33 +733,19 @@ def load_distribution(
     ValueError
         If column specification is ambiguous or not found
     """
-    df = pd.read_csv(filepath, sep='\t')
-    
-    # Apply productive filter if requested and column exists
-    if productive_filter and 'productive' in df.columns:
-        df = df[df['productive'] == True].copy()
-
-    # Apply VDJ filter if requested (for columns that exist)
-    if vdj_filter:
-        for vdj_col in ['v_call', 'd_call', 'j_call']:
-            if vdj_col in df.columns:
-                non_empty_mask = df[vdj_col].notna() & (df[vdj_col].astype(str).str.strip() != "")
-                df = df[non_empty_mask].copy()
-
-    # Apply VJ filter if requested (for columns that exist)
-    if vj_filter:
-        for vj_col in ['v_call', 'j_call']:
-            if vj_col in df.columns:
-                non_empty_mask = df[vj_col].notna() & (df[vj_col].astype(str).str.strip() != "")
-                df = df[non_empty_mask].copy()
-    
-    # Get frequency column
-    freq_idx = _find_column_index(df, freq_column, 'freq_column')
-    values = df.iloc[:, freq_idx].values
-    
-    # Filter positive values
-    valid_mask = values > 0
-    values = values[valid_mask]
+    values_parts = []
+    weights_parts = []
+    count('files_loaded')
+    with stage('load'):
+        for values, weights in iter_filtered_chunks(
+            filepath, freq_column, weights_column,
+            productive_filter, vdj_filter, vj_filter, chunk_size,
+        ):
+            values_parts.append(values)
+            weights_parts.append(weights)
+
+    values = np.concatenate(values_parts) if values_parts else np.array([])
+    weights = np.concatenate(weights_parts) if weights_parts else np.array([])
 
     if len(values) == 0:
         raise ValueError(
@@ -158,149 +753,721 @@ def load_distribution(
             "Check --productive-filter / --vdj-filter / --vj-filter or input data."
         )
     
-    # Get weights
-    if weights_column == "off":
-        weights = np.ones(len(values)) / len(values)
-    else:
-        weight_idx = _find_column_index(df, weights_column, 'weights_column')
-        weights = df.iloc[:, weight_idx].values[valid_mask]
-        if weights.sum() <= 0:
-            raise ValueError(
-                f"Weights sum to zero after filtering for file '{filepath}'."
-            )
-        weights = weights / weights.sum()
+    # Normalize weights
+    if weights.sum() <= 0:
+        raise ValueError(
+            f"Weights sum to zero after filtering for file '{filepath}'."
+        )
+    weights = weights / weights.sum()
     
     return values, weights
 
 
-def compute_cost_matrix(support1, support2, metric='log_l1'):
+def load_histogram(
+    filepath,
+    grid,
+    freq_column="pgen",
+    weights_column="duplicate_frequency_percent",
+    productive_filter=False,
+    vdj_filter=False,
+    vj_filter=False,
+    chunk_size=None,
+    discretization='nearest',
+):
     """
-    Compute cost matrix between two supports.
-    
+    Load a TCR distribution directly as a histogram on a fixed grid.
+
+    Chunks are binned as they are read (same binning as
+    discretize_distribution), so no per-row arrays are kept at all.
+
     Parameters
     ----------
-    support1 : np.ndarray
-        First support points (e.g., pgen values)
-    support2 : np.ndarray
-        Second support points
-    metric : str
-        Distance metric, options:
-        - 'log_l1': L1 distance in log space (default, robust for wide ranges)
-        - 'l1': L1 distance in original space
-        - 'l2': L2 (Euclidean) distance
-        
+    filepath : str
+        Path to TSV file
+    grid : np.ndarray
+        Grid points for discretization
+    freq_column, weights_column, productive_filter, vdj_filter, vj_filter, chunk_size
+        Same as in load_distribution.
+    discretization : str
+        Method of discretize_distribution ('nearest' or 'linear').
+
     Returns
     -------
-    cost_matrix : np.ndarray
-        Cost matrix of shape (len(support1), len(support2))
+    histogram : np.ndarray
+        Normalized weights on the grid.
+    n_rows : int
+        Number of rows that passed all filters.
+    value_range : tuple of float
+        (min, max) of the frequency values that passed all filters.
     """
-    if metric == 'log_l1':
-        # L1 distance in log space (robust for pgen ranges)
-        log_s1 = np.log(support1.reshape(-1, 1))
-        log_s2 = np.log(support2.reshape(1, -1))
-        return np.abs(log_s1 - log_s2)
-    
-    elif metric == 'l1':
-        # L1 distance in original space
-        s1 = support1.reshape(-1, 1)
-        s2 = support2.reshape(1, -1)
-        return np.abs(s1 - s2)
-    
-    elif metric == 'l2':
-        # L2 (Euclidean) distance
-        s1 = support1.reshape(-1, 1)
-        s2 = support2.reshape(1, -1)
-        return np.sqrt((s1 - s2)**2)
-    
-    else:
-        raise ValueError(f"Unknown metric: {metric}")
+    histogram = np.zeros(len(grid))
+    n_rows = 0
+    vmin, vmax = np.inf, -np.inf
+    count('files_loaded')
+    with stage('load'):
+        for values, weights in iter_filtered_chunks(
+            filepath, freq_column, weights_column,
+            productive_filter, vdj_filter, vj_filter, chunk_size,
+        ):
+            if len(values) == 0:
+                continue
+            with stage('discretize'):
+                histogram += _bin_onto_grid(values, weights, grid, discretization)
+            n_rows += len(values)
+            vmin = min(vmin, values.min())
+            vmax = max(vmax, values.max())
+
+    if n_rows == 0:
+        raise ValueError(
+            f"No valid rows remaining after filtering for file '{filepath}'. "
+            "Check --productive-filter / --vdj-filter / --vj-filter or input data."
+        )
+    if histogram.sum() <= 0:
+        raise ValueError(
+            f"Weights sum to zero after filtering for file '{filepath}'."
+        )
+    return histogram / histogram.sum(), n_rows, (vmin, vmax)
 
 
-def compute_wasserstein_distance(values1, weights1, values2, weights2, 
-                                  metric='log_l1', method='emd'):
+def save_histograms(filepath, grid, histograms, files, options=None):
     """
-    Compute Wasserstein distance between two distributions.
-    
-    This is the core function used across all scripts to ensure
-    consistent distance computation.
-    
+    Save discretized histograms of several samples to .npz for reuse.
+
     Parameters
     ----------
-    values1 : np.ndarray
-        Support points of first distribution (e.g., pgen values)
-    weights1 : np.ndarray
-        Weights of first distribution (must sum to 1)
-    values2 : np.ndarray
-        Support points of second distribution
-    weights2 : np.ndarray
-        Weights of second distribution (must sum to 1)
-    metric : str
-        Distance metric for cost matrix (default: 'log_l1')
-    method : str
-        OT solver method:
-        - 'emd': Exact EMD solver (default)
-        - 'sinkhorn': Entropic regularization (faster, approximate)
-        
-    Returns
-    -------
-    distance : float
-        Wasserstein distance between the two distributions
+    filepath : str or Path
+        Output .npz file
+    grid : np.ndarray
+        Common grid of the histograms
+    histograms : array-like
+        (n_samples, len(grid)) normalized weights
+    files : list
+        Source file of each histogram (stored by name, with its size and
+        modification time for histogram_cache_mismatches)
+    options : dict or None
+        Loading options (columns, filters) stored as JSON, so that readers
+        can check the cache matches what they would compute
     """
-    # Ensure weights sum to 1
-    weights1 = weights1 / weights1.sum()
-    weights2 = weights2 / weights2.sum()
-    
-    # Compute cost matrix
-    cost_matrix = compute_cost_matrix(values1, values2, metric=metric)
-    
-    # Compute distance
-    if method == 'emd':
-        distance = ot.emd2(weights1, weights2, cost_matrix)
-    elif method == 'sinkhorn':
-        distance = ot.sinkhorn2(weights1, weights2, cost_matrix, reg=0.01)
-    else:
-        raise ValueError(f"Unknown method: {method}")
-    
-    return distance
+    np.savez(
+        filepath,
+        grid=grid,
+        histograms=np.asarray(histograms, dtype=float),
+        files=np.array([Path(str(f)).name for f in files], dtype=str),
+        options=np.array(json.dumps(options or {}, sort_keys=True)),
+        inputs=np.array(json.dumps([_describe_input_file(f, with_hash=False) for f in files])),
+    )
 
 
-def discretize_distribution(values, weights, grid):
+def load_histograms(filepath):
     """
-    Discretize a distribution onto a fixed grid.
-    
-    Parameters
+    Load histograms written by save_histograms.
+
+    Returns
+    -------
+    grid : np.ndarray
+    histograms : np.ndarray
+        (n_samples, len(grid))
+    files : list of str
+        Source file names
+    options : dict
+        Loading options recorded with the cache
+    """
+    with np.load(filepath) as data:
+        return (
+            data['grid'],
+            data['histograms'],
+            data['files'].tolist(),
+            json.loads(str(data['options'])),
+        )
+
+
+def histogram_cache_mismatches(filepath, files):
+    """
+    Why the histograms in `filepath` do not describe `files` as they are now.
+
+    As lookup_distances, the files are compared by name, size and
+    modification time: files added or removed since the cache was saved,
+    and files that changed, are reported.
+
+    Parameters
     ----------
-    values : np.ndarray
-        Support points of the distribution
-    weights : np.ndarray
-        Weights at each support point
+    filepath : str or Path
+        Cache written by save_histograms
+    files : list
+        Samples the caller would read instead
+
+    Returns
+    -------
+    list of str
+        Problems (empty if the cache can be used).
+    """
+    with np.load(filepath) as data:
+        if 'inputs' not in data.files:
+            return ["cache saved without file sizes and modification times"]
+        recorded = {entry['file']: entry for entry in json.loads(str(data['inputs']))}
+
+    current = {Path(str(f)).name: _describe_input_file(f, with_hash=False) for f in files}
+    problems = []
+    added = sorted(set(current) - set(recorded))
+    if added:
+        problems.append(f"files not in the cache: {added[:5]}")
+    removed = sorted(set(recorded) - set(current))
+    if removed:
+        problems.append(f"cached files no longer present: {removed[:5]}")
+    changed = sorted(
+        name for name in current
+        if name in recorded and (
+            recorded[name].get('size') != current[name].get('size')
+            or recorded[name].get('mtime_ns') != current[name].get('mtime_ns')
+        )
+    )
+    if changed:
+        problems.append(f"files changed since the cache was saved: {changed[:5]}")
+    return problems
+
+
+def sketch_grid():
+    """Bin centers (geometric) of the canonical sketch lattice."""
+    return 10.0 ** (SKETCH_LOG10_MIN + (np.arange(SKETCH_N_BINS) + 0.5) / SKETCH_BINS_PER_DECADE)
+
+
+def sketch_bin_indices(values):
+    """Canonical lattice bin of each positive value (clipped to the end bins)."""
+    positions = (np.log10(values) - SKETCH_LOG10_MIN) * SKETCH_BINS_PER_DECADE
+    return np.clip(np.floor(positions), 0, SKETCH_N_BINS - 1).astype(np.int64)
+
+
+def load_sketch(
+    filepath,
+    freq_column="pgen",
+    weights_column="duplicate_frequency_percent",
+    productive_filter=False,
+    vdj_filter=False,
+    vj_filter=False,
+    chunk_size=None,
+):
+    """
+    Load a TCR distribution as a histogram on the canonical sketch lattice.
+
+    For cohort store members the sketch stored at build time is used and no
+    rows are read; TSV files are streamed and binned chunk by chunk. Any
+    analysis grid can then be derived with sketch_to_grid or
+    coarsen_sketches, without going back to the raw values.
+
+    Parameters
+    ----------
+    filepath, freq_column, weights_column, productive_filter, vdj_filter, vj_filter, chunk_size
+        Same as in load_distribution.
+
+    Returns
+    -------
+    sketch : np.ndarray
+        Normalized weights on the SKETCH_N_BINS lattice bins.
+    n_rows : int
+        Number of rows that passed all filters.
+    """
+    count('files_loaded')
+    with stage('load'):
+        sketch, n_rows = _load_sketch_histogram(
+            filepath, freq_column, weights_column,
+            productive_filter, vdj_filter, vj_filter, chunk_size,
+        )
+
+    if n_rows == 0:
+        raise ValueError(
+            f"No valid rows remaining after filtering for file '{filepath}'. "
+            "Check --productive-filter / --vdj-filter / --vj-filter or input data."
+        )
+    if sketch.sum() <= 0:
+        raise ValueError(
+            f"Weights sum to zero after filtering for file '{filepath}'."
+        )
+    return sketch / sketch.sum(), n_rows
+
+
+def _load_sketch_histogram(filepath, freq_column, weights_column, productive_filter, vdj_filter, vj_filter, chunk_size):
+    """Unnormalized sketch and row count of one sample (see load_sketch)."""
+    member = split_member_path(filepath)
+    if member is not None:
+        store, index, use_weights = _open_store_member(member, freq_column, weights_column)
+        lattice = {
+            'log10_min': SKETCH_LOG10_MIN,
+            'log10_max': SKETCH_LOG10_MAX,
+            'bins_per_decade': SKETCH_BINS_PER_DECADE,
+        }
+        if store.header.get('sketch') != lattice:
+            raise ValueError(
+                f"Cohort store '{store.path}' uses sketch lattice {store.header.get('sketch')}, "
+                f"expected {lattice}. Rebuild it with olga-build-cohort-store.py."
+            )
+        bins, flags, weights, counts = store.sketch(index)
+        required = filter_flags(productive_filter, vdj_filter, vj_filter)
+        mask = (flags & required) == required
+        source = weights if use_weights else counts
+        sketch = np.bincount(bins[mask], weights=source[mask], minlength=SKETCH_N_BINS)
+        n_rows = int(round(counts[mask].sum()))
+    else:
+        sketch = np.zeros(SKETCH_N_BINS)
+        n_rows = 0
+        for values, weights in iter_filtered_chunks(
+            filepath, freq_column, weights_column,
+            productive_filter, vdj_filter, vj_filter, chunk_size,
+        ):
+            sketch += np.bincount(sketch_bin_indices(values), weights=weights, minlength=SKETCH_N_BINS)
+            n_rows += len(values)
+    return sketch, n_rows
+
+
+def sketch_to_grid(sketch, grid, method='nearest'):
+    """
+    Rebin a canonical sketch onto an arbitrary grid.
+
+    Each lattice bin is assigned, by its center, the way
+    discretize_distribution assigns a value with the same method, so the
+    result matches binning the raw values up to the lattice resolution.
+
+    Returns
+    -------
+    np.ndarray
+        Normalized weights on the grid.
+    """
+    histogram = _bin_onto_grid(sketch_grid(), sketch, grid, method)
+    total = histogram.sum()
+    return histogram / total if total > 0 else histogram
+
+
+def coarsen_sketches(sketches, n_grid=200, method='nearest'):
+    """
+    Derive a common coarse grid from canonical sketches by summing bins.
+
+    The coarse bins are blocks of `factor` adjacent lattice bins aligned to
+    the lattice, covering the joint support of all sketches, with `factor`
+    chosen so that there are at most about `n_grid` of them.
+
+    Parameters
+    ----------
+    sketches : list of np.ndarray
+        Sketches from load_sketch
+    n_grid : int
+        Target number of grid points
+    method : str
+        'nearest' sums each block onto its center; 'linear' splits every
+        lattice bin between the two nearest block centers (see
+        discretize_distribution).
+
+    Returns
+    -------
     grid : np.ndarray
-        Grid points for discretization
+        Coarse grid points (geometric centers of the blocks)
+    coarse : list of np.ndarray
+        Each sketch summed onto the coarse grid
+    """
+    occupied = np.flatnonzero(np.sum(sketches, axis=0) > 0)
+    if len(occupied) == 0:
+        raise ValueError("All sketches are empty")
+    first, last = int(occupied[0]), int(occupied[-1])
+    factor = max(1, int(np.ceil((last - first + 1) / n_grid)))
+    start = first // factor * factor
+    n_blocks = (last - start) // factor + 1
+    stop = min(start + n_blocks * factor, SKETCH_N_BINS)
+
+    edges_log10 = SKETCH_LOG10_MIN + np.arange(start, start + n_blocks * factor + 1, factor) / SKETCH_BINS_PER_DECADE
+    grid = 10.0 ** ((edges_log10[:-1] + edges_log10[1:]) / 2)
+
+    if method != 'nearest':
+        return grid, [sketch_to_grid(sketch, grid, method) for sketch in sketches]
+
+    coarse = []
+    for sketch in sketches:
+        block = np.zeros(n_blocks * factor)
+        block[:stop - start] = sketch[start:stop]
+        coarse.append(block.reshape(n_blocks, factor).sum(axis=1))
+    return grid, coarse
+
+
+def build_cohort_store(
+    input_files,
+    output_path,
+    freq_column="pgen",
+    weights_column="duplicate_frequency_percent",
+    chunk_size=None,
+):
+    """
+    Build a memory-mapped cohort store from TSV files.
+
+    Rows with positive frequency are stored once with the outcome of each
+    row filter, so the store serves every combination of productive / VDJ /
+    VJ filters, as well as uniform weights. The frequency and weights
+    columns are fixed at build time.
+
+    Parameters
+    ----------
+    input_files : list of str or Path
+        Plain or compressed TSV files (see find_tsv_files).
+    output_path : str or Path
+        Store file to write (conventionally with COHORT_STORE_SUFFIX).
+    freq_column, weights_column : str or int
+        Column specifications as in load_distribution.
+    chunk_size : int or None
+        Rows per chunk while reading the TSV files.
+
+    Returns
+    -------
+    CohortStore
+        The newly written store, opened for reading.
+    """
+    import pandas as pd
+    header_fields = {
+        'freq_column': None,
+        'weights_column': None,
+        'sketch': {
+            'log10_min': SKETCH_LOG10_MIN,
+            'log10_max': SKETCH_LOG10_MAX,
+            'bins_per_decade': SKETCH_BINS_PER_DECADE,
+        },
+    }
+    n_classes = 8  # all combinations of FLAG_* bits
+    with CohortStoreWriter(output_path, header_fields) as writer:
+        for filepath in input_files:
+            freq_name, weights_name, filter_columns = _resolve_load_columns(
+                filepath, freq_column, weights_column, True, True, True
+            )
+            for key, name in (('freq_column', freq_name), ('weights_column', weights_name)):
+                if writer.header_fields[key] is None:
+                    writer.header_fields[key] = name
+                elif writer.header_fields[key] != name:
+                    raise ValueError(
+                        f"'{filepath}': {key} resolves to {name!r}, "
+                        f"but earlier files use {writer.header_fields[key]!r}"
+                    )
+
+            with open_tsv(filepath, external=_needs_external_decompressor(filepath)) as handle:
+                columns = list(pd.read_csv(handle, sep='\t', nrows=0).columns)
+            sample = writer.begin_sample({
+                'file': Path(filepath).name,
+                'label': _label_from_filename(Path(filepath)),
+                'columns': columns,
+                'source': _describe_input_file(filepath),
+            })
+
+            needed = {freq_name} | {col for cols in filter_columns.values() for col in cols}
+            if weights_name is not None:
+                needed.add(weights_name)
+            n_rows = 0
+            vmin, vmax = np.inf, -np.inf
+            sketch_weights = np.zeros(n_classes * SKETCH_N_BINS)
+            sketch_counts = np.zeros(n_classes * SKETCH_N_BINS)
+            with open_tsv(filepath) as handle:
+                reader = pd.read_csv(handle, sep='\t', usecols=sorted(needed), chunksize=chunk_size)
+                for chunk in ([reader] if chunk_size is None else reader):
+                    flags = np.zeros(len(chunk), dtype=np.uint8)
+                    for bit, key in ((FLAG_PRODUCTIVE, 'productive'), (FLAG_VDJ, 'vdj'), (FLAG_VJ, 'vj')):
+                        only = {'productive': [], 'vdj': [], 'vj': []}
+                        only[key] = filter_columns[key]
+                        flags[_row_filter_mask(chunk, only)] |= bit
+                    values = chunk[freq_name].to_numpy(dtype=float)
+                    valid_mask = values > 0
+                    values = values[valid_mask]
+                    if weights_name is None:
+                        weights = np.ones(len(values))
+                    else:
+                        weights = chunk[weights_name].to_numpy(dtype=float)[valid_mask]
+                    writer.append_rows(np.log(values), weights, flags[valid_mask])
+                    cells = flags[valid_mask].astype(np.int64) * SKETCH_N_BINS + sketch_bin_indices(values)
+                    sketch_weights += np.bincount(cells, weights=weights, minlength=len(sketch_weights))
+                    sketch_counts += np.bincount(cells, minlength=len(sketch_counts))
+                    if len(values):
+                        n_rows += len(values)
+                        vmin = min(vmin, values.min())
+                        vmax = max(vmax, values.max())
+
+            cells = np.flatnonzero(sketch_counts)
+            writer.set_sketch(cells % SKETCH_N_BINS, cells // SKETCH_N_BINS, sketch_weights[cells], sketch_counts[cells])
+            sample.update({
+                'n_rows': n_rows,
+                'min': float(vmin) if n_rows else None,
+                'max': float(vmax) if n_rows else None,
+            })
+    return open_cohort_store(output_path)
+
+
+def compute_cost_matrix(support1, support2, metric='log_l1'):
+    """
+    Compute cost matrix between two supports.
+    
+    Parameters
+    ----------
+    support1 : np.ndarray
+        First support points (e.g., pgen values)
+    support2 : np.ndarray
+        Second support points
+    metric : str
+        Distance metric, options:
+        - 'log_l1': L1 distance in log space (default, robust for wide ranges)
+        - 'l1': L1 distance in original space
+        - 'l2': L2 (Euclidean) distance
         
     Returns
     -------
-    discretized_weights : np.ndarray
-        Weights on the grid (same length as grid)
+    cost_matrix : np.ndarray
+        Cost matrix of shape (len(support1), len(support2))
+    """
+    if metric == 'log_l1':
+        # L1 distance in log space (robust for pgen ranges)
+        log_s1 = np.log(support1.reshape(-1, 1))
+        log_s2 = np.log(support2.reshape(1, -1))
+        return np.abs(log_s1 - log_s2)
+    
+    elif metric == 'l1':
+        # L1 distance in original space
+        s1 = support1.reshape(-1, 1)
+        s2 = support2.reshape(1, -1)
+        return np.abs(s1 - s2)
+    
+    elif metric == 'l2':
+        # L2 (Euclidean) distance
+        s1 = support1.reshape(-1, 1)
+        s2 = support2.reshape(1, -1)
+        return np.sqrt((s1 - s2)**2)
+    
+    else:
+        raise ValueError(f"Unknown metric: {metric}")
+
+
+def _ground_coordinates(values, metric):
+    """Coordinates in which the ground cost of `metric` is |x - y|."""
+    if metric == 'log_l1':
+        return np.log(values)
+    if metric in ('l1', 'l2'):
+        # In one dimension the L2 cost sqrt((x - y)^2) is also |x - y|
+        return np.asarray(values, dtype=float)
+    raise ValueError(f"Unknown metric: {metric}")
+
+
+def _wasserstein_1d(x1, weights1, x2, weights2):
+    """
+    Exact W1 between two 1-D distributions by merging their sorted supports.
+
+    W1 is the integral of |F1 - F2|: walking the merged support in order,
+    the CDF difference is constant between consecutive points. Weights
+    must be normalized; supports need not be sorted.
+    """
+    x = np.concatenate([x1, x2])
+    order = np.argsort(x, kind='stable')
+    cdf_difference = np.cumsum(np.concatenate([weights1, -weights2])[order])[:-1]
+    return float(np.dot(np.abs(cdf_difference), np.diff(x[order])))
+
+
+def compute_wasserstein_distance(values1, weights1, values2, weights2, 
+                                  metric='log_l1', method='emd', reg=0.01):
+    """
+    Compute Wasserstein distance between two distributions.
+    
+    This is the core function used across all scripts to ensure
+    consistent distance computation.
+    
+    Parameters
+    ----------
+    values1 : np.ndarray
+        Support points of first distribution (e.g., pgen values)
+    weights1 : np.ndarray
+        Weights of first distribution (must sum to 1)
+    values2 : np.ndarray
+        Support points of second distribution
+    weights2 : np.ndarray
+        Weights of second distribution (must sum to 1)
+    metric : str
+        Distance metric for cost matrix (default: 'log_l1')
+    method : str
+        OT solver method:
+        - 'emd': Exact EMD solver (default)
+        - 'sinkhorn': Entropic regularization (faster, approximate)
+        - 'exact_1d': Exact 1-D solution from the sorted CDFs, O(n log n)
+          without a cost matrix (same value as 'emd')
+    reg : float
+        Entropic regularization of 'sinkhorn' (default: 0.01)
+        
+    Returns
+    -------
+    distance : float
+        Wasserstein distance between the two distributions
+    """
+    # Ensure weights sum to 1
+    weights1 = weights1 / weights1.sum()
+    weights2 = weights2 / weights2.sum()
+    
+    count('solver_calls')
+    if method == 'exact_1d':
+        with stage('ot_solve'):
+            return _wasserstein_1d(
+                _ground_coordinates(values1, metric), weights1,
+                _ground_coordinates(values2, metric), weights2,
+            )
+
+    import ot
+    with stage('ot_solve'):
+        # Compute cost matrix
+        cost_matrix = compute_cost_matrix(values1, values2, metric=metric)
+
+        # Compute distance
+        if method == 'emd':
+            distance = ot.emd2(weights1, weights2, cost_matrix)
+        elif method == 'sinkhorn':
+            distance = ot.sinkhorn2(weights1, weights2, cost_matrix, reg=reg)
+        else:
+            raise ValueError(f"Unknown method: {method}")
+
+    return distance
+
+
+def _lattice_step(points):
+    """
+    Spacing of evenly spaced sorted points, or None if some point is more
+    than a quarter step off the lattice (or there are fewer than 2).
+    """
+    n_points = len(points)
+    if n_points < 2:
+        return None
+    step = (points[-1] - points[0]) / (n_points - 1)
+    if not step > 0:
+        return None
+    deviation = np.abs(points - (points[0] + step * np.arange(n_points))).max()
+    return step if deviation < 0.25 * step else None
+
+
+def _correct_position(edges, values, position, side='left'):
+    """
+    np.searchsorted(edges, values, side) from a guess that is off by at
+    most one (clipped into range first), with two vectorized comparisons.
+    """
+    position = np.clip(position, 0, len(edges)).astype(np.intp)
+    padded = np.concatenate([[-np.inf], edges, [np.inf]])
+    if side == 'left':
+        position -= padded[position] >= values
+        position += padded[position + 1] < values
+    else:
+        position -= padded[position] > values
+        position += padded[position + 1] <= values
+    return position
+
+
+def _grid_bin_indices(values, grid, log_domain=False):
+    """
+    Index of the grid bin each value falls into.
+
+    Bins are centered around grid points (edges at midpoints between
+    neighbouring points); values outside the grid go to the end bins.
+    With log_domain, `values` are natural logs and are compared with the
+    logs of the same edges.
+
+    On a log-spaced grid the inner edges are evenly spaced in log, so each
+    bin is found arithmetically from log(value) and then checked against
+    the edges themselves: the same result as a binary search, several
+    times faster.
     """
-    # Create bins centered around grid points
-    # Extend grid boundaries
     bin_edges = np.concatenate([
         [grid[0] / 2],
         (grid[:-1] + grid[1:]) / 2,
         [grid[-1] * 2]
     ])
+    log_edges = np.log(bin_edges)
+    if log_domain:
+        bin_edges = log_edges
+    step = _lattice_step(log_edges[1:-1])
+    if step is None:
+        bin_idx = np.searchsorted(bin_edges, values) - 1
+    else:
+        log_values = values if log_domain else np.log(values)
+        guess = np.floor((log_values - log_edges[1]) / step) + 2
+        guess = np.clip(guess, 0, len(bin_edges))
+        bin_idx = _correct_position(bin_edges, values, guess) - 1
+    return np.clip(bin_idx, 0, len(grid) - 1)
+
+
+def _grid_linear_split(values, grid, log_domain=False):
+    """
+    Neighbouring grid points of each value and the share of its mass that
+    goes to the upper one, linear in log space.
+
+    Values outside the grid go entirely to the end points. With log_domain,
+    `values` are already natural logs.
+
+    Returns
+    -------
+    lower : np.ndarray
+        Index of the grid point at or below each value
+    upper_share : np.ndarray
+        Share of the mass for grid point lower + 1, in [0, 1]
+    """
+    log_grid = np.log(grid)
+    log_values = values if log_domain else np.log(values)
+    if len(grid) == 1:
+        return np.zeros(len(log_values), dtype=np.intp), np.zeros(len(log_values))
+    step = _lattice_step(log_grid)
+    if step is None:
+        position = np.searchsorted(log_grid, log_values, side='right')
+    else:
+        # Log-spaced grid: arithmetic position, checked as in _grid_bin_indices
+        guess = np.clip(np.floor((log_values - log_grid[0]) / step) + 1, 0, len(grid))
+        position = _correct_position(log_grid, log_values, guess, side='right')
+    lower = np.clip(position - 1, 0, len(grid) - 2)
+    upper_share = (log_values - log_grid[lower]) / (log_grid[lower + 1] - log_grid[lower])
+    return lower, np.clip(upper_share, 0.0, 1.0)
+
+
+def _bin_onto_grid(values, weights, grid, method='nearest', log_domain=False):
+    """Unnormalized histogram of weighted values on a grid (see discretize_distribution)."""
+    if method == 'nearest':
+        bin_idx = _grid_bin_indices(values, grid, log_domain)
+        return np.bincount(bin_idx, weights=weights, minlength=len(grid)).astype(float)
+    if method == 'linear':
+        lower, upper_share = _grid_linear_split(values, grid, log_domain)
+        if weights is None:
+            weights = np.ones(len(upper_share))
+        upper_weights = weights * upper_share
+        histogram = np.bincount(lower, weights=weights - upper_weights, minlength=len(grid)).astype(float)
+        histogram += np.bincount(lower + 1, weights=upper_weights, minlength=len(grid))
+        return histogram
+    raise ValueError(f"Unknown discretization method: {method!r} (expected one of {DISCRETIZATION_METHODS})")
+
+
+def discretize_distribution(values, weights, grid, method='nearest', log_domain=False):
+    """
+    Discretize a distribution onto a fixed grid.
+
+    With method 'nearest' each value's weight goes to the grid bin it falls
+    into, which moves it by up to half a bin. With 'linear' the weight is
+    split between the two neighbouring grid points in proportion to the
+    log-distance to each, so the mean of log(value) is kept exactly (for
+    values inside the grid) and a coarser grid gives the same accuracy.
     
-    # Assign each value to nearest bin
-    discretized = np.zeros(len(grid))
-    for val, weight in zip(values, weights):
-        bin_idx = np.searchsorted(bin_edges, val) - 1
-        bin_idx = np.clip(bin_idx, 0, len(grid) - 1)
-        discretized[bin_idx] += weight
-    
-    # Normalize
-    if discretized.sum() > 0:
-        discretized = discretized / discretized.sum()
-    
+    Parameters
+    ----------
+    values : np.ndarray
+        Support points of the distribution
+    weights : np.ndarray or None
+        Weights at each support point (None: uniform); need not be
+        normalized
+    grid : np.ndarray
+        Grid points for discretization
+    method : str
+        'nearest' or 'linear' (see DISCRETIZATION_METHODS)
+    log_domain : bool
+        If True, `values` are the natural logs of the support points (as
+        held by repertoires.LogDistribution), which saves a log per value
+        
+    Returns
+    -------
+    discretized_weights : np.ndarray
+        Weights on the grid (same length as grid)
+    """
+    with stage('discretize'):
+        discretized = _bin_onto_grid(values, weights, grid, method, log_domain)
+
+        # Normalize
+        if discretized.sum() > 0:
+            discretized = discretized / discretized.sum()
+
     return discretized
 
 
@@ -323,8 +1490,7 @@ def create_common_grid(values_list, n_grid=200, log_space=True):
         Grid points
     """
     # Find global range
-    all_values = np.concatenate(values_list)
-    vmin, vmax = all_values.min(), all_values.max()
+    vmin, vmax = values_range(values_list)
     
     if log_space:
         grid = np.logspace(np.log10(vmin), np.log10(vmax), n_grid)
@@ -334,7 +1500,7 @@ def create_common_grid(values_list, n_grid=200, log_space=True):
     return grid
 
 
-def compute_lp_barycenter(values_list, weights_list, n_grid=200):
+def compute_lp_barycenter(values_list, weights_list, n_grid=200, discretization='nearest'):
     """
     Compute Wasserstein barycenter with LP solver on a common log-spaced grid.
 
@@ -346,6 +1512,8 @@ def compute_lp_barycenter(values_list, weights_list, n_grid=200):
         Per-sample weights for each input distribution (same length as values_list).
     n_grid : int
         Number of grid points for common discretization.
+    discretization : str
+        Method of discretize_distribution ('nearest' or 'linear').
 
     Returns
     -------
@@ -363,24 +1531,13 @@ def compute_lp_barycenter(values_list, weights_list, n_grid=200):
 
     grid = create_common_grid(values_list, n_grid=n_grid, log_space=True)
     discretized_distributions = [
-        discretize_distribution(values, weights, grid)
+        discretize_distribution(values, weights, grid, method=discretization)
         for values, weights in zip(values_list, weights_list)
     ]
-
-    distributions_matrix = np.array(discretized_distributions)
-    log_grid = np.log(grid)
-    cost_matrix = np.abs(log_grid.reshape(-1, 1) - log_grid.reshape(1, -1))
-
-    barycenter = ot.lp.barycenter(
-        distributions_matrix.T,
-        cost_matrix,
-        weights=None,
-        verbose=False,
-    )
-    return grid, barycenter
+    return grid, lp_barycenter_of_histograms(grid, discretized_distributions)
 
 
-def compute_lp_barycenter_on_grid(grid, values_list, weights_list):
+def compute_lp_barycenter_on_grid(grid, values_list, weights_list, discretization='nearest'):
     """
     Compute Wasserstein LP barycenter on a precomputed fixed grid.
 
@@ -392,6 +1549,8 @@ def compute_lp_barycenter_on_grid(grid, values_list, weights_list):
         Support values for each input distribution.
     weights_list : list of np.ndarray
         Per-sample weights for each input distribution.
+    discretization : str
+        Method of discretize_distribution ('nearest' or 'linear').
 
     Returns
     -------
@@ -404,30 +1563,369 @@ def compute_lp_barycenter_on_grid(grid, values_list, weights_list):
         raise ValueError("values_list and weights_list must have the same length")
 
     discretized_distributions = [
-        discretize_distribution(values, weights, grid)
+        discretize_distribution(values, weights, grid, method=discretization)
         for values, weights in zip(values_list, weights_list)
     ]
-    distributions_matrix = np.array(discretized_distributions)
+    return lp_barycenter_of_histograms(grid, discretized_distributions)
 
-    log_grid = np.log(grid)
-    cost_matrix = np.abs(log_grid.reshape(-1, 1) - log_grid.reshape(1, -1))
 
-    barycenter = ot.lp.barycenter(
-        distributions_matrix.T,
-        cost_matrix,
-        weights=None,
-        verbose=False,
-    )
-    return barycenter
+def lp_barycenter_of_histograms(grid, histograms):
+    """
+    Wasserstein LP barycenter of distributions already discretized on `grid`.
 
+    Lets callers that keep histograms (e.g. repertoires.Repertoire.histogram)
+    solve many barycenters without the raw values.
 
-def load_barycenter(filepath):
-    """
-    Load a precomputed barycenter from .npz file.
-    
     Parameters
     ----------
-    filepath : str
+    grid : np.ndarray
+        Support grid of the histograms.
+    histograms : list of np.ndarray
+        Weights of each input distribution on the grid.
+
+    Returns
+    -------
+    barycenter : np.ndarray
+        Barycenter weights on the grid.
+    """
+    import ot
+    if len(histograms) == 0:
+        raise ValueError("histograms must contain at least one distribution")
+    distributions_matrix = np.array(histograms)
+
+    log_grid = np.log(grid)
+    cost_matrix = np.abs(log_grid.reshape(-1, 1) - log_grid.reshape(1, -1))
+
+    count('barycenter_calls')
+    with stage('barycenter'):
+        barycenter = ot.lp.barycenter(
+            distributions_matrix.T,
+            cost_matrix,
+            weights=None,
+            verbose=False,
+        )
+    return barycenter
+
+
+def median_quantile_barycenter(values_list, weights_list):
+    """
+    Exact W1 barycenter of 1-D distributions (equal weights), without a solver.
+
+    In one dimension W1 is the L1 distance between quantile functions, so
+    the barycenter's quantile function is the pointwise median of the input
+    quantile functions. The lower median is used, so every barycenter point
+    is a support point of an input: on a shared grid the result lies on the
+    grid and minimizes the same objective as ot.lp.barycenter with the
+    log_l1 cost (any monotone ground metric gives the same barycenter).
+
+    Parameters
+    ----------
+    values_list : list of np.ndarray
+        Support values for each input distribution.
+    weights_list : list of np.ndarray
+        Weights for each input distribution (same length as values_list).
+
+    Returns
+    -------
+    support : np.ndarray
+        Sorted support of the barycenter.
+    weights : np.ndarray
+        Barycenter weights (sum to 1).
+    """
+    if len(values_list) == 0:
+        raise ValueError("values_list must contain at least one distribution")
+    if len(values_list) != len(weights_list):
+        raise ValueError("values_list and weights_list must have the same length")
+
+    with stage('barycenter'):
+        supports = []
+        cdfs = []
+        for values, weights in zip(values_list, weights_list):
+            order = np.argsort(values, kind='stable')
+            cdf = np.cumsum(np.asarray(weights, dtype=float)[order])
+            supports.append(np.asarray(values)[order])
+            cdfs.append(cdf / cdf[-1])
+
+        # Quantile levels at which any input quantile function jumps
+        levels = np.unique(np.concatenate(cdfs))
+        levels = levels[levels > 0]
+        quantiles = np.empty((len(supports), len(levels)))
+        for i, (support, cdf) in enumerate(zip(supports, cdfs)):
+            index = np.minimum(np.searchsorted(cdf, levels, side='left'), len(support) - 1)
+            quantiles[i] = support[index]
+        middle = (len(supports) - 1) // 2
+        median = np.partition(quantiles, middle, axis=0)[middle]
+
+        mass = np.diff(levels, prepend=0.0)
+        support, inverse = np.unique(median, return_inverse=True)
+        weights = np.bincount(inverse, weights=mass, minlength=len(support))
+    return support, weights / weights.sum()
+
+
+def compute_median_barycenter_on_grid(grid, values_list, weights_list, discretization='nearest'):
+    """
+    W1 barycenter on a fixed grid by the median of quantile functions.
+
+    Drop-in alternative to compute_lp_barycenter_on_grid: the inputs are
+    discretized the same way, and the result minimizes the same objective
+    (see median_quantile_barycenter), in milliseconds instead of an LP solve.
+
+    Parameters
+    ----------
+    grid : np.ndarray
+        Fixed support grid used for all input distributions.
+    values_list : list of np.ndarray
+        Support values for each input distribution.
+    weights_list : list of np.ndarray
+        Per-sample weights for each input distribution.
+    discretization : str
+        Method of discretize_distribution ('nearest' or 'linear').
+
+    Returns
+    -------
+    barycenter : np.ndarray
+        Barycenter weights on the provided grid.
+    """
+    if len(values_list) != len(weights_list):
+        raise ValueError("values_list and weights_list must have the same length")
+
+    histograms = [
+        discretize_distribution(values, weights, grid, method=discretization)
+        for values, weights in zip(values_list, weights_list)
+    ]
+    count('barycenter_calls')
+    support, weights = median_quantile_barycenter([grid] * len(histograms), histograms)
+    barycenter = np.zeros(len(grid))
+    barycenter[np.searchsorted(grid, support)] = weights
+    return barycenter
+
+
+def leave_one_out_distances(grid, histograms, block_size=1 << 20):
+    """
+    Distance of each histogram to the W1 barycenter of all the others.
+
+    The barycenter of the others is the lower median of their quantile
+    functions (see median_quantile_barycenter). With the n quantile values
+    at one level partitioned around the middle, that median is one of the
+    two middle values: the lower one if the left-out value lies above it,
+    else the upper one. One partition per quantile level thus gives all n
+    leave-one-out barycenters, and each distance is the L1 distance between
+    quantile functions, so the cost is about that of one median barycenter
+    instead of n barycenter solves. Distances use the log_l1 metric, as
+    compute_wasserstein_distance.
+
+    Parameters
+    ----------
+    grid : np.ndarray
+        Common (positive) support grid of the histograms.
+    histograms : list of np.ndarray
+        Weights of each distribution on the grid (at least two).
+    block_size : int
+        Number of quantile values held in memory at once.
+
+    Returns
+    -------
+    distances : np.ndarray
+        distances[i] is the distance of histograms[i] to the barycenter of
+        the other histograms.
+    """
+    n = len(histograms)
+    if n < 2:
+        raise ValueError("leave-one-out distances need at least two histograms")
+
+    with stage('barycenter'):
+        coordinates = np.log(np.asarray(grid, dtype=float))
+        cdfs = []
+        for histogram in histograms:
+            cdf = np.cumsum(np.asarray(histogram, dtype=float))
+            cdfs.append(cdf / cdf[-1])
+        levels = np.unique(np.concatenate(cdfs))
+        levels = levels[levels > 0]
+        mass = np.diff(levels, prepend=0.0)
+
+        # Lower median of the n - 1 others
+        middle = (n - 2) // 2
+        distances = np.zeros(n)
+        step = max(1, block_size // n)
+        for start in range(0, len(levels), step):
+            block = levels[start:start + step]
+            quantiles = np.empty((n, len(block)))
+            for i, cdf in enumerate(cdfs):
+                index = np.minimum(np.searchsorted(cdf, block, side='left'), len(grid) - 1)
+                quantiles[i] = coordinates[index]
+            ordered = np.partition(quantiles, (middle, middle + 1), axis=0)
+            low, high = ordered[middle], ordered[middle + 1]
+            gaps = np.where(quantiles > low, quantiles - low, high - quantiles)
+            distances += gaps @ mass[start:start + step]
+    return distances
+
+
+def member_positions(files, members):
+    """
+    Position of each file among `members` (e.g. the cloud files), or None.
+
+    Paths are compared after expanding `~` and resolving, so a sample listed
+    by another path than its cloud folder entry is still recognised.
+    """
+    def key(path):
+        return Path(os.path.expanduser(str(path))).resolve()
+
+    positions = {key(member): position for position, member in enumerate(members)}
+    return [positions.get(key(path)) for path in files]
+
+
+def n_grid_argument(value):
+    """argparse type of --n-grid: an integer > 1 or 'auto'."""
+    from argparse import ArgumentTypeError
+    if value == 'auto':
+        return value
+    try:
+        n_grid = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f"expected an integer or 'auto', got {value!r}")
+    if n_grid <= 1:
+        raise ArgumentTypeError("must be > 1")
+    return n_grid
+
+
+def n_grid_selection_settings(
+    tolerance=N_GRID_AUTO_TOLERANCE,
+    subsample=N_GRID_AUTO_SUBSAMPLE,
+    start=N_GRID_AUTO_START,
+    factor=N_GRID_AUTO_FACTOR,
+    max_n_grid=N_GRID_AUTO_MAX,
+):
+    """Settings part of a select_n_grid record (for provenance checks)."""
+    return {
+        'mode': 'auto',
+        'tolerance': float(tolerance),
+        'subsample': int(subsample),
+        'start': int(start),
+        'factor': int(factor),
+        'max_n_grid': int(max_n_grid),
+    }
+
+
+def select_n_grid(
+    values_list,
+    weights_list,
+    tolerance=N_GRID_AUTO_TOLERANCE,
+    subsample=N_GRID_AUTO_SUBSAMPLE,
+    start=N_GRID_AUTO_START,
+    factor=N_GRID_AUTO_FACTOR,
+    max_n_grid=N_GRID_AUTO_MAX,
+    discretization='nearest',
+):
+    """
+    Smallest grid size at which distances and barycenter have converged.
+
+    The grid is refined geometrically (start, start * factor, ...) on an
+    evenly spaced subsample of the cohort. At each size the subsample's
+    barycenter (median_quantile_barycenter, same objective as the LP) and
+    its sample-to-barycenter distances are computed. Once refining moves
+    the barycenter by less than `tolerance` times its spread (W1 between
+    successive barycenters over their mean absolute deviation in log pgen)
+    and every distance by less than `tolerance` times the mean distance,
+    the coarser of the two sizes is returned.
+
+    Parameters
+    ----------
+    values_list, weights_list : list of np.ndarray
+        Distributions of the cohort (as from load_distribution).
+    tolerance : float
+        Allowed relative change of the barycenter and of the distances.
+    subsample : int
+        Number of distributions the sizes are tried on.
+    start, factor, max_n_grid : int
+        Grid sizes tried.
+    discretization : str
+        Method of discretize_distribution the sizes are tried with;
+        'linear' usually converges at a smaller size.
+
+    Returns
+    -------
+    n_grid : int
+        Selected grid size (max_n_grid if nothing converged before).
+    selection : dict
+        JSON-serializable record: settings, every size tried with its
+        barycenter and distance change, chosen size and whether it converged.
+    """
+    if len(values_list) == 0:
+        raise ValueError("values_list must contain at least one distribution")
+    n_inputs = len(values_list)
+    picked = np.unique(np.linspace(0, n_inputs - 1, min(subsample, n_inputs)).round().astype(int))
+    values_list = [values_list[i] for i in picked]
+    weights_list = [weights_list[i] for i in picked]
+
+    selection = n_grid_selection_settings(tolerance, subsample, start, factor, max_n_grid)
+    selection['steps'] = []
+    with stage('select_n_grid'):
+        previous = None
+        n_grid = start
+        while True:
+            grid = create_common_grid(values_list, n_grid=n_grid, log_space=True)
+            histograms = [
+                discretize_distribution(values, weights, grid, method=discretization)
+                for values, weights in zip(values_list, weights_list)
+            ]
+            support, barycenter = median_quantile_barycenter([grid] * len(histograms), histograms)
+            log_grid, log_support = np.log(grid), np.log(support)
+            distances = np.array([
+                _wasserstein_1d(log_grid, histogram, log_support, barycenter)
+                for histogram in histograms
+            ])
+            step = {'n_grid': int(n_grid)}
+            if previous is not None:
+                tiny = np.finfo(float).tiny
+                center = np.dot(previous[1], previous[0])
+                spread = max(float(np.dot(previous[1], np.abs(previous[0] - center))), tiny)
+                step['barycenter_change'] = _wasserstein_1d(
+                    log_support, barycenter, previous[0], previous[1]
+                ) / spread
+                step['distance_change'] = (
+                    float(np.abs(distances - previous[2]).max()) / max(float(distances.mean()), tiny)
+                )
+            selection['steps'].append(step)
+
+            if previous is not None and max(step['barycenter_change'], step['distance_change']) < tolerance:
+                chosen, converged = previous[3], True
+                break
+            if n_grid >= max_n_grid:
+                chosen, converged = int(n_grid), False
+                break
+            previous = (log_support, barycenter, distances, int(n_grid))
+            n_grid = min(n_grid * factor, max_n_grid)
+
+    selection['n_grid'] = chosen
+    selection['converged'] = converged
+    return chosen, selection
+
+
+def format_n_grid_selection(selection):
+    """One line per grid size tried by select_n_grid."""
+    lines = []
+    for step in selection['steps']:
+        line = f"  n_grid {step['n_grid']:>5}"
+        if 'barycenter_change' in step:
+            line += (
+                f": barycenter change {step['barycenter_change']:.2e}, "
+                f"distance change {step['distance_change']:.2e}"
+            )
+        lines.append(line)
+    state = "converged" if selection['converged'] else "not converged, using the largest size"
+    lines.append(
+        f"  -> n_grid {selection['n_grid']} (tolerance {selection['tolerance']:g}, {state})"
+    )
+    return "\n".join(lines)
+
+
+def load_barycenter(filepath):
+    """
+    Load a precomputed barycenter from .npz file.
+    
+    Parameters
+    ----------
+    filepath : str
         Path to barycenter .npz file
         
     Returns
@@ -443,6 +1941,624 @@ def load_barycenter(filepath):
     return grid, barycenter
 
 
+def file_sha256(filepath, block_size=1 << 20):
+    """Return the hex SHA-256 digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _describe_input_file(filepath, with_hash=True):
+    """Identity record (name, size, mtime, content hash) of one input file."""
+    member = split_member_path(filepath)
+    if member is not None:
+        # Identity of the source file recorded when the store was built
+        store_path, name = member
+        store = open_cohort_store(store_path)
+        return dict(store.samples[store.index(name)]['source'])
+
+    stat = os.stat(filepath)
+    entry = {
+        'file': Path(filepath).name,
+        'size': int(stat.st_size),
+        'mtime_ns': int(stat.st_mtime_ns),
+    }
+    if with_hash:
+        entry['sha256'] = file_sha256(filepath)
+    return entry
+
+
+def barycenter_provenance(
+    cloud_files,
+    freq_column="pgen",
+    weights_column="duplicate_frequency_percent",
+    productive_filter=False,
+    vdj_filter=False,
+    vj_filter=False,
+    n_grid=None,
+    solver="ot.lp.barycenter",
+    hash_inputs=True,
+    n_grid_selection=None,
+    discretization='nearest',
+):
+    """
+    Describe the inputs a barycenter is (or would be) computed from.
+
+    Parameters
+    ----------
+    cloud_files : list of str or Path
+        Cloud TSV files that enter the barycenter.
+    freq_column, weights_column : str or int
+        Column specifications passed to load_distribution.
+    productive_filter, vdj_filter, vj_filter : bool
+        Row filters passed to load_distribution.
+    n_grid : int or None
+        Number of grid points. None means "unknown to the caller"; such
+        fields are skipped by barycenter_provenance_mismatches.
+    solver : str or None
+        Barycenter solver identifier.
+    hash_inputs : bool
+        If False, input files are described by name, size and mtime only
+        (used for cheap validation, see check_barycenter_provenance).
+    n_grid_selection : dict or None
+        Record of select_n_grid when the grid size was chosen by
+        --n-grid auto (stored as 'n_grid_selection'; left out otherwise).
+    discretization : str or None
+        Method of discretize_distribution; None is not compared. Records
+        without it were written before the option and used 'nearest'.
+
+    Returns
+    -------
+    provenance : dict
+        JSON-serializable record of the barycenter inputs.
+    """
+    provenance = {
+        'version': BARYCENTER_PROVENANCE_VERSION,
+        'inputs': [
+            _describe_input_file(f, with_hash=hash_inputs)
+            for f in sorted(cloud_files, key=lambda f: Path(f).name)
+        ],
+        'freq_column': str(freq_column),
+        'weights_column': str(weights_column),
+        'productive_filter': bool(productive_filter),
+        'vdj_filter': bool(vdj_filter),
+        'vj_filter': bool(vj_filter),
+        'n_grid': None if n_grid is None else int(n_grid),
+        'grid_spacing': 'log',
+        'discretization': discretization,
+        'metric': 'log_l1',
+        'solver': solver,
+    }
+    if n_grid_selection is not None:
+        provenance['n_grid_selection'] = n_grid_selection
+    return provenance
+
+
+def provenance_fingerprint(provenance):
+    """
+    Short hash of a provenance record.
+
+    File modification times are left out, so copying a cloud folder does not
+    change the fingerprint as long as file contents stay the same.
+    """
+    record = dict(provenance)
+    record['inputs'] = [
+        {key: value for key, value in entry.items() if key != 'mtime_ns'}
+        for entry in provenance.get('inputs', [])
+    ]
+    payload = json.dumps(record, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(payload).hexdigest()[:16]
+
+
+def save_barycenter(filepath, grid, barycenter, provenance=None):
+    """
+    Save a barycenter to .npz, optionally with its provenance record.
+
+    The archive always contains 'grid' and 'barycenter' (readable by
+    load_barycenter). With provenance it also holds 'provenance' (JSON text)
+    and 'fingerprint' (see provenance_fingerprint).
+    """
+    arrays = {'grid': grid, 'barycenter': barycenter}
+    if provenance is not None:
+        arrays['provenance'] = np.array(json.dumps(provenance, sort_keys=True))
+        arrays['fingerprint'] = np.array(provenance_fingerprint(provenance))
+    np.savez(filepath, **arrays)
+
+
+def load_barycenter_provenance(filepath):
+    """
+    Load the provenance record stored with a barycenter.
+
+    Returns
+    -------
+    provenance : dict or None
+        None for barycenter files written without provenance.
+    """
+    with np.load(filepath) as data:
+        if 'provenance' not in data.files:
+            return None
+        return json.loads(str(data['provenance']))
+
+
+def barycenter_provenance_mismatches(stored, expected):
+    """
+    List the differences between a stored and an expected provenance record.
+
+    Fields that are None in `expected` are not compared. Input files match
+    on name and size, then on content hash when both records carry one, or
+    on modification time otherwise.
+
+    Returns
+    -------
+    problems : list of str
+        Human-readable differences (empty if the barycenter is up to date).
+    """
+    if stored is None:
+        return ["barycenter file has no provenance metadata (written by an older version)"]
+
+    problems = []
+    if stored.get('version') != expected.get('version'):
+        problems.append(
+            f"provenance version {stored.get('version')} != {expected.get('version')}"
+        )
+
+    for key in [
+        'freq_column', 'weights_column', 'productive_filter', 'vdj_filter',
+        'vj_filter', 'n_grid', 'grid_spacing', 'metric', 'solver',
+    ]:
+        if expected.get(key) is None:
+            continue
+        if stored.get(key) != expected[key]:
+            problems.append(f"{key}: barycenter has {stored.get(key)!r}, current run uses {expected[key]!r}")
+
+    # Barycenters written before --discretization existed used 'nearest'
+    if expected.get('discretization') is not None:
+        stored_discretization = stored.get('discretization', 'nearest')
+        if stored_discretization != expected['discretization']:
+            problems.append(
+                f"discretization: barycenter has {stored_discretization!r}, "
+                f"current run uses {expected['discretization']!r}"
+            )
+
+    # --n-grid auto: the selected size follows from the inputs, so only the
+    # selection settings are compared
+    if 'n_grid_selection' in expected:
+        stored_selection = stored.get('n_grid_selection')
+        if stored_selection is None:
+            problems.append(f"n_grid: barycenter has fixed {stored.get('n_grid')!r}, current run uses 'auto'")
+        else:
+            for key in ('tolerance', 'subsample', 'start', 'factor', 'max_n_grid'):
+                if stored_selection.get(key) != expected['n_grid_selection'].get(key):
+                    problems.append(
+                        f"n_grid auto {key}: barycenter has {stored_selection.get(key)!r}, "
+                        f"current run uses {expected['n_grid_selection'].get(key)!r}"
+                    )
+
+    stored_inputs = {entry['file']: entry for entry in stored.get('inputs', [])}
+    expected_inputs = {entry['file']: entry for entry in expected.get('inputs', [])}
+
+    added = sorted(set(expected_inputs) - set(stored_inputs))
+    removed = sorted(set(stored_inputs) - set(expected_inputs))
+    if added:
+        problems.append(f"cloud files not in barycenter: {added}")
+    if removed:
+        problems.append(f"barycenter files missing from cloud: {removed}")
+
+    changed = []
+    for name in sorted(set(stored_inputs) & set(expected_inputs)):
+        old, new = stored_inputs[name], expected_inputs[name]
+        if old.get('size') != new.get('size'):
+            changed.append(name)
+        elif 'sha256' in old and 'sha256' in new:
+            if old['sha256'] != new['sha256']:
+                changed.append(name)
+        elif old.get('mtime_ns') != new.get('mtime_ns'):
+            changed.append(name)
+    if changed:
+        problems.append(f"cloud files changed since barycenter was computed: {changed}")
+
+    return problems
+
+
+def check_barycenter_provenance(
+    barycenter_path,
+    cloud_files,
+    freq_column="pgen",
+    weights_column="duplicate_frequency_percent",
+    productive_filter=False,
+    vdj_filter=False,
+    vj_filter=False,
+    n_grid=None,
+    solver=None,
+    n_grid_selection=None,
+    discretization=None,
+):
+    """
+    Validate a barycenter file against the cloud files and loading options.
+
+    Files with unchanged name, size and modification time are accepted
+    without reading them; only files whose modification time differs are
+    hashed. Arguments left as None are not checked.
+
+    Returns
+    -------
+    problems : list of str
+        Reasons the barycenter is stale (empty if it is up to date).
+    """
+    stored = load_barycenter_provenance(barycenter_path)
+    expected = barycenter_provenance(
+        cloud_files,
+        freq_column=freq_column,
+        weights_column=weights_column,
+        productive_filter=productive_filter,
+        vdj_filter=vdj_filter,
+        vj_filter=vj_filter,
+        n_grid=n_grid,
+        solver=solver,
+        hash_inputs=False,
+        n_grid_selection=n_grid_selection,
+        discretization=discretization,
+    )
+    if stored is None:
+        return barycenter_provenance_mismatches(stored, expected)
+
+    stored_inputs = {entry['file']: entry for entry in stored.get('inputs', [])}
+    paths = {Path(f).name: f for f in cloud_files}
+    for entry in expected['inputs']:
+        old = stored_inputs.get(entry['file'])
+        if old is None or old.get('size') != entry['size']:
+            continue
+        if old.get('mtime_ns') != entry['mtime_ns'] and 'sha256' in old and 'sha256' not in entry:
+            entry['sha256'] = file_sha256(paths[entry['file']])
+    return barycenter_provenance_mismatches(stored, expected)
+
+
+def barycenter_fingerprint(filepath):
+    """
+    Short identifier of a barycenter file.
+
+    The provenance fingerprint when the file has one, otherwise a hash of
+    the file contents.
+    """
+    with np.load(filepath) as data:
+        if 'fingerprint' in data.files:
+            return str(data['fingerprint'])
+    return file_sha256(filepath)[:16]
+
+
+def distance_parameters(
+    grid,
+    freq_column="pgen",
+    weights_column="duplicate_frequency_percent",
+    productive_filter=False,
+    vdj_filter=False,
+    vj_filter=False,
+    discretization='nearest',
+):
+    """
+    Describe the options distances are computed with.
+
+    Parameters
+    ----------
+    grid : str
+        Grid the samples are discretized on: 'barycenter:<fingerprint>' for
+        the (extended) grid of a barycenter, or 'common:<n_grid>' for a
+        common log grid over the samples.
+    freq_column, weights_column : str or int
+        Column specifications passed to load_distribution.
+    productive_filter, vdj_filter, vj_filter : bool
+        Row filters passed to load_distribution.
+    discretization : str
+        Method of discretize_distribution ('nearest' or 'linear').
+
+    Returns
+    -------
+    parameters : dict
+        JSON-serializable record; see distances_fingerprint.
+    """
+    return {
+        'version': DISTANCES_VERSION,
+        'grid': str(grid),
+        'freq_column': str(freq_column),
+        'weights_column': str(weights_column),
+        'productive_filter': bool(productive_filter),
+        'vdj_filter': bool(vdj_filter),
+        'vj_filter': bool(vj_filter),
+        'discretization': str(discretization),
+        'metric': 'log_l1',
+    }
+
+
+def distances_fingerprint(parameters):
+    """Short hash of a distance parameter record."""
+    payload = json.dumps(parameters, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(payload).hexdigest()[:16]
+
+
+def save_distances(filepath, files, parameters, labels=None, to_barycenter=None, pairwise=None, n_rows=None):
+    """
+    Save distances computed for a set of samples to .npz for reuse.
+
+    Parameters
+    ----------
+    filepath : str or Path
+        Output .npz file
+    files : list
+        Sample files, in the order of the distance arrays
+    parameters : dict
+        Options the distances were computed with (see distance_parameters)
+    labels : list of str or None
+        Display label of each sample (default: derived from the file name)
+    to_barycenter : array-like or None
+        (n_samples,) distance of each sample to the barycenter
+    pairwise : array-like or None
+        Pairwise distances, either condensed (upper triangle, row by row, as
+        scipy.spatial.distance.squareform) or as a square matrix
+    n_rows : array-like or None
+        Number of rows of each sample after filtering
+
+    The archive also records the identity (name, size, modification time)
+    of every input file and the fingerprint of `parameters`, which
+    lookup_distances checks before reusing the distances.
+    """
+    if labels is None:
+        labels = [_label_from_filename(Path(str(f))) for f in files]
+    arrays = {
+        'files': np.array([Path(str(f)).name for f in files], dtype=str),
+        'labels': np.array(labels, dtype=str),
+        'inputs': np.array(json.dumps([_describe_input_file(f, with_hash=False) for f in files])),
+        'parameters': np.array(json.dumps(parameters, sort_keys=True)),
+        'fingerprint': np.array(distances_fingerprint(parameters)),
+    }
+    if to_barycenter is not None:
+        arrays['to_barycenter'] = np.asarray(to_barycenter, dtype=float)
+    if pairwise is not None:
+        pairwise = np.asarray(pairwise, dtype=float)
+        if pairwise.ndim == 2:
+            pairwise = pairwise[np.triu_indices(len(pairwise), k=1)]
+        arrays['pairwise'] = pairwise
+    if n_rows is not None:
+        arrays['n_rows'] = np.asarray(n_rows, dtype=np.int64)
+    np.savez(filepath, **arrays)
+
+
+def load_distances(filepath):
+    """
+    Load distances written by save_distances.
+
+    Returns
+    -------
+    artifact : dict
+        files, labels, inputs, parameters, fingerprint, and to_barycenter,
+        pairwise (condensed) and n_rows (None when not stored)
+    """
+    with np.load(filepath) as data:
+        return {
+            'files': data['files'].tolist(),
+            'labels': data['labels'].tolist(),
+            'inputs': json.loads(str(data['inputs'])),
+            'parameters': json.loads(str(data['parameters'])),
+            'fingerprint': str(data['fingerprint']),
+            'to_barycenter': data['to_barycenter'] if 'to_barycenter' in data.files else None,
+            'pairwise': data['pairwise'] if 'pairwise' in data.files else None,
+            'n_rows': data['n_rows'] if 'n_rows' in data.files else None,
+        }
+
+
+def _condensed_to_square(condensed, n):
+    """Square symmetric matrix from a condensed upper triangle."""
+    square = np.zeros((n, n))
+    rows, cols = np.triu_indices(n, k=1)
+    square[rows, cols] = condensed
+    square[cols, rows] = condensed
+    return square
+
+
+def save_square_distances(filepath, condensed, n):
+    """
+    Write pairwise distances as a square matrix in a memory-mappable .npy file.
+
+    The matrix is written row by row through a memory map, so it is never
+    held in memory; readers can open it with np.load(filepath, mmap_mode='r').
+
+    Parameters
+    ----------
+    filepath : str or Path
+        Output .npy file
+    condensed : np.ndarray
+        Condensed upper triangle of the matrix (see save_distances)
+    n : int
+        Number of samples
+    """
+    condensed = np.asarray(condensed, dtype=float)
+    if len(condensed) != n * (n - 1) // 2:
+        raise ValueError(f"Condensed distances have length {len(condensed)}, expected {n * (n - 1) // 2} for {n} samples")
+    square = np.lib.format.open_memmap(filepath, mode='w+', dtype=np.float64, shape=(n, n))
+    # Start of row i of the upper triangle in the condensed array
+    row_start = np.concatenate([[0], np.cumsum(np.arange(n - 1, 0, -1))])
+    for i in range(n):
+        # (j, i) for j < i is stored in row j, at column i
+        columns = np.arange(i)
+        square[i, :i] = condensed[row_start[columns] + i - columns - 1]
+        square[i, i] = 0.0
+        square[i, i + 1:] = condensed[row_start[i]:row_start[i] + n - i - 1]
+    square.flush()
+    del square
+
+
+def lookup_distances(filepaths, files, parameters, to_barycenter=False, pairwise=False):
+    """
+    Look up precomputed distances of `files` in distance artifacts.
+
+    An artifact is used only if its parameter fingerprint matches
+    `parameters` and the files it recorded have the same name, size and
+    modification time as `files` now. Distances to the barycenter may be
+    collected from several artifacts; pairwise distances must all come from
+    one artifact that covers every file.
+
+    Parameters
+    ----------
+    filepaths : list of str or Path
+        Artifacts written by save_distances
+    files : list
+        Samples the caller needs distances for
+    parameters : dict
+        Options the caller would compute with (see distance_parameters)
+    to_barycenter, pairwise : bool
+        Which distances are needed
+
+    Returns
+    -------
+    distances : dict or None
+        'to_barycenter' and 'n_rows' ((n,) arrays) and 'pairwise' ((n, n)
+        matrix) for the requested kinds, in the order of `files`; None if
+        any requested distance is missing or stale.
+    problems : list of str
+        Why the artifacts could not be used (empty on success).
+    """
+    expected = distances_fingerprint(parameters)
+    current = {}
+    for f in files:
+        name = Path(str(f)).name
+        current[name] = _describe_input_file(f, with_hash=False)
+    names = list(current)
+
+    problems = []
+    found_to_barycenter = {}
+    found_pairwise = None
+    for filepath in filepaths:
+        artifact = load_distances(filepath)
+        stored = artifact['parameters']
+        if 'discretization' not in stored:
+            # Written before --discretization existed, always 'nearest'
+            stored = dict(stored, discretization='nearest')
+        if distances_fingerprint(stored) != expected:
+            differences = [
+                f"{key}: {stored.get(key)!r} (current run: {value!r})"
+                for key, value in parameters.items()
+                if stored.get(key) != value
+            ]
+            problems.append(f"{Path(filepath).name}: computed with other options ({'; '.join(differences)})")
+            continue
+
+        recorded = {entry['file']: entry for entry in artifact['inputs']}
+        changed = sorted(
+            name for name in names
+            if name in recorded and (
+                recorded[name].get('size') != current[name].get('size')
+                or recorded[name].get('mtime_ns') != current[name].get('mtime_ns')
+            )
+        )
+        if changed:
+            problems.append(f"{Path(filepath).name}: files changed since the distances were computed: {changed}")
+            continue
+
+        index = {name: i for i, name in enumerate(artifact['files'])}
+        if to_barycenter and artifact['to_barycenter'] is not None:
+            for name in names:
+                if name in index:
+                    i = index[name]
+                    rows = -1 if artifact['n_rows'] is None else int(artifact['n_rows'][i])
+                    found_to_barycenter[name] = (float(artifact['to_barycenter'][i]), rows)
+        if pairwise and found_pairwise is None and artifact['pairwise'] is not None:
+            if all(name in index for name in names):
+                order = np.array([index[name] for name in names], dtype=int)
+                square = _condensed_to_square(artifact['pairwise'], len(artifact['files']))
+                found_pairwise = square[np.ix_(order, order)]
+
+    complete = True
+    distances = {}
+    if to_barycenter:
+        missing = [name for name in names if name not in found_to_barycenter]
+        if missing:
+            problems.append(f"no distance to the barycenter for {len(missing)} file(s): {missing[:5]}")
+            complete = False
+        else:
+            distances['to_barycenter'] = np.array([found_to_barycenter[name][0] for name in names])
+            distances['n_rows'] = np.array([found_to_barycenter[name][1] for name in names])
+    if pairwise:
+        if found_pairwise is None:
+            problems.append("no artifact holds pairwise distances for all files")
+            complete = False
+        else:
+            distances['pairwise'] = found_pairwise
+
+    if not complete:
+        return None, problems
+    return distances, []
+
+
+def values_range(values_list):
+    """(min, max) over several value arrays, without concatenating them."""
+    value_min, value_max = np.inf, -np.inf
+    for values in values_list:
+        value_min = min(value_min, float(values.min()))
+        value_max = max(value_max, float(values.max()))
+    return value_min, value_max
+
+
+def stored_value_range(files):
+    """
+    Range of the frequency values of cohort store members, from metadata.
+
+    Cohort stores record each sample's min/max at build time, so no rows
+    are read. The range is over all rows, so it covers any filter
+    combination.
+
+    Returns
+    -------
+    tuple of float or None
+        (min, max), or None if a file is not a store member or lacks the
+        metadata (the caller then extends the grid as samples are loaded).
+    """
+    vmin, vmax = np.inf, -np.inf
+    for filepath in files:
+        member = split_member_path(filepath)
+        if member is None:
+            return None
+        store_path, name = member
+        store = open_cohort_store(store_path)
+        sample = store.samples[store.index(name)]
+        if sample.get('min') is None or sample.get('max') is None:
+            return None
+        vmin = min(vmin, sample['min'])
+        vmax = max(vmax, sample['max'])
+    if not np.isfinite(vmin):
+        return None
+    return vmin, vmax
+
+
+def extend_grid_for_files(grid, weights, files):
+    """
+    Extend a barycenter grid once for all `files`, before loading them.
+
+    Uses stored_value_range; when the range is unknown the grid is returned
+    unchanged, and callers keep extending the returned grid with
+    extend_grid_if_needed as samples are loaded. That returns the same
+    arrays for every sample already covered, so each run builds at most a
+    few grids instead of one per sample.
+    """
+    value_range = stored_value_range(files)
+    if value_range is None:
+        return grid, weights
+    return extend_grid_if_needed(grid, weights, *value_range)
+
+
+def pad_to_extended_grid(weights, grid, extended_grid):
+    """
+    Place weights given on `grid` onto a grid extended from it by
+    extend_grid_if_needed (which keeps the original points), zeros elsewhere.
+    """
+    if len(extended_grid) == len(grid):
+        return weights
+    offset = int(np.searchsorted(extended_grid, grid[0]))
+    padded = np.zeros(len(extended_grid))
+    padded[offset:offset + len(grid)] = weights
+    return padded
+
+
 def extend_grid_if_needed(grid, weights, new_data_min, new_data_max):
     """
     Extend grid and weights if new data falls outside the current grid range.
@@ -471,39 +2587,40 @@ def extend_grid_if_needed(grid, weights, new_data_min, new_data_max):
     extended_weights : np.ndarray
         Extended weights (with zeros in new regions)
     """
-    # Check if extension is needed
-    needs_lower = new_data_min < grid[0]
-    needs_upper = new_data_max > grid[-1]
-    
-    if not needs_lower and not needs_upper:
-        return grid, weights
-    
-    # Calculate the log-spacing step from original grid
-    log_grid = np.log(grid)
-    log_step = np.mean(np.diff(log_grid))
-    
-    # Extend below if needed
-    lower_grid = []
-    lower_weights = []
-    if needs_lower:
-        log_min = np.log(new_data_min)
-        log_first = log_grid[0]
-        n_below = int(np.ceil((log_first - log_min) / log_step))
-        lower_grid = np.exp(np.arange(log_first - n_below * log_step, log_first, log_step))
-        lower_weights = np.zeros(len(lower_grid))
-    
-    # Extend above if needed
-    upper_grid = []
-    upper_weights = []
-    if needs_upper:
-        log_max = np.log(new_data_max)
-        log_last = log_grid[-1]
-        n_above = int(np.ceil((log_max - log_last) / log_step))
-        upper_grid = np.exp(np.arange(log_last + log_step, log_last + (n_above + 1) * log_step, log_step))
-        upper_weights = np.zeros(len(upper_grid))
-    
-    # Combine all parts
-    extended_grid = np.concatenate([lower_grid, grid, upper_grid])
-    extended_weights = np.concatenate([lower_weights, weights, upper_weights])
-    
+    with stage('extend_grid'):
+        # Check if extension is needed
+        needs_lower = new_data_min < grid[0]
+        needs_upper = new_data_max > grid[-1]
+
+        if not needs_lower and not needs_upper:
+            return grid, weights
+
+        # Calculate the log-spacing step from original grid
+        log_grid = np.log(grid)
+        log_step = np.mean(np.diff(log_grid))
+
+        # Extend below if needed
+        lower_grid = []
+        lower_weights = []
+        if needs_lower:
+            log_min = np.log(new_data_min)
+            log_first = log_grid[0]
+            n_below = int(np.ceil((log_first - log_min) / log_step))
+            lower_grid = np.exp(np.arange(log_first - n_below * log_step, log_first, log_step))
+            lower_weights = np.zeros(len(lower_grid))
+
+        # Extend above if needed
+        upper_grid = []
+        upper_weights = []
+        if needs_upper:
+            log_max = np.log(new_data_max)
+            log_last = log_grid[-1]
+            n_above = int(np.ceil((log_max - log_last) / log_step))
+            upper_grid = np.exp(np.arange(log_last + log_step, log_last + (n_above + 1) * log_step, log_step))
+            upper_weights = np.zeros(len(upper_grid))
+
+        # Combine all parts
+        extended_grid = np.concatenate([lower_grid, grid, upper_grid])
+        extended_weights = np.concatenate([lower_weights, weights, upper_weights])
+
     return extended_grid, extended_weights
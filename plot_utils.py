@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Plotting helpers shared by the plotting scripts.
+
+matplotlib is imported on first use, with the non-interactive Agg
+backend selected before pyplot is loaded, so scripts start fast and never
+need a display. Also provides fast label placement for scatter plots with
+many points.
+"""
+import numpy as np
+
+
+def pyplot():
+    """
+    Return matplotlib.pyplot set up for writing image files.
+
+    Selects the Agg backend before the first pyplot import (no GUI toolkit
+    is probed or loaded).
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+
+LABEL_PLACEMENTS = ("auto", "grid", "adjust")
+
+# Above this many labels, 'auto' placement switches from adjust_text
+# (iterative, superlinear in the number of labels) to the grid placer.
+ADJUST_TEXT_MAX_LABELS = 60
+
+# Candidate label positions around a point: (dx, dy) in points, ha, va.
+_LABEL_CANDIDATES = (
+    (0, 4, 'center', 'bottom'),
+    (0, -4, 'center', 'top'),
+    (6, 0, 'left', 'center'),
+    (-6, 0, 'right', 'center'),
+    (5, 4, 'left', 'bottom'),
+    (-5, 4, 'right', 'bottom'),
+    (5, -4, 'left', 'top'),
+    (-5, -4, 'right', 'top'),
+)
+
+
+def _label_box(x, y, dx, dy, ha, va, width, height):
+    """Pixel box (x0, y0, x1, y1) of a label anchored at (x + dx, y + dy)."""
+    x0 = x + dx - {'left': 0.0, 'center': width / 2, 'right': width}[ha]
+    y0 = y + dy - {'bottom': 0.0, 'center': height / 2, 'top': height}[va]
+    return x0, y0, x0 + width, y0 + height
+
+
+def place_labels(
+    ax,
+    x,
+    y,
+    labels,
+    priority=None,
+    method="auto",
+    max_per_region=3,
+    region_grid=8,
+    fontsize=9,
+    label_offset=0.04,
+    **text_kwargs,
+):
+    """
+    Label points without overlaps, scaling to thousands of points.
+
+    'grid' places labels greedily by decreasing priority: each label tries a
+    few positions around its point and takes the first whose box does not
+    collide with an already placed label (checked in a spatial hash, so the
+    cost is linear in the number of labels). The axes are divided into
+    region_grid x region_grid regions and at most max_per_region labels are
+    drawn per region; the rest are skipped. 'adjust' runs adjust_text on
+    all labels, which gives a nicer layout but is only practical for small
+    plots. 'auto' uses 'adjust' up to ADJUST_TEXT_MAX_LABELS labels.
+
+    Call after the axes limits and layout are final (e.g. after
+    tight_layout), since placement works in display coordinates.
+
+    Parameters
+    ----------
+    ax : matplotlib.axes.Axes
+        Axes holding the points
+    x, y : array-like
+        Data coordinates of the points
+    labels : list of str
+        Label of each point
+    priority : array-like or None
+        Higher values are placed first (default: input order)
+    method : str
+        'auto', 'grid' or 'adjust'
+    max_per_region : int or None
+        Label cap per region for 'grid' (None: no cap)
+    region_grid : int
+        Number of regions along each axis for the cap
+    fontsize : float
+        Label font size in points
+    label_offset : float
+        Initial vertical offset (data units) of the labels for 'adjust'
+    **text_kwargs
+        Extra matplotlib text properties (e.g. fontweight, color, zorder)
+
+    Returns
+    -------
+    texts : list of matplotlib.text.Text
+        The labels drawn
+    n_skipped : int
+        Labels left out by the grid placer
+    """
+    if method not in LABEL_PLACEMENTS:
+        raise ValueError(f"Unknown label placement '{method}'. Choose from: {', '.join(LABEL_PLACEMENTS)}")
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if method == "auto":
+        method = "adjust" if len(labels) <= ADJUST_TEXT_MAX_LABELS else "grid"
+
+    if method == "adjust":
+        from adjustText import adjust_text
+
+        texts = [
+            ax.text(px, py + label_offset, label, ha='center', va='bottom', fontsize=fontsize, **text_kwargs)
+            for px, py, label in zip(x, y, labels)
+        ]
+        # Move labels only (no arrows/boxes) to avoid overlaps
+        adjust_text(
+            texts,
+            expand_points=(1.2, 1.2),
+            expand_text=(1.1, 1.1),
+            force_points=0.2,
+            force_text=0.3
+        )
+        return texts, 0
+
+    order = np.arange(len(labels)) if priority is None else np.argsort(-np.asarray(priority), kind='stable')
+    pixels = ax.transData.transform(np.column_stack([x, y]))
+    scale = ax.figure.dpi / 72.0
+    height = 1.3 * fontsize * scale
+    char_width = 0.62 * fontsize * scale
+    cell = 4 * height
+    axes_box = ax.bbox
+
+    placed = {}
+    per_region = {}
+    texts = []
+    for i in order:
+        px, py = pixels[i]
+        region = (
+            min(max(int((px - axes_box.x0) / axes_box.width * region_grid), 0), region_grid - 1),
+            min(max(int((py - axes_box.y0) / axes_box.height * region_grid), 0), region_grid - 1),
+        )
+        if max_per_region is not None and per_region.get(region, 0) >= max_per_region:
+            continue
+
+        width = char_width * len(labels[i])
+        for dx, dy, ha, va in _LABEL_CANDIDATES:
+            box = _label_box(px, py, dx * scale, dy * scale, ha, va, width, height)
+            cells = [
+                (cx, cy)
+                for cx in range(int(box[0] // cell), int(box[2] // cell) + 1)
+                for cy in range(int(box[1] // cell), int(box[3] // cell) + 1)
+            ]
+            collides = any(
+                box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]
+                for key in cells
+                for other in placed.get(key, ())
+            )
+            if collides:
+                continue
+            for key in cells:
+                placed.setdefault(key, []).append(box)
+            per_region[region] = per_region.get(region, 0) + 1
+            texts.append(ax.annotate(
+                labels[i], (x[i], y[i]), xytext=(dx, dy), textcoords='offset points',
+                ha=ha, va=va, fontsize=fontsize, **text_kwargs,
+            ))
+            break
+
+    return texts, len(labels) - len(texts)
@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+"""
+Compact repertoires and lazy handles sharing one memory-bounded cache.
+
+A LogDistribution holds one filtered repertoire as the natural log of its
+frequency values, in float32 by default (or float64), and its raw weights
+as int32 counts or float32/float64 (None for uniform weights), together
+with the min/max values and total weight. This is half the memory of the
+float64 (values, weights) of ot_utils.load_distribution, and the logs are
+taken once, at load time (not at all for cohort stores, which hold them).
+
+A Repertoire stands for one sample file and its loading options. Its
+LogDistribution is read on first access and kept in a RepertoireCache,
+which evicts the least recently used records once their total size
+exceeds the memory budget; an evicted
+repertoire is simply read again when it is next needed. Compact derived
+forms are computed once and kept on the handle, outside the budget: the
+value range, the row count and the histogram (and CDF) on each grid used.
+
+Code that works on whole cohorts (grids, barycenters, all-pairs distances,
+bootstrap replicates) then needs the raw arrays of only a few samples at
+a time, and runs in the same memory whatever the cohort size:
+
+    repertoires = open_repertoires(files, memory_budget=2 << 30, **load_options)
+    grid = create_common_grid(value_ranges(repertoires), n_grid=200)
+    histograms = [repertoire.histogram(grid) for repertoire in repertoires]
+
+values_view/weights_view present the handles as the lists of arrays the
+ot_utils functions take (select_n_grid, compute_lp_barycenter, ...).
+
+open_filter_variants gives handles of the same files under several filter
+combinations; all combinations of a file are read in one pass.
+open_repertoire_settings does the same for (weights column, filters)
+settings, with one pass per weights column.
+"""
+import re
+from collections import OrderedDict
+from collections.abc import Sequence
+
+import numpy as np
+
+from instrumentation import count, stage
+from ot_utils import (
+    _weights_disabled,
+    discretize_distribution,
+    filter_variant_label,
+    iter_filter_variant_chunks,
+    iter_filtered_chunks,
+)
+
+
+# Storage precision of LogDistribution.log_values (and of float weights)
+REPERTOIRE_PRECISIONS = ('float32', 'float64')
+
+_MEMORY_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+
+def parse_memory_budget(value):
+    """
+    Parse a memory size such as '512M', '2G', '1.5g' or '1000000' (bytes).
+
+    'none' and 'unlimited' return None (no budget). Raises ValueError for
+    anything else.
+    """
+    text = str(value).strip().lower()
+    if text in ('none', 'unlimited'):
+        return None
+    match = re.fullmatch(r'(\d+(?:\.\d*)?)\s*([kmgt]?)i?b?', text)
+    if match is None:
+        raise ValueError(f"invalid memory size: {value!r} (use e.g. 512M, 2G or a number of bytes)")
+    size = int(float(match.group(1)) * _MEMORY_UNITS[match.group(2)])
+    if size <= 0:
+        raise ValueError(f"memory size must be > 0: {value!r}")
+    return size
+
+
+def memory_budget_argument(value):
+    """argparse type of --memory-budget (see parse_memory_budget)."""
+    from argparse import ArgumentTypeError
+    try:
+        return parse_memory_budget(value)
+    except ValueError as exc:
+        raise ArgumentTypeError(str(exc))
+
+
+class LogDistribution:
+    """
+    One filtered repertoire in compact log-domain form.
+
+    Attributes
+    ----------
+    log_values : np.ndarray
+        Natural log of the positive frequency values (float32 or float64)
+    weights : np.ndarray or None
+        Raw weights: int32 when the weights column holds counts, float32 or
+        float64 (the precision of log_values) otherwise; None for uniform
+        weights
+    total_weight : float
+        Sum of the raw weights (the number of rows when uniform)
+    min, max : float
+        Smallest and largest frequency value (not log)
+    """
+
+    __slots__ = ('log_values', 'weights', 'total_weight', 'min', 'max')
+
+    def __init__(self, log_values, weights, total_weight, min, max):
+        self.log_values = log_values
+        self.weights = weights
+        self.total_weight = total_weight
+        self.min = min
+        self.max = max
+
+    def __len__(self):
+        return len(self.log_values)
+
+    @property
+    def nbytes(self):
+        """Size of the arrays in bytes."""
+        return self.log_values.nbytes + (0 if self.weights is None else self.weights.nbytes)
+
+    @property
+    def values(self):
+        """Frequency values as float64 (computed on each access)."""
+        return np.exp(self.log_values, dtype=float)
+
+    @property
+    def normalized_weights(self):
+        """Weights as float64 summing to 1 (computed on each access)."""
+        if self.weights is None:
+            return np.full(len(self.log_values), 1.0 / len(self.log_values))
+        return self.weights / self.total_weight
+
+    def histogram(self, grid, method='nearest'):
+        """discretize_distribution on `grid`, straight from the logs."""
+        return discretize_distribution(self.log_values, self.weights, grid, method=method, log_domain=True)
+
+    def with_uniform_weights(self):
+        """The same rows with uniform weights (shares log_values)."""
+        return LogDistribution(self.log_values, None, float(len(self.log_values)), self.min, self.max)
+
+
+def _compact_weights(weights, dtype):
+    """Raw weights as int32 if they are integer counts that fit, else `dtype`."""
+    if weights.dtype.kind in 'iu' and (len(weights) == 0 or weights.max() <= np.iinfo(np.int32).max):
+        return weights.astype(np.int32)
+    return weights.astype(dtype)
+
+
+def load_log_distribution(
+    filepath,
+    freq_column="pgen",
+    weights_column="duplicate_frequency_percent",
+    productive_filter=False,
+    vdj_filter=False,
+    vj_filter=False,
+    chunk_size=None,
+    precision='float32',
+):
+    """
+    Load a TSV file or cohort store member as a LogDistribution.
+
+    Same rows, filters and errors as ot_utils.load_distribution; only the
+    representation differs.
+
+    Parameters
+    ----------
+    filepath, freq_column, weights_column, productive_filter, vdj_filter, vj_filter, chunk_size
+        As in load_distribution
+    precision : str
+        dtype of the log values and float weights ('float32' or 'float64')
+
+    Returns
+    -------
+    LogDistribution
+    """
+    if precision not in REPERTOIRE_PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision!r} (expected one of {REPERTOIRE_PRECISIONS})")
+    uniform = _weights_disabled(weights_column)
+    log_parts = []
+    weights_parts = []
+    count('files_loaded')
+    with stage('load'):
+        for log_values, weights in iter_filtered_chunks(
+            filepath, freq_column, weights_column,
+            productive_filter, vdj_filter, vj_filter, chunk_size,
+            log_values=True,
+        ):
+            log_parts.append(log_values.astype(precision))
+            if not uniform:
+                weights_parts.append(_compact_weights(weights, precision))
+    return _assemble_log_distribution(filepath, log_parts, None if uniform else weights_parts, precision)
+
+
+def _assemble_log_distribution(filepath, log_parts, weights_parts, precision, description=""):
+    """LogDistribution of the concatenated chunks (weights_parts None: uniform)."""
+    log_values = np.concatenate(log_parts) if log_parts else np.array([], dtype=precision)
+    if len(log_values) == 0:
+        raise ValueError(
+            f"No valid rows remaining after filtering{description} for file '{filepath}'. "
+            "Check --productive-filter / --vdj-filter / --vj-filter or input data."
+        )
+    if weights_parts is None:
+        weights, total_weight = None, float(len(log_values))
+    else:
+        weights = np.concatenate(weights_parts)
+        total_weight = float(weights.sum(dtype=float))
+        if total_weight <= 0:
+            raise ValueError(
+                f"Weights sum to zero after filtering{description} for file '{filepath}'."
+            )
+    return LogDistribution(
+        log_values, weights, total_weight,
+        float(np.exp(float(log_values.min()))), float(np.exp(float(log_values.max()))),
+    )
+
+
+def load_log_distribution_variants(
+    filepath,
+    variants,
+    freq_column="pgen",
+    weights_column="duplicate_frequency_percent",
+    chunk_size=None,
+    precision='float32',
+):
+    """
+    Load a sample once as a LogDistribution per filter combination.
+
+    Each result is the load_log_distribution of the file with that
+    combination's filters, from a single parse (iter_filter_variant_chunks).
+
+    Parameters
+    ----------
+    filepath : str
+        Path to TSV file or cohort store member
+    variants : list of (productive_filter, vdj_filter, vj_filter)
+        Filter combinations (see ot_utils.parse_filter_variants)
+    freq_column, weights_column, chunk_size, precision
+        As in load_log_distribution
+
+    Returns
+    -------
+    list of LogDistribution
+        One per combination, in the order of `variants`
+    """
+    if precision not in REPERTOIRE_PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision!r} (expected one of {REPERTOIRE_PRECISIONS})")
+    uniform = _weights_disabled(weights_column)
+    log_parts = [[] for _ in variants]
+    weights_parts = [[] for _ in variants]
+    count('files_loaded')
+    with stage('load'):
+        for log_values, weights, masks in iter_filter_variant_chunks(
+            filepath, variants, freq_column, weights_column, chunk_size, log_values=True,
+        ):
+            log_values = log_values.astype(precision)
+            if not uniform:
+                weights = _compact_weights(weights, precision)
+            for variant_index, mask in enumerate(masks):
+                log_parts[variant_index].append(log_values[mask])
+                if not uniform:
+                    weights_parts[variant_index].append(weights[mask])
+    return [
+        _assemble_log_distribution(
+            filepath, log_parts[variant_index], None if uniform else weights_parts[variant_index],
+            precision, description=f" ({filter_variant_label(variant)})",
+        )
+        for variant_index, variant in enumerate(variants)
+    ]
+
+
+class RepertoireCache:
+    """
+    Least-recently-used store of loaded LogDistribution records.
+
+    Parameters
+    ----------
+    memory_budget : int or None
+        Largest total size in bytes of the cached records (None: keep all).
+        The most recently loaded repertoire is always kept, so a budget
+        smaller than one repertoire still works, one sample at a time.
+    """
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.peak_nbytes = 0
+
+    def get(self, key, loader):
+        """
+        Cached record of `key`, loaded with loader() on a miss.
+
+        The handles use themselves as keys, so an entry never outlives its
+        key and is never found by another handle.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        entry = loader()
+        self._entries[key] = entry
+        self.nbytes += entry.nbytes
+        self.peak_nbytes = max(self.peak_nbytes, self.nbytes)
+        self._evict()
+        return entry
+
+    def _evict(self):
+        if self.memory_budget is None:
+            return
+        while self.nbytes > self.memory_budget and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self.nbytes -= entry.nbytes
+            count('repertoire_evictions')
+
+    def clear(self):
+        """Drop every cached record."""
+        self._entries.clear()
+        self.nbytes = 0
+
+
+class Repertoire:
+    """
+    Handle on one sample file, loaded on first access.
+
+    Parameters
+    ----------
+    path : str or Path
+        TSV file or cohort store member path
+    cache : RepertoireCache
+        Cache holding the raw arrays (shared by the handles of a run)
+    **load_options
+        Keyword arguments of load_log_distribution (freq_column,
+        weights_column, productive_filter, vdj_filter, vj_filter,
+        chunk_size, precision)
+    """
+
+    def __init__(self, path, cache, **load_options):
+        self.path = path
+        self.cache = cache
+        self.load_options = load_options
+        self._value_range = None
+        self._n_rows = None
+        self._histograms = {}
+        # Set by open_repertoire_settings: (_VariantGroup, position in it)
+        self._group = None
+
+    def __repr__(self):
+        return f"Repertoire({str(self.path)!r})"
+
+    def _load(self):
+        distribution = load_log_distribution(str(self.path), **self.load_options)
+        count('repertoire_loads')
+        self._remember(distribution)
+        return distribution
+
+    def _remember(self, distribution):
+        self._value_range = (distribution.min, distribution.max)
+        self._n_rows = len(distribution)
+
+    def distribution(self):
+        """The LogDistribution, from the cache or read again."""
+        if self._group is not None:
+            group, position = self._group
+            return group.distributions()[position]
+        # Keyed on the handle itself: an id() could be reused once it is freed
+        return self.cache.get(self, self._load)
+
+    @property
+    def values(self):
+        """Frequency values as float64 (see LogDistribution.values)."""
+        return self.distribution().values
+
+    @property
+    def weights(self):
+        """Normalized float64 weights (see LogDistribution.normalized_weights)."""
+        return self.distribution().normalized_weights
+
+    @property
+    def value_range(self):
+        """(min, max) of the values; kept after the record is evicted."""
+        if self._value_range is None:
+            self.distribution()
+        return self._value_range
+
+    @property
+    def n_rows(self):
+        """Number of rows left after filtering."""
+        if self._n_rows is None:
+            self.distribution()
+        return self._n_rows
+
+    def histogram(self, grid, method='nearest'):
+        """
+        discretize_distribution of the repertoire on `grid`, computed once.
+
+        The histogram of every (grid, method) asked for is kept; each costs
+        len(grid) floats, against millions for the raw arrays.
+        """
+        key = (method, grid.tobytes())
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self.distribution().histogram(grid, method)
+            self._histograms[key] = histogram
+        return histogram
+
+    def cdf(self, grid, method='nearest'):
+        """Cumulative distribution on `grid` (cumsum of histogram)."""
+        return np.cumsum(self.histogram(grid, method))
+
+    def forget_histograms(self):
+        """Drop the kept histograms (e.g. of a grid no longer used)."""
+        self._histograms.clear()
+
+
+class _DistributionList(list):
+    """LogDistribution records cached as one entry."""
+
+    @property
+    def nbytes(self):
+        # Records with uniform weights share the log values of another
+        arrays = {}
+        for distribution in self:
+            for array in (distribution.log_values, distribution.weights):
+                if array is not None:
+                    arrays[id(array)] = array.nbytes
+        return sum(arrays.values())
+
+
+class _VariantGroup:
+    """
+    The handles of one file under several (weights column, filters) settings.
+
+    The file is read once per weights column, for all filter combinations
+    at once; uniform weights reuse the rows of a weighted read. The records
+    are cached as one entry, so they are evicted and read again together.
+    """
+
+    def __init__(self, path, cache, settings, load_options):
+        self.path = path
+        self.cache = cache
+        self.settings = settings
+        self.load_options = load_options
+        self.repertoires = []
+
+    def distributions(self):
+        return self.cache.get(self, self._load)
+
+    def _load(self):
+        weighted = [column for column, _ in self.settings if not _weights_disabled(column)]
+        reads = {}
+        for column, variant in self.settings:
+            source = weighted[0] if _weights_disabled(column) and weighted else column
+            variants = reads.setdefault(source, [])
+            if variant not in variants:
+                variants.append(variant)
+        records = {}
+        for source, variants in reads.items():
+            loaded = load_log_distribution_variants(
+                str(self.path), variants, weights_column=source, **self.load_options
+            )
+            records.update(((source, variant), distribution) for variant, distribution in zip(variants, loaded))
+
+        distributions = _DistributionList()
+        for column, variant in self.settings:
+            if _weights_disabled(column) and weighted:
+                distributions.append(records[(weighted[0], variant)].with_uniform_weights())
+            else:
+                distributions.append(records[(column, variant)])
+        count('repertoire_loads')
+        for repertoire, distribution in zip(self.repertoires, distributions):
+            repertoire._remember(distribution)
+        return distributions
+
+
+class _ArrayView(Sequence):
+    """Read-only list of one float64 array of each repertoire, loaded on access."""
+
+    def __init__(self, repertoires, attribute):
+        self._repertoires = repertoires
+        self._attribute = attribute
+
+    def __len__(self):
+        return len(self._repertoires)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return _ArrayView(self._repertoires[item], self._attribute)
+        return getattr(self._repertoires[item], self._attribute)
+
+
+def values_view(repertoires):
+    """The values arrays of `repertoires`, as a lazily loading sequence."""
+    return _ArrayView(repertoires, 'values')
+
+
+def weights_view(repertoires):
+    """The normalized weights of `repertoires`, as a lazily loading sequence."""
+    return _ArrayView(repertoires, 'weights')
+
+
+def value_ranges(repertoires):
+    """
+    [min, max] array of each repertoire.
+
+    Enough for create_common_grid and values_range, which only need the
+    overall range, without keeping any raw array.
+    """
+    return [np.array(repertoire.value_range) for repertoire in repertoires]
+
+
+def open_repertoires(files, memory_budget=None, cache=None, **load_options):
+    """
+    Handles on `files` sharing one cache.
+
+    Parameters
+    ----------
+    files : list of str or Path
+        Sample files (TSV or cohort store members)
+    memory_budget : int or None
+        Budget of a new cache (ignored when `cache` is given)
+    cache : RepertoireCache or None
+        Existing cache to share, e.g. between the cloud and the samples
+    **load_options
+        Keyword arguments of load_log_distribution
+
+    Returns
+    -------
+    list of Repertoire
+    """
+    if cache is None:
+        cache = RepertoireCache(memory_budget)
+    return [Repertoire(path, cache, **load_options) for path in files]
+
+
+def open_filter_variants(files, variants, memory_budget=None, cache=None, **load_options):
+    """
+    Handles on `files` under each filter combination, one read per file.
+
+    Loading any handle of a file loads the file under every combination
+    (load_log_distribution_variants); the records share one cache entry.
+    Histograms, value ranges and row counts are kept per handle as usual.
+
+    Parameters
+    ----------
+    files : list of str or Path
+        Sample files (TSV or cohort store members)
+    variants : list of (productive_filter, vdj_filter, vj_filter)
+        Filter combinations (see ot_utils.parse_filter_variants)
+    memory_budget, cache
+        As in open_repertoires
+    **load_options
+        Keyword arguments of load_log_distribution other than the filters
+
+    Returns
+    -------
+    list of list of Repertoire
+        The handles of `files` for each combination, in the order of `variants`
+    """
+    weights_column = load_options.pop('weights_column', "duplicate_frequency_percent")
+    return open_repertoire_settings(
+        files,
+        [(weights_column, variant) for variant in variants],
+        memory_budget=memory_budget,
+        cache=cache,
+        **load_options,
+    )
+
+
+def open_repertoire_settings(files, settings, memory_budget=None, cache=None, **load_options):
+    """
+    Handles on `files` under several (weights column, filters) settings.
+
+    Loading any handle of a file loads the file under every setting, with
+    one read per distinct weights column (none for 'off' when another
+    column is read); the records share one cache entry.
+
+    Parameters
+    ----------
+    files : list of str or Path
+        Sample files (TSV or cohort store members)
+    settings : list of (weights_column, (productive_filter, vdj_filter, vj_filter))
+        Distinct loading settings
+    memory_budget, cache
+        As in open_repertoires
+    **load_options
+        Other keyword arguments of load_log_distribution (freq_column,
+        chunk_size, precision)
+
+    Returns
+    -------
+    list of list of Repertoire
+        The handles of `files` for each setting, in the order of `settings`
+    """
+    if cache is None:
+        cache = RepertoireCache(memory_budget)
+    setting_repertoires = [[] for _ in settings]
+    for path in files:
+        group = _VariantGroup(path, cache, settings, load_options)
+        for position, (weights_column, (productive_filter, vdj_filter, vj_filter)) in enumerate(settings):
+            repertoire = Repertoire(
+                path, cache,
+                weights_column=weights_column,
+                productive_filter=productive_filter, vdj_filter=vdj_filter, vj_filter=vj_filter,
+                **load_options,
+            )
+            repertoire._group = (group, position)
+            group.repertoires.append(repertoire)
+            setting_repertoires[position].append(repertoire)
+    return setting_repertoires